@@ -6,6 +6,18 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
-from mqtt_data_logger.log_data import add_sensors_reading_record, logged
+from mqtt_data_logger.log_data import (
+    add_sensors_reading_record,
+    add_sensors_reading_records,
+    add_sensors_reading_records_bulk,
+    logged,
+)
+from mqtt_data_logger.query import query_readings
 
-__all__ = ["add_sensors_reading_record", "logged"]
+__all__ = [
+    "add_sensors_reading_record",
+    "add_sensors_reading_records",
+    "add_sensors_reading_records_bulk",
+    "logged",
+    "query_readings",
+]
@@ -6,13 +6,480 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import argparse
+import logging
+import time
+from functools import partial
 
 from mqtt_data_logger.util import start_session, get_mqtt_client
+from mqtt_data_logger.batch_writer import BatchWriter
+from mqtt_data_logger.log_data import (
+    DimensionCache,
+    DuplicateFilter,
+    add_sensors_reading_records,
+    add_sensors_reading_records_bulk,
+)
+from mqtt_data_logger import callbacks
+from mqtt_data_logger.callbacks import (
+    set_batch_writer,
+    set_duplicate_filter,
+    set_sensor_clocks,
+    set_latest_values,
+    set_packet_parser,
+    set_dimension_cache,
+    set_session,
+    set_spool,
+)
+from mqtt_data_logger.clocks import SensorClocks
+from mqtt_data_logger.config import (
+    ConfigError,
+    is_sqlite_url,
+    load_config,
+    sqlite_path,
+)
+from mqtt_data_logger.migrate import is_legacy_schema, schema_version
+from mqtt_data_logger.db import (
+    SQLITE_PROFILES,
+    DEFAULT_SQLITE_PROFILE,
+    create_sqlite_engine,
+)
+from mqtt_data_logger.latest import LatestValues, start_live_feed
+from mqtt_data_logger.logs import (
+    add_logging_arguments,
+    configure_logging,
+    logging_options,
+    stop_logging,
+)
+from mqtt_data_logger.metrics import (
+    DB_SIZE,
+    QUEUE_DEPTH,
+    file_size,
+    start_metrics_server,
+)
+from mqtt_data_logger.sensor_data_models import Base, LatestReading
+from mqtt_data_logger.spool import Spool, SpoolReplayer
+from mqtt_data_logger.parsing import DECODER_CHOICES, PacketParser
+from mqtt_data_logger.profiling import (
+    PROFILERS,
+    ProfileSession,
+    read_capture,
+    replay_capture,
+)
+from mqtt_data_logger.partitions import GRANULARITIES, PartitionedStorage
+from mqtt_data_logger.runtime import (
+    RoutedStorage,
+    connect_brokers,
+    disconnect_brokers,
+)
 
 from pathlib import Path
 
 
-def main():
-    session = start_session(Path("/home/beta/sensor_data.db"))
-    client = get_mqtt_client()
-    client.loop_forever()
+logger = logging.getLogger("mqtt_data_logger.main")
+
+
+def get_parser():
+    """Build the command line parser for run_mqtt_logger."""
+    parser = argparse.ArgumentParser(prog="run_mqtt_logger")
+    parser.add_argument(
+        "--config", type=Path,
+        help="TOML or JSON file of brokers, databases and routes "
+             "(default $MQTT_LOGGER_CONFIG)",
+    )
+    parser.add_argument(
+        "--broker", action="append", metavar="HOST[:PORT]",
+        help="broker to connect to, repeat for several (default "
+             "$MQTT_LOGGER_BROKERS or localhost:1883)",
+    )
+    parser.add_argument(
+        "--subscribe", action="append", metavar="TOPIC",
+        help="topic filter to subscribe to, repeat for several (default "
+             "$MQTT_LOGGER_SUBSCRIPTIONS or sensor_data/#)",
+    )
+    parser.add_argument(
+        "--db",
+        help="sqlite database file or database URL to log to (default "
+             "$MQTT_LOGGER_DB or /home/beta/sensor_data.db)",
+    )
+    parser.add_argument(
+        "--sqlite-profile", choices=list(SQLITE_PROFILES),
+        default=DEFAULT_SQLITE_PROFILE,
+        help="durability/throughput trade-off of the sqlite connection",
+    )
+    parser.add_argument(
+        "--partition", choices=list(GRANULARITIES),
+        help="write one database file per day or month next to --db",
+    )
+    parser.add_argument(
+        "--no-batching", action="store_true",
+        help="write every packet inline on the mqtt thread",
+    )
+    parser.add_argument(
+        "--no-dimension-cache", action="store_true",
+        help="query topic, sensor and measurement ids for every packet",
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=500,
+        help="packets committed per transaction at most",
+    )
+    parser.add_argument(
+        "--max-latency", type=float, default=0.5,
+        help="seconds a batch may wait before it is committed",
+    )
+    parser.add_argument(
+        "--queue-size", type=int, default=10000,
+        help="packets waiting to be written before back-pressure applies",
+    )
+    parser.add_argument(
+        "--overflow", choices=["block", "drop"], default="block",
+        help="block the mqtt thread or drop packets when the queue is full",
+    )
+    parser.add_argument(
+        "--put-timeout", type=float, default=1.0,
+        help="seconds to block on a full queue before dropping",
+    )
+    parser.add_argument(
+        "--no-flush-on-shutdown", action="store_true",
+        help="discard queued packets on shutdown instead of writing them",
+    )
+    parser.add_argument(
+        "--dedup-capacity", type=int, default=100_000,
+        help="packet keys (seq or time) remembered to drop redelivered "
+             "packets before they are queued, 0 to rely on the database",
+    )
+    parser.add_argument(
+        "--clock-tolerance", type=float, default=2.0,
+        help="seconds a sensor's clock may be off before the device times "
+             "(\"time\" of a packet) are corrected onto the logger's clock",
+    )
+    parser.add_argument(
+        "--rollups", action="store_true",
+        help="keep the 1m/1h/1d rollup tables updated with every batch",
+    )
+    parser.add_argument(
+        "--latest-values", action="store_true",
+        help="keep the newest value of every sensor in memory and in the "
+             "latest_readings table of --db",
+    )
+    parser.add_argument(
+        "--latest-snapshot-interval", type=float, default=1.0,
+        help="seconds between latest_readings snapshots",
+    )
+    parser.add_argument(
+        "--live-port", type=int,
+        help="serve the latest values and an SSE feed of changes on this "
+             "port (implies --latest-values)",
+    )
+    parser.add_argument(
+        "--spool", type=Path, metavar="DIR",
+        help="append raw messages to a spool in DIR and replay them into "
+             "the database, so outages of the database lose nothing",
+    )
+    parser.add_argument(
+        "--spool-segment-size", type=int, default=16 * 1024 * 1024,
+        help="bytes per spool segment file",
+    )
+    parser.add_argument(
+        "--json-decoder", choices=DECODER_CHOICES, default="auto",
+        help="JSON library decoding payloads, auto picks the fastest one "
+             "installed",
+    )
+    parser.add_argument(
+        "--metrics-port", type=int,
+        help="serve Prometheus metrics on /metrics at this port",
+    )
+    parser.add_argument(
+        "--metrics-host", default="127.0.0.1",
+        help="address the metrics endpoint listens on",
+    )
+    parser.add_argument(
+        "--profile", choices=PROFILERS,
+        help="profile the ingest path with cProfile or a stack sampler",
+    )
+    parser.add_argument(
+        "--profile-seconds", type=float, default=60.0,
+        help="length of the profiling window; a replay is profiled whole",
+    )
+    parser.add_argument(
+        "--profile-interval", type=float, default=0.005,
+        help="seconds between stack samples of --profile sample",
+    )
+    parser.add_argument(
+        "--profile-output", type=Path, default=Path("mqtt_logger_profile"),
+        help="prefix of the profile files: .pstats/.txt (cprofile), "
+             ".collapsed (sample, for flamegraph.pl or speedscope) and "
+             ".stages.json (time per stage)",
+    )
+    parser.add_argument(
+        "--replay", type=Path, metavar="CAPTURE",
+        help="instead of connecting to the broker, feed the messages of a "
+             "capture file or --spool directory through the logger and "
+             "report the time per stage",
+    )
+    add_logging_arguments(parser)
+    return parser
+
+
+def resolve_config(args, parser):
+    """
+    Merge --config, ``MQTT_LOGGER_*`` and the command line into a
+    ``LoggerConfig``.
+
+    ``args.db`` becomes the file of the default database (None if it is
+    not SQLite), and its sqlite_profile and rollups are applied to
+    ``args``, for the code paths that run on one SQLite file.
+    """
+    try:
+        config = load_config(
+            args.config,
+            brokers=args.broker,
+            subscriptions=args.subscribe,
+            db=args.db,
+            sqlite_profile=args.sqlite_profile,
+            rollups=args.rollups,
+        )
+    except ConfigError as e:
+        parser.error(str(e))
+    database = config.default_database
+    args.db = None
+    if is_sqlite_url(database.url):
+        args.db = sqlite_path(database.url)
+    args.sqlite_profile = database.sqlite_profile
+    args.rollups = database.rollups
+    return config
+
+
+def writer_options(args):
+    """Keyword arguments of the ``BatchWriter``s selected by ``args``."""
+    return {
+        "max_batch_size": args.batch_size,
+        "max_latency": args.max_latency,
+        "max_queue_size": args.queue_size,
+        "overflow": args.overflow,
+        "put_timeout": args.put_timeout,
+        "flush_on_shutdown": not args.no_flush_on_shutdown,
+    }
+
+
+def open_storage(args):
+    """
+    Open the database selected by ``args``.
+
+    Returns the session (None with partitions), the DimensionCache of the
+    inline path, the batch write function and the PartitionedStorage.
+    """
+    if args.partition:
+        storage = PartitionedStorage(
+            args.db.parent, args.partition, args.sqlite_profile,
+            prefix=args.db.stem,
+        )
+        # every partition is opened with its own session
+        return None, None, storage.write_batch, storage
+
+    session = start_session(args.db, args.sqlite_profile)
+    if is_legacy_schema(session.get_bind()):
+        raise SystemExit(
+            f"{args.db} uses schema version "
+            f"{schema_version(session.get_bind())}, convert it with "
+            "migrate_sensor_data_db first."
+        )
+    if args.no_dimension_cache:
+        return session, None, add_sensors_reading_records, None
+
+    cache = DimensionCache().warm(session)
+    session.commit()
+    write_batch = partial(
+        add_sensors_reading_records_bulk, cache=cache, rollups=args.rollups
+    )
+    return session, cache, write_batch, None
+
+
+def open_latest_values(args):
+    """Start the LatestValues table and live feed selected by ``args``."""
+    engine = create_sqlite_engine(args.db, args.sqlite_profile)
+    Base.metadata.create_all(engine, tables=[LatestReading.__table__])
+    latest_values = LatestValues().load(engine).start(
+        engine, args.latest_snapshot_interval
+    )
+    live_feed = None
+    if args.live_port is not None:
+        live_feed = start_live_feed(latest_values, port=args.live_port)
+    return latest_values, live_feed, engine
+
+
+def start_metrics(args, db_size=None, queue_depth=None):
+    """
+    Serve the metrics on ``--metrics-port``, None if it is not set.
+
+    The database size and queue depth gauges call ``db_size`` (by default
+    the size of ``args.db``) and ``queue_depth`` when scraped.
+    """
+    if args.metrics_port is None:
+        return None
+    if db_size is None:
+        DB_SIZE.set_function(lambda: file_size(args.db))
+    else:
+        DB_SIZE.set_function(db_size)
+    QUEUE_DEPTH.set_function(queue_depth)
+    return start_metrics_server(
+        host=args.metrics_host, port=args.metrics_port
+    )
+
+
+def main(argv=None):
+    parser = get_parser()
+    args = parser.parse_args(argv)
+    config = resolve_config(args, parser)
+    # several databases, or one that is not SQLite, are written through
+    # one BatchWriter per database
+    routed = not config.is_single_sqlite()
+    if routed and (
+        args.partition or args.spool or args.no_batching
+        or args.no_dimension_cache or args.latest_values
+        or args.live_port is not None
+    ):
+        parser.error(
+            "several or non-SQLite databases are written in batches with "
+            "the dimension cache, without --partition, --spool or latest "
+            "values"
+        )
+    if args.partition and args.no_batching:
+        parser.error("--partition requires batching")
+    if args.rollups and (
+        args.partition or args.no_batching or args.no_dimension_cache
+    ):
+        parser.error("--rollups requires batching with the dimension cache")
+    if args.spool and (args.partition or args.no_dimension_cache):
+        parser.error("--spool requires one database and the dimension cache")
+    if args.replay and args.spool:
+        parser.error("--replay cannot be combined with --spool")
+    if args.log_payload_every < 1:
+        parser.error("--log-payload-every must be at least 1")
+    if args.dedup_capacity < 0:
+        parser.error("--dedup-capacity cannot be negative")
+    if args.clock_tolerance < 0:
+        parser.error("--clock-tolerance cannot be negative")
+
+    try:
+        set_packet_parser(PacketParser(decoder=args.json_decoder))
+    except ValueError as e:
+        parser.error(str(e))
+    configure_logging(**logging_options(args))
+    if args.dedup_capacity:
+        set_duplicate_filter(DuplicateFilter(args.dedup_capacity))
+    clocks = SensorClocks(args.clock_tolerance)
+    set_sensor_clocks(clocks)
+    session = cache = write_batch = storage = None
+    if not routed:
+        session, cache, write_batch, storage = open_storage(args)
+
+    latest_values = None
+    if args.latest_values or args.live_port is not None:
+        latest_values, live_feed, latest_engine = open_latest_values(args)
+        set_latest_values(latest_values)
+
+    profile = None
+    if args.profile or args.replay:
+        profile = ProfileSession(
+            args.profile, args.profile_output,
+            None if args.replay else args.profile_seconds,
+            args.profile_interval,
+        )
+        if write_batch is not None:
+            write_batch = profile.wrap("write", write_batch)
+
+    writer = None
+    replayer = None
+    if routed:
+        writer = RoutedStorage(
+            config, writer_options(args),
+            wrap_write=(
+                partial(profile.wrap, "write")
+                if profile is not None else None
+            ),
+        )
+        set_batch_writer(writer)
+    elif args.spool:
+        spool = Spool(args.spool, args.spool_segment_size)
+        replayer = SpoolReplayer(
+            spool, session, cache,
+            max_batch_size=args.batch_size,
+            max_latency=args.max_latency,
+            rollups=args.rollups,
+            latest_values=latest_values,
+            clocks=clocks,
+        ).start()
+        set_spool(spool)
+    elif not args.no_batching:
+        writer = BatchWriter(
+            session, write_batch=write_batch, **writer_options(args)
+        ).start()
+        set_batch_writer(writer)
+    else:
+        set_session(session)
+        set_dimension_cache(cache)
+
+    db_size = None
+    if routed:
+        db_size = writer.db_size
+    elif storage is not None:
+        db_size = storage.db_size
+    metrics_server = start_metrics(
+        args, db_size, writer.qsize if writer is not None else None
+    )
+    callback = callbacks.log_sensor_data
+    if profile is not None:
+        callback = profile.wrap("callback", callback)
+        profile.start()
+    try:
+        if args.replay:
+            replayed = replay_capture(read_capture(args.replay), callback)
+            logger.info("Replayed %d messages from %s", replayed, args.replay)
+        elif len(config.brokers) == 1:
+            client = get_mqtt_client(callback, config.brokers[0])
+            try:
+                client.loop_forever()
+            except KeyboardInterrupt:
+                client.disconnect()
+        else:
+            # one network thread per broker, this one just waits
+            clients = connect_brokers(config.brokers, callback)
+            try:
+                while True:
+                    time.sleep(3600)
+            except KeyboardInterrupt:
+                pass
+            finally:
+                disconnect_brokers(clients)
+    finally:
+        logger.info("Dead letters: %s", callbacks.dead_letters.stats())
+        logger.info("Clock corrections: %s", clocks.stats())
+        if replayer is not None:
+            set_spool(None)
+            replayer.close()
+            logger.info("Spool stats: %s", replayer.stats())
+            spool.close()
+        if writer is not None:
+            set_batch_writer(None)
+            writer.close()
+            logger.info("Writer stats: %s", writer.stats())
+        if profile is not None:
+            # after the writer is closed, so a replay is profiled to the end
+            profile.stop()
+        if storage is not None:
+            storage.close()
+        if latest_values is not None:
+            set_latest_values(None)
+            if live_feed is not None:
+                live_feed.shutdown()
+            latest_values.close()
+            latest_engine.dispose()
+        if metrics_server is not None:
+            metrics_server.shutdown()
+        set_duplicate_filter(None)
+        set_sensor_clocks(None)
+        stop_logging()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,437 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, 4CSCC development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import argparse
+import hashlib
+import json
+import logging
+import math
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qsl, urlsplit
+
+from sqlalchemy import func, select
+from sqlalchemy.orm import sessionmaker
+
+from mqtt_data_logger.db import (
+    DEFAULT_SQLITE_PROFILE,
+    SQLITE_PROFILES,
+    create_sqlite_engine,
+)
+from mqtt_data_logger.query import latest_readings, query_readings
+from mqtt_data_logger.rollups import read_series
+from mqtt_data_logger.sensor_data_models import (
+    LatestReading,
+    SensorMeasurement,
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+class BadRequest(ValueError):
+    """A query parameter is missing or malformed."""
+
+
+class ResponseCache:
+    """
+    LRU cache of encoded responses with a time to live.
+
+    Every entry remembers the ingest watermark it was built at; a lookup
+    with a newer watermark misses, so cached data is never older than the
+    last watermark check. ``ttl`` bounds the age of entries whose data can
+    change without new readings (e.g. a rollup backfill). Thread safe.
+    """
+
+    def __init__(self, max_entries=1024, ttl=30.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, watermark):
+        """Return the cached ``(etag, body)`` of ``key`` or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry_watermark, created, etag, body = entry
+                if (
+                    entry_watermark == watermark
+                    and time.monotonic() - created < self.ttl
+                ):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return etag, body
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, watermark, etag, body):
+        with self._lock:
+            self._entries[key] = (watermark, time.monotonic(), etag, body)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class Watermark:
+    """
+    The id of the newest reading, re-read at most every ``interval`` s.
+
+    Reading ``max(id)`` is an index lookup, but with many clients polling
+    even that adds up; between checks every request shares one value.
+    """
+
+    def __init__(self, engine, interval=0.5):
+        self.engine = engine
+        self.interval = interval
+        self._value = None
+        self._checked = float("-inf")
+        self._lock = threading.Lock()
+
+    def current(self):
+        with self._lock:
+            now = time.monotonic()
+            if now - self._checked >= self.interval:
+                with self.engine.connect() as conn:
+                    self._value = conn.execute(select(func.max(
+                        SensorMeasurement.sensor_measurement_num_id
+                    ))).scalar() or 0
+                self._checked = now
+            return self._value
+
+
+def _time_param(params, name):
+    value = params.get(name)
+    if value is None:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        raise BadRequest(f"{name} must be an ISO time, not {value!r}")
+
+
+def _number_param(params, name, convert=int):
+    value = params.get(name)
+    if value is None:
+        return None
+    try:
+        return convert(value)
+    except ValueError:
+        raise BadRequest(f"{name} must be a number, not {value!r}")
+
+
+def _positive_param(params, name, convert=int):
+    value = _number_param(params, name, convert)
+    if value is not None and not (value > 0 and math.isfinite(value)):
+        raise BadRequest(f"{name} must be positive, not {params[name]!r}")
+    return value
+
+
+def _after_param(params):
+    value = params.get("after")
+    if value is None:
+        return None
+    try:
+        at, reading_id = value.rsplit(",", 1)
+        return datetime.fromisoformat(at), int(reading_id)
+    except ValueError:
+        raise BadRequest(f"after must be '<ISO time>,<id>', not {value!r}")
+
+
+def _reading_json(reading):
+    return {
+        "id": reading.reading_id,
+        "time": reading.time.isoformat(),
+        "topic": reading.topic,
+        "sensor": reading.sensor,
+        "measurement": reading.measurement,
+        "value": reading.value,
+        "str_value": reading.str_value,
+    }
+
+
+def _names(params):
+    return {
+        name: params.get(name) for name in ("sensor", "measurement", "topic")
+    }
+
+
+def get_latest(session, params):
+    """``/latest``: newest reading of every sensor and measurement."""
+    return {
+        "readings": [
+            _reading_json(r)
+            for r in latest_readings(session, **_names(params))
+        ],
+    }
+
+
+def get_latest_snapshot(session, params):
+    """``/latest`` from the latest_readings table the logger keeps."""
+    statement = select(LatestReading).order_by(
+        LatestReading.sensor, LatestReading.measurement
+    )
+    for name, value in _names(params).items():
+        if value is not None:
+            statement = statement.where(getattr(LatestReading, name) == value)
+    return {
+        "readings": [
+            {
+                "id": None,
+                "time": latest.time.isoformat(),
+                "topic": latest.topic,
+                "sensor": latest.sensor,
+                "measurement": latest.measurement,
+                "value": latest.value,
+                "str_value": latest.str_value,
+            }
+            for latest in session.scalars(statement)
+        ],
+    }
+
+
+def get_readings(session, params, max_limit=10000):
+    """``/readings``: raw readings of a time range, keyset paginated."""
+    limit = _positive_param(params, "limit") or 1000
+    readings = list(query_readings(
+        session,
+        start=_time_param(params, "start"),
+        end=_time_param(params, "end"),
+        limit=min(limit, max_limit),
+        after=_after_param(params),
+        descending=params.get("order") == "desc",
+        **_names(params),
+    ))
+    next_after = None
+    if len(readings) == min(limit, max_limit):
+        time_, reading_id = readings[-1].key
+        next_after = f"{time_.isoformat()},{reading_id}"
+    return {
+        "readings": [_reading_json(r) for r in readings],
+        "next": next_after,
+    }
+
+
+def get_series(session, params):
+    """``/series``: a measurement aggregated to a resolution, from rollups."""
+    for name in ("sensor", "measurement", "start", "end"):
+        if name not in params:
+            raise BadRequest(f"{name} is required")
+    series = read_series(
+        session,
+        params["sensor"],
+        params["measurement"],
+        _time_param(params, "start"),
+        _time_param(params, "end"),
+        _positive_param(params, "resolution", float),
+    )
+    return {
+        "series": [
+            {
+                "time": bucket.isoformat(),
+                "count": count,
+                "mean": mean,
+                "min": low,
+                "max": high,
+            }
+            for bucket, count, mean, low, high in series
+        ],
+    }
+
+
+ROUTES = {
+    "/latest": get_latest,
+    "/readings": get_readings,
+    "/series": get_series,
+}
+
+
+class ReadingsApi:
+    """
+    Serves the read routes from a read-only engine with response caching.
+
+    Parameters:
+    - engine (Engine): A read-only engine on the logger database.
+    - cache (ResponseCache): Cache of encoded responses.
+    - watermark (Watermark): Invalidates the cache as readings arrive.
+    - latest_snapshot (bool): Serve ``/latest`` from the latest_readings
+      snapshot of a logger run with --latest-values instead of searching
+      the readings.
+
+    Methods:
+    - respond(path, query, if_none_match): Returns status, headers, body.
+    """
+
+    def __init__(
+        self, engine, cache=None, watermark=None, latest_snapshot=False
+    ):
+        self.engine = engine
+        self.routes = dict(ROUTES)
+        if latest_snapshot:
+            self.routes["/latest"] = get_latest_snapshot
+        self.cache = cache if cache is not None else ResponseCache()
+        self.watermark = (
+            watermark if watermark is not None else Watermark(engine)
+        )
+        self._sessions = sessionmaker(bind=engine)
+
+    def respond(self, path, query="", if_none_match=None):
+        """Answer a GET of ``path?query``."""
+        if path == "/health":
+            return self._json(HTTPStatus.OK, {
+                "watermark": self.watermark.current(),
+                "cache_entries": len(self.cache),
+                "cache_hits": self.cache.hits,
+                "cache_misses": self.cache.misses,
+            })
+        route = self.routes.get(path)
+        if route is None:
+            return self._json(HTTPStatus.NOT_FOUND, {"error": "not found"})
+
+        params = dict(parse_qsl(query))
+        key = (path, tuple(sorted(params.items())))
+        watermark = self.watermark.current()
+        cached = self.cache.get(key, watermark)
+        if cached is None:
+            try:
+                with self._sessions() as session:
+                    document = route(session, params)
+            except BadRequest as e:
+                return self._json(HTTPStatus.BAD_REQUEST, {"error": str(e)})
+            except Exception:
+                logger.exception("Failed to answer %s?%s", path, query)
+                return self._json(
+                    HTTPStatus.INTERNAL_SERVER_ERROR,
+                    {"error": "internal error"},
+                )
+            body = json.dumps(document).encode("utf-8")
+            etag = '"{}-{}"'.format(
+                watermark, hashlib.blake2b(body, digest_size=8).hexdigest()
+            )
+            self.cache.put(key, watermark, etag, body)
+        else:
+            etag, body = cached
+
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if if_none_match is not None and etag in (
+            tag.strip() for tag in if_none_match.split(",")
+        ):
+            return HTTPStatus.NOT_MODIFIED, headers, b""
+        headers["Content-Type"] = "application/json"
+        return HTTPStatus.OK, headers, body
+
+    @staticmethod
+    def _json(status, document):
+        return (
+            status,
+            {"Content-Type": "application/json"},
+            json.dumps(document).encode("utf-8"),
+        )
+
+
+class ApiRequestHandler(BaseHTTPRequestHandler):
+    """Hands GET requests to the server's ``ReadingsApi``."""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        status, headers, body = self.server.api.respond(
+            url.path, url.query, self.headers.get("If-None-Match")
+        )
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_server(api, host="127.0.0.1", port=8080):
+    """Create a threading HTTP server answering with ``api``."""
+    server = ThreadingHTTPServer((host, port), ApiRequestHandler)
+    server.daemon_threads = True
+    server.api = api
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="serve_api",
+        description="Serve latest values, time ranges and rollups of the "
+                    "logger database over HTTP, read-only.",
+    )
+    parser.add_argument(
+        "--db", type=Path, default=Path("/home/beta/sensor_data.db"),
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument(
+        "--sqlite-profile", choices=list(SQLITE_PROFILES),
+        default=DEFAULT_SQLITE_PROFILE,
+    )
+    parser.add_argument(
+        "--pool-size", type=int, default=4,
+        help="read-only connections kept open",
+    )
+    parser.add_argument(
+        "--cache-size", type=int, default=1024,
+        help="responses kept in the cache",
+    )
+    parser.add_argument(
+        "--cache-ttl", type=float, default=30.0,
+        help="seconds a cached response lives at most",
+    )
+    parser.add_argument(
+        "--watermark-interval", type=float, default=0.5,
+        help="seconds between checks for new readings",
+    )
+    parser.add_argument(
+        "--latest-snapshot", action="store_true",
+        help="serve /latest from the latest_readings table kept by a "
+             "logger run with --latest-values",
+    )
+    args = parser.parse_args(argv)
+
+    engine = create_sqlite_engine(
+        args.db, args.sqlite_profile, read_only=True,
+        pool_size=args.pool_size,
+    )
+    api = ReadingsApi(
+        engine,
+        ResponseCache(args.cache_size, args.cache_ttl),
+        Watermark(engine, args.watermark_interval),
+        args.latest_snapshot,
+    )
+    server = make_server(api, args.host, args.port)
+    print(f"Serving {args.db} on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
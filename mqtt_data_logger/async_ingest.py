@@ -0,0 +1,446 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, 4CSCC development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import asyncio
+import logging
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from paho.mqtt import client as mqtt
+from sqlalchemy.exc import OperationalError
+
+from mqtt_data_logger.__main__ import (
+    get_parser,
+    open_latest_values,
+    open_storage,
+    resolve_config,
+    start_metrics,
+)
+from mqtt_data_logger.callbacks import (
+    dead_letters,
+    parse_sensor_packet,
+    set_packet_parser,
+)
+from mqtt_data_logger.clocks import SensorClocks
+from mqtt_data_logger.config import DEFAULT_BROKER
+from mqtt_data_logger.log_data import (
+    DuplicateFilter,
+    add_sensors_reading_records,
+)
+from mqtt_data_logger.logs import (
+    configure_logging,
+    logging_options,
+    stop_logging,
+)
+from mqtt_data_logger.metrics import ERRORS, MESSAGES_RECEIVED
+from mqtt_data_logger.parsing import PacketParser
+from mqtt_data_logger.util import get_mqtt_client
+
+
+logger = logging.getLogger(__name__)
+
+
+class StageStats:
+    """Count and latency of the items that went through one stage."""
+
+    def __init__(self):
+        self.count = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def record(self, seconds, count=1):
+        self.count += count
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+
+    def summary(self):
+        mean = self.total_seconds / self.count if self.count else 0.0
+        return {
+            "count": self.count,
+            "mean_ms": round(mean * 1000, 3),
+            "max_ms": round(self.max_seconds * 1000, 3),
+        }
+
+
+class AsyncIngestPipeline:
+    """
+    Asyncio pipeline from raw mqtt messages to committed readings.
+
+    Three stages are linked by bounded queues:
+
+    - receive: ``submit`` puts the raw payload on the receive queue, it
+      never waits, a full queue drops the message and counts it.
+    - parse: decodes the json and munges wind fields into a
+      ``SensorPacket``, records malformed packets in the dead letters and
+      drops redelivered ones.
+    - write: gathers packets until ``max_batch_size`` or ``max_latency`` and
+      commits them with ``write_batch`` on a single worker thread, so slow
+      disk I/O never blocks the event loop receiving messages. Like the
+      ``BatchWriter``, a batch that hits a locked database is retried and
+      one that fails otherwise is written a packet at a time.
+
+    Latencies are recorded per stage; ``stats`` returns them together with
+    the queue depths and counters.
+
+    Attributes:
+    - session (Session): Passed to ``write_batch``, only used by its thread.
+    - write_batch (callable): ``write_batch(session, packets)``.
+    - max_batch_size (int): Packets committed per transaction at most.
+    - max_latency (float): Seconds a batch may wait before it is committed.
+    - queue_size (int): Bound of the receive and the write queue.
+    - latest_values (LatestValues): Updated with every parsed packet.
+    - clocks (SensorClocks): Assigns the time of every parsed packet.
+    - duplicate_filter (DuplicateFilter): Drops redelivered packets.
+    - retries (int): Attempts for a batch that hits a locked database.
+    - retry_delay (float): Seconds between those attempts.
+    """
+
+    _STOP = object()
+
+    def __init__(
+        self,
+        session,
+        write_batch=add_sensors_reading_records,
+        max_batch_size=500,
+        max_latency=0.5,
+        queue_size=10000,
+        latest_values=None,
+        clocks=None,
+        duplicate_filter=None,
+        retries=3,
+        retry_delay=0.5,
+    ):
+        self.session = session
+        self.latest_values = latest_values
+        self.clocks = clocks
+        self.duplicate_filter = duplicate_filter
+        self.write_batch = write_batch
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.queue_size = queue_size
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.counts = {
+            "received": 0,
+            "dropped": 0,
+            "malformed": 0,
+            "duplicates": 0,
+            "written": 0,
+            "failed": 0,
+        }
+        self.stages = {
+            "receive_wait": StageStats(),
+            "parse": StageStats(),
+            "write_wait": StageStats(),
+            "write": StageStats(),
+            "end_to_end": StageStats(),
+        }
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="mqtt-data-logger-db"
+        )
+        self._tasks = []
+
+    async def start(self):
+        """Start the parse and write stages on the running loop."""
+        self._received = asyncio.Queue(self.queue_size)
+        self._packets = asyncio.Queue(self.queue_size)
+        self._tasks = [
+            asyncio.ensure_future(self._parse_stage()),
+            asyncio.ensure_future(self._write_stage()),
+        ]
+        return self
+
+    def submit(self, topic, payload, received_at=None):
+        """Queue a raw message, returns False if it had to be dropped."""
+        MESSAGES_RECEIVED.inc()
+        if received_at is None:
+            received_at = time.time()
+        try:
+            self._received.put_nowait(
+                (topic, payload, received_at, time.perf_counter())
+            )
+        except asyncio.QueueFull:
+            self.counts["dropped"] += 1
+            ERRORS.labels("dropped").inc()
+            return False
+        self.counts["received"] += 1
+        return True
+
+    def on_message(self, client, userdata, msg):
+        """Paho message callback feeding the pipeline."""
+        self.submit(msg.topic, msg.payload)
+
+    async def stop(self):
+        """Write out everything queued, then stop the stages."""
+        await self._received.put(self._STOP)
+        await asyncio.gather(*self._tasks)
+        self._executor.shutdown(wait=True)
+
+    def queue_depth(self):
+        """Return the number of messages and packets not yet written."""
+        return self._received.qsize() + self._packets.qsize()
+
+    def stats(self):
+        """Return counters, queue depths and per-stage latencies."""
+        stats = dict(self.counts)
+        stats["receive_queue_depth"] = self._received.qsize()
+        stats["write_queue_depth"] = self._packets.qsize()
+        stats["stages"] = {
+            name: stage.summary() for name, stage in self.stages.items()
+        }
+        return stats
+
+    async def _parse_stage(self):
+        while True:
+            item = await self._received.get()
+            if item is self._STOP:
+                await self._packets.put(self._STOP)
+                return
+            topic, payload, received_at, enqueued = item
+            started = time.perf_counter()
+            self.stages["receive_wait"].record(started - enqueued)
+            try:
+                packet = parse_sensor_packet(topic, payload, received_at)
+            except Exception as e:
+                self.counts["malformed"] += 1
+                dead_letters.record(topic, payload, e)
+                logger.warning("Malformed packet on %s: %s", topic, e)
+                continue
+            if self.duplicate_filter is not None and (
+                self.duplicate_filter.seen(packet)
+            ):
+                self.counts["duplicates"] += 1
+                continue
+            if self.clocks is not None:
+                packet = self.clocks.stamp(packet)
+            if self.latest_values is not None:
+                self.latest_values.update(packet)
+            parsed = time.perf_counter()
+            self.stages["parse"].record(parsed - started)
+            await self._packets.put((packet, enqueued, parsed))
+
+    async def _write_stage(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            batch, stopping = await self._collect()
+            if not batch:
+                continue
+            started = time.perf_counter()
+            for packet, enqueued, parsed in batch:
+                self.stages["write_wait"].record(started - parsed)
+            packets = [packet for packet, enqueued, parsed in batch]
+            failed = await loop.run_in_executor(
+                self._executor, self._write, packets
+            )
+            finished = time.perf_counter()
+            if failed:
+                self.counts["failed"] += failed
+                ERRORS.labels("dropped").inc(failed)
+            if failed == len(batch):
+                continue
+            self.stages["write"].record(
+                finished - started, len(batch) - failed
+            )
+            self.counts["written"] += len(batch) - failed
+            for packet, enqueued, parsed in batch:
+                self.stages["end_to_end"].record(finished - enqueued)
+
+    def _write(self, packets):
+        """
+        Write a batch on the worker thread, return how many packets failed.
+
+        A ``write_batch`` that commits in parts removes the packets it
+        committed from ``packets`` before raising, so a retry only writes
+        the rest.
+        """
+        for attempt in range(self.retries):
+            try:
+                self.write_batch(self.session, packets)
+            except OperationalError as e:
+                if attempt + 1 < self.retries:
+                    time.sleep(self.retry_delay)
+                    continue
+                logger.error(
+                    "Dropping batch of %d packets: %s", len(packets), e
+                )
+                return len(packets)
+            except Exception as e:
+                # one bad packet must not drop the batch, retry one by one
+                logger.error(
+                    "Batch of %d packets failed, writing singly: %s",
+                    len(packets), e,
+                )
+                return self._write_singly(packets)
+            return 0
+        return len(packets)
+
+    def _write_singly(self, packets):
+        failed = 0
+        for packet in packets:
+            try:
+                self.write_batch(self.session, [packet])
+            except Exception as e:
+                failed += 1
+                logger.error("Dropping packet of %s: %s", packet.sensor, e)
+        return failed
+
+    async def _collect(self):
+        item = await self._packets.get()
+        if item is self._STOP:
+            return [], True
+        batch = [item]
+        deadline = time.monotonic() + self.max_latency
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(self._packets.get(), remaining)
+            except asyncio.TimeoutError:
+                break
+            if item is self._STOP:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+
+class AsyncioMqttHelper:
+    """
+    Drives a paho client from an asyncio event loop instead of a thread.
+
+    Paho reports its socket through callbacks; reads and writes are
+    registered with the loop and ``loop_misc`` (keepalive pings) runs as a
+    task, so message callbacks execute on the event loop itself.
+    """
+
+    def __init__(self, loop, client):
+        self.loop = loop
+        self.client = client
+        self.disconnected = loop.create_future()
+        self._misc = None
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def on_socket_open(self, client, userdata, sock):
+        self.loop.add_reader(sock, client.loop_read)
+        self._misc = self.loop.create_task(self._misc_loop())
+
+    def on_socket_close(self, client, userdata, sock):
+        self.loop.remove_reader(sock)
+        if self._misc is not None:
+            self._misc.cancel()
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.loop.add_writer(sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.remove_writer(sock)
+
+    async def _misc_loop(self):
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            try:
+                await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                break
+        if not self.disconnected.done():
+            self.disconnected.set_result(None)
+
+
+async def run_async_logger(args, broker=DEFAULT_BROKER):
+    """
+    Run the asyncio logger until SIGINT/SIGTERM or the broker goes away.
+
+    There is no reconnect: when the connection to the broker is lost the
+    queued packets are written and the logger exits, to be restarted by
+    its service manager.
+    """
+    session, cache, write_batch, storage = open_storage(args)
+    latest_values = None
+    if args.latest_values or args.live_port is not None:
+        latest_values, live_feed, latest_engine = open_latest_values(args)
+    pipeline = await AsyncIngestPipeline(
+        session,
+        write_batch,
+        max_batch_size=args.batch_size,
+        max_latency=args.max_latency,
+        queue_size=args.queue_size,
+        latest_values=latest_values,
+        clocks=SensorClocks(args.clock_tolerance),
+        duplicate_filter=(
+            DuplicateFilter(args.dedup_capacity)
+            if args.dedup_capacity else None
+        ),
+    ).start()
+    metrics_server = start_metrics(
+        args, storage.db_size if storage is not None else None,
+        pipeline.queue_depth,
+    )
+
+    loop = asyncio.get_running_loop()
+    client = get_mqtt_client(pipeline.on_message, broker, connect=False)
+    helper = AsyncioMqttHelper(loop, client)
+    client.connect(broker.host, broker.port, broker.keepalive)
+
+    stop = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+    try:
+        await asyncio.wait(
+            [asyncio.ensure_future(stop.wait()), helper.disconnected],
+            return_when=asyncio.FIRST_COMPLETED,
+        )
+        if not stop.is_set():
+            logger.error(
+                "Lost the connection to broker %s, stopping", broker.name
+            )
+    finally:
+        client.disconnect()
+        await pipeline.stop()
+        logger.info("Pipeline stats: %s", pipeline.stats())
+        if metrics_server is not None:
+            metrics_server.shutdown()
+        if storage is not None:
+            storage.close()
+        if latest_values is not None:
+            if live_feed is not None:
+                live_feed.shutdown()
+            latest_values.close()
+            latest_engine.dispose()
+
+
+def main(argv=None):
+    parser = get_parser()
+    parser.prog = "run_mqtt_logger_async"
+    args = parser.parse_args(argv)
+    config = resolve_config(args, parser)
+    if len(config.brokers) > 1 or not config.is_single_sqlite():
+        parser.error("the async logger runs on one broker and one database")
+    if args.no_batching:
+        parser.error("the async logger always batches")
+    if args.spool:
+        parser.error("the async logger does not spool")
+    if args.profile or args.replay:
+        parser.error("profile or replay with run_mqtt_logger")
+    if args.dedup_capacity < 0:
+        parser.error("--dedup-capacity cannot be negative")
+    if args.clock_tolerance < 0:
+        parser.error("--clock-tolerance cannot be negative")
+    set_packet_parser(PacketParser(decoder=args.json_decoder))
+    configure_logging(**logging_options(args))
+    try:
+        asyncio.run(run_async_logger(args, config.brokers[0]))
+    finally:
+        stop_logging()
+
+
+if __name__ == "__main__":
+    main()
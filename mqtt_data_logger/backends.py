@@ -0,0 +1,330 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, 4CSCC development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import csv
+import io
+import logging
+from datetime import datetime, timezone
+
+from sqlalchemy import text
+from sqlalchemy.engine import make_url
+
+from mqtt_data_logger.log_data import (
+    DimensionCache,
+    add_sensors_reading_records_bulk,
+    commit_session,
+    count_stored,
+    packet_time,
+    split_value,
+)
+from mqtt_data_logger.metrics import BATCH_SIZE, ERRORS
+from mqtt_data_logger.sensor_data_models import Base
+
+
+logger = logging.getLogger(__name__)
+
+COPY_FORMATS = ["binary", "csv"]
+
+# columns of sensor_measurements written by COPY, in order
+COPY_COLUMNS = [
+    "time", "topic_num_id", "sensor_num_id", "measurement_num_id", "value",
+    "label_num_id", "packet_key",
+]
+COPY_TYPES = [
+    "timestamptz", "int4", "int4", "int4", "float8", "int4", "int8",
+]
+
+# COPY cannot skip rows that conflict, readings with a packet_key are copied
+# here and moved into sensor_measurements with INSERT ... ON CONFLICT
+STAGING_TABLE = "sensor_measurements_staging"
+
+
+class StorageBackend:
+    """
+    Writes batches of ``SensorPacket``s to one kind of database.
+
+    A backend is what a ``BatchWriter`` calls with each batch, so every
+    database the logger writes to is driven the same way whatever the
+    statements underneath.
+
+    Parameters:
+    - cache (DimensionCache): Ids of topics, sensors and measurements.
+
+    Methods:
+    - prepare(session): Creates the schema and warms the cache.
+    - write_batch(session, packets, before_commit): Writes a batch in one
+      transaction, ``before_commit(session)`` runs last in it.
+    """
+
+    def __init__(self, cache=None):
+        self.cache = cache if cache is not None else DimensionCache()
+
+    def prepare(self, session):
+        Base.metadata.create_all(session.get_bind())
+        self.cache.warm(session)
+        session.commit()
+        return self
+
+    def write_batch(self, session, packets, before_commit=None):
+        raise NotImplementedError
+
+
+class SQLiteBackend(StorageBackend):
+    """
+    Multi-row Core inserts, see ``add_sensors_reading_records_bulk``.
+
+    The backend of SQLite databases and of any other database without a
+    backend of its own.
+
+    Parameters:
+    - rollups (bool): Also update the rollup tables (SQLite only).
+    """
+
+    def __init__(self, cache=None, rollups=False):
+        super().__init__(cache)
+        self.rollups = rollups
+
+    def write_batch(self, session, packets, before_commit=None):
+        add_sensors_reading_records_bulk(
+            session, packets, self.cache, self.rollups, before_commit
+        )
+
+
+class PostgresCopyBackend(StorageBackend):
+    """
+    Streams readings into PostgreSQL with ``COPY ... FROM STDIN``.
+
+    COPY skips the parsing and planning of an INSERT per row, so a batch
+    costs one round trip and the server ingests it at close to its bulk
+    load rate. Names missing from the cache are resolved with one upsert
+    per dimension and batch; the statements' text never changes, so the
+    driver (psycopg prepares statements it has run a few times) keeps them
+    prepared on the server.
+
+    ``binary`` COPY needs psycopg 3; with psycopg2 the rows are sent as
+    CSV. A batch with packet keys is copied into a temporary table first,
+    so redelivered readings are skipped rather than failing the COPY.
+    With ``chunk_interval`` sensor_measurements is turned into a
+    TimescaleDB hypertable of chunks that long, e.g. "1 day".
+
+    Parameters:
+    - copy_format (str): "binary" or "csv".
+    - chunk_interval (str): Chunk length of the hypertable, None for a
+      plain table.
+    """
+
+    _dimensions = {
+        "topic": ("topics", "topic", "topic_num_id"),
+        "sensor": ("sensors", "sensor_id", "sensor_num_id"),
+        "measurement": (
+            "measurements", "measurement", "measurement_num_id",
+        ),
+        "label": ("labels", "label", "label_num_id"),
+    }
+
+    def __init__(self, cache=None, copy_format="binary", chunk_interval=None):
+        super().__init__(cache)
+        if copy_format not in COPY_FORMATS:
+            raise ValueError(f"Unknown COPY format {copy_format}")
+        self.copy_format = copy_format
+        self.chunk_interval = chunk_interval
+        # inserts the new names and returns the ids of all of them; the
+        # select does not see the CTE's rows, so together they are each
+        # name exactly once
+        self._upserts = {
+            dimension: text(
+                f"WITH new AS (INSERT INTO {table} ({name}) "
+                f"SELECT unnest(CAST(:names AS text[])) "
+                f"ON CONFLICT ({name}) DO NOTHING "
+                f"RETURNING {name}, {num_id}) "
+                f"SELECT {name}, {num_id} FROM new UNION ALL "
+                f"SELECT {name}, {num_id} FROM {table} "
+                f"WHERE {name} = ANY(CAST(:names AS text[]))"
+            )
+            for dimension, (table, name, num_id) in self._dimensions.items()
+        }
+        columns = ", ".join(COPY_COLUMNS)
+        self._create_staging = text(
+            f"CREATE TEMPORARY TABLE IF NOT EXISTS {STAGING_TABLE} "
+            f"ON COMMIT DELETE ROWS AS SELECT {columns} "
+            "FROM sensor_measurements WITH NO DATA"
+        )
+        self._move_staged = text(
+            f"INSERT INTO sensor_measurements ({columns}) "
+            f"SELECT {columns} FROM {STAGING_TABLE} "
+            "ON CONFLICT DO NOTHING"
+        )
+
+    def prepare(self, session):
+        super().prepare(session)
+        if self.copy_format == "binary" and not _has_copy(session):
+            logger.warning("Binary COPY needs psycopg 3, sending CSV")
+            self.copy_format = "csv"
+        if self.chunk_interval is not None:
+            create_hypertable(session, self.chunk_interval)
+        return self
+
+    def write_batch(self, session, packets, before_commit=None):
+        cache = self.cache
+        rows = []
+        try:
+            self._resolve_missing(session, packets)
+            for packet in packets:
+                topic_num_id = cache.topic_id(session, packet.topic)
+                sensor_num_id = cache.sensor_id(session, packet.sensor)
+                recorded_at = datetime.fromtimestamp(
+                    packet_time(packet), timezone.utc
+                )
+                for measurement, value in packet.measurements.items():
+                    value, str_value = split_value(value)
+                    rows.append((
+                        recorded_at,
+                        topic_num_id,
+                        sensor_num_id,
+                        cache.measurement_id(session, measurement),
+                        value,
+                        cache.label_id(session, str_value),
+                        packet.key,
+                    ))
+            stored = len(rows)
+            if any(row[-1] is not None for row in rows):
+                # temporary tables are per connection, and emptied on commit
+                session.execute(self._create_staging)
+                self._copy(session, rows, STAGING_TABLE)
+                stored = session.execute(self._move_staged).rowcount
+            elif rows:
+                self._copy(session, rows)
+            if before_commit is not None:
+                before_commit(session)
+            commit_session(session)
+        except Exception:
+            session.rollback()
+            cache.discard_pending()
+            ERRORS.labels("write").inc()
+            raise
+        cache.commit_pending()
+        BATCH_SIZE.observe(len(packets))
+        count_stored(len(packets), len(rows), len(rows) - stored)
+
+    def _resolve_missing(self, session, packets):
+        names = {
+            "topic": [packet.topic for packet in packets],
+            "sensor": [packet.sensor for packet in packets],
+            "measurement": [
+                measurement
+                for packet in packets
+                for measurement in packet.measurements
+            ],
+            "label": [
+                label
+                for packet in packets
+                for label in map(_label, packet.measurements.values())
+                if label
+            ],
+        }
+        for dimension, values in names.items():
+            missing = self.cache.missing(dimension, values)
+            if missing:
+                # a name a concurrent transaction committed meanwhile is
+                # in neither half, the cache looks those up one by one
+                self.cache.add(dimension, dict(session.execute(
+                    self._upserts[dimension], {"names": missing}
+                ).all()))
+
+    def _copy(self, session, rows, table="sensor_measurements"):
+        connection = session.connection().connection.driver_connection
+        columns = ", ".join(COPY_COLUMNS)
+        cursor = connection.cursor()
+        try:
+            if self.copy_format == "binary":
+                statement = (
+                    f"COPY {table} ({columns}) FROM STDIN (FORMAT BINARY)"
+                )
+                with cursor.copy(statement) as copy:
+                    copy.set_types(COPY_TYPES)
+                    for row in rows:
+                        copy.write_row(row)
+                return
+            statement = f"COPY {table} ({columns}) FROM STDIN (FORMAT CSV)"
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            for recorded_at, *fields in rows:
+                # None is written as an empty field, which CSV reads as NULL
+                writer.writerow([recorded_at.isoformat(), *fields])
+            if hasattr(cursor, "copy"):
+                with cursor.copy(statement) as copy:
+                    copy.write(buffer.getvalue())
+            else:
+                buffer.seek(0)
+                cursor.copy_expert(statement, buffer)
+        finally:
+            cursor.close()
+
+
+def _label(value):
+    return split_value(value)[1]
+
+
+def _has_copy(session):
+    connection = session.connection().connection.driver_connection
+    cursor = connection.cursor()
+    try:
+        return hasattr(cursor, "copy")
+    finally:
+        cursor.close()
+
+
+def create_hypertable(session, chunk_interval):
+    """
+    Turn sensor_measurements into a TimescaleDB hypertable, once.
+
+    A hypertable needs the time column in every unique index, so the
+    primary key becomes (sensor_measurement_num_id, time) first; time
+    always has a value, the backend stamps every reading. The packet_key
+    index gets the time too, so only redeliveries stamped with the same
+    time are caught by it.
+    """
+    session.execute(text("CREATE EXTENSION IF NOT EXISTS timescaledb"))
+    exists = session.execute(text(
+        "SELECT 1 FROM timescaledb_information.hypertables "
+        "WHERE hypertable_name = 'sensor_measurements'"
+    )).first()
+    if exists is None:
+        session.execute(text(
+            "ALTER TABLE sensor_measurements "
+            "DROP CONSTRAINT sensor_measurements_pkey, "
+            "ADD PRIMARY KEY (sensor_measurement_num_id, time)"
+        ))
+        session.execute(text(
+            "DROP INDEX ux_sensor_measurements_packet_key"
+        ))
+        session.execute(text(
+            "CREATE UNIQUE INDEX ux_sensor_measurements_packet_key "
+            "ON sensor_measurements "
+            "(sensor_num_id, measurement_num_id, packet_key, time) "
+            "WHERE packet_key IS NOT NULL"
+        ))
+        session.execute(
+            text(
+                "SELECT create_hypertable('sensor_measurements', 'time', "
+                "chunk_time_interval => CAST(:interval AS interval), "
+                "migrate_data => true)"
+            ),
+            {"interval": chunk_interval},
+        )
+    session.commit()
+
+
+def backend_for(database):
+    """Return the ``StorageBackend`` for a ``config.DatabaseConfig``."""
+    if make_url(database.url).get_backend_name() == "postgresql":
+        return PostgresCopyBackend(
+            copy_format=database.copy_format,
+            chunk_interval=database.chunk_interval,
+        )
+    return SQLiteBackend(rollups=database.rollups)
@@ -0,0 +1,235 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, 4CSCC development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import logging
+import queue
+import threading
+import time
+
+from sqlalchemy.exc import OperationalError
+
+from mqtt_data_logger.log_data import add_sensors_reading_records
+from mqtt_data_logger.metrics import ERRORS
+
+
+logger = logging.getLogger(__name__)
+
+
+class BatchWriter:
+    """
+    Write-behind queue that commits sensor packets to the database in batches.
+
+    The paho callbacks only parse packets and hand them to ``put``. A
+    dedicated writer thread drains the bounded queue and commits everything
+    it collected in one transaction once either ``max_batch_size`` packets
+    are waiting or ``max_latency`` seconds have passed since the first one
+    of the batch was picked up.
+
+    Attributes:
+    - session (Session): The SQLAlchemy session, only used by the writer thread.
+    - max_batch_size (int): Packets committed per transaction at most.
+    - max_latency (float): Seconds a packet may wait before a flush is forced.
+    - max_queue_size (int): Bound on packets waiting to be written.
+    - overflow (str): ``"block"`` to apply back-pressure to the caller for up
+      to ``put_timeout`` seconds, ``"drop"`` to discard new packets at once.
+    - put_timeout (float): Seconds ``put`` blocks before dropping, ``None``
+      blocks forever.
+    - flush_on_shutdown (bool): Write out queued packets on ``close``.
+    - retries (int): Attempts for a batch that hits a locked database.
+    - retry_delay (float): Seconds between those attempts.
+
+    Methods:
+    - start(): Starts the writer thread.
+    - put(packet): Queues a ``SensorPacket``.
+    - close(): Stops the writer thread.
+    - stats(): Returns the writer counters.
+    """
+
+    _STOP = object()
+
+    def __init__(
+        self,
+        session,
+        max_batch_size=500,
+        max_latency=0.5,
+        max_queue_size=10000,
+        overflow="block",
+        put_timeout=1.0,
+        flush_on_shutdown=True,
+        retries=3,
+        retry_delay=0.5,
+        write_batch=add_sensors_reading_records,
+    ):
+        if overflow not in ("block", "drop"):
+            raise ValueError(
+                "overflow must be 'block' or 'drop', not {!r}".format(overflow)
+            )
+        self.session = session
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.max_queue_size = max_queue_size
+        self.overflow = overflow
+        self.put_timeout = put_timeout
+        self.flush_on_shutdown = flush_on_shutdown
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.write_batch = write_batch
+
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._thread = None
+        self._discard = False
+        self._counts = {
+            "enqueued": 0,
+            "dropped": 0,
+            "written": 0,
+            "batches": 0,
+            "failed": 0,
+        }
+
+    def start(self):
+        """Start the writer thread."""
+        if self._thread is not None:
+            return self
+        self._thread = threading.Thread(
+            target=self._run, name="mqtt-data-logger-writer", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def put(self, packet):
+        """
+        Queue a packet for writing.
+
+        Returns True if the packet was queued, False if it was dropped because
+        the queue stayed full. Never touches the database.
+        """
+        try:
+            if self.overflow == "block":
+                self._queue.put(packet, timeout=self.put_timeout)
+            else:
+                self._queue.put_nowait(packet)
+        except queue.Full:
+            self._counts["dropped"] += 1
+            ERRORS.labels("dropped").inc()
+            return False
+        self._counts["enqueued"] += 1
+        return True
+
+    def close(self, flush=None, timeout=None):
+        """
+        Stop the writer thread.
+
+        With ``flush`` (defaults to ``flush_on_shutdown``) every queued packet
+        is written before the thread exits, otherwise they are discarded.
+        """
+        if flush is None:
+            flush = self.flush_on_shutdown
+        if self._thread is None:
+            return
+        self._discard = not flush
+        # blocks until the writer thread makes room for the sentinel
+        self._queue.put(self._STOP)
+        self._thread.join(timeout)
+        self._thread = None
+
+    def qsize(self):
+        """Return the number of packets waiting to be written."""
+        return self._queue.qsize()
+
+    def stats(self):
+        """Return a copy of the writer counters with the current queue depth."""
+        stats = dict(self._counts)
+        stats["queue_depth"] = self.qsize()
+        return stats
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch, stopping = self._collect()
+            if batch and not self._discard:
+                self._flush(batch)
+            elif batch:
+                self._counts["dropped"] += len(batch)
+                ERRORS.labels("dropped").inc(len(batch))
+        if self._discard:
+            self._drain_discard()
+
+    def _collect(self):
+        """Block for a first packet, then gather until size or deadline."""
+        item = self._queue.get()
+        if item is self._STOP:
+            return [], True
+        batch = [item]
+        deadline = time.monotonic() + self.max_latency
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is self._STOP:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _flush(self, batch):
+        # a write_batch that commits in parts, like PartitionedStorage,
+        # removes the packets it committed from the batch before raising,
+        # so a retry only writes the rest
+        size = len(batch)
+        for attempt in range(self.retries):
+            try:
+                self.write_batch(self.session, batch)
+            except OperationalError as e:
+                if attempt + 1 < self.retries:
+                    time.sleep(self.retry_delay)
+                    continue
+                logger.error(
+                    "Dropping batch of %d packets: %s", len(batch), e
+                )
+                failed = len(batch)
+            except Exception as e:
+                # one bad packet must not drop the batch, retry one by one
+                logger.error(
+                    "Batch of %d packets failed, writing singly: %s",
+                    len(batch), e,
+                )
+                failed = self._write_singly(batch)
+            else:
+                failed = 0
+            break
+        if failed < size:
+            self._counts["written"] += size - failed
+            self._counts["batches"] += 1
+        if failed:
+            self._counts["failed"] += failed
+            ERRORS.labels("dropped").inc(failed)
+
+    def _write_singly(self, batch):
+        """Write packets one at a time, return how many failed."""
+        failed = 0
+        for packet in batch:
+            try:
+                self.write_batch(self.session, [packet])
+            except Exception as e:
+                failed += 1
+                logger.error(
+                    "Dropping packet of %s: %s", packet.sensor, e
+                )
+        return failed
+
+    def _drain_discard(self):
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                return
+            self._counts["dropped"] += 1
+            ERRORS.labels("dropped").inc()
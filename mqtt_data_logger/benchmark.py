@@ -0,0 +1,502 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, 4CSCC development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import argparse
+import contextlib
+import json
+import platform
+import random
+import tempfile
+import time
+from datetime import datetime, timezone
+from functools import partial
+from importlib import metadata
+from pathlib import Path
+from types import SimpleNamespace
+
+from paho.mqtt.client import topic_matches_sub
+from sqlalchemy.orm import sessionmaker
+
+from mqtt_data_logger import callbacks
+from mqtt_data_logger.batch_writer import BatchWriter
+from mqtt_data_logger.callbacks import log_sensor_data, parse_sensor_packet
+from mqtt_data_logger.log_data import (
+    DimensionCache,
+    add_sensors_reading_record,
+    add_sensors_reading_records,
+    add_sensors_reading_records_bulk,
+)
+from mqtt_data_logger.db import (
+    DEFAULT_SQLITE_PROFILE,
+    SQLITE_PROFILES,
+    create_sqlite_engine,
+)
+from mqtt_data_logger.metrics import file_size as db_size
+from mqtt_data_logger.sensor_data_models import Base
+
+
+###############################################################################
+# synthetic sensor traffic
+###############################################################################
+
+def _env_data(rng):
+    return {
+        "temp": round(rng.uniform(-10, 35), 2),
+        "humidity": round(rng.uniform(10, 100), 2),
+        "pressure": round(rng.uniform(980, 1040), 2),
+    }
+
+
+def _wind_data(rng):
+    return {
+        "wind_speed": round(rng.uniform(0, 80), 1),
+        "wind_direction": round(rng.uniform(0, 359.9), 1),
+    }
+
+
+def _air_quality_data(rng):
+    return {
+        "pm1_0": rng.randrange(0, 50),
+        "pm2_5": rng.randrange(0, 80),
+        "pm10": rng.randrange(0, 120),
+        "co2": rng.randrange(400, 2000),
+        "tvoc": rng.randrange(0, 600),
+        "temp": round(rng.uniform(15, 30), 2),
+    }
+
+
+# topic, sensor name prefix and data generator of each kind of sensor hub
+SENSOR_KINDS = [
+    ("sensor_data/env", "env", _env_data),
+    ("sensor_data/wind", "wind", _wind_data),
+    ("sensor_data/air_quality", "aq", _air_quality_data),
+]
+
+
+def generate_messages(number_of_messages, sensors=10, seed=0):
+    """
+    Generate raw ``(topic, payload)`` mqtt messages like the sensor hubs send.
+
+    Env, wind (with ``wind_speed``/``wind_direction``) and multi-measurement
+    air quality packets are mixed, spread over ``sensors`` sensors per kind.
+    """
+    rng = random.Random(seed)
+    messages = []
+    for _ in range(number_of_messages):
+        topic, prefix, make_data = rng.choice(SENSOR_KINDS)
+        packet = {
+            "sensor": "{}_{}".format(prefix, rng.randrange(sensors)),
+            "data": make_data(rng),
+        }
+        messages.append((topic, json.dumps(packet).encode("utf-8")))
+    return messages
+
+
+def generate_packets(number_of_packets, sensors=10, seed=0):
+    """Generate parsed ``SensorPacket``s of ``generate_messages`` traffic."""
+    return [
+        parse_sensor_packet(topic, payload)
+        for topic, payload in generate_messages(
+            number_of_packets, sensors, seed
+        )
+    ]
+
+
+class LoopbackBroker:
+    """
+    In-process stand-in for an mqtt broker.
+
+    ``publish`` hands the message straight to every callback whose
+    subscription matches, the way paho dispatches ``message_callback_add``
+    callbacks, without a network round trip.
+    """
+
+    def __init__(self):
+        self._callbacks = []
+
+    def message_callback_add(self, sub, callback):
+        self._callbacks.append((sub, callback))
+
+    def publish(self, topic, payload):
+        msg = SimpleNamespace(topic=topic, payload=payload, qos=0)
+        for sub, callback in self._callbacks:
+            if topic_matches_sub(sub, topic):
+                callback(self, None, msg)
+
+
+###############################################################################
+# measurements
+###############################################################################
+
+def percentile(values, q):
+    """Return the ``q`` (0-100) percentile of ``values``, nearest rank."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, round(q / 100 * len(ordered)) - 1))
+    return ordered[rank]
+
+
+class _LatencyRecorder:
+    """Wraps a batch write function to time commit minus ``received_at``."""
+
+    def __init__(self, write_batch):
+        self.write_batch = write_batch
+        self.latencies = []
+
+    def __call__(self, session, packets):
+        self.write_batch(session, packets)
+        committed = time.time()
+        self.latencies.extend(committed - p.received_at for p in packets)
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+def _result(
+    name, messages, seconds, latencies, size_before, size_after, readings
+):
+    return {
+        "scenario": name,
+        "messages": messages,
+        "seconds": round(seconds, 4),
+        "msgs_per_sec": round(messages / seconds, 1),
+        # None when nothing was written, e.g. every batch failed
+        "latency_p50_ms": _ms(percentile(latencies, 50)),
+        "latency_p99_ms": _ms(percentile(latencies, 99)),
+        "db_bytes_growth": size_after - size_before,
+        "db_bytes_per_reading": round(
+            (size_after - size_before) / readings, 1
+        ) if readings else None,
+    }
+
+
+@contextlib.contextmanager
+def _database(db_fp, profile):
+    engine = create_sqlite_engine(db_fp, profile)
+    Base.metadata.create_all(engine)
+    # measure growth from and to a checkpointed database, not the WAL
+    _checkpoint(engine)
+    session = sessionmaker(bind=engine)()
+    try:
+        yield session
+    finally:
+        session.close()
+        _checkpoint(engine)
+        engine.dispose()
+
+
+def _checkpoint(engine):
+    with engine.connect() as conn:
+        conn.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+
+
+def _readings(messages):
+    return sum(
+        len(parse_sensor_packet(topic, payload).measurements)
+        for topic, payload in messages
+    )
+
+
+def _message(topic, payload):
+    return SimpleNamespace(topic=topic, payload=payload)
+
+
+###############################################################################
+# scenarios
+###############################################################################
+
+def bench_direct(messages, db_fp, profile=DEFAULT_SQLITE_PROFILE, **options):
+    """``add_sensors_reading_record`` per packet, one commit each."""
+    packets = [parse_sensor_packet(t, p) for t, p in messages]
+    latencies = []
+    with _database(db_fp, profile) as session:
+        size_before = db_size(db_fp)
+        start = time.perf_counter()
+        for packet in packets:
+            started = time.perf_counter()
+            add_sensors_reading_record(
+                session, packet.topic, packet.sensor, packet.measurements
+            )
+            latencies.append(time.perf_counter() - started)
+        seconds = time.perf_counter() - start
+    return _result("direct", len(messages), seconds, latencies,
+                   size_before, db_size(db_fp), _readings(messages))
+
+
+def bench_callback_inline(
+    messages, db_fp, profile=DEFAULT_SQLITE_PROFILE, **options
+):
+    """``log_sensor_data`` writing inline on the mqtt thread."""
+    latencies = []
+    # the session is closed with the benchmark database, later inline
+    # writes in this process go back to what they used before
+    previous = getattr(callbacks, "session", None), callbacks.dimension_cache
+    with _database(db_fp, profile) as session:
+        callbacks.set_session(session)
+        callbacks.set_dimension_cache(DimensionCache())
+        size_before = db_size(db_fp)
+        start = time.perf_counter()
+        try:
+            for topic, payload in messages:
+                started = time.perf_counter()
+                log_sensor_data(None, None, _message(topic, payload))
+                latencies.append(time.perf_counter() - started)
+        finally:
+            callbacks.set_session(previous[0])
+            callbacks.set_dimension_cache(previous[1])
+        seconds = time.perf_counter() - start
+    return _result("callback_inline", len(messages), seconds, latencies,
+                   size_before, db_size(db_fp), _readings(messages))
+
+
+def _bench_batched(
+    name, messages, db_fp, profile, publish,
+    batch_size=500, max_latency=0.05, **options
+):
+    with _database(db_fp, profile) as session:
+        recorder = _LatencyRecorder(
+            partial(add_sensors_reading_records_bulk, cache=DimensionCache())
+        )
+        writer = BatchWriter(
+            session, max_batch_size=batch_size, max_latency=max_latency,
+            put_timeout=None, write_batch=recorder,
+        ).start()
+        callbacks.set_batch_writer(writer)
+        size_before = db_size(db_fp)
+        start = time.perf_counter()
+        try:
+            for topic, payload in messages:
+                publish(topic, payload)
+        finally:
+            callbacks.set_batch_writer(None)
+            writer.close()
+        seconds = time.perf_counter() - start
+    return _result(name, len(messages), seconds, recorder.latencies,
+                   size_before, db_size(db_fp), _readings(messages))
+
+
+def bench_callback_batched(
+    messages, db_fp, profile=DEFAULT_SQLITE_PROFILE, **options
+):
+    """``log_sensor_data`` handing packets to the batch writer."""
+    def publish(topic, payload):
+        log_sensor_data(None, None, _message(topic, payload))
+    return _bench_batched(
+        "callback_batched", messages, db_fp, profile, publish, **options
+    )
+
+
+def bench_broker_batched(
+    messages, db_fp, profile=DEFAULT_SQLITE_PROFILE, **options
+):
+    """Messages published through the loopback broker, batched writes."""
+    broker = LoopbackBroker()
+    broker.message_callback_add("sensor_data/#", log_sensor_data)
+    return _bench_batched(
+        "broker_batched", messages, db_fp, profile, broker.publish, **options
+    )
+
+
+SCENARIOS = {
+    "direct": bench_direct,
+    "callback_inline": bench_callback_inline,
+    "callback_batched": bench_callback_batched,
+    "broker_batched": bench_broker_batched,
+}
+
+
+def _package_version():
+    try:
+        return metadata.version("mqtt-data-logger")
+    except metadata.PackageNotFoundError:
+        return None
+
+
+def run_benchmarks(
+    number_of_messages=5000,
+    scenarios=tuple(SCENARIOS),
+    profile=DEFAULT_SQLITE_PROFILE,
+    seed=0,
+    **options,
+):
+    """
+    Run benchmark ``scenarios`` on the same synthetic traffic.
+
+    Every scenario writes to a fresh database. Returns a JSON-ready dict
+    with the environment and one result per scenario: msgs/sec, p50/p99
+    latency (commit time minus receipt time for batched scenarios, call
+    time for the others) and database growth.
+    """
+    messages = generate_messages(number_of_messages, seed=seed)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for name in scenarios:
+            results[name] = SCENARIOS[name](
+                messages, Path(tmpdir) / f"{name}.db", profile, **options
+            )
+    return {
+        "created": datetime.now(timezone.utc).isoformat(),
+        "environment": {
+            "mqtt_data_logger": _package_version(),
+            "python": platform.python_version(),
+            "sqlalchemy": metadata.version("sqlalchemy"),
+            "platform": platform.platform(),
+        },
+        "parameters": dict(
+            messages=number_of_messages, profile=profile, seed=seed, **options
+        ),
+        "results": results,
+    }
+
+
+def find_regressions(results, baseline, tolerance=0.1):
+    """
+    Compare two ``run_benchmarks`` outputs.
+
+    Returns a message for every scenario whose throughput dropped, or whose
+    p99 latency rose, by more than ``tolerance`` relative to ``baseline``.
+    """
+    regressions = []
+    for name, result in results["results"].items():
+        before = baseline["results"].get(name)
+        if before is None:
+            continue
+        if result["msgs_per_sec"] < before["msgs_per_sec"] * (1 - tolerance):
+            regressions.append("{}: {} msgs/sec, was {}".format(
+                name, result["msgs_per_sec"], before["msgs_per_sec"]
+            ))
+        if None in (result["latency_p99_ms"], before["latency_p99_ms"]):
+            continue
+        p99_limit = before["latency_p99_ms"] * (1 + tolerance)
+        if result["latency_p99_ms"] > p99_limit:
+            regressions.append("{}: p99 {} ms, was {}".format(
+                name, result["latency_p99_ms"], before["latency_p99_ms"]
+            ))
+    return regressions
+
+
+def ingest_main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="benchmark_logger",
+        description="Benchmark the logger on synthetic sensor traffic.",
+    )
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument(
+        "--scenario", action="append", choices=list(SCENARIOS),
+        help="scenario to run, repeat for several (default: all)",
+    )
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--max-latency", type=float, default=0.05)
+    parser.add_argument(
+        "--sqlite-profile", choices=list(SQLITE_PROFILES),
+        default=DEFAULT_SQLITE_PROFILE,
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--output", type=Path, help="save the results as JSON here",
+    )
+    parser.add_argument(
+        "--baseline", type=Path,
+        help="JSON results of an earlier run to check for regressions",
+    )
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(
+        args.messages,
+        args.scenario or tuple(SCENARIOS),
+        args.sqlite_profile,
+        args.seed,
+        batch_size=args.batch_size,
+        max_latency=args.max_latency,
+    )
+    print(json.dumps(results, indent=2))
+    if args.output is not None:
+        args.output.write_text(json.dumps(results, indent=2))
+    if args.baseline is not None:
+        regressions = find_regressions(
+            results, json.loads(args.baseline.read_text()), args.tolerance
+        )
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            raise SystemExit(1)
+
+
+###############################################################################
+# write path comparison
+###############################################################################
+
+def write_paths():
+    """Return the batch write functions to compare, keyed by name."""
+    return {
+        "orm": add_sensors_reading_records,
+        "orm_cached": partial(
+            add_sensors_reading_records, cache=DimensionCache()
+        ),
+        "bulk": partial(
+            add_sensors_reading_records_bulk, cache=DimensionCache()
+        ),
+    }
+
+
+def time_write_path(
+    write_batch, packets, batch_size, db_fp, profile=DEFAULT_SQLITE_PROFILE
+):
+    """Write ``packets`` to a fresh database, return elapsed seconds."""
+    with _database(db_fp, profile) as session:
+        start = time.perf_counter()
+        for i in range(0, len(packets), batch_size):
+            write_batch(session, packets[i:i + batch_size])
+        return time.perf_counter() - start
+
+
+def compare_write_paths(
+    number_of_packets=5000, batch_size=500, profile=DEFAULT_SQLITE_PROFILE
+):
+    """Time every write path on the same packets and report msgs/sec."""
+    packets = generate_packets(number_of_packets)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for name, write_batch in write_paths().items():
+            seconds = time_write_path(
+                write_batch, packets, batch_size,
+                Path(tmpdir) / f"{name}.db", profile,
+            )
+            results[name] = {
+                "seconds": round(seconds, 4),
+                "msgs_per_sec": round(number_of_packets / seconds, 1),
+            }
+    for name, result in results.items():
+        result["speedup_vs_orm"] = round(
+            results["orm"]["seconds"] / result["seconds"], 2
+        )
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="benchmark_write_paths")
+    parser.add_argument("--packets", type=int, default=5000)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument(
+        "--sqlite-profile", choices=list(SQLITE_PROFILES),
+        default=DEFAULT_SQLITE_PROFILE,
+    )
+    args = parser.parse_args(argv)
+    print(json.dumps(
+        compare_write_paths(
+            args.packets, args.batch_size, args.sqlite_profile
+        ),
+        indent=2,
+    ))
+
+
+if __name__ == "__main__":
+    main()
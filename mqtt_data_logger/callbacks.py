@@ -6,65 +6,204 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
-import json
-import retry
-from sqlite3 import OperationalError
-from mqtt_data_logger.log_data import add_sensors_reading_record
-from mqtt_data_logger.munge_wind import lookup_beaufort, lookup_cardinal
+import logging
+import time
+from retry.api import retry_call
+from sqlalchemy.exc import OperationalError
+from mqtt_data_logger.config import SENSOR_DATA_TOPIC
+from mqtt_data_logger.log_data import (
+    add_sensors_reading_record,
+    packet_time,
+    utc_datetime,
+)
+from mqtt_data_logger.logs import log_payload
+from mqtt_data_logger.metrics import MESSAGES_RECEIVED
+from mqtt_data_logger.parsing import DeadLetters, MalformedPacket, PacketParser
+
+
+logger = logging.getLogger(__name__)
+
+
+# When set, log_sensor_data hands packets to this BatchWriter instead of
+# writing them inline on the paho network thread.
+batch_writer = None
+
+# When set, inline writes resolve topic, sensor and measurement ids from this
+# DimensionCache instead of querying for them on every packet.
+dimension_cache = None
+
+
+# When set, log_sensor_data records every packet in this LatestValues table
+# of the newest value per topic, sensor and measurement.
+latest_values = None
+
+
+# When set, packets this DuplicateFilter has seen already are dropped.
+duplicate_filter = None
+
+
+# When set, this SensorClocks assigns every packet the time of its readings.
+sensor_clocks = None
+
+
+# When set, log_sensor_data only appends the raw message to this Spool; a
+# SpoolReplayer parses it and writes it to the database.
+spool = None
+
+
+# Decodes and validates payloads, see ``set_packet_parser``.
+packet_parser = PacketParser()
+
+# Malformed packets are counted here instead of raising on the paho thread.
+dead_letters = DeadLetters()
+
+
+def set_session(new_session):
+    """Write inline through ``new_session``, ``None`` opens one on demand."""
+    global session
+    if new_session is None:
+        globals().pop("session", None)
+    else:
+        session = new_session
+
+
+def set_dimension_cache(cache):
+    """Resolve inline ids from ``cache``, ``None`` queries every packet."""
+    global dimension_cache
+    dimension_cache = cache
+
+
+def set_packet_parser(parser):
+    """Parse payloads with ``parser``, e.g. one with other schemas."""
+    global packet_parser
+    packet_parser = parser
+
+
+def set_batch_writer(writer):
+    """Route sensor_data packets through ``writer``, ``None`` writes inline."""
+    global batch_writer
+    batch_writer = writer
+
+
+def set_spool(new_spool):
+    """Append sensor_data messages to ``new_spool``, ``None`` stops it."""
+    global spool
+    spool = new_spool
+
+
+def set_duplicate_filter(new_filter):
+    """Drop packets ``new_filter`` has seen, ``None`` keeps them all."""
+    global duplicate_filter
+    duplicate_filter = new_filter
+
+
+def set_sensor_clocks(clocks):
+    """Time packets with ``clocks``, ``None`` takes their times as is."""
+    global sensor_clocks
+    sensor_clocks = clocks
+
+
+def set_latest_values(values):
+    """Keep ``values`` up to date with every packet, ``None`` stops it."""
+    global latest_values
+    latest_values = values
 
 
 # Callbacks for Paho
 def on_connect(client, userdata, flags, rc):
-    """ "Generic on_connect function."""
-    print("Connected with result code " + str(rc))
-    client.subscribe("#")  # Subscribe to all topics
+    """
+    Subscribe to the topic filters in ``userdata["subscriptions"]``, only
+    sensor_data/# by default, so the broker sends nothing we would drop.
+    """
+    logger.info("Connected with result code %s", rc)
+    subscriptions = (userdata or {}).get(
+        "subscriptions", [SENSOR_DATA_TOPIC]
+    )
+    client.subscribe([(topic, 0) for topic in subscriptions])
 
 
 def on_message(client, userdata, msg):
     """Generic on_message function."""
-    print(f"Topic: {msg.topic} Message: {str(msg.payload.decode())}")
+    log_payload(msg.topic, msg.payload)
+
+
+def parse_sensor_packet(topic, payload, received_at=None):
+    """
+    Decode a sensor_data payload into a ``SensorPacket`` with the current
+    ``packet_parser``, raises ``MalformedPacket`` for invalid payloads.
+    """
+    return packet_parser.parse(topic, payload, received_at)
 
 
 def log_sensor_data(client, userdata, msg):
-    """Provides callback for logging sensor_data."""
+    """
+    Provides callback for logging sensor_data.
+
+    A message replayed from a capture carries the time it was first
+    received in ``received_at``, live ones are received now.
+    """
+    MESSAGES_RECEIVED.inc()
+    received_at = getattr(msg, "received_at", None)
+    if received_at is None:
+        received_at = time.time()
+    if spool is not None:
+        # durable in microseconds, parsing and writing happen on replay
+        spool.append(msg.topic, msg.payload, received_at)
+        return
+
+    try:
+        packet = packet_parser.parse(msg.topic, msg.payload, received_at)
+    except MalformedPacket as e:
+        dead_letters.record(msg.topic, msg.payload, e)
+        logger.warning("Malformed packet on %s: %s", msg.topic, e)
+        return
+    if duplicate_filter is not None and duplicate_filter.seen(packet):
+        return
+    if sensor_clocks is not None:
+        packet = sensor_clocks.stamp(packet)
+    topic, sensor, measurements = packet[:3]
+    log_payload(msg.topic, msg.payload)
+
+    if latest_values is not None:
+        latest_values.update(packet)
+
+    if batch_writer is not None:
+        batch_writer.put(packet)
+        return
+
     global session
     if "session" not in globals():
         from mqtt_data_logger.util import start_session
         session = start_session()
-    
-    topic = msg.topic
-    parsed_packet = json.loads(msg.payload.decode("utf-8"))
-    measurements = parsed_packet["data"]
-    if "wind_speed" in measurements:
-        measurements["wind_speed_beaufort"] = lookup_beaufort(
-            measurements["wind_speed"]
-            )
-        measurements.pop("wind_speed")
-
-    if "wind_direction" in measurements:
-        measurements["cardinal_direction"] = lookup_cardinal(
-            measurements["wind_direction"]
-            )
-
-    sensor = parsed_packet["sensor"]
-    print(f"Topic: {msg.topic} Message: {str(msg.payload.decode())}")
+
+    record = dict(
+        session=session,
+        measurements=measurements,
+        sensor=sensor,
+        topic=topic,
+        cache=dimension_cache,
+        recorded_at=utc_datetime(packet_time(packet)),
+        packet_key=packet.key,
+    )
     try:
-        add_sensors_reading_record(
-            session=session,
-            measurements=measurements,
-            sensor=sensor,
-            topic=topic
-        )
-    except OperationalError:
-        retry.retry(
-            add_sensors_reading_record,
-            fargs=(session, measurements, sensor, topic),
+        # a locked database is retried, waiting on the paho thread; run
+        # with a batch writer or a spool to keep it free
+        retry_call(
+            _write_record,
+            fkwargs=record,
+            exceptions=OperationalError,
             tries=3,
             delay=0.53,
         )
     except Exception as e:
-        print(f"Error: {e}")
+        logger.error("Error: %s", e)
         raise e
-    # add_sensors_reading_record(
-        # session=session, measurements=measurements, sensor=sensor, topic=topic
-    # )
+
+
+def _write_record(session, **record):
+    """Write one packet inline, rolling back a failed transaction."""
+    try:
+        add_sensors_reading_record(session=session, **record)
+    except Exception:
+        session.rollback()
+        raise
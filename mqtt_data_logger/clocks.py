@@ -0,0 +1,149 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, 4CSCC development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import logging
+import threading
+
+from mqtt_data_logger.metrics import CLOCK_CORRECTIONS
+
+
+logger = logging.getLogger(__name__)
+
+# a reading clamped behind the previous one of its sensor is this much later
+CLAMP_STEP = 1e-6
+
+
+class _Clock:
+    """What ``SensorClocks`` knows about the clock of one sensor."""
+
+    __slots__ = ("skew", "sent_at", "first_received", "last", "skewed")
+
+    def __init__(self):
+        self.skew = None
+        self.sent_at = None
+        self.first_received = None
+        self.last = None
+        self.skewed = False
+
+
+class SensorClocks:
+    """
+    Assigns every packet the time of its readings.
+
+    A packet that carries the time its sensor sent it (``sent_at``) gets
+    that time, the reading happened then and not when it reached the
+    logger, which is much later for a redelivered or spooled packet. The
+    offset of each sensor's clock from the logger's is estimated from
+    ``received_at - sent_at``. Network and broker delays only ever add to
+    it, so a lower offset is taken at once and a higher one only as fast
+    as a clock drifts (``max_drift`` seconds per second of sensor time,
+    100 ppm by default, so hours of redelivered packets stay as sent).
+    A sensor whose clock is off by more than ``tolerance`` seconds has its
+    times shifted onto the logger's clock. A sensor ahead of the logger is
+    corrected at once, no delay explains that, but a sensor behind it only
+    once the lowest offset of ``settle`` seconds of its packets is still
+    too high: the first packets after a restart may be a redelivered
+    backlog of a sensor in sync, hours old. A ``sent_at`` older than
+    ``max_age`` seconds, e.g. of a sensor that lost its clock and starts
+    in 1970, is not trusted at all. Packets without a ``sent_at`` get
+    their ``received_at``.
+
+    The times of a sensor do not go backwards by ``tolerance`` or less:
+    jitter of the correction or a step of the logger's clock is clamped to
+    just after the previous reading, so the readings of a sensor stay in
+    order. A packet older than that is a late reading and keeps its time.
+
+    Parameters:
+    - tolerance (float): Seconds a sensor's clock may be off uncorrected.
+    - max_drift (float): Seconds per second a sensor's clock may drift.
+    - max_age (float): Seconds a packet may be older than its receipt.
+    - settle (float): Seconds of receipt a sensor is watched for before
+      its clock is taken to be behind.
+
+    Methods:
+    - stamp(packet): Returns ``packet`` with its ``time`` set.
+    - skew(sensor): Returns the estimated offset of a sensor's clock.
+    - stats(): Returns the counts of corrected, untrusted and clamped times.
+    """
+
+    def __init__(
+        self, tolerance=2.0, max_drift=1e-4, max_age=7 * 86400, settle=300.0
+    ):
+        self.tolerance = tolerance
+        self.max_drift = max_drift
+        self.max_age = max_age
+        self.settle = settle
+        self.counts = {"corrected": 0, "untrusted": 0, "clamped": 0}
+        self._clocks = {}
+        self._lock = threading.Lock()
+
+    def stamp(self, packet):
+        """Return ``packet`` with the time of its readings in ``time``."""
+        with self._lock:
+            clock = self._clocks.get(packet.sensor)
+            if clock is None:
+                clock = self._clocks[packet.sensor] = _Clock()
+            time = self._device_time(packet, clock)
+            if clock.last is not None and (
+                clock.last - self.tolerance <= time <= clock.last
+            ):
+                time = clock.last + CLAMP_STEP
+                self._count("clamped")
+            if clock.last is None or time > clock.last:
+                clock.last = time
+        return packet._replace(time=time)
+
+    def skew(self, sensor):
+        """Seconds the logger's clock is ahead of ``sensor``'s, or None."""
+        with self._lock:
+            clock = self._clocks.get(sensor)
+            return clock.skew if clock is not None else None
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counts)
+
+    def _device_time(self, packet, clock):
+        sent_at = packet.sent_at
+        if sent_at is None:
+            return packet.received_at
+        offset = packet.received_at - sent_at
+        if offset > self.max_age:
+            self._count("untrusted")
+            return packet.received_at
+
+        if clock.skew is None or offset < clock.skew:
+            clock.skew = offset
+        else:
+            elapsed = max(sent_at - clock.sent_at, 0.0)
+            clock.skew = min(offset, clock.skew + self.max_drift * elapsed)
+        clock.sent_at = sent_at
+        if clock.first_received is None:
+            clock.first_received = packet.received_at
+
+        skewed = clock.skew < -self.tolerance or (
+            clock.skew > self.tolerance
+            and packet.received_at - clock.first_received >= self.settle
+        )
+        if skewed != clock.skewed:
+            clock.skewed = skewed
+            if skewed:
+                logger.warning(
+                    "Clock of %s is off by %.3fs, correcting its times",
+                    packet.sensor, clock.skew,
+                )
+            else:
+                logger.info("Clock of %s is back in sync", packet.sensor)
+        if skewed:
+            self._count("corrected")
+            return sent_at + clock.skew
+        return sent_at
+
+    def _count(self, kind):
+        self.counts[kind] += 1
+        CLOCK_CORRECTIONS.labels(kind).inc()
@@ -0,0 +1,538 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, 4CSCC development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import argparse
+import struct
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+from sqlalchemy import delete, func, insert, select
+
+from mqtt_data_logger.db import (
+    DEFAULT_SQLITE_PROFILE,
+    SQLITE_PROFILES,
+    create_sqlite_engine,
+)
+from mqtt_data_logger.sensor_data_models import (
+    Base,
+    Label,
+    ReadingBlock,
+    SensorMeasurement,
+)
+
+
+# A block holds the readings of one topic, sensor and measurement of a closed
+# window in (time, id) order. Ids are stored as zigzag varint deltas, times as
+# deltas of deltas since sensors report at a steady rate, labels as runs of
+# label ids, packet keys as runs of deltas of deltas since they count up per
+# sensor, and values with the XOR encoding of Facebook's Gorilla, where a
+# value equal to the previous one costs one bit and a slowly changing one a
+# few more. Regular float readings take a few bytes each instead of a row
+# and three index entries.
+#
+# query_readings and latest_readings decode blocks transparently, export
+# exports and backfill_rollups aggregates them. Tools that rewrite readings
+# in place, like reprocess_wind, only see the readings not compacted yet.
+BLOCK_VERSION = 2
+
+EPOCH = datetime(1970, 1, 1)
+
+_MICROSECOND = timedelta(microseconds=1)
+
+
+###############################################################################
+# encoding
+###############################################################################
+
+def to_micros(time):
+    """Microseconds since the epoch of a naive UTC or aware datetime."""
+    if time.tzinfo is not None:
+        time = time.astimezone(timezone.utc).replace(tzinfo=None)
+    return (time - EPOCH) // _MICROSECOND
+
+
+def from_micros(micros):
+    """The naive UTC datetime of ``to_micros``."""
+    return EPOCH + timedelta(microseconds=micros)
+
+
+def _zigzag(value):
+    return value * 2 if value >= 0 else -value * 2 - 1
+
+
+def _unzigzag(value):
+    return value >> 1 if not value & 1 else -((value + 1) >> 1)
+
+
+def _write_varint(out, value):
+    while value > 0x7F:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+class _Reader:
+    """Reads varints and then bits from an encoded block."""
+
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+        self._bits = 0
+        self._buffered = 0
+
+    def varint(self):
+        value = shift = 0
+        while True:
+            byte = self.data[self.position]
+            self.position += 1
+            value |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                return value
+            shift += 7
+
+    def bits(self, count):
+        while self._buffered < count:
+            self._bits = (self._bits << 8) | self.data[self.position]
+            self.position += 1
+            self._buffered += 8
+        self._buffered -= count
+        value = self._bits >> self._buffered
+        self._bits &= (1 << self._buffered) - 1
+        return value
+
+
+class _BitWriter:
+    """Appends bit fields to a bytearray, most significant bit first."""
+
+    def __init__(self, out):
+        self.out = out
+        self._bits = 0
+        self._buffered = 0
+
+    def write(self, value, count):
+        self._bits = (self._bits << count) | value
+        self._buffered += count
+        while self._buffered >= 8:
+            self._buffered -= 8
+            self.out.append(self._bits >> self._buffered)
+            self._bits &= (1 << self._buffered) - 1
+
+    def flush(self):
+        if self._buffered:
+            self.out.append(self._bits << (8 - self._buffered))
+            self._bits = self._buffered = 0
+
+
+def _float_bits(value):
+    return struct.unpack(">Q", struct.pack(">d", value))[0]
+
+
+def _bits_float(bits):
+    return struct.unpack(">d", struct.pack(">Q", bits))[0]
+
+
+def _encode_values(writer, values):
+    """Gorilla XOR encoding, with a presence bit so NULLs cost one bit."""
+    previous = None
+    leading = trailing = None
+    for value in values:
+        if value is None:
+            writer.write(0, 1)
+            continue
+        writer.write(1, 1)
+        bits = _float_bits(value)
+        if previous is None:
+            writer.write(bits, 64)
+            previous = bits
+            continue
+        xor = bits ^ previous
+        previous = bits
+        if xor == 0:
+            writer.write(0, 1)
+            continue
+        writer.write(1, 1)
+        new_leading = min(64 - xor.bit_length(), 31)
+        new_trailing = (xor & -xor).bit_length() - 1
+        if (
+            leading is not None
+            and new_leading >= leading
+            and new_trailing >= trailing
+        ):
+            # fits in the window of meaningful bits of the previous value
+            writer.write(0, 1)
+            writer.write(xor >> trailing, 64 - leading - trailing)
+            continue
+        leading, trailing = new_leading, new_trailing
+        meaningful = 64 - leading - trailing
+        writer.write(1, 1)
+        writer.write(leading, 5)
+        writer.write(meaningful - 1, 6)
+        writer.write(xor >> trailing, meaningful)
+
+
+def _decode_values(reader, count):
+    values = []
+    previous = None
+    leading = trailing = 0
+    for _ in range(count):
+        if not reader.bits(1):
+            values.append(None)
+            continue
+        if previous is None:
+            previous = reader.bits(64)
+        elif reader.bits(1):
+            if reader.bits(1):
+                leading = reader.bits(5)
+                trailing = 64 - leading - (reader.bits(6) + 1)
+            previous ^= reader.bits(64 - leading - trailing) << trailing
+        values.append(_bits_float(previous))
+    return values
+
+
+def _deltas(numbers):
+    """Zigzag deltas of deltas of ``numbers``."""
+    deltas = []
+    previous = previous_delta = 0
+    for number in numbers:
+        delta = number - previous
+        deltas.append(_zigzag(delta - previous_delta))
+        previous, previous_delta = number, delta
+    return deltas
+
+
+def _undeltas(deltas):
+    numbers = []
+    number = delta = 0
+    for zigzag in deltas:
+        delta += _unzigzag(zigzag)
+        number += delta
+        numbers.append(number)
+    return numbers
+
+
+def _write_runs(out, values):
+    """Write ``values`` as ``(value, length)`` runs of varints."""
+    runs = []
+    for value in values:
+        if runs and runs[-1][0] == value:
+            runs[-1][1] += 1
+        else:
+            runs.append([value, 1])
+    for value, length in runs:
+        _write_varint(out, value)
+        _write_varint(out, length)
+
+
+def _read_runs(reader, count):
+    values = []
+    while len(values) < count:
+        value = reader.varint()
+        values.extend([value] * reader.varint())
+    return values
+
+
+def encode_block(readings, keys=None):
+    """
+    Encode ``(reading_id, micros, value, label_num_id)`` tuples as bytes.
+
+    ``readings`` are in (time, id) order, ``micros`` is the time in
+    microseconds since the epoch (``to_micros``), ``value`` a float or
+    None and ``label_num_id`` an int or None. ``keys`` are the packet keys
+    of the readings, int or None, see ``block_keys``.
+    """
+    out = bytearray([BLOCK_VERSION])
+    _write_varint(out, len(readings))
+
+    previous_id = 0
+    for reading_id, _, _, _ in readings:
+        _write_varint(out, _zigzag(reading_id - previous_id))
+        previous_id = reading_id
+
+    for delta in _deltas([reading[1] for reading in readings]):
+        _write_varint(out, delta)
+
+    _write_runs(out, [reading[3] or 0 for reading in readings])
+
+    if keys is None:
+        keys = [None] * len(readings)
+    # shifted by one, 0 is a reading without a key; keys counting up at a
+    # steady rate, or none at all, are a single run
+    _write_runs(out, _deltas([0 if key is None else key + 1 for key in keys]))
+
+    writer = _BitWriter(out)
+    _encode_values(writer, [reading[2] for reading in readings])
+    writer.flush()
+    return bytes(out)
+
+
+def decode_block(data):
+    """Return the ``(reading_id, micros, value, label_num_id)`` tuples."""
+    return _decode(data)[0]
+
+
+def _decode(data):
+    """Return the readings of a block and their packet keys."""
+    reader = _Reader(data)
+    version = reader.varint()
+    if version not in (1, BLOCK_VERSION):
+        raise ValueError(f"Unknown reading block version {version}")
+    count = reader.varint()
+
+    ids = []
+    reading_id = 0
+    for _ in range(count):
+        reading_id += _unzigzag(reader.varint())
+        ids.append(reading_id)
+
+    times = _undeltas(reader.varint() for _ in range(count))
+
+    labels = [label or None for label in _read_runs(reader, count)]
+
+    # version 1 blocks have no packet keys
+    keys = [None] * count
+    if version > 1:
+        keys = [
+            key - 1 if key else None
+            for key in _undeltas(_read_runs(reader, count))
+        ]
+
+    values = _decode_values(reader, count)
+    return list(zip(ids, times, values, labels)), keys
+
+
+###############################################################################
+# reading blocks back
+###############################################################################
+
+def label_names(session_or_conn):
+    """Return every label id with its label."""
+    return dict(session_or_conn.execute(
+        select(Label.label_num_id, Label.label)
+    ).all())
+
+
+def block_readings(block, start=None, end=None):
+    """
+    Decode a ``ReadingBlock`` row into ``(reading_id, micros, value,
+    label_num_id)`` tuples, only those in ``start``..``end`` if given.
+    """
+    readings = decode_block(block.data)
+    if start is not None:
+        start = to_micros(start)
+        readings = [r for r in readings if r[1] >= start]
+    if end is not None:
+        end = to_micros(end)
+        readings = [r for r in readings if r[1] < end]
+    return readings
+
+
+def block_keys(block):
+    """Return the packet keys of the readings of a ``ReadingBlock`` row."""
+    return {key for key in _decode(block.data)[1] if key is not None}
+
+
+def overlapping_blocks(statement, start=None, end=None):
+    """Restrict a select of ``ReadingBlock`` to blocks overlapping a range."""
+    if start is not None:
+        statement = statement.where(ReadingBlock.end_time >= start)
+    if end is not None:
+        statement = statement.where(ReadingBlock.start_time < end)
+    return statement
+
+
+###############################################################################
+# compaction
+###############################################################################
+
+def _is_float(value):
+    return value is None or (
+        isinstance(value, (int, float)) and not isinstance(value, bool)
+    )
+
+
+def _insert_block(conn, series, readings, keys=None):
+    topic_num_id, sensor_num_id, measurement_num_id = series
+    conn.execute(insert(ReadingBlock).values(
+        topic_num_id=topic_num_id,
+        sensor_num_id=sensor_num_id,
+        measurement_num_id=measurement_num_id,
+        start_time=from_micros(readings[0][1]),
+        end_time=from_micros(readings[-1][1]),
+        count=len(readings),
+        max_reading_id=max(reading[0] for reading in readings),
+        data=encode_block(readings, keys),
+    ))
+
+
+def _compact_window(conn, start, end):
+    reading = SensorMeasurement
+    in_window = (reading.time >= start, reading.time < end)
+    series_columns = (
+        reading.topic_num_id, reading.sensor_num_id,
+        reading.measurement_num_id,
+    )
+    blocks = compacted = 0
+    for series in conn.execute(
+        select(*series_columns).where(*in_window).distinct()
+    ).all():
+        in_series = [
+            column == value for column, value in zip(series_columns, series)
+        ]
+        rows = conn.execute(
+            select(
+                reading.sensor_measurement_num_id, reading.time,
+                reading.value, reading.label_num_id, reading.packet_key,
+            )
+            .where(*in_series, *in_window)
+            .order_by(reading.time, reading.sensor_measurement_num_id)
+        ).all()
+        if not all(_is_float(row.value) for row in rows):
+            # text stored as a value, keep the rows as they are
+            continue
+        # packets redelivered after their window was compacted were stored
+        # again, the unique index only covers the table
+        compacted_keys = set()
+        for block in conn.execute(overlapping_blocks(
+            select(ReadingBlock).where(
+                ReadingBlock.sensor_num_id == series[1],
+                ReadingBlock.measurement_num_id == series[2],
+            ),
+            start, end,
+        )):
+            compacted_keys |= block_keys(block)
+        rows = [
+            row for row in rows
+            if row.packet_key is None or row.packet_key not in compacted_keys
+        ]
+        if rows:
+            _insert_block(conn, series, [
+                (
+                    row.sensor_measurement_num_id, to_micros(row.time),
+                    None if row.value is None else float(row.value),
+                    row.label_num_id,
+                )
+                for row in rows
+            ], [row.packet_key for row in rows])
+            blocks += 1
+            compacted += len(rows)
+        conn.execute(delete(reading).where(*in_series, *in_window))
+    return blocks, compacted
+
+
+def compact_readings(engine, before, window=timedelta(days=1)):
+    """
+    Move the readings of closed windows into compressed ``ReadingBlock``s.
+
+    Windows are ``window`` long, aligned to the epoch (UTC midnights for
+    days), and closed when they end at or before ``before``. Each window
+    is compacted in its own transaction, one block per topic, sensor and
+    measurement, so compaction can be interrupted and rerun; readings
+    logged late into a compacted window end up in a block of their own.
+
+    Blocks keep the packet keys of their readings, but the unique index
+    that skips redelivered packets only covers the table: a packet
+    redelivered after its window was compacted is stored again, and
+    dropped when the window is compacted next. Windows should be closed
+    long after any redelivery or spool replay, which is what the default
+    of the command line tool allows for.
+
+    Returns:
+    tuple: The number of blocks written and of readings compacted.
+    """
+    Base.metadata.create_all(engine, tables=[ReadingBlock.__table__])
+    with engine.connect() as conn:
+        first = conn.execute(select(func.min(SensorMeasurement.time))).scalar()
+    if first is None:
+        return 0, 0
+    if first.tzinfo is not None:
+        first = first.astimezone(timezone.utc).replace(tzinfo=None)
+    start = first - (first - EPOCH) % window
+
+    blocks = compacted = 0
+    while start + window <= before:
+        with engine.begin() as conn:
+            window_blocks, window_readings = _compact_window(
+                conn, start, start + window
+            )
+        blocks += window_blocks
+        compacted += window_readings
+        start += window
+    return blocks, compacted
+
+
+def trim_blocks(conn, cutoff):
+    """
+    Delete the readings before ``cutoff`` from the blocks.
+
+    Blocks entirely before ``cutoff`` are deleted, a block straddling it is
+    re-encoded with the readings at or after ``cutoff``.
+    """
+    conn.execute(delete(ReadingBlock).where(ReadingBlock.end_time < cutoff))
+    straddling = conn.execute(
+        select(ReadingBlock).where(ReadingBlock.start_time < cutoff)
+    ).all()
+    for block in straddling:
+        start = to_micros(cutoff)
+        kept = [
+            (reading, key) for reading, key in zip(*_decode(block.data))
+            if reading[1] >= start
+        ]
+        conn.execute(delete(ReadingBlock).where(
+            ReadingBlock.block_num_id == block.block_num_id
+        ))
+        if kept:
+            readings, keys = zip(*kept)
+            _insert_block(conn, (
+                block.topic_num_id, block.sensor_num_id,
+                block.measurement_num_id,
+            ), list(readings), list(keys))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="compact_sensor_data_db",
+        description="Compress the readings of closed windows into blocks. "
+                    "Queries decode them transparently.",
+    )
+    parser.add_argument("db", type=Path)
+    parser.add_argument(
+        "--older-than-days", type=int, default=7, metavar="DAYS",
+        help="compact the days that ended more than DAYS days ago",
+    )
+    parser.add_argument(
+        "--window-hours", type=int, default=24,
+        help="length of the compressed windows",
+    )
+    parser.add_argument(
+        "--vacuum", action="store_true",
+        help="shrink the database file after compacting",
+    )
+    parser.add_argument(
+        "--sqlite-profile", choices=list(SQLITE_PROFILES),
+        default=DEFAULT_SQLITE_PROFILE,
+    )
+    args = parser.parse_args(argv)
+
+    engine = create_sqlite_engine(args.db, args.sqlite_profile)
+    try:
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        blocks, compacted = compact_readings(
+            engine,
+            now - timedelta(days=args.older_than_days),
+            timedelta(hours=args.window_hours),
+        )
+        if args.vacuum:
+            with engine.connect() as conn:
+                conn.exec_driver_sql("VACUUM")
+        print(f"Compacted {compacted} readings into {blocks} blocks")
+    finally:
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,322 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, 4CSCC development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import json
+import os
+from collections import namedtuple
+from pathlib import Path
+
+from sqlalchemy.engine import make_url
+
+from mqtt_data_logger.db import DEFAULT_SQLITE_PROFILE, SQLITE_PROFILES
+
+try:
+    import tomllib
+except ImportError:
+    try:
+        import tomli as tomllib
+    except ImportError:
+        tomllib = None
+
+
+# The logger's own traffic; subscribing to "#" would have every broker send
+# (and the logger decode and drop) every message of the site.
+SENSOR_DATA_TOPIC = "sensor_data/#"
+
+DEFAULT_DB = "/home/beta/sensor_data.db"
+
+ENV_PREFIX = "MQTT_LOGGER_"
+
+
+class ConfigError(ValueError):
+    """The configuration is missing, malformed or inconsistent."""
+
+
+# An mqtt broker and the topic filters to subscribe to on it.
+BrokerConfig = namedtuple(
+    "BrokerConfig",
+    ["name", "host", "port", "subscriptions", "keepalive", "client_id",
+     "username", "password"],
+)
+
+# A database readings are written to. ``url`` is a SQLAlchemy URL, e.g.
+# sqlite:////home/beta/sensor_data.db or postgresql+psycopg://host/db.
+DatabaseConfig = namedtuple(
+    "DatabaseConfig",
+    ["name", "url", "sqlite_profile", "pool_size", "max_overflow",
+     "rollups", "copy_format", "chunk_interval"],
+)
+
+DEFAULT_BROKER = BrokerConfig(
+    "localhost", "localhost", 1883, (SENSOR_DATA_TOPIC,), 60, "", None, None
+)
+
+# Packets on topics matching ``topic`` go to database ``database``.
+Route = namedtuple("Route", ["topic", "database"])
+
+
+class LoggerConfig(namedtuple(
+    "LoggerConfig", ["brokers", "databases", "routes"],
+)):
+    """
+    Brokers to listen to, databases to write to and the routes between.
+
+    Routes are tried in order, the first topic filter matching a packet's
+    topic picks its database. Without routes everything goes to the first
+    database.
+    """
+
+    __slots__ = ()
+
+    @property
+    def default_database(self):
+        return self.databases[0]
+
+    def is_single_sqlite(self):
+        """True for one SQLite database, what the plain logger runs on."""
+        return (
+            len(self.databases) == 1
+            and is_sqlite_url(self.default_database.url)
+        )
+
+
+def is_sqlite_url(url):
+    return make_url(url).get_backend_name() == "sqlite"
+
+
+def sqlite_path(url):
+    """Return the file of a sqlite URL."""
+    return Path(make_url(url).database)
+
+
+def database_url(value):
+    """Turn a database file path or URL into a URL."""
+    value = str(value)
+    if "://" in value:
+        return value
+    return f"sqlite:///{value}"
+
+
+def parse_broker(value, name=None):
+    """Parse ``host[:port]`` into the settings of a broker."""
+    host, _, port = str(value).rpartition(":")
+    if not host or not port.isdigit():
+        host, port = str(value), 1883
+    return {"name": name or host, "host": host, "port": int(port)}
+
+
+def read_config_file(path):
+    """Read a TOML (``.toml``) or JSON configuration file into a dict."""
+    path = Path(path)
+    try:
+        if path.suffix == ".toml":
+            if tomllib is None:
+                raise ConfigError(
+                    "Reading TOML needs Python 3.11 or tomli, use JSON"
+                )
+            with open(path, "rb") as f:
+                return tomllib.load(f)
+        with open(path) as f:
+            return json.load(f)
+    except OSError as e:
+        raise ConfigError(f"Cannot read {path}: {e}") from None
+    except ValueError as e:
+        if isinstance(e, ConfigError):
+            raise
+        raise ConfigError(f"Cannot parse {path}: {e}") from None
+
+
+def env_settings(environ=os.environ):
+    """
+    Return the settings given by ``MQTT_LOGGER_*`` environment variables.
+
+    - MQTT_LOGGER_CONFIG: the configuration file.
+    - MQTT_LOGGER_BROKERS: comma separated ``host[:port]`` brokers.
+    - MQTT_LOGGER_SUBSCRIPTIONS: comma separated topic filters.
+    - MQTT_LOGGER_DB: file or URL of the default database.
+    """
+    settings = {}
+    for name in ("config", "brokers", "subscriptions", "db"):
+        value = environ.get(ENV_PREFIX + name.upper())
+        if value:
+            settings[name] = value
+    for name in ("brokers", "subscriptions"):
+        if name in settings:
+            settings[name] = [
+                item.strip() for item in settings[name].split(",")
+                if item.strip()
+            ]
+    return settings
+
+
+def _integer(document, key, default, where):
+    """Return setting ``key`` as an int, given as a number or a string."""
+    value = document.get(key, default)
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.strip().isdigit():
+        return int(value)
+    raise ConfigError(f"{where}: {key} must be an integer, not {value!r}")
+
+
+def _broker(document, index):
+    if not isinstance(document, dict) or "host" not in document:
+        raise ConfigError(f"brokers[{index}] needs a host")
+    subscriptions = document.get("subscriptions", [SENSOR_DATA_TOPIC])
+    if not isinstance(subscriptions, (list, tuple)) or not all(
+        isinstance(topic, str) for topic in subscriptions
+    ):
+        raise ConfigError(
+            f"brokers[{index}]: subscriptions must be a list of topic "
+            f"filters, not {subscriptions!r}"
+        )
+    return BrokerConfig(
+        name=document.get("name", document["host"]),
+        host=document["host"],
+        port=_integer(document, "port", 1883, f"brokers[{index}]"),
+        subscriptions=tuple(subscriptions),
+        keepalive=_integer(document, "keepalive", 60, f"brokers[{index}]"),
+        client_id=document.get("client_id", ""),
+        username=document.get("username"),
+        password=document.get("password"),
+    )
+
+
+def _database(name, document):
+    if isinstance(document, str):
+        document = {"url": document}
+    if not isinstance(document, dict) or not (
+        "url" in document or "path" in document
+    ):
+        raise ConfigError(f"database {name} needs a url or a path")
+    url = database_url(document.get("url") or document["path"])
+    profile = document.get("sqlite_profile", DEFAULT_SQLITE_PROFILE)
+    if profile not in SQLITE_PROFILES:
+        raise ConfigError(f"database {name}: unknown sqlite_profile {profile}")
+    rollups = bool(document.get("rollups", False))
+    if rollups and not is_sqlite_url(url):
+        raise ConfigError(f"database {name}: rollups need SQLite")
+    copy_format = document.get("copy_format", "binary")
+    if copy_format not in ("binary", "csv"):
+        raise ConfigError(
+            f"database {name}: unknown copy_format {copy_format}"
+        )
+    chunk_interval = document.get("chunk_interval")
+    if (
+        chunk_interval is not None
+        and make_url(url).get_backend_name() != "postgresql"
+    ):
+        raise ConfigError(
+            f"database {name}: chunk_interval needs PostgreSQL"
+        )
+    return DatabaseConfig(
+        name=name,
+        url=url,
+        sqlite_profile=profile,
+        pool_size=_integer(document, "pool_size", 5, f"database {name}"),
+        max_overflow=_integer(
+            document, "max_overflow", 10, f"database {name}"
+        ),
+        rollups=rollups,
+        copy_format=copy_format,
+        chunk_interval=chunk_interval,
+    )
+
+
+def load_config(
+    path=None,
+    environ=os.environ,
+    brokers=None,
+    subscriptions=None,
+    db=None,
+    sqlite_profile=None,
+    rollups=None,
+):
+    """
+    Build the ``LoggerConfig`` from a file, the environment and the CLI.
+
+    Later sources override earlier ones: the defaults (localhost:1883,
+    sensor_data/#, /home/beta/sensor_data.db), then the file at ``path``
+    or $MQTT_LOGGER_CONFIG, then ``MQTT_LOGGER_*`` variables, then the
+    keyword arguments. ``brokers`` replaces the brokers of the file,
+    ``subscriptions`` the subscriptions of every broker and ``db`` the
+    url of the first (default) database. ``sqlite_profile`` and
+    ``rollups`` apply to databases that do not set them.
+
+    The file has ``brokers`` (a list of tables with host, port,
+    subscriptions, keepalive, client_id, username and password),
+    ``databases`` (a table of name to url or path, sqlite_profile,
+    pool_size, max_overflow, rollups and, for PostgreSQL, copy_format
+    and chunk_interval) and ``routes`` (a list of tables
+    with topic and database).
+
+    Returns:
+    LoggerConfig: The validated configuration.
+    """
+    env = env_settings(environ)
+    path = path or env.get("config")
+    document = read_config_file(path) if path is not None else {}
+
+    broker_documents = document.get("brokers") or [parse_broker("localhost")]
+    broker_values = brokers or env.get("brokers")
+    if broker_values:
+        broker_documents = [parse_broker(value) for value in broker_values]
+    subscriptions = subscriptions or env.get("subscriptions")
+    if subscriptions:
+        broker_documents = [
+            dict(broker, subscriptions=list(subscriptions))
+            for broker in broker_documents
+        ]
+    broker_configs = [
+        _broker(broker, index)
+        for index, broker in enumerate(broker_documents)
+    ]
+    if not broker_configs:
+        raise ConfigError("no brokers configured")
+
+    database_documents = dict(document.get("databases") or {})
+    if not database_documents:
+        database_documents["default"] = {"path": DEFAULT_DB}
+    first = next(iter(database_documents))
+    db = db or env.get("db")
+    if db is not None:
+        database_documents[first] = {
+            **_as_table(database_documents[first]),
+            "url": database_url(db),
+        }
+    for name, table in database_documents.items():
+        table = _as_table(table)
+        if sqlite_profile is not None:
+            table.setdefault("sqlite_profile", sqlite_profile)
+        if rollups and is_sqlite_url(
+            database_url(table.get("url") or table.get("path", ""))
+        ):
+            table.setdefault("rollups", True)
+        database_documents[name] = table
+    databases = [
+        _database(name, table) for name, table in database_documents.items()
+    ]
+
+    names = {database.name for database in databases}
+    routes = []
+    for index, route in enumerate(document.get("routes") or []):
+        if not isinstance(route, dict) or "topic" not in route:
+            raise ConfigError(f"routes[{index}] needs a topic")
+        database = route.get("database", first)
+        if database not in names:
+            raise ConfigError(
+                f"routes[{index}] goes to unknown database {database}"
+            )
+        routes.append(Route(route["topic"], database))
+    return LoggerConfig(broker_configs, databases, routes)
+
+
+def _as_table(document):
+    if isinstance(document, str):
+        return {"url": document}
+    return dict(document)
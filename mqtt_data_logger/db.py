@@ -0,0 +1,160 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, 4CSCC development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+
+
+# PRAGMAs applied to every new SQLite connection, by profile name.
+#
+# All profiles use WAL so readers (dashboards, logged) never block the
+# logger and the logger never blocks them, and a busy_timeout so a
+# briefly locked database waits instead of raising OperationalError.
+# - durable: fsync on every commit, nothing is lost on power failure.
+# - balanced: fsync only at WAL checkpoints, the last commits can be lost on
+#   power failure but the database is never corrupted.
+# - max-throughput: no fsync at all and bigger caches, for bulk loads and
+#   backfills where the input can be replayed.
+SQLITE_PROFILES = {
+    "durable": {
+        "journal_mode": "WAL",
+        "synchronous": "FULL",
+        "busy_timeout": 5000,
+        "cache_size": -8000,
+        "temp_store": "DEFAULT",
+        "mmap_size": 0,
+    },
+    "balanced": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "busy_timeout": 5000,
+        "cache_size": -16000,
+        "temp_store": "MEMORY",
+        "mmap_size": 64 * 1024 * 1024,
+    },
+    "max-throughput": {
+        "journal_mode": "WAL",
+        "synchronous": "OFF",
+        "busy_timeout": 10000,
+        "cache_size": -64000,
+        "temp_store": "MEMORY",
+        "mmap_size": 256 * 1024 * 1024,
+    },
+}
+
+DEFAULT_SQLITE_PROFILE = "balanced"
+
+
+def sqlite_pragmas(profile=DEFAULT_SQLITE_PROFILE, **overrides):
+    """Return the PRAGMAs of ``profile`` with ``overrides`` applied."""
+    try:
+        pragmas = dict(SQLITE_PROFILES[profile])
+    except KeyError:
+        raise ValueError(
+            "Unknown sqlite profile: ({}), expected one of {}".format(
+                profile, ", ".join(SQLITE_PROFILES)
+            )
+        ) from None
+    pragmas.update(overrides)
+    return pragmas
+
+
+def create_sqlite_engine(
+    db_fp,
+    profile=DEFAULT_SQLITE_PROFILE,
+    echo=False,
+    read_only=False,
+    pool_size=5,
+    **overrides,
+):
+    """
+    Create an engine for a SQLite database file with a performance profile.
+
+    The PRAGMAs of the profile (see ``SQLITE_PROFILES``) are set on each
+    connection as it is opened, keyword arguments override single PRAGMAs,
+    e.g. ``create_sqlite_engine(fp, "balanced", cache_size=-32000)``.
+
+    A ``read_only`` engine opens the file with ``mode=ro`` and
+    ``query_only``, so readers such as the API server can never take the
+    write lock from the logger. The journal mode is left to the writer.
+
+    Parameters:
+    - db_fp (Path or str): The database file, ":memory:" for a memory db.
+    - profile (str): One of "durable", "balanced" or "max-throughput".
+    - echo (bool): Log all SQL statements.
+    - read_only (bool): Open the database read-only.
+    - pool_size (int): Connections kept open by a read-only engine.
+
+    Returns:
+    Engine: The configured SQLAlchemy engine.
+    """
+    pragmas = sqlite_pragmas(profile, **overrides)
+    if read_only:
+        pragmas.pop("journal_mode")
+        pragmas["query_only"] = 1
+        engine = create_engine(
+            f"sqlite:///file:{db_fp}?mode=ro&uri=true",
+            echo=echo,
+            pool_size=pool_size,
+            connect_args={"check_same_thread": False},
+        )
+    else:
+        engine = create_engine(f"sqlite:///{db_fp}", echo=echo)
+
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma, value in pragmas.items():
+            cursor.execute("PRAGMA {} = {}".format(pragma, value))
+        cursor.close()
+
+    return engine
+
+
+def create_database_engine(
+    url,
+    sqlite_profile=DEFAULT_SQLITE_PROFILE,
+    pool_size=5,
+    max_overflow=10,
+    pool_recycle=3600,
+    echo=False,
+):
+    """
+    Create a pooled engine for any database the logger can write to.
+
+    SQLite URLs get ``create_sqlite_engine`` with ``sqlite_profile``. Other
+    databases (e.g. ``postgresql+psycopg://`` for PostgreSQL/TimescaleDB)
+    get a ``QueuePool`` of ``pool_size`` connections plus ``max_overflow``
+    extra under load. Connections are checked before use and recycled
+    after ``pool_recycle`` seconds, so a restarted server or a proxy that
+    drops idle connections costs a reconnect instead of a failed batch.
+
+    Parameters:
+    - url (str): SQLAlchemy database URL.
+    - sqlite_profile (str): Profile of SQLite databases.
+    - pool_size (int): Connections kept open.
+    - max_overflow (int): Connections opened beyond ``pool_size``.
+    - pool_recycle (int): Seconds after which a connection is replaced.
+    - echo (bool): Log all SQL statements.
+
+    Returns:
+    Engine: The configured SQLAlchemy engine.
+    """
+    parsed = make_url(url)
+    if parsed.get_backend_name() == "sqlite":
+        return create_sqlite_engine(
+            parsed.database or ":memory:", sqlite_profile, echo
+        )
+    return create_engine(
+        parsed,
+        echo=echo,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_pre_ping=True,
+        pool_recycle=pool_recycle,
+    )
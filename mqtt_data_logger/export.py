@@ -0,0 +1,369 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, 4CSCC development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import argparse
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+from sqlalchemy import delete, func, select
+
+from mqtt_data_logger.compression import (
+    block_readings,
+    from_micros,
+    label_names,
+    overlapping_blocks,
+    trim_blocks,
+)
+from mqtt_data_logger.db import (
+    DEFAULT_SQLITE_PROFILE,
+    SQLITE_PROFILES,
+    create_sqlite_engine,
+)
+from mqtt_data_logger.sensor_data_models import (
+    Topic,
+    Sensor,
+    Measurement,
+    Label,
+    ReadingBlock,
+    SensorMeasurement,
+)
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pa = None
+
+
+FORMATS = {"parquet": ".parquet", "arrow": ".arrow"}
+
+# column name and arrow type of every exported reading, in file order
+EXPORT_COLUMNS = [
+    ("sensor_measurement_num_id", "int64"),
+    ("time", "timestamp[us]"),
+    ("topic", "string"),
+    ("sensor", "string"),
+    ("measurement", "string"),
+    ("value", "float64"),
+    ("str_value", "string"),
+]
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError(
+            "Exporting readings needs pyarrow, install it with "
+            "`pip install mqtt-data-logger[export]`."
+        )
+
+
+def export_schema():
+    """Return the arrow schema of exported readings."""
+    _require_pyarrow()
+    return pa.schema([
+        (name, pa.type_for_alias(arrow_type))
+        for name, arrow_type in EXPORT_COLUMNS
+    ])
+
+
+def _readings_query(after_id, chunk_size, start=None, end=None):
+    """Select the next chunk of readings joined with their dimension names."""
+    reading_id = SensorMeasurement.sensor_measurement_num_id
+    query = (
+        select(
+            reading_id,
+            SensorMeasurement.time,
+            Topic.topic,
+            Sensor.sensor_id.label("sensor"),
+            Measurement.measurement,
+            SensorMeasurement.value,
+            func.coalesce(Label.label, "").label("str_value"),
+        )
+        .join(Topic, SensorMeasurement.topic_num_id == Topic.topic_num_id)
+        .join(Sensor, SensorMeasurement.sensor_num_id == Sensor.sensor_num_id)
+        .join(
+            Measurement,
+            SensorMeasurement.measurement_num_id
+            == Measurement.measurement_num_id,
+        )
+        .outerjoin(
+            Label, SensorMeasurement.label_num_id == Label.label_num_id
+        )
+        .where(reading_id > after_id)
+        .order_by(reading_id)
+        .limit(chunk_size)
+    )
+    if start is not None:
+        query = query.where(SensorMeasurement.time >= start)
+    if end is not None:
+        query = query.where(SensorMeasurement.time < end)
+    return query
+
+
+def iter_reading_chunks(engine, chunk_size=50000, start=None, end=None):
+    """
+    Yield readings in start..end as lists of row mappings, ``chunk_size`` at
+    a time, paging on the reading id so memory use stays bounded. The
+    readings compacted into blocks follow, a block at a time.
+    """
+    after_id = 0
+    with engine.connect() as conn:
+        while True:
+            rows = conn.execute(
+                _readings_query(after_id, chunk_size, start, end)
+            ).mappings().all()
+            if not rows:
+                break
+            yield rows
+            after_id = rows[-1]["sensor_measurement_num_id"]
+
+        labels = None
+        for block in conn.execute(overlapping_blocks(
+            select(
+                *ReadingBlock.__table__.c,
+                Topic.topic,
+                Sensor.sensor_id.label("sensor"),
+                Measurement.measurement,
+            )
+            .join(Topic, ReadingBlock.topic_num_id == Topic.topic_num_id)
+            .join(Sensor, ReadingBlock.sensor_num_id == Sensor.sensor_num_id)
+            .join(
+                Measurement,
+                ReadingBlock.measurement_num_id
+                == Measurement.measurement_num_id,
+            )
+            .order_by(ReadingBlock.block_num_id),
+            start, end,
+        )):
+            if labels is None:
+                labels = label_names(conn)
+            rows = [
+                {
+                    "sensor_measurement_num_id": reading_id,
+                    "time": from_micros(micros),
+                    "topic": block.topic,
+                    "sensor": block.sensor,
+                    "measurement": block.measurement,
+                    "value": value,
+                    "str_value": labels.get(label, "") if label else "",
+                }
+                for reading_id, micros, value, label
+                in block_readings(block, start, end)
+            ]
+            if rows:
+                yield rows
+
+
+def _safe_path_part(value):
+    """Make a sensor id usable as a directory name."""
+    return "".join(c if c.isalnum() or c in "-_." else "_" for c in value)
+
+
+class _PartitionWriters:
+    """Open file writers per ``date=.../sensor=...`` directory.
+
+    At most ``max_open`` writers are open at once; a partition whose writer
+    was closed gets a new part file when more rows arrive for it.
+    """
+
+    def __init__(self, out_dir, fmt, max_open=64):
+        self.out_dir = Path(out_dir)
+        self.fmt = fmt
+        self.max_open = max_open
+        self.schema = export_schema()
+        self.files = []
+        self._run_id = uuid.uuid4().hex[:8]
+        self._writers = OrderedDict()
+
+    def write(self, partition, rows):
+        writer = self._writers.get(partition)
+        if writer is None:
+            writer = self._open(partition)
+        else:
+            self._writers.move_to_end(partition)
+        table = pa.Table.from_pylist(rows, schema=self.schema)
+        writer.write_table(table)
+
+    def close(self):
+        while self._writers:
+            self._writers.popitem(last=False)[1].close()
+
+    def _open(self, partition):
+        day, sensor = partition
+        directory = self.out_dir / f"date={day}" / f"sensor={sensor}"
+        directory.mkdir(parents=True, exist_ok=True)
+        fp = directory / "part-{}-{}{}".format(
+            self._run_id, len(self.files), FORMATS[self.fmt]
+        )
+        if self.fmt == "parquet":
+            writer = pa.parquet.ParquetWriter(str(fp), self.schema)
+        else:
+            writer = pa.ipc.new_file(str(fp), self.schema)
+        self.files.append(fp)
+        self._writers[partition] = writer
+        while len(self._writers) > self.max_open:
+            self._writers.popitem(last=False)[1].close()
+        return writer
+
+
+def export_readings(
+    engine,
+    out_dir,
+    fmt="parquet",
+    chunk_size=50000,
+    start=None,
+    end=None,
+):
+    """
+    Stream readings into columnar files partitioned by date and sensor.
+
+    Files are written as ``out_dir/date=YYYY-MM-DD/sensor=<id>/part-*.ext``,
+    the hive layout pyarrow, pandas, polars and duckdb read as one dataset.
+    Each chunk of ``chunk_size`` readings is appended as row groups, so
+    memory use does not depend on the number of readings exported.
+
+    Parameters:
+    - engine (Engine): The sensor data database.
+    - out_dir (Path): Root directory of the dataset.
+    - fmt (str): "parquet" or "arrow" (Arrow IPC file).
+    - chunk_size (int): Readings read and written at a time.
+    - start (datetime): Only export readings at or after this time.
+    - end (datetime): Only export readings before this time.
+
+    Returns:
+    tuple: The number of readings exported, the highest exported reading
+    id and the list of files written.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(
+            "fmt must be one of {}, not {!r}".format(", ".join(FORMATS), fmt)
+        )
+    writers = _PartitionWriters(out_dir, fmt)
+    exported = 0
+    last_id = 0
+    try:
+        for rows in iter_reading_chunks(engine, chunk_size, start, end):
+            partitions = OrderedDict()
+            for row in rows:
+                partition = (
+                    row["time"].strftime("%Y-%m-%d"),
+                    _safe_path_part(row["sensor"]),
+                )
+                partitions.setdefault(partition, []).append(row)
+            for partition, partition_rows in partitions.items():
+                writers.write(partition, partition_rows)
+            exported += len(rows)
+            last_id = max(
+                last_id, max(row["sensor_measurement_num_id"] for row in rows)
+            )
+    finally:
+        writers.close()
+    return exported, last_id, writers.files
+
+
+def archive_readings(
+    engine,
+    out_dir,
+    older_than_days,
+    fmt="parquet",
+    chunk_size=50000,
+    vacuum=False,
+    now=None,
+):
+    """
+    Move readings older than ``older_than_days`` out of the database.
+
+    The readings are exported with ``export_readings`` first; only once
+    every file is closed are they deleted, ``chunk_size`` ids per
+    transaction so the logger is never locked out for long. Pass
+    ``vacuum`` to give the freed pages back to the file system.
+
+    Returns:
+    int: The number of readings archived.
+    """
+    if now is None:
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+    cutoff = now - timedelta(days=older_than_days)
+    archived, last_id, files = export_readings(
+        engine, out_dir, fmt, chunk_size, end=cutoff
+    )
+    if not archived:
+        return 0
+
+    reading_id = SensorMeasurement.sensor_measurement_num_id
+    with engine.connect() as conn:
+        first_id = conn.execute(select(func.min(reading_id))).scalar()
+    if first_id is None:
+        # only compacted readings were archived
+        first_id = last_id + 1
+    for low in range(first_id, last_id + 1, chunk_size):
+        with engine.begin() as conn:
+            conn.execute(
+                delete(SensorMeasurement)
+                .where(reading_id >= low)
+                .where(reading_id < min(low + chunk_size, last_id + 1))
+                .where(SensorMeasurement.time < cutoff)
+            )
+    with engine.begin() as conn:
+        trim_blocks(conn, cutoff)
+    if vacuum:
+        with engine.connect() as conn:
+            conn.exec_driver_sql("VACUUM")
+    return archived
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="export_readings",
+        description="Export readings to parquet or arrow files partitioned "
+                    "by date and sensor, optionally removing them from the "
+                    "database (archive mode).",
+    )
+    parser.add_argument("db", type=Path)
+    parser.add_argument("out_dir", type=Path)
+    parser.add_argument("--format", choices=list(FORMATS), default="parquet")
+    parser.add_argument("--chunk-size", type=int, default=50000)
+    parser.add_argument("--start", type=datetime.fromisoformat, help="ISO time, UTC")
+    parser.add_argument("--end", type=datetime.fromisoformat, help="ISO time, UTC")
+    parser.add_argument(
+        "--archive-older-than", type=int, metavar="DAYS",
+        help="export readings older than DAYS and delete them from the db",
+    )
+    parser.add_argument(
+        "--vacuum", action="store_true",
+        help="shrink the database file after archiving",
+    )
+    parser.add_argument(
+        "--sqlite-profile", choices=list(SQLITE_PROFILES),
+        default=DEFAULT_SQLITE_PROFILE,
+    )
+    args = parser.parse_args(argv)
+
+    engine = create_sqlite_engine(args.db, args.sqlite_profile)
+    try:
+        if args.archive_older_than is not None:
+            archived = archive_readings(
+                engine, args.out_dir, args.archive_older_than, args.format,
+                args.chunk_size, args.vacuum,
+            )
+            print(f"Archived {archived} readings to {args.out_dir}")
+        else:
+            exported, last_id, files = export_readings(
+                engine, args.out_dir, args.format, args.chunk_size,
+                args.start, args.end,
+            )
+            print(f"Exported {exported} readings to {len(files)} files")
+    finally:
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
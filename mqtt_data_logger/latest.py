@@ -0,0 +1,271 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, 4CSCC development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import json
+import logging
+import queue
+import threading
+from collections import namedtuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from numbers import Real
+
+from sqlalchemy import select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from mqtt_data_logger.log_data import (
+    packet_time,
+    split_value,
+    utc_datetime,
+)
+from mqtt_data_logger.sensor_data_models import LatestReading
+
+
+logger = logging.getLogger(__name__)
+
+
+# The newest value of one (topic, sensor, measurement), ``time`` is naive UTC.
+LatestValue = namedtuple(
+    "LatestValue",
+    ["topic", "sensor", "measurement", "time", "value", "str_value"],
+)
+
+
+def _value_json(latest):
+    document = latest._asdict()
+    document["time"] = latest.time.isoformat()
+    return document
+
+
+class LatestValues:
+    """
+    In-memory table of the newest value of every topic/sensor/measurement.
+
+    ``update`` is called from the ingest path for every packet; reads are a
+    dict lookup. Changes are pushed to subscriber queues for live feeds and
+    ``snapshot`` writes the keys changed since the last snapshot to the
+    latest_readings table, which ``start`` does every ``interval`` seconds
+    on a thread of its own.
+
+    Attributes:
+    - max_subscriber_queue (int): Events buffered per subscriber before
+      new ones are dropped for it.
+    - dropped_events (int): Events dropped for slow subscribers.
+
+    Methods:
+    - update(packet): Records the measurements of a ``SensorPacket``.
+    - get(topic, sensor, measurement): Returns one ``LatestValue``.
+    - values(): Returns every ``LatestValue``.
+    - subscribe() / unsubscribe(q): Registers a queue of change events.
+    - load(engine): Restores the table from the last snapshot.
+    - snapshot(engine): Writes changed values to the database.
+    - start(engine, interval) / close(): Runs snapshots periodically.
+    """
+
+    def __init__(self, max_subscriber_queue=1000):
+        self.max_subscriber_queue = max_subscriber_queue
+        self.dropped_events = 0
+        self._values = {}
+        self._dirty = set()
+        self._subscribers = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def update(self, packet):
+        """Record the measurements of ``packet`` as the newest values."""
+        at = utc_datetime(packet_time(packet))
+        changed = []
+        with self._lock:
+            for measurement, value in packet.measurements.items():
+                value, str_value = split_value(value)
+                if value is not None and (
+                    not isinstance(value, Real) or isinstance(value, bool)
+                ):
+                    value, str_value = None, str(value)
+                key = (packet.topic, packet.sensor, measurement)
+                current = self._values.get(key)
+                if current is not None and current.time > at:
+                    continue
+                latest = LatestValue(*key, at, value, str_value)
+                self._values[key] = latest
+                self._dirty.add(key)
+                changed.append(latest)
+            subscribers = list(self._subscribers)
+        for latest in changed:
+            for subscriber in subscribers:
+                try:
+                    subscriber.put_nowait(latest)
+                except queue.Full:
+                    self.dropped_events += 1
+
+    def get(self, topic, sensor, measurement):
+        """Return the newest ``LatestValue`` of a key, None if unseen."""
+        return self._values.get((topic, sensor, measurement))
+
+    def values(self):
+        """Return every ``LatestValue`` ordered by key."""
+        with self._lock:
+            return [self._values[key] for key in sorted(self._values)]
+
+    def subscribe(self):
+        """Return a queue receiving every changed ``LatestValue``."""
+        subscriber = queue.Queue(self.max_subscriber_queue)
+        with self._lock:
+            self._subscribers.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            if subscriber in self._subscribers:
+                self._subscribers.remove(subscriber)
+
+    def load(self, engine):
+        """Fill the table from the latest_readings snapshot."""
+        with engine.connect() as conn:
+            rows = conn.execute(select(LatestReading.__table__)).all()
+        with self._lock:
+            for row in rows:
+                latest = LatestValue(*row)
+                self._values.setdefault(latest[:3], latest)
+        return self
+
+    def snapshot(self, engine):
+        """Upsert the values changed since the last snapshot."""
+        with self._lock:
+            changed = [self._values[key]._asdict() for key in self._dirty]
+            self._dirty.clear()
+        if not changed:
+            return 0
+        table = LatestReading.__table__
+        statement = sqlite_insert(table)
+        statement = statement.on_conflict_do_update(
+            index_elements=[
+                table.c.topic, table.c.sensor, table.c.measurement
+            ],
+            set_={
+                name: statement.excluded[name]
+                for name in ("time", "value", "str_value")
+            },
+        )
+        try:
+            with engine.begin() as conn:
+                conn.execute(statement, changed)
+        except Exception:
+            with self._lock:
+                self._dirty.update(
+                    (v["topic"], v["sensor"], v["measurement"])
+                    for v in changed
+                )
+            raise
+        return len(changed)
+
+    def start(self, engine, interval=1.0):
+        """Snapshot to ``engine`` every ``interval`` seconds."""
+        self._thread = threading.Thread(
+            target=self._run, args=(engine, interval),
+            name="mqtt-data-logger-latest", daemon=True,
+        )
+        self._thread.start()
+        return self
+
+    def close(self):
+        """Stop snapshotting, write a final snapshot and end live feeds."""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        with self._lock:
+            subscribers, self._subscribers = self._subscribers, []
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(None)
+            except queue.Full:
+                pass
+
+    def _run(self, engine, interval):
+        while not self._stop.wait(interval):
+            self._snapshot_logged(engine)
+        self._snapshot_logged(engine)
+
+    def _snapshot_logged(self, engine):
+        try:
+            self.snapshot(engine)
+        except Exception as e:
+            logger.error("Latest value snapshot failed: %s", e)
+
+
+class LiveFeedHandler(BaseHTTPRequestHandler):
+    """
+    ``/latest`` returns every latest value as JSON, straight from memory.
+    ``/events`` is a server-sent events stream: one event per latest value,
+    then one per change.
+    """
+
+    keepalive = 15.0
+
+    def do_GET(self):
+        latest_values = self.server.latest_values
+        if self.path == "/latest":
+            body = json.dumps({
+                "readings": [_value_json(v) for v in latest_values.values()]
+            }).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif self.path == "/events":
+            self._stream(latest_values)
+        else:
+            self.send_error(404)
+
+    def _stream(self, latest_values):
+        subscriber = latest_values.subscribe()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        try:
+            for latest in latest_values.values():
+                self._send_event(latest)
+            while True:
+                try:
+                    latest = subscriber.get(timeout=self.keepalive)
+                except queue.Empty:
+                    self.wfile.write(b": keepalive\n\n")
+                    self.wfile.flush()
+                    continue
+                if latest is None:
+                    return
+                self._send_event(latest)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            latest_values.unsubscribe(subscriber)
+
+    def _send_event(self, latest):
+        self.wfile.write(
+            b"data: " + json.dumps(_value_json(latest)).encode("utf-8")
+            + b"\n\n"
+        )
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_live_feed(latest_values, host="127.0.0.1", port=8081):
+    """Serve ``latest_values`` over HTTP/SSE from a daemon thread."""
+    server = ThreadingHTTPServer((host, port), LiveFeedHandler)
+    server.daemon_threads = True
+    server.latest_values = latest_values
+    threading.Thread(
+        target=server.serve_forever, name="mqtt-data-logger-live-feed",
+        daemon=True,
+    ).start()
+    return server
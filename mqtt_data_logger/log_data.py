@@ -6,22 +6,373 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import threading
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timezone
+from time import perf_counter
+
+from sqlalchemy import insert, select
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
+
+from mqtt_data_logger.metrics import (
+    BATCH_SIZE,
+    COMMIT_SECONDS,
+    DUPLICATE_PACKETS,
+    DUPLICATE_READINGS,
+    ERRORS,
+    PACKETS_STORED,
+    READINGS_STORED,
+)
+from mqtt_data_logger.query import query_readings
+from mqtt_data_logger.rollups import update_rollups
 from mqtt_data_logger.sensor_data_models import (
     Topic,
     Sensor,
     Measurement,
+    Label,
     SensorMeasurement,
 )
 
 
+# what ``update_rollups`` reads of each inserted reading
+ROLLUP_COLUMNS = [
+    SensorMeasurement.sensor_num_id,
+    SensorMeasurement.measurement_num_id,
+    SensorMeasurement.time,
+    SensorMeasurement.value,
+]
+
+
+# A parsed mqtt packet waiting to be written, ``received_at`` is the
+# ``time.time()`` at which the callback saw it. ``key`` identifies the
+# packet among those of its sensor (its sequence number or device time),
+# None if it carried neither. ``sent_at`` is the device time of the packet
+# and ``time`` the time a ``SensorClocks`` assigned its readings, see
+# ``packet_time``.
+SensorPacket = namedtuple(
+    "SensorPacket",
+    ["topic", "sensor", "measurements", "received_at", "key", "sent_at",
+     "time"],
+    defaults=(None, None, None),
+)
+
+
+def packet_time(packet):
+    """
+    Return the unix time of the readings of ``packet``: its ``time``, else
+    the device time it was sent at, else the time it was received.
+    """
+    if packet.time is not None:
+        return packet.time
+    if packet.sent_at is not None:
+        return packet.sent_at
+    return packet.received_at
+
+
+def utc_datetime(timestamp):
+    """Convert a unix ``timestamp`` to the naive UTC datetime sqlite stores."""
+    return datetime.fromtimestamp(timestamp, timezone.utc).replace(tzinfo=None)
+
+
+class DimensionCache:
+    """
+    In-process cache of topic, sensor, measurement and label names to ids.
+
+    The dimension tables almost never change, so once a name has been seen
+    its ``*_num_id`` is served from memory and the ingest path issues no
+    SELECTs for it. A miss looks the name up and inserts it if needed,
+    inside a savepoint so a concurrent writer inserting the same name only
+    costs a second lookup.
+
+    Ids inserted in the current transaction are held back as pending until
+    ``commit_pending`` is called, ``discard_pending`` forgets them again
+    after a rollback so the cache never points at rows that do not exist.
+
+    Methods:
+    - warm(session): Loads every existing dimension row.
+    - topic_id(session, topic): Returns the topic_num_id for a topic.
+    - sensor_id(session, sensor): Returns the sensor_num_id for a sensor.
+    - measurement_id(session, measurement): Returns the measurement_num_id.
+    - label_id(session, label): Returns the label_num_id, None for "".
+    - missing(dimension, values): Returns the values not cached yet.
+    - add(dimension, ids): Caches ids the caller resolved itself.
+    - commit_pending(): Keeps ids inserted in the committed transaction.
+    - discard_pending(): Forgets ids inserted in a rolled back transaction.
+    - clear(): Empties the cache.
+    """
+
+    _dimensions = {
+        "topic": (Topic, Topic.topic, Topic.topic_num_id),
+        "sensor": (Sensor, Sensor.sensor_id, Sensor.sensor_num_id),
+        "measurement": (
+            Measurement,
+            Measurement.measurement,
+            Measurement.measurement_num_id,
+        ),
+        "label": (Label, Label.label, Label.label_num_id),
+    }
+
+    def __init__(self):
+        self._ids = {dimension: {} for dimension in self._dimensions}
+        self._pending = []
+        self.hits = 0
+        self.misses = 0
+
+    def warm(self, session):
+        """Load every existing topic, sensor and measurement id."""
+        for dimension, (model, name, num_id) in self._dimensions.items():
+            self._ids[dimension].update(
+                session.execute(select(name, num_id)).all()
+            )
+        return self
+
+    def topic_id(self, session, topic):
+        """Return the topic_num_id of ``topic``, inserting it if needed."""
+        return self._resolve(session, "topic", topic)
+
+    def sensor_id(self, session, sensor):
+        """Return the sensor_num_id of ``sensor``, inserting it if needed."""
+        return self._resolve(session, "sensor", sensor)
+
+    def measurement_id(self, session, measurement):
+        """Return the id of ``measurement``, inserting it if needed."""
+        return self._resolve(session, "measurement", measurement)
+
+    def label_id(self, session, label):
+        """Return the label_num_id of ``label``, None if it is empty."""
+        if not label:
+            return None
+        return self._resolve(session, "label", label)
+
+    def missing(self, dimension, values):
+        """Return the ``values`` of ``dimension`` that are not cached."""
+        ids = self._ids[dimension]
+        return sorted({value for value in values if value not in ids})
+
+    def add(self, dimension, ids):
+        """
+        Cache ``ids`` (name to num_id) the caller resolved in bulk.
+
+        They are pending like the ids the cache inserts itself, since
+        some may have been inserted in the current transaction.
+        """
+        self._ids[dimension].update(ids)
+        self._pending.extend((dimension, value) for value in ids)
+
+    def commit_pending(self):
+        """Keep the ids inserted since the last commit."""
+        self._pending.clear()
+
+    def discard_pending(self):
+        """Forget the ids inserted since the last commit."""
+        for dimension, value in self._pending:
+            self._ids[dimension].pop(value, None)
+        self._pending.clear()
+
+    def clear(self):
+        """Forget every cached id."""
+        for ids in self._ids.values():
+            ids.clear()
+        self._pending.clear()
+
+    def _resolve(self, session, dimension, value):
+        ids = self._ids[dimension]
+        try:
+            num_id = ids[value]
+        except KeyError:
+            pass
+        else:
+            self.hits += 1
+            return num_id
+
+        self.misses += 1
+        model, name, pk = self._dimensions[dimension]
+        num_id = session.execute(
+            select(pk).where(name == value)
+        ).scalar_one_or_none()
+        if num_id is None:
+            try:
+                with session.begin_nested():
+                    num_id = session.execute(
+                        insert(model).values({name.key: value}).returning(pk)
+                    ).scalar_one()
+            except IntegrityError:
+                # someone else inserted it between our select and insert
+                num_id = session.execute(
+                    select(pk).where(name == value)
+                ).scalar_one()
+            else:
+                self._pending.append((dimension, value))
+        ids[value] = num_id
+        return num_id
+
+
+class DuplicateFilter:
+    """
+    The keys of the most recently seen packets, to drop redeliveries.
+
+    With QoS 1 a broker resends every packet it has no acknowledgement
+    for after a reconnect. Checking the sensor, key and measurement names
+    of each packet against the last ``capacity`` ones drops those before
+    they are queued, without a round trip to the database; the unique
+    ``(sensor, measurement, packet_key)`` index catches what has been
+    forgotten, e.g. after a restart. The filter is exact, a false positive
+    would drop a real reading: packets a sensor sends on several topics
+    at the same device time share a key but not their measurements.
+    Packets without a key always pass.
+
+    Attributes:
+    - capacity (int): Keys remembered, the least recently seen go first.
+    - duplicates (int): Packets dropped.
+
+    Methods:
+    - seen(packet): Returns True for a duplicate, remembers it otherwise.
+    - clear(): Forgets every key.
+    """
+
+    def __init__(self, capacity=100_000):
+        self.capacity = capacity
+        self.duplicates = 0
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def seen(self, packet):
+        """Return True if ``packet`` was seen already."""
+        if packet.key is None:
+            return False
+        key = (packet.sensor, packet.key, tuple(sorted(packet.measurements)))
+        with self._lock:
+            if key in self._keys:
+                self._keys.move_to_end(key)
+                self.duplicates += 1
+                DUPLICATE_PACKETS.inc()
+                return True
+            self._keys[key] = None
+            if len(self._keys) > self.capacity:
+                self._keys.popitem(last=False)
+        return False
+
+    def clear(self):
+        with self._lock:
+            self._keys.clear()
+
+
+def _readings_insert(session):
+    """
+    Return the insert of readings for the database of ``session``.
+
+    Readings whose packet_key is stored already are skipped instead of
+    failing the transaction.
+    """
+    table = SensorMeasurement.__table__
+    dialect = session.get_bind().dialect.name
+    if dialect == "sqlite":
+        return sqlite_insert(table).on_conflict_do_nothing()
+    if dialect == "postgresql":
+        return postgresql_insert(table).on_conflict_do_nothing()
+    return insert(table)
+
+
+def commit_session(session):
+    """Commit ``session``, timing it in ``COMMIT_SECONDS``."""
+    started = perf_counter()
+    session.commit()
+    COMMIT_SECONDS.observe(perf_counter() - started)
+
+
+def count_stored(packets, readings, duplicates=0):
+    """Count stored packets and readings, without the duplicates skipped."""
+    PACKETS_STORED.inc(packets)
+    READINGS_STORED.inc(readings - duplicates)
+    if duplicates:
+        DUPLICATE_READINGS.inc(duplicates)
+
+
+def split_value(value):
+    """
+    Split a ``(label, number)`` reading into ``(number, label)``; a string
+    reading is a label without a number.
+    """
+    if isinstance(value, list) | isinstance(value, tuple):
+        return value[1], value[0]
+    if isinstance(value, str):
+        return None, value
+    return value, ""
+
+
+def _add_cached_reading_record(
+    session, cache, topic, sensor, measurements, recorded_at=None,
+    packet_key=None,
+):
+    """
+    Write one packet with Core inserts using ids from ``cache``, returns
+    the number of readings skipped as duplicates.
+    """
+    topic_num_id = cache.topic_id(session, topic)
+    sensor_num_id = cache.sensor_id(session, sensor)
+    statement = _readings_insert(session)
+
+    duplicates = 0
+    for measurement, value in measurements.items():
+        value, str_value = split_value(value)
+        measurement_num_id = cache.measurement_id(session, measurement)
+
+        reading = {
+            "topic_num_id": topic_num_id,
+            "sensor_num_id": sensor_num_id,
+            "measurement_num_id": measurement_num_id,
+            "value": value,
+            "label_num_id": cache.label_id(session, str_value),
+            "packet_key": packet_key,
+        }
+        if recorded_at is not None:
+            reading["time"] = recorded_at
+        if session.execute(statement.values(reading)).rowcount == 0:
+            duplicates += 1
+    return duplicates
+
+
 # DONE: add multiple sensor measurements at once
 def add_sensors_reading_record(
     session,
     topic: str = "sensor_data",
     sensor: str = "env",
     measurements: dict = {"temp": 25.0, "humidity": 78.3},
+    commit: bool = True,
+    cache: DimensionCache = None,
+    recorded_at: datetime = None,
+    packet_key: int = None,
 ):
-    """Add a new measurement record to the database."""
+    """Add a new measurement record to the database.
+
+    Pass ``commit=False`` to leave the records pending in the session so
+    several packets can share a single transaction. With a ``cache`` the
+    topic, sensor and measurement ids come from memory instead of a query
+    per packet. ``recorded_at`` is stored as the reading time, the
+    database clock is used when it is None. Readings of a ``packet_key``
+    that is stored already are skipped; returns how many were.
+    """
+    if cache is not None:
+        try:
+            duplicates = _add_cached_reading_record(
+                session, cache, topic, sensor, measurements, recorded_at,
+                packet_key,
+            )
+            if commit:
+                commit_session(session)
+        except Exception:
+            if commit:
+                session.rollback()
+                cache.discard_pending()
+                ERRORS.labels("write").inc()
+            raise
+        if commit:
+            cache.commit_pending()
+            count_stored(1, len(measurements), duplicates)
+        return duplicates
+
     # create instance of SensorMeasurement
     target_topic = session.query(Topic).filter_by(topic=topic).one_or_none()
     if target_topic is None:
@@ -35,12 +386,9 @@ def add_sensors_reading_record(
 
     # time = func.now(timezone=True)
 
+    duplicates = 0
     for measurement, value in measurements.items():
-        if isinstance(value, list) | isinstance(value, tuple):
-            str_value = value[0]
-            value = value[1]
-        else:
-            str_value = ""
+        value, str_value = split_value(value)
 
         target_measurement = (
             session.query(Measurement)
@@ -51,37 +399,170 @@ def add_sensors_reading_record(
             target_measurement = Measurement(measurement=measurement)
             session.add(target_measurement)
 
+        if packet_key is not None and session.query(
+            SensorMeasurement.sensor_measurement_num_id
+        ).filter_by(
+            sensor=sensor_id,
+            measurement=target_measurement,
+            packet_key=packet_key,
+        ).first() is not None:
+            duplicates += 1
+            continue
+
+        label = None
+        if str_value:
+            label = session.query(Label).filter_by(
+                label=str_value
+            ).one_or_none()
+            if label is None:
+                label = Label(label=str_value)
+                session.add(label)
+
         measurement_record = SensorMeasurement(
-            topic=[target_topic],
-            sensor=[sensor_id],
-            measurement=[target_measurement],
+            topic=target_topic,
+            sensor=sensor_id,
+            measurement=target_measurement,
             value=value,
-            str_value=str_value,
+            label=label,
+            packet_key=packet_key,
         )
+        if recorded_at is not None:
+            measurement_record.time = recorded_at
         session.add(measurement_record)
 
-    session.commit()
+    if commit:
+        commit_session(session)
+        count_stored(1, len(measurements), duplicates)
+    return duplicates
+
+
+def add_sensors_reading_records(session, packets, cache=None):
+    """Add a batch of ``SensorPacket`` records in a single transaction.
 
+    Readings are stamped with the ``packet_time`` of their packet, so the
+    time a packet waited in a queue does not shift it.
+    """
+    duplicates = 0
+    try:
+        for packet in packets:
+            duplicates += add_sensors_reading_record(
+                session=session,
+                topic=packet.topic,
+                sensor=packet.sensor,
+                measurements=packet.measurements,
+                commit=False,
+                cache=cache,
+                recorded_at=utc_datetime(packet_time(packet)),
+                packet_key=packet.key,
+            )
+        commit_session(session)
+    except Exception:
+        session.rollback()
+        if cache is not None:
+            cache.discard_pending()
+        ERRORS.labels("write").inc()
+        raise
+    if cache is not None:
+        cache.commit_pending()
+    BATCH_SIZE.observe(len(packets))
+    count_stored(
+        len(packets),
+        sum(len(packet.measurements) for packet in packets),
+        duplicates,
+    )
 
-def logged(session, number_of_records=25, sensor=None, measurement=None):
-    """Get the latest sensor reading."""
-    records = session.query(SensorMeasurement)
-    if records is None:
+
+def add_sensors_reading_records_bulk(
+    session, packets, cache=None, rollups=False, before_commit=None
+):
+    """Add a batch of ``SensorPacket`` records with Core ``executemany``.
+
+    Produces the same rows as ``add_sensors_reading_records`` but skips the
+    ORM unit of work: ids are resolved through ``cache`` up front and the
+    whole batch goes in with a single multi-row insert. Readings are stamped
+    with the ``packet_time`` of their packet. With ``rollups`` the
+    batch is also folded into the rollup tables in the same transaction.
+    ``before_commit(session)`` runs last in the transaction, e.g. to record
+    how far a spool has been replayed atomically with the readings.
+    Readings of a packet_key that is stored already are skipped, and left
+    out of the rollups.
+    """
+    if cache is None:
+        cache = DimensionCache()
+
+    readings = []
+    stored = 0
+    try:
+        for packet in packets:
+            topic_num_id = cache.topic_id(session, packet.topic)
+            sensor_num_id = cache.sensor_id(session, packet.sensor)
+            recorded_at = utc_datetime(packet_time(packet))
+            for measurement, value in packet.measurements.items():
+                value, str_value = split_value(value)
+                readings.append({
+                    "time": recorded_at,
+                    "topic_num_id": topic_num_id,
+                    "sensor_num_id": sensor_num_id,
+                    "measurement_num_id": cache.measurement_id(
+                        session, measurement
+                    ),
+                    "value": value,
+                    "label_num_id": cache.label_id(session, str_value),
+                    "packet_key": packet.key,
+                })
+
+        if readings:
+            statement = _readings_insert(session)
+            if rollups:
+                # the rows actually inserted, without the duplicates
+                inserted = session.execute(
+                    statement.returning(*ROLLUP_COLUMNS), readings
+                ).mappings().all()
+                update_rollups(session, inserted)
+                stored = len(inserted)
+            else:
+                stored = session.execute(statement, readings).rowcount
+        if before_commit is not None:
+            before_commit(session)
+        commit_session(session)
+    except Exception:
+        session.rollback()
+        cache.discard_pending()
+        ERRORS.labels("write").inc()
+        raise
+    cache.commit_pending()
+    BATCH_SIZE.observe(len(packets))
+    count_stored(len(packets), len(readings), len(readings) - stored)
+
+
+def logged(
+    session, number_of_records=25, sensor=None, measurement=None, topic=None
+):
+    """Print and return the latest readings, newest first.
+
+    Optionally only readings of one ``sensor``, ``measurement`` or
+    ``topic``. Readings are ``Reading`` tuples from ``query_readings``.
+    """
+    records = list(query_readings(
+        session,
+        sensor=sensor,
+        measurement=measurement,
+        topic=topic,
+        limit=number_of_records,
+        descending=True,
+    ))
+    if not records:
         print("No records in the database.")
-        return None
-    elif sensor is not None:
-        records = records.filter_by(sensor_id=sensor).one_or_none()
-    elif measurement is not None:
-        records = records.filter_by(measurement=measurement).one_or_none()
-    else:
-        records = records.order_by(SensorMeasurement.time.desc()) \
-                  .head(number_of_records)
+        return records
     for record in records:
-        print(record)
+        print(
+            "topic: {}, sensor: {}, time: {}, measurement_kind: {}, "
+            "measurement_value: {}".format(
+                record.topic,
+                record.sensor,
+                record.time.strftime("%Y-%m-%d %H:%M:%S"),
+                record.measurement,
+                record.str_value or record.value,
+            )
+        )
     return records
-
-# if __name__ == "__main__":
-    # __spec__ = None
-    # from mqtt_data_logger.util import start_session, test_path
-    # session = start_session(test_path)
-    # add_sensors_reading_record(session=session, measurements={"temp": 25.0, "humidity": 78.3})
\ No newline at end of file
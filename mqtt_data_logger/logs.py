@@ -0,0 +1,256 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, 4CSCC development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+from datetime import datetime, timezone
+
+
+LEVELS = ["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"]
+FORMATS = ["text", "json"]
+
+# Every module logs to a child of this logger.
+logger = logging.getLogger("mqtt_data_logger")
+
+# Raw payloads go to their own logger, only enabled by --log-payloads.
+payload_logger = logging.getLogger("mqtt_data_logger.payloads")
+
+TEXT_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+# attributes every LogRecord has, anything else came in through ``extra``
+_RECORD_ATTRIBUTES = frozenset(
+    vars(logging.LogRecord("", 0, "", 0, "", (), None))
+) | {"message", "asctime", "taskName"}
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats records as one JSON object per line.
+
+    Has the keys time (ISO UTC), level, logger and message, the fields
+    passed with ``extra`` and the traceback as exc_info, if any.
+    """
+
+    def format(self, record):
+        document = {
+            "time": datetime.fromtimestamp(
+                record.created, timezone.utc
+            ).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for name, value in vars(record).items():
+            if name not in _RECORD_ATTRIBUTES:
+                document[name] = value
+        if record.exc_info:
+            document["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(document, default=str)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    ``QueueHandler`` that leaves formatting to the listener thread.
+
+    The stock handler formats every record before queueing it, so the
+    thread that logs pays for it. The queue here never leaves the process,
+    so the record is queued as is and the message is only built by the
+    ``QueueListener`` that writes it.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class PayloadSampler:
+    """
+    Decides which payloads are logged.
+
+    Logs every ``every``-th payload, and of those at most ``rate`` per
+    second (a token bucket holding one second's worth, and at least one
+    payload so that a rate below 1 still logs), so a flood of messages
+    costs a counter increment each instead of a line of output.
+
+    Attributes:
+    - seen (int): Payloads offered.
+    - sampled (int): Payloads logged.
+    """
+
+    def __init__(self, every=1, rate=None, clock=time.monotonic):
+        if every < 1:
+            raise ValueError("every must be at least 1")
+        self.every = every
+        self.rate = rate
+        self.seen = 0
+        self.sampled = 0
+        self._clock = clock
+        self._capacity = None if rate is None else max(rate, 1)
+        self._tokens = self._capacity
+        self._refilled = clock()
+
+    def sample(self):
+        """Return True if the current payload should be logged."""
+        self.seen += 1
+        if self.seen % self.every:
+            return False
+        if self.rate is not None:
+            now = self._clock()
+            self._tokens = min(
+                self._capacity,
+                self._tokens + (now - self._refilled) * self.rate,
+            )
+            self._refilled = now
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+        self.sampled += 1
+        return True
+
+
+payload_sampler = PayloadSampler()
+
+
+def set_payload_sampler(sampler):
+    """Sample logged payloads with ``sampler``."""
+    global payload_sampler
+    payload_sampler = sampler
+
+
+def log_payload(topic, payload):
+    """
+    Log a received payload at DEBUG on ``payload_logger``, if sampled.
+
+    Costs one level check while payload logging is off.
+    """
+    if (
+        payload_logger.isEnabledFor(logging.DEBUG)
+        and payload_sampler.sample()
+    ):
+        if isinstance(payload, (bytes, bytearray)):
+            payload = payload.decode("utf-8", "replace")
+        payload_logger.debug(
+            "Topic: %s Message: %s", topic, payload, extra={"topic": topic}
+        )
+
+
+_listener = None
+
+
+def configure_logging(
+    level="INFO",
+    fmt="text",
+    log_file=None,
+    log_payloads=False,
+    payload_every=1,
+    payload_rate=None,
+):
+    """
+    Send the package's log records through a queue to stderr or a file.
+
+    Logging calls only put the record on a queue; a ``QueueListener``
+    thread formats and writes it. Replaces an earlier configuration.
+
+    Parameters:
+    - level (str): Lowest level logged.
+    - fmt (str): "text" lines or "json" objects.
+    - log_file (Path): Append to this file instead of writing to stderr.
+    - log_payloads (bool): Log received payloads at DEBUG.
+    - payload_every (int): Log every n-th payload only.
+    - payload_rate (float): Log at most this many payloads per second.
+
+    Returns:
+    QueueListener: Call ``stop_logging()`` to flush it on shutdown.
+    """
+    global _listener
+    stop_logging()
+
+    if log_file is None:
+        handler = logging.StreamHandler(sys.stderr)
+    else:
+        # reopens the file when logrotate moves it away
+        handler = logging.handlers.WatchedFileHandler(log_file)
+    if fmt == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+
+    records = queue.SimpleQueue()
+    for old in list(logger.handlers):
+        logger.removeHandler(old)
+    logger.addHandler(DeferredQueueHandler(records))
+    logger.setLevel(level)
+    logger.propagate = False
+    payload_logger.setLevel(
+        logging.DEBUG if log_payloads else logging.CRITICAL + 1
+    )
+    set_payload_sampler(PayloadSampler(payload_every, payload_rate))
+
+    _listener = logging.handlers.QueueListener(records, handler)
+    _listener.start()
+    return _listener
+
+
+def stop_logging():
+    """Write out queued records and stop the listener thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+    # records go back to the default handling
+    for handler in list(logger.handlers):
+        if isinstance(handler, DeferredQueueHandler):
+            logger.removeHandler(handler)
+    logger.propagate = True
+
+
+def add_logging_arguments(parser):
+    """Add the logging options of the logger commands to ``parser``."""
+    parser.add_argument(
+        "--log-level", choices=LEVELS, default="INFO",
+        help="lowest level of log records written",
+    )
+    parser.add_argument(
+        "--log-format", choices=FORMATS, default="text",
+        help="plain text lines or one JSON object per record",
+    )
+    parser.add_argument(
+        "--log-file", type=str,
+        help="append log records to this file instead of stderr",
+    )
+    parser.add_argument(
+        "--log-payloads", action="store_true",
+        help="log received payloads (sampled, see --log-payload-every and "
+             "--log-payload-rate)",
+    )
+    parser.add_argument(
+        "--log-payload-every", type=int, default=1, metavar="N",
+        help="log every N-th payload only",
+    )
+    parser.add_argument(
+        "--log-payload-rate", type=float, metavar="PER_SECOND",
+        help="log at most this many payloads per second",
+    )
+    return parser
+
+
+def logging_options(args):
+    """Keyword arguments of ``configure_logging`` from parsed ``args``."""
+    return {
+        "level": args.log_level,
+        "fmt": args.log_format,
+        "log_file": args.log_file,
+        "log_payloads": args.log_payloads,
+        "payload_every": args.log_payload_every,
+        "payload_rate": args.log_payload_rate,
+    }
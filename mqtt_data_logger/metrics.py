@@ -0,0 +1,337 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, 4CSCC development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(
+        '{}="{}"'.format(
+            name,
+            str(value)
+            .replace("\\", "\\\\")
+            .replace('"', '\\"')
+            .replace("\n", "\\n"),
+        )
+        for name, value in pairs
+    ) + "}"
+
+
+class Registry:
+    """The metrics rendered together on one ``/metrics`` page."""
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Return every metric in the Prometheus text format."""
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+# metrics of the logger, see the definitions at the end of the module
+REGISTRY = Registry()
+
+
+class _Metric:
+    """Base of the metric types, children per label values are cached."""
+
+    kind = None
+
+    def __init__(self, name, help, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def labels(self, *values):
+        """Return the child metric of one combination of label values."""
+        values = tuple(str(value) for value in values)
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(
+                    "{} takes labels {}".format(self.name, self.labelnames)
+                )
+            with self._lock:
+                child = self._children.setdefault(values, self._child())
+        return child
+
+    def _items(self):
+        with self._lock:
+            if not self.labelnames:
+                return [((), self)]
+            return sorted(self._children.items())
+
+
+class Counter(_Metric):
+    """
+    A value that only goes up, e.g. messages received.
+
+    ``inc`` takes an uncontended lock, a few hundred nanoseconds.
+    """
+
+    kind = "counter"
+
+    def __init__(self, name, help, labelnames=(), registry=REGISTRY):
+        super().__init__(name, help, labelnames, registry)
+        self.value = 0
+
+    def _child(self):
+        return Counter(self.name, self.help, registry=None)
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self):
+        return [
+            "{}{} {}".format(
+                self.name,
+                _format_labels(self.labelnames, values),
+                _format_value(metric.value),
+            )
+            for values, metric in self._items()
+        ]
+
+
+class Gauge(_Metric):
+    """
+    A value that goes up and down, e.g. a queue depth.
+
+    Either ``set`` by the code that knows it, or read from ``function``
+    when the metrics are rendered, which costs nothing in between.
+    """
+
+    kind = "gauge"
+
+    def __init__(
+        self, name, help, labelnames=(), registry=REGISTRY, function=None
+    ):
+        super().__init__(name, help, labelnames, registry)
+        self.value = 0
+        self.function = function
+
+    def _child(self):
+        return Gauge(self.name, self.help, registry=None)
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        """Read the value from ``function()``, None goes back to ``set``."""
+        self.function = function
+
+    def get(self):
+        if self.function is not None:
+            try:
+                return self.function()
+            except Exception:
+                return float("nan")
+        return self.value
+
+    def samples(self):
+        return [
+            "{}{} {}".format(
+                self.name,
+                _format_labels(self.labelnames, values),
+                _format_value(metric.get()),
+            )
+            for values, metric in self._items()
+        ]
+
+
+class Histogram(_Metric):
+    """
+    Counts of observations in cumulative buckets, with their sum.
+
+    Parameters:
+    - buckets (list): Upper bounds of the buckets, ascending; +Inf is
+      added.
+    """
+
+    kind = "histogram"
+
+    def __init__(
+        self, name, help, buckets, labelnames=(), registry=REGISTRY
+    ):
+        super().__init__(name, help, labelnames, registry)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def _child(self):
+        return Histogram(
+            self.name, self.help, self.buckets[:-1], registry=None
+        )
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def samples(self):
+        lines = []
+        for values, metric in self._items():
+            with metric._lock:
+                counts = list(metric.counts)
+                total, count = metric.sum, metric.count
+            cumulative = 0
+            for bound, bucket_count in zip(metric.buckets, counts):
+                cumulative += bucket_count
+                lines.append("{}_bucket{} {}".format(
+                    self.name,
+                    _format_labels(
+                        self.labelnames, values,
+                        [("le", _format_value(float(bound)))],
+                    ),
+                    cumulative,
+                ))
+            labels = _format_labels(self.labelnames, values)
+            lines.append(
+                f"{self.name}_sum{labels} {_format_value(float(total))}"
+            )
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+def file_size(db_fp):
+    """Return the size in bytes of a sqlite database and its WAL."""
+    return sum(
+        fp.stat().st_size
+        for fp in (Path(db_fp), Path(f"{db_fp}-wal"))
+        if fp.exists()
+    )
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Answers ``GET /metrics`` with the server's registry."""
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(registry=REGISTRY, host="127.0.0.1", port=9108):
+    """Serve ``registry`` on ``/metrics`` from a daemon thread."""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    server.registry = registry
+    threading.Thread(
+        target=server.serve_forever, name="mqtt-data-logger-metrics",
+        daemon=True,
+    ).start()
+    return server
+
+
+###############################################################################
+# logger metrics
+###############################################################################
+
+MESSAGES_RECEIVED = Counter(
+    "mqtt_logger_messages_received_total",
+    "sensor_data messages received from the broker",
+)
+MESSAGES_PARSED = Counter(
+    "mqtt_logger_messages_parsed_total",
+    "payloads decoded into valid sensor packets",
+)
+PACKETS_STORED = Counter(
+    "mqtt_logger_packets_stored_total",
+    "sensor packets committed to the database",
+)
+READINGS_STORED = Counter(
+    "mqtt_logger_readings_stored_total",
+    "readings (one per measurement) committed to the database",
+)
+DUPLICATE_PACKETS = Counter(
+    "mqtt_logger_duplicate_packets_total",
+    "redelivered packets dropped by the duplicate filter",
+)
+DUPLICATE_READINGS = Counter(
+    "mqtt_logger_duplicate_readings_total",
+    "readings not stored since their packet_key was stored already",
+)
+CLOCK_CORRECTIONS = Counter(
+    "mqtt_logger_clock_corrections_total",
+    "reading times of skewed, untrusted or out of order sensor clocks",
+    ["kind"],
+)
+ERRORS = Counter(
+    "mqtt_logger_errors_total",
+    "malformed packets, failed transactions and dropped packets",
+    ["kind"],
+)
+DECODE_SECONDS = Histogram(
+    "mqtt_logger_decode_seconds",
+    "time to decode, validate and munge one payload",
+    [1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 1e-2],
+)
+COMMIT_SECONDS = Histogram(
+    "mqtt_logger_commit_seconds",
+    "time to commit one transaction of readings",
+    [1e-4, 5e-4, 1e-3, 5e-3, 1e-2, 5e-2, 0.1, 0.5, 1.0, 5.0],
+)
+BATCH_SIZE = Histogram(
+    "mqtt_logger_batch_size",
+    "sensor packets written per transaction",
+    [1, 5, 10, 50, 100, 250, 500, 1000, 5000],
+)
+QUEUE_DEPTH = Gauge(
+    "mqtt_logger_queue_depth",
+    "packets waiting to be written",
+)
+DB_SIZE = Gauge(
+    "mqtt_logger_db_size_bytes",
+    "size of the database file and its WAL",
+)
@@ -0,0 +1,364 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, 4CSCC development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import argparse
+from pathlib import Path
+
+from sqlalchemy import (
+    Column,
+    Float,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    TIMESTAMP,
+    create_engine,
+    inspect,
+    select,
+    text,
+)
+from sqlalchemy.dialects.sqlite import insert
+
+from mqtt_data_logger.db import create_sqlite_engine
+from mqtt_data_logger.sensor_data_models import (
+    SCHEMA_VERSION,
+    Base,
+    Topic,
+    Sensor,
+    Measurement,
+    Label,
+    SensorMeasurement,
+)
+
+
+###############################################################################
+# version 1 tables, only read from
+###############################################################################
+
+legacy_metadata = MetaData()
+
+legacy_sensor_measurements = Table(
+    "sensor_measurements",
+    legacy_metadata,
+    Column("sensor_measurement_num_id", Integer, primary_key=True),
+    Column("time", TIMESTAMP(timezone=True)),
+    Column("value", Float),
+    Column("value_2", Float),
+    Column("str_value", String),
+)
+
+legacy_topic_sensor_measurement = Table(
+    "topic_sensor_measurement",
+    legacy_metadata,
+    Column("topic_num_id", Integer),
+    Column("sensor_measurement_num_id", Integer),
+)
+
+legacy_sensor_sensor_measurement = Table(
+    "sensor_sensor_measurement",
+    legacy_metadata,
+    Column("sensor_num_id", Integer),
+    Column("sensor_measurement_num_id", Integer),
+)
+
+legacy_measurement_kind_sensor_measurement = Table(
+    "measurement_kind_sensor_measurement",
+    legacy_metadata,
+    Column("measurement_num_id", Integer),
+    Column("sensor_measurement_num_id", Integer),
+)
+
+
+###############################################################################
+# version 2 table, only read from
+###############################################################################
+
+v2_metadata = MetaData()
+
+v2_sensor_measurements = Table(
+    "sensor_measurements",
+    v2_metadata,
+    Column("sensor_measurement_num_id", Integer, primary_key=True),
+    Column("topic_num_id", Integer),
+    Column("sensor_num_id", Integer),
+    Column("measurement_num_id", Integer),
+    Column("time", TIMESTAMP(timezone=True)),
+    Column("value", Float),
+    Column("value_2", Float),
+    Column("str_value", String),
+)
+
+# Progress is kept in the target database and updated in the same transaction
+# as each chunk, so an interrupted migration resumes where it stopped.
+migration_progress = Table(
+    "schema_migration_progress",
+    MetaData(),
+    Column("source", String, primary_key=True),
+    Column("last_sensor_measurement_num_id", Integer, nullable=False),
+    Column("migrated", Integer, nullable=False),
+)
+
+
+def schema_version(engine):
+    """Return the schema version of the database of ``engine``."""
+    inspector = inspect(engine)
+    if inspector.has_table(legacy_topic_sensor_measurement.name):
+        return 1
+    if not inspector.has_table(v2_sensor_measurements.name):
+        return SCHEMA_VERSION
+    columns = {
+        column["name"]
+        for column in inspector.get_columns(v2_sensor_measurements.name)
+    }
+    if "str_value" in columns:
+        return 2
+    if "packet_key" not in columns:
+        return 3
+    return SCHEMA_VERSION
+
+
+def is_legacy_schema(engine):
+    """Return True if ``engine`` holds a db older than SCHEMA_VERSION."""
+    return schema_version(engine) < SCHEMA_VERSION
+
+
+def add_packet_keys(engine):
+    """
+    Upgrade a version 3 database to version 4 in place.
+
+    The packet_key column is added empty, which SQLite does without
+    touching the readings, and its index is only as big as the readings
+    that have a key, none yet.
+    """
+    index, = [
+        index for index in SensorMeasurement.__table__.indexes
+        if index.name == "ux_sensor_measurements_packet_key"
+    ]
+    with engine.begin() as conn:
+        conn.execute(text(
+            "ALTER TABLE sensor_measurements ADD COLUMN packet_key BIGINT"
+        ))
+        index.create(conn)
+
+
+def _legacy_readings_query(after_id, chunk_size):
+    """Select the next chunk of version 1 readings with their dimension ids."""
+    readings = legacy_sensor_measurements
+    reading_id = readings.c.sensor_measurement_num_id
+    topics = legacy_topic_sensor_measurement
+    sensors = legacy_sensor_sensor_measurement
+    measurements = legacy_measurement_kind_sensor_measurement
+    return (
+        select(
+            reading_id,
+            topics.c.topic_num_id,
+            sensors.c.sensor_num_id,
+            measurements.c.measurement_num_id,
+            readings.c.time,
+            readings.c.value,
+            readings.c.value_2,
+            readings.c.str_value,
+        )
+        .join(topics, topics.c.sensor_measurement_num_id == reading_id)
+        .join(sensors, sensors.c.sensor_measurement_num_id == reading_id)
+        .join(
+            measurements,
+            measurements.c.sensor_measurement_num_id == reading_id,
+        )
+        .where(reading_id > after_id)
+        .order_by(reading_id)
+        .limit(chunk_size)
+    )
+
+
+def _v2_readings_query(after_id, chunk_size):
+    """Select the next chunk of version 2 readings."""
+    readings = v2_sensor_measurements
+    reading_id = readings.c.sensor_measurement_num_id
+    return (
+        select(readings)
+        .where(reading_id > after_id)
+        .order_by(reading_id)
+        .limit(chunk_size)
+    )
+
+
+def _label_ids(dst, rows):
+    """Return the label_num_id of every str_value in ``rows``."""
+    labels = sorted({row["str_value"] for row in rows if row["str_value"]})
+    if not labels:
+        return {}
+    dst.execute(
+        insert(Label).on_conflict_do_nothing(),
+        [{"label": label} for label in labels],
+    )
+    return dict(dst.execute(
+        select(Label.label, Label.label_num_id)
+        .where(Label.label.in_(labels))
+    ).all())
+
+
+def _current_rows(rows, label_ids):
+    """Turn version 1 or 2 reading rows into current ones."""
+    return [
+        {
+            "sensor_measurement_num_id": row["sensor_measurement_num_id"],
+            "topic_num_id": row["topic_num_id"],
+            "sensor_num_id": row["sensor_num_id"],
+            "measurement_num_id": row["measurement_num_id"],
+            "time": row["time"],
+            "value": row["value"],
+            "label_num_id": label_ids.get(row["str_value"]),
+        }
+        for row in rows
+    ]
+
+
+def _copy_dimensions(source, target):
+    """Copy topics, sensors and measurements, keeping their ids."""
+    with source.connect() as src, target.begin() as dst:
+        for model in (Topic, Sensor, Measurement):
+            table = model.__table__
+            rows = [dict(r._mapping) for r in src.execute(select(table))]
+            if rows:
+                dst.execute(insert(table).on_conflict_do_nothing(), rows)
+
+
+def migrate_sensor_data_db(source_fp, target_fp, chunk_size=5000):
+    """
+    Stream a version 1 or 2 database into a new current version database.
+
+    Readings are copied in ``chunk_size`` pieces ordered by id, so memory
+    use does not depend on the size of the source. Each chunk commits
+    together with the migration progress; running the migration again on
+    the same files picks up after the last committed chunk. String values
+    become ids into the labels table and the unused value_2 column is
+    dropped; the new file has no free pages, so it is also the smallest.
+
+    Parameters:
+    - source_fp (Path): The version 1 or 2 database to read.
+    - target_fp (Path): The database to write, created if missing.
+    - chunk_size (int): Readings copied per transaction.
+
+    Returns:
+    int: The number of readings migrated so far.
+    """
+    source = create_engine(f"sqlite:///{source_fp}")
+    target = create_sqlite_engine(target_fp)
+    try:
+        version = schema_version(source)
+        if version == 1:
+            readings_query = _legacy_readings_query
+        elif version == 2:
+            readings_query = _v2_readings_query
+        else:
+            raise ValueError(
+                "{} is not a version 1 or 2 sensor data database".format(
+                    source_fp
+                )
+            )
+        Base.metadata.create_all(target)
+        migration_progress.create(target, checkfirst=True)
+        _copy_dimensions(source, target)
+
+        key = str(Path(source_fp).resolve())
+        with target.connect() as dst:
+            progress = dst.execute(
+                select(
+                    migration_progress.c.last_sensor_measurement_num_id,
+                    migration_progress.c.migrated,
+                ).where(migration_progress.c.source == key)
+            ).one_or_none()
+        last_id, migrated = progress if progress is not None else (0, 0)
+
+        with source.connect() as src:
+            while True:
+                rows = [
+                    dict(r._mapping) for r in
+                    src.execute(readings_query(last_id, chunk_size))
+                ]
+                if not rows:
+                    break
+                last_id = rows[-1]["sensor_measurement_num_id"]
+                migrated += len(rows)
+                with target.begin() as dst:
+                    dst.execute(
+                        insert(SensorMeasurement.__table__)
+                        .on_conflict_do_nothing(),
+                        _current_rows(rows, _label_ids(dst, rows)),
+                    )
+                    dst.execute(
+                        insert(migration_progress)
+                        .values(
+                            source=key,
+                            last_sensor_measurement_num_id=last_id,
+                            migrated=migrated,
+                        )
+                        .on_conflict_do_update(
+                            index_elements=[migration_progress.c.source],
+                            set_={
+                                "last_sensor_measurement_num_id": last_id,
+                                "migrated": migrated,
+                            },
+                        )
+                    )
+                print(f"Migrated {migrated} readings (up to id {last_id})")
+        return migrated
+    finally:
+        source.dispose()
+        target.dispose()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="migrate_sensor_data_db",
+        description="Convert a version 1 or 2 sensor_data.db to the "
+                    "current schema. Safe to rerun, it resumes where it "
+                    "stopped. A version 3 database is upgraded in place.",
+    )
+    parser.add_argument("source", type=Path)
+    parser.add_argument(
+        "target", type=Path, nargs="?",
+        help=f"defaults to SOURCE with a .v{SCHEMA_VERSION}.db suffix",
+    )
+    parser.add_argument("--chunk-size", type=int, default=5000)
+    parser.add_argument(
+        "--replace", action="store_true",
+        help="when done, keep SOURCE as .v<N>.db, N its schema version, "
+             "and move TARGET into its place",
+    )
+    args = parser.parse_args(argv)
+    if not args.source.is_file():
+        parser.error(f"{args.source} does not exist")
+    target = args.target or args.source.with_suffix(
+        f".v{SCHEMA_VERSION}.db"
+    )
+    source = create_engine(f"sqlite:///{args.source}")
+    try:
+        version = schema_version(source)
+        if version == SCHEMA_VERSION:
+            parser.exit(message=(
+                f"{args.source} is at version {SCHEMA_VERSION} already\n"
+            ))
+        if version == 3:
+            add_packet_keys(source)
+            print(f"Upgraded {args.source} to version {SCHEMA_VERSION}")
+            return
+    finally:
+        source.dispose()
+
+    migrate_sensor_data_db(args.source, target, args.chunk_size)
+    if args.replace:
+        backup = args.source.with_suffix(f".v{version}.db")
+        args.source.rename(backup)
+        target.rename(args.source)
+        print(f"Moved {args.source} to {backup}, {target} to {args.source}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,11 @@
 # functions to get cardinal direction and beaufort from wind speed and direction
+from bisect import bisect_right
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 master_map = {
     (0, 11.25): ('N', 0),
     (11.25, 33.75): ('NNE', 22.5),
@@ -19,6 +26,12 @@ master_map = {
     (348.75, 360): ('N', 0)
     }
 
+# sorted lower bounds of master_map, for bisecting instead of scanning
+cardinal_keys = sorted(master_map)
+cardinal_breaks = [low for low, high in cardinal_keys]
+cardinal_labels = [master_map[key][0] for key in cardinal_keys]
+cardinal_degrees = [master_map[key][1] for key in cardinal_keys]
+
 
 # TODO: fail gracefully on bad wind angle
 def lookup_cardinal(angle):
@@ -26,9 +39,7 @@ def lookup_cardinal(angle):
         raise ValueError(
             'Provided angle: ({}) not between 0 and 360'.format(angle))
 
-    for cardinal_breaks in master_map.keys():
-        if cardinal_breaks[0] <= angle < cardinal_breaks[1]:
-            return master_map[cardinal_breaks]
+    return master_map[cardinal_keys[bisect_right(cardinal_breaks, angle) - 1]]
 
 
 beaufort_scale = [0, 1, 5, 11, 19, 28, 38, 49, 61, 74, 88, 102, 117, 999] 
@@ -54,6 +65,9 @@ beaufort_map = {
     (118, 999): 'Hurricane Force'
     }
 
+# lower bounds of beaufort_map, index i is beaufort class i
+beaufort_breaks = sorted(low for low, high in beaufort_map)
+
 
 def lookup_beaufort(speed):
     if not isinstance(speed, (int, float)) or isinstance(speed, bool):
@@ -64,6 +78,47 @@ def lookup_beaufort(speed):
         raise ValueError(
             'Provided speed: ({}) not expected range: (0, 999)'.format(speed))
 
-    for beaufort_breaks in beaufort_map.keys():
-        if beaufort_breaks[0] <= speed < beaufort_breaks[1]:
-            return (beaufort_map[beaufort_breaks], speed)
\ No newline at end of file
+    return (beaufort_labels[beaufort_class(speed)], speed)
+
+
+def beaufort_class(speed):
+    return bisect_right(beaufort_breaks, speed) - 1
+
+
+# array versions for reprocessing many readings at once, they take a numpy
+# array (vectorized with np.searchsorted) or any sequence (bisect per item)
+def _classify(values, breaks, low, high, name):
+    if np is not None and isinstance(values, np.ndarray):
+        if values.size and not (
+            (values >= low).all() and (values < high).all()
+        ):
+            raise ValueError(
+                '{} not all between {} and {}'.format(name, low, high))
+        return np.searchsorted(breaks, values, side='right') - 1
+
+    classes = []
+    for value in values:
+        if not low <= value < high:
+            raise ValueError(
+                'Provided {}: ({}) not between {} and {}'.format(
+                    name, value, low, high))
+        classes.append(bisect_right(breaks, value) - 1)
+    return classes
+
+
+def _take(table, classes):
+    if np is not None and isinstance(classes, np.ndarray):
+        return np.asarray(table)[classes]
+    return [table[c] for c in classes]
+
+
+def lookup_cardinals(angles):
+    """Return the cardinal labels and degrees of many wind angles."""
+    classes = _classify(angles, cardinal_breaks, 0, 360, 'angles')
+    return _take(cardinal_labels, classes), _take(cardinal_degrees, classes)
+
+
+def lookup_beauforts(speeds):
+    """Return the beaufort labels and classes (0-12) of many wind speeds."""
+    classes = _classify(speeds, beaufort_breaks, 0, 999, 'speeds')
+    return _take(beaufort_labels, classes), classes
\ No newline at end of file
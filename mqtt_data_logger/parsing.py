@@ -0,0 +1,343 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, 4CSCC development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import json
+import threading
+import time
+from time import perf_counter
+from collections import deque
+from collections.abc import Mapping
+
+from paho.mqtt.client import topic_matches_sub
+
+from mqtt_data_logger.log_data import SensorPacket
+from mqtt_data_logger.metrics import (
+    DECODE_SECONDS,
+    ERRORS,
+    MESSAGES_PARSED,
+)
+from mqtt_data_logger.munge_wind import lookup_beaufort, lookup_cardinal
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+
+###############################################################################
+# json decoders
+###############################################################################
+
+# name and loads function of every available decoder, fastest first; each
+# takes the raw bytes payload, no ``.decode()`` needed
+DECODERS = {}
+if msgspec is not None:
+    DECODERS["msgspec"] = msgspec.json.decode
+if orjson is not None:
+    DECODERS["orjson"] = orjson.loads
+DECODERS["json"] = json.loads
+
+DECODER_CHOICES = ["auto", "msgspec", "orjson", "json"]
+
+
+def get_decoder(name="auto"):
+    """Return the ``loads`` function of decoder ``name``, "auto" = fastest."""
+    if name == "auto":
+        return next(iter(DECODERS.values()))
+    try:
+        return DECODERS[name]
+    except KeyError:
+        raise ValueError(
+            "JSON decoder {} is not installed, available: {}".format(
+                name, ", ".join(DECODERS)
+            )
+        ) from None
+
+
+###############################################################################
+# packets
+###############################################################################
+
+class MalformedPacket(ValueError):
+    """A payload that is not a valid sensor packet."""
+
+
+class Measurements(Mapping):
+    """
+    Read-only mapping of measurement names to values.
+
+    Holds two tuples instead of a dict, which is smaller and cheaper to
+    build for the handful of measurements of a packet. Supports everything
+    the writers use: ``items()``, lookup, ``in`` and ``len``.
+    """
+
+    __slots__ = ("names", "values")
+
+    def __init__(self, names, values):
+        self.names = tuple(names)
+        self.values = tuple(values)
+
+    def __getitem__(self, name):
+        try:
+            return self.values[self.names.index(name)]
+        except ValueError:
+            raise KeyError(name) from None
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def items(self):
+        return zip(self.names, self.values)
+
+    def __repr__(self):
+        return "Measurements({})".format(dict(self.items()))
+
+
+# kinds of measurement value
+NUMBER = "number"
+STRING = "string"
+LABEL = "label"  # a ``[label, number]`` pair, e.g. from wind munging
+
+
+def value_kind(value):
+    """Return the kind of a measurement value, None if it is not valid."""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return NUMBER
+    if isinstance(value, str):
+        return STRING
+    if (
+        isinstance(value, (list, tuple))
+        and len(value) == 2
+        and isinstance(value[0], str)
+        and value_kind(value[1]) == NUMBER
+    ):
+        return LABEL
+    return None
+
+
+def device_time(packet):
+    """Return the ``"time"`` (unix seconds) of a decoded packet, or None."""
+    sent_at = packet.get("time")
+    # the bound keeps the microseconds of a packet_key in 64 bits
+    if sent_at is not None and (
+        value_kind(sent_at) != NUMBER or not 0 <= sent_at < 1e11
+    ):
+        raise MalformedPacket(f"time must be unix seconds: {sent_at!r}")
+    return sent_at
+
+
+def packet_key(packet, sent_at=None):
+    """
+    Return the key of a decoded packet, None if it has none.
+
+    A packet may carry a ``"seq"`` number, counting up per sensor, or the
+    ``"time"`` its sensor sent it at (``sent_at``). A redelivered packet
+    has the same key, the sequence number if there is one, else the time
+    in microseconds.
+    """
+    seq = packet.get("seq")
+    if seq is not None:
+        if isinstance(seq, bool) or not isinstance(seq, int) or not (
+            0 <= seq < 2**63
+        ):
+            raise MalformedPacket(f"seq must be a 64 bit count: {seq!r}")
+        return seq
+    if sent_at is not None:
+        return round(sent_at * 1_000_000)
+    return None
+
+
+class PacketSchema:
+    """
+    What the packets of a topic must look like.
+
+    Every packet is ``{"sensor": str, "data": {name: value}}`` where a value
+    is a number, a string or a ``[label, number]`` pair, optionally with a
+    ``"seq"`` or ``"time"``, see ``packet_key``. A schema can also require
+    measurements and pin the kind of a measurement.
+
+    Parameters:
+    - required (iterable): Measurement names every packet must carry.
+    - kinds (dict): Measurement name to NUMBER, STRING or LABEL.
+    - allow_extra (bool): Accept measurements not listed in ``kinds``.
+    """
+
+    def __init__(self, required=(), kinds=None, allow_extra=True):
+        self.required = frozenset(required)
+        self.kinds = dict(kinds or {})
+        self.allow_extra = allow_extra
+
+    def check(self, data):
+        """Raise ``MalformedPacket`` if ``data`` does not fit the schema."""
+        missing = self.required.difference(data)
+        if missing:
+            raise MalformedPacket(
+                "missing measurements: {}".format(", ".join(sorted(missing)))
+            )
+        for name, value in data.items():
+            kind = value_kind(value)
+            if kind is None:
+                raise MalformedPacket(
+                    "{} has an invalid value: {!r}".format(name, value)
+                )
+            expected = self.kinds.get(name)
+            if expected is None:
+                if not self.allow_extra:
+                    raise MalformedPacket(f"unexpected measurement: {name}")
+            elif kind != expected:
+                raise MalformedPacket(
+                    "{} should be a {}, not {!r}".format(name, expected, value)
+                )
+
+
+# topic filter and schema, the first matching filter applies; by default
+# every topic gets the generic packet checks
+DEFAULT_SCHEMAS = [
+    ("#", PacketSchema()),
+]
+
+
+def munge_wind(names, values):
+    """Derive beaufort and cardinal direction from raw wind measurements."""
+    if "wind_speed" in names:
+        index = names.index("wind_speed")
+        names[index] = "wind_speed_beaufort"
+        values[index] = lookup_beaufort(values[index])
+    if "wind_direction" in names:
+        names.append("cardinal_direction")
+        values.append(
+            lookup_cardinal(values[names.index("wind_direction")])
+        )
+
+
+class PacketParser:
+    """
+    Turns raw mqtt payloads into ``SensorPacket``s.
+
+    Decodes the bytes payload with the fastest available JSON library,
+    checks it against the schema of its topic and applies the wind
+    munging; measurements are returned as a ``Measurements`` mapping.
+
+    Parameters:
+    - schemas (list): ``(topic filter, PacketSchema)`` pairs.
+    - decoder (str): "auto", "msgspec", "orjson" or "json".
+
+    Methods:
+    - parse(topic, payload, received_at): Returns a ``SensorPacket`` or
+      raises ``MalformedPacket``.
+    - schema_for(topic): Returns the schema that applies to a topic.
+    """
+
+    def __init__(self, schemas=None, decoder="auto"):
+        self.schemas = list(DEFAULT_SCHEMAS if schemas is None else schemas)
+        self.decoder = decoder
+        self._loads = get_decoder(decoder)
+        self._topic_schemas = {}
+
+    def schema_for(self, topic):
+        """Return the schema of ``topic``, None if no filter matches."""
+        try:
+            return self._topic_schemas[topic]
+        except KeyError:
+            pass
+        schema = next(
+            (s for sub, s in self.schemas if topic_matches_sub(sub, topic)),
+            None,
+        )
+        self._topic_schemas[topic] = schema
+        return schema
+
+    def parse(self, topic, payload, received_at=None):
+        """Decode, validate and munge one payload."""
+        started = perf_counter()
+        try:
+            packet = self._parse(topic, payload, received_at)
+        except MalformedPacket:
+            ERRORS.labels("malformed").inc()
+            raise
+        DECODE_SECONDS.observe(perf_counter() - started)
+        MESSAGES_PARSED.inc()
+        return packet
+
+    def _parse(self, topic, payload, received_at):
+        if received_at is None:
+            received_at = time.time()
+        try:
+            packet = self._loads(payload)
+        except Exception as e:
+            raise MalformedPacket(f"invalid JSON: {e}") from None
+        if not isinstance(packet, dict):
+            raise MalformedPacket("packet is not a JSON object")
+        sensor = packet.get("sensor")
+        if not isinstance(sensor, str) or not sensor:
+            raise MalformedPacket("sensor must be a non-empty string")
+        data = packet.get("data")
+        if not isinstance(data, dict) or not data:
+            raise MalformedPacket("data must be a non-empty object")
+
+        schema = self.schema_for(topic)
+        if schema is None:
+            raise MalformedPacket(f"no packet schema for topic {topic}")
+        schema.check(data)
+        sent_at = device_time(packet)
+        key = packet_key(packet, sent_at)
+
+        names = list(data)
+        values = list(data.values())
+        try:
+            munge_wind(names, values)
+        except (TypeError, ValueError) as e:
+            raise MalformedPacket(str(e)) from None
+        return SensorPacket(
+            topic, sensor, Measurements(names, values), received_at, key,
+            sent_at,
+        )
+
+
+class DeadLetters:
+    """
+    Counts malformed packets by reason and keeps the latest few.
+
+    Attributes:
+    - count (int): Malformed packets seen.
+    - reasons (dict): Reason to number of packets.
+    - latest (deque): ``(topic, reason, payload)`` of the newest packets,
+      payloads cut to ``max_payload`` bytes.
+    """
+
+    def __init__(self, keep=100, max_payload=256):
+        self.count = 0
+        self.reasons = {}
+        self.latest = deque(maxlen=keep)
+        self.max_payload = max_payload
+        self._lock = threading.Lock()
+
+    def record(self, topic, payload, error):
+        reason = str(error).split(":", 1)[0]
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8", "replace")
+        with self._lock:
+            self.count += 1
+            self.reasons[reason] = self.reasons.get(reason, 0) + 1
+            self.latest.append(
+                (topic, str(error), bytes(payload[:self.max_payload]))
+            )
+
+    def stats(self):
+        with self._lock:
+            return {"dead_letters": self.count, "reasons": dict(self.reasons)}
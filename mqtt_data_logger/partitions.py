@@ -0,0 +1,269 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, 4CSCC development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import shutil
+import sqlite3
+from collections import OrderedDict
+from datetime import datetime
+from pathlib import Path
+
+from sqlalchemy.orm import sessionmaker
+
+from mqtt_data_logger.db import create_sqlite_engine, DEFAULT_SQLITE_PROFILE
+from mqtt_data_logger.log_data import (
+    DimensionCache,
+    add_sensors_reading_records_bulk,
+    packet_time,
+    utc_datetime,
+)
+from mqtt_data_logger.metrics import file_size
+from mqtt_data_logger.query import query_readings
+from mqtt_data_logger.sensor_data_models import Base
+
+
+# files SQLite keeps next to a database in WAL mode
+WAL_SUFFIXES = ("-wal", "-shm")
+
+# strftime format of the partition key, by granularity
+GRANULARITIES = {
+    "day": "%Y-%m-%d",
+    "month": "%Y-%m",
+}
+
+
+class PartitionedStorage:
+    """
+    Stores readings in one SQLite file per day or per month.
+
+    A reading goes to the partition of its time, so each file stays small
+    and its indexes shallow. Dropping or archiving old data is a file move
+    instead of a long locking DELETE, and a query for a time range only
+    opens the partitions that overlap it.
+
+    Files are named ``<prefix>_<key>.db`` in ``directory``, where the key is
+    ``YYYY-MM-DD`` or ``YYYY-MM``. Each partition has its own engine, session
+    and ``DimensionCache``; only the ``max_open`` most recently used
+    partitions are kept open.
+
+    Attributes:
+    - directory (Path): Where the partition files live.
+    - granularity (str): "day" or "month".
+    - profile (str): The ``db.SQLITE_PROFILES`` profile of each partition.
+    - prefix (str): File name prefix of the partitions.
+    - max_open (int): Partitions kept open at once.
+
+    Methods:
+    - partition_key(when): Returns the key of the partition holding ``when``.
+    - session_for(key): Returns the session of a partition, creating it.
+    - write_batch(session, packets): Writes packets to their partitions.
+    - partitions(): Lists the keys of existing partitions.
+    - db_size(): Returns the bytes of all partitions.
+    - partitions_between(start, end): Lists keys overlapping a time range.
+    - archive(key, archive_dir): Moves a partition out of the live set.
+    - drop(key): Deletes a partition.
+    - logged(...): Latest readings across the partitions of a time range.
+    - close(): Closes every open partition.
+    """
+
+    def __init__(
+        self,
+        directory,
+        granularity="day",
+        profile=DEFAULT_SQLITE_PROFILE,
+        prefix="sensor_data",
+        max_open=4,
+    ):
+        if granularity not in GRANULARITIES:
+            raise ValueError(
+                "granularity must be one of {}, not {!r}".format(
+                    ", ".join(GRANULARITIES), granularity
+                )
+            )
+        self.directory = Path(directory)
+        self.granularity = granularity
+        self.profile = profile
+        self.prefix = prefix
+        self.max_open = max_open
+        self._open = OrderedDict()
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def partition_key(self, when):
+        """Return the partition key of a datetime or unix timestamp."""
+        if not isinstance(when, datetime):
+            when = utc_datetime(when)
+        return when.strftime(GRANULARITIES[self.granularity])
+
+    def path_for(self, key):
+        """Return the file of partition ``key``."""
+        return self.directory / "{}_{}.db".format(self.prefix, key)
+
+    def session_for(self, key):
+        """Return the session of partition ``key``, creating the file."""
+        return self._partition(key)[1]
+
+    def write_batch(self, session, packets):
+        """
+        Write ``SensorPacket``s to the partitions of their ``packet_time``.
+
+        Matches the ``BatchWriter`` hook; ``session`` is not used since every
+        partition has a session of its own. Each partition is committed on
+        its own, so when one fails the packets of the partitions committed
+        before it are removed from the ``packets`` list before the error is
+        raised: a retry of the same list does not store them twice.
+        """
+        by_key = OrderedDict()
+        for packet in packets:
+            key = self.partition_key(packet_time(packet))
+            by_key.setdefault(key, []).append(packet)
+        committed = set()
+        try:
+            for key, partition_packets in by_key.items():
+                engine, partition_session, cache = self._partition(key)
+                add_sensors_reading_records_bulk(
+                    partition_session, partition_packets, cache
+                )
+                committed.add(key)
+        except Exception:
+            packets[:] = [
+                packet for key, partition_packets in by_key.items()
+                if key not in committed
+                for packet in partition_packets
+            ]
+            raise
+
+    def partitions(self):
+        """Return the keys of the existing partitions, oldest first."""
+        keys = []
+        for fp in self.directory.glob("{}_*.db".format(self.prefix)):
+            key = fp.stem[len(self.prefix) + 1:]
+            try:
+                datetime.strptime(key, GRANULARITIES[self.granularity])
+            except ValueError:
+                continue
+            keys.append(key)
+        return sorted(keys)
+
+    def db_size(self):
+        """Return the bytes of every partition and its WAL."""
+        return sum(
+            file_size(self.path_for(key)) for key in self.partitions()
+        )
+
+    def partitions_between(self, start=None, end=None):
+        """Return the keys of existing partitions overlapping start..end."""
+        first = self.partition_key(start) if start is not None else None
+        last = self.partition_key(end) if end is not None else None
+        # keys sort chronologically, so comparing them is comparing ranges
+        return [
+            key for key in self.partitions()
+            if (first is None or key >= first)
+            and (last is None or key <= last)
+        ]
+
+    def archive(self, key, archive_dir):
+        """Close partition ``key`` and move its file into ``archive_dir``.
+
+        Meant for partitions that no longer receive readings; a packet that
+        arrives late for an archived partition starts a new file for it.
+        """
+        path = self._release(key)
+        archive_dir = Path(archive_dir)
+        archive_dir.mkdir(parents=True, exist_ok=True)
+        target = archive_dir / path.name
+        # readings a reader kept from being checkpointed move along
+        for suffix in WAL_SUFFIXES:
+            sidecar = path.with_name(path.name + suffix)
+            if sidecar.exists():
+                shutil.move(str(sidecar), str(target) + suffix)
+        shutil.move(str(path), str(target))
+        return target
+
+    def drop(self, key):
+        """Close partition ``key`` and delete its files."""
+        path = self._release(key)
+        for suffix in WAL_SUFFIXES:
+            path.with_name(path.name + suffix).unlink(missing_ok=True)
+        path.unlink()
+
+    def _release(self, key):
+        """
+        Close partition ``key`` and checkpoint its WAL into the database
+        file, which another process, e.g. the API server, may hold open.
+        """
+        self._close(key)
+        path = self.path_for(key)
+        if path.with_name(path.name + "-wal").exists():
+            connection = sqlite3.connect(path)
+            try:
+                connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            finally:
+                connection.close()
+        return path
+
+    def logged(
+        self,
+        number_of_records=25,
+        sensor=None,
+        measurement=None,
+        start=None,
+        end=None,
+    ):
+        """
+        Get the latest readings as ``Reading`` tuples, newest first, only
+        opening partitions in start..end.
+        """
+        if start is not None and not isinstance(start, datetime):
+            start = utc_datetime(start)
+        if end is not None and not isinstance(end, datetime):
+            end = utc_datetime(end)
+        records = []
+        for key in reversed(self.partitions_between(start, end)):
+            # plain tuples, the partition may be closed before the caller
+            # looks at the records
+            records.extend(query_readings(
+                self.session_for(key),
+                sensor=sensor,
+                measurement=measurement,
+                start=start,
+                end=end,
+                limit=number_of_records - len(records),
+                descending=True,
+            ))
+            if len(records) >= number_of_records:
+                break
+        return records
+
+    def close(self):
+        """Close every open partition."""
+        for key in list(self._open):
+            self._close(key)
+
+    def _partition(self, key):
+        try:
+            self._open.move_to_end(key)
+            return self._open[key]
+        except KeyError:
+            pass
+        engine = create_sqlite_engine(self.path_for(key), self.profile)
+        Base.metadata.create_all(engine)
+        session = sessionmaker(bind=engine)()
+        partition = (engine, session, DimensionCache().warm(session))
+        session.commit()
+        self._open[key] = partition
+        while len(self._open) > self.max_open:
+            self._close(next(iter(self._open)))
+        return partition
+
+    def _close(self, key):
+        partition = self._open.pop(key, None)
+        if partition is None:
+            return
+        engine, session, cache = partition
+        session.close()
+        # disposing the last connection checkpoints and removes the WAL file
+        engine.dispose()
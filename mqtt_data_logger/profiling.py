@@ -0,0 +1,371 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, 4CSCC development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import base64
+import cProfile
+import json
+import logging
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from types import SimpleNamespace
+
+from mqtt_data_logger.metrics import COMMIT_SECONDS, DECODE_SECONDS
+from mqtt_data_logger.spool import SEGMENT_SUFFIX, read_records
+
+
+logger = logging.getLogger(__name__)
+
+PROFILERS = ["cprofile", "sample"]
+
+
+###############################################################################
+# captures
+###############################################################################
+
+def write_capture(path, messages):
+    """
+    Write ``(topic, payload, received_at)`` messages to a capture file.
+
+    One JSON object per line, the payload as text or, if it is not utf-8,
+    base64 encoded.
+    """
+    with open(path, "w") as f:
+        for topic, payload, received_at in messages:
+            record = {"topic": topic, "received_at": received_at}
+            try:
+                record["payload"] = payload.decode("utf-8")
+            except UnicodeDecodeError:
+                record["payload_base64"] = base64.b64encode(payload).decode()
+            f.write(json.dumps(record) + "\n")
+
+
+def read_capture(path):
+    """
+    Yield the ``(topic, payload, received_at)`` messages of a capture.
+
+    ``path`` is a capture file or the directory of a ``--spool``, which
+    holds every raw message the logger received.
+    """
+    path = Path(path)
+    if path.is_dir():
+        if not any(path.glob("*" + SEGMENT_SUFFIX)):
+            raise ValueError(f"{path} holds no spool segments")
+        # read only, the spool may belong to a logger that is running
+        offset = 0
+        while True:
+            records = read_records(path, offset)
+            if not records:
+                return
+            for record in records:
+                yield record.topic, record.payload, record.received_at
+            offset = records[-1].next_offset
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if "payload_base64" in record:
+                payload = base64.b64decode(record["payload_base64"])
+            else:
+                payload = record["payload"].encode("utf-8")
+            yield record["topic"], payload, record.get("received_at")
+
+
+def replay_capture(messages, callback):
+    """
+    Feed captured messages to a paho message ``callback``, no broker needed.
+
+    Messages carry their captured ``received_at`` (None if unknown), which
+    ``log_sensor_data`` uses instead of the time of the replay, so a replay
+    reproduces the time axis of the capture.
+
+    Returns the number of messages replayed.
+    """
+    replayed = 0
+    for topic, payload, received_at in messages:
+        callback(None, None, SimpleNamespace(
+            topic=topic, payload=payload, received_at=received_at
+        ))
+        replayed += 1
+    return replayed
+
+
+###############################################################################
+# profilers
+###############################################################################
+
+class StageTimes:
+    """Wall time and calls of the functions wrapped as named stages."""
+
+    def __init__(self):
+        self.seconds = Counter()
+        self.calls = Counter()
+        self._lock = threading.Lock()
+
+    def wrap(self, stage, function):
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - started
+                with self._lock:
+                    self.seconds[stage] += elapsed
+                    self.calls[stage] += 1
+        return timed
+
+
+class CallProfiler:
+    """
+    cProfile over the wrapped functions, with one profile per thread.
+
+    A cProfile profile only sees the thread it is enabled on, while the
+    logger decodes on the mqtt thread and writes on the writer thread;
+    wrapping the entry points of both profiles exactly the ingest work.
+    """
+
+    def __init__(self):
+        self.active = False
+        self._profiles = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def wrap(self, function):
+        def profiled(*args, **kwargs):
+            local = self._local
+            if not self.active or getattr(local, "depth", 0):
+                return function(*args, **kwargs)
+            profile = getattr(local, "profile", None)
+            if profile is None:
+                profile = local.profile = cProfile.Profile()
+                with self._lock:
+                    self._profiles.append(profile)
+            local.depth = 1
+            profile.enable()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                profile.disable()
+                local.depth = 0
+        return profiled
+
+    def write(self, output):
+        """Write ``output``.pstats and the top functions to ``output``.txt."""
+        with self._lock:
+            profiles = list(self._profiles)
+        if not profiles:
+            return []
+        stats = pstats.Stats(*profiles)
+        pstats_fp = Path(f"{output}.pstats")
+        stats.dump_stats(pstats_fp)
+        text_fp = Path(f"{output}.txt")
+        with open(text_fp, "w") as f:
+            pstats.Stats(str(pstats_fp), stream=f).sort_stats(
+                "cumulative"
+            ).print_stats(40)
+        return [pstats_fp, text_fp]
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of every thread every ``interval`` seconds.
+
+    Unlike cProfile it adds no cost to the profiled code and also sees the
+    threads nobody wrapped. ``stacks`` counts each stack, root first, as
+    the "collapsed" lines flamegraph.pl, speedscope and inferno read.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = 0
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name="mqtt-data-logger-profiler", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            self.sample(exclude=own)
+
+    def sample(self, exclude=None):
+        """Record the current stack of every thread but ``exclude``."""
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == exclude:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append("{} ({}:{})".format(
+                    code.co_name, Path(code.co_filename).name,
+                    code.co_firstlineno,
+                ))
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            self.stacks[";".join(reversed(stack))] += 1
+        self.samples += 1
+
+    def write(self, output):
+        """Write the stacks to ``output``.collapsed."""
+        collapsed_fp = Path(f"{output}.collapsed")
+        with open(collapsed_fp, "w") as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write(f"{stack} {count}\n")
+        return [collapsed_fp]
+
+
+class ProfileSession:
+    """
+    Profiles the ingest path for a window and breaks its time into stages.
+
+    Wrap the message callback and the batch write function with ``wrap``
+    before they are used. Between ``start`` and ``stop`` (which a timer
+    calls after ``seconds``, if given) the wrapped stages are timed and,
+    depending on ``profiler``, profiled with cProfile or sampled. The
+    decode and commit stages come from the metrics of the parser and the
+    writers. ``stop`` writes the profile and ``output``.stages.json.
+
+    Parameters:
+    - profiler (str): "cprofile", "sample" or None for stage times only.
+    - output (Path): Prefix of the files written.
+    - seconds (float): Length of the window, None until ``stop``.
+    - interval (float): Seconds between samples of the sampler.
+    """
+
+    def __init__(
+        self, profiler=None, output="mqtt_logger_profile", seconds=None,
+        interval=0.005,
+    ):
+        if profiler not in PROFILERS + [None]:
+            raise ValueError(f"Unknown profiler {profiler}")
+        self.profiler = profiler
+        self.output = Path(output)
+        self.seconds = seconds
+        self.stage_times = StageTimes()
+        self.calls = CallProfiler() if profiler == "cprofile" else None
+        self.sampler = (
+            SamplingProfiler(interval) if profiler == "sample" else None
+        )
+        self.breakdown = None
+        self._active = False
+        self._started = None
+        self._baseline = None
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def wrap(self, stage, function):
+        """Return ``function`` timed as ``stage`` while the window is open."""
+        timed = self.stage_times.wrap(stage, function)
+        if self.calls is not None:
+            timed = self.calls.wrap(timed)
+
+        def wrapped(*args, **kwargs):
+            if self._active:
+                return timed(*args, **kwargs)
+            return function(*args, **kwargs)
+        return wrapped
+
+    def start(self):
+        self._baseline = _metric_totals()
+        self._started = time.perf_counter()
+        if self.calls is not None:
+            self.calls.active = True
+        if self.sampler is not None:
+            self.sampler.start()
+        self._active = True
+        if self.seconds is not None:
+            self._timer = threading.Timer(self.seconds, self.stop)
+            self._timer.daemon = True
+            self._timer.start()
+        logger.info(
+            "Profiling with %s for %s", self.profiler or "stage times",
+            f"{self.seconds}s" if self.seconds is not None else "the run",
+        )
+        return self
+
+    def stop(self):
+        """Close the window, write the results, return the breakdown."""
+        with self._lock:
+            if not self._active:
+                return self.breakdown
+            self._active = False
+        if self._timer is not None:
+            self._timer.cancel()
+        if self.calls is not None:
+            self.calls.active = False
+        if self.sampler is not None:
+            self.sampler.stop()
+        self.breakdown = self._breakdown()
+
+        files = []
+        if self.calls is not None:
+            files += self.calls.write(self.output)
+        if self.sampler is not None:
+            files += self.sampler.write(self.output)
+        stages_fp = Path(f"{self.output}.stages.json")
+        stages_fp.write_text(json.dumps(self.breakdown, indent=2))
+        files.append(stages_fp)
+        logger.info("Stage breakdown: %s", self.breakdown["stages"])
+        logger.info("Profile written to %s", ", ".join(map(str, files)))
+        return self.breakdown
+
+    def _breakdown(self):
+        seconds = time.perf_counter() - self._started
+        totals = _metric_totals()
+        stages = {}
+        for stage in self.stage_times.seconds:
+            stages[stage] = _stage(
+                self.stage_times.seconds[stage],
+                self.stage_times.calls[stage],
+            )
+        for stage, (total, calls) in totals.items():
+            base_total, base_calls = self._baseline[stage]
+            stages[stage] = _stage(total - base_total, calls - base_calls)
+        if "write" in stages:
+            # statements built and executed, i.e. everything but the commit
+            stages["insert"] = _stage(
+                stages["write"]["seconds"] - stages["commit"]["seconds"],
+                stages["write"]["calls"],
+            )
+        return {
+            "profiler": self.profiler,
+            "seconds": seconds,
+            "stages": stages,
+        }
+
+
+def _stage(seconds, calls):
+    return {
+        "seconds": seconds,
+        "calls": calls,
+        "mean_us": seconds / calls * 1e6 if calls else None,
+    }
+
+
+def _metric_totals():
+    return {
+        "decode": (DECODE_SECONDS.sum, DECODE_SECONDS.count),
+        "commit": (COMMIT_SECONDS.sum, COMMIT_SECONDS.count),
+    }
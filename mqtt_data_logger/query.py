@@ -0,0 +1,372 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, 4CSCC development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import heapq
+from collections import namedtuple
+from itertools import islice
+
+from sqlalchemy import func, select, tuple_
+
+from mqtt_data_logger.compression import (
+    block_readings,
+    from_micros,
+    label_names,
+    overlapping_blocks,
+    to_micros,
+)
+from mqtt_data_logger.sensor_data_models import (
+    Topic,
+    Sensor,
+    Measurement,
+    Label,
+    ReadingBlock,
+    SensorMeasurement,
+)
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# One reading as returned by ``query_readings``, ``key`` is what to pass as
+# ``after`` to continue after it.
+class Reading(namedtuple(
+    "Reading",
+    ["reading_id", "time", "topic", "sensor", "measurement", "value",
+     "str_value"],
+)):
+    __slots__ = ()
+
+    @property
+    def key(self):
+        return (self.time, self.reading_id)
+
+
+def _name_id(id_column, name_column, name):
+    """Subquery turning a dimension name into its id, once per statement."""
+    return select(id_column).where(name_column == name).scalar_subquery()
+
+
+def _readings_select():
+    """Select the ``Reading`` columns of sensor_measurements."""
+    reading = SensorMeasurement
+    return (
+        select(
+            reading.sensor_measurement_num_id,
+            reading.time,
+            Topic.topic,
+            Sensor.sensor_id,
+            Measurement.measurement,
+            reading.value,
+            func.coalesce(Label.label, "").label("str_value"),
+        )
+        .join(Topic, reading.topic_num_id == Topic.topic_num_id)
+        .join(Sensor, reading.sensor_num_id == Sensor.sensor_num_id)
+        .join(
+            Measurement,
+            reading.measurement_num_id == Measurement.measurement_num_id,
+        )
+        .outerjoin(Label, reading.label_num_id == Label.label_num_id)
+    )
+
+
+def _blocks_select():
+    """Select ``ReadingBlock``s with the names of their dimensions."""
+    block = ReadingBlock
+    return (
+        select(
+            *block.__table__.c,
+            Topic.topic,
+            Sensor.sensor_id,
+            Measurement.measurement,
+        )
+        .join(Topic, block.topic_num_id == Topic.topic_num_id)
+        .join(Sensor, block.sensor_num_id == Sensor.sensor_num_id)
+        .join(
+            Measurement,
+            block.measurement_num_id == Measurement.measurement_num_id,
+        )
+    )
+
+
+def _filter_names(
+    statement, sensor=None, measurement=None, topic=None,
+    reading=SensorMeasurement,
+):
+    if sensor is not None:
+        statement = statement.where(reading.sensor_num_id == _name_id(
+            Sensor.sensor_num_id, Sensor.sensor_id, sensor
+        ))
+    if measurement is not None:
+        statement = statement.where(reading.measurement_num_id == _name_id(
+            Measurement.measurement_num_id, Measurement.measurement,
+            measurement,
+        ))
+    if topic is not None:
+        statement = statement.where(reading.topic_num_id == _name_id(
+            Topic.topic_num_id, Topic.topic, topic
+        ))
+    return statement
+
+
+def readings_statement(
+    sensor=None,
+    measurement=None,
+    topic=None,
+    start=None,
+    end=None,
+    limit=None,
+    after=None,
+    descending=False,
+):
+    """
+    Build the select behind ``query_readings``.
+
+    Names are resolved to ids in scalar subqueries so sqlite filters the
+    readings on the (sensor, measurement, time) or (topic, time) index and
+    only joins the dimension tables for the rows it returns.
+    """
+    reading = SensorMeasurement
+    statement = _filter_names(
+        _readings_select(), sensor, measurement, topic
+    )
+    if start is not None:
+        statement = statement.where(reading.time >= start)
+    if end is not None:
+        statement = statement.where(reading.time < end)
+
+    key = tuple_(reading.time, reading.sensor_measurement_num_id)
+    if after is not None:
+        statement = statement.where(
+            key < tuple_(*after) if descending else key > tuple_(*after)
+        )
+    if descending:
+        statement = statement.order_by(
+            reading.time.desc(), reading.sensor_measurement_num_id.desc()
+        )
+    else:
+        statement = statement.order_by(
+            reading.time, reading.sensor_measurement_num_id
+        )
+    if limit is not None:
+        statement = statement.limit(limit)
+    return statement
+
+
+def query_readings(
+    session,
+    sensor=None,
+    measurement=None,
+    topic=None,
+    start=None,
+    end=None,
+    limit=None,
+    after=None,
+    descending=False,
+    chunk_size=1000,
+):
+    """
+    Stream readings matching the filters as ``Reading`` tuples.
+
+    A single indexed statement is executed and rows are fetched
+    ``chunk_size`` at a time, no ORM objects are built. Readings come in
+    (time, id) order; pass the ``key`` of the last reading seen as
+    ``after`` to page through a large range without an OFFSET.
+
+    Parameters:
+    - session (Session): The database session.
+    - sensor (str): Only readings of this sensor.
+    - measurement (str): Only readings of this measurement.
+    - topic (str): Only readings logged on this topic.
+    - start (datetime): First time included, naive UTC.
+    - end (datetime): First time excluded, naive UTC.
+    - limit (int): Return at most this many readings.
+    - after (tuple): ``(time, reading_id)`` to continue after.
+    - descending (bool): Newest first.
+    - chunk_size (int): Rows fetched from the cursor at a time.
+
+    Returns:
+    iterator: ``Reading`` tuples.
+    """
+    result = session.execute(
+        readings_statement(
+            sensor, measurement, topic, start, end, limit, after, descending
+        ),
+        execution_options={"yield_per": chunk_size},
+    )
+    readings = heapq.merge(
+        (Reading._make(row) for row in result),
+        _block_readings(
+            session, sensor, measurement, topic, start, end, after,
+            descending,
+        ),
+        key=Reading.key.fget,
+        reverse=descending,
+    )
+    if limit is not None:
+        readings = islice(readings, limit)
+    yield from readings
+
+
+def _block_reading(block, reading, labels):
+    reading_id, micros, value, label = reading
+    return Reading(
+        reading_id,
+        from_micros(micros),
+        block.topic,
+        block.sensor_id,
+        block.measurement,
+        value,
+        labels.get(label, "") if label is not None else "",
+    )
+
+
+def _block_readings(
+    session, sensor, measurement, topic, start, end, after, descending
+):
+    """
+    Yield the readings of the compressed blocks matching the filters, in
+    the order of ``query_readings``.
+
+    Blocks come ordered by their first (last, if ``descending``) time and
+    are decoded one at a time; a reading is yielded once no block still to
+    come can hold an earlier one, so only overlapping blocks are held in
+    memory.
+    """
+    block = ReadingBlock
+    statement = overlapping_blocks(
+        _filter_names(_blocks_select(), sensor, measurement, topic, block),
+        start, end,
+    )
+    # keys are negated when descending so the heap always pops the next one
+    sign = -1 if descending else 1
+    after_key = None
+    if after is not None:
+        after_key = (sign * to_micros(after[0]), sign * after[1])
+        statement = statement.where(
+            block.start_time <= after[0] if descending
+            else block.end_time >= after[0]
+        )
+    statement = statement.order_by(
+        block.end_time.desc() if descending else block.start_time
+    )
+
+    labels = None
+    pending = []
+    for row in session.execute(statement):
+        if labels is None:
+            labels = label_names(session)
+        bound = sign * to_micros(
+            row.end_time if descending else row.start_time
+        )
+        while pending and pending[0][0][0] < bound:
+            yield heapq.heappop(pending)[1]
+        for reading in block_readings(row, start, end):
+            key = (sign * reading[1], sign * reading[0])
+            if after_key is None or key > after_key:
+                heapq.heappush(
+                    pending, (key, _block_reading(row, reading, labels))
+                )
+    while pending:
+        yield heapq.heappop(pending)[1]
+
+
+def iter_reading_pages(session, page_size=10000, **filters):
+    """
+    Yield lists of up to ``page_size`` readings, one query per page.
+
+    Each page continues after the last key of the previous one, so no
+    cursor stays open between pages and every page costs the same however
+    deep into the range it is. Takes the filters of ``query_readings``.
+    """
+    after = filters.pop("after", None)
+    while True:
+        page = list(query_readings(
+            session, limit=page_size, after=after, **filters
+        ))
+        if not page:
+            return
+        yield page
+        if len(page) < page_size:
+            return
+        after = page[-1].key
+
+
+def query_columns(session, **filters):
+    """
+    Return readings matching the filters column by column.
+
+    Returns a dict of column name to a numpy array when numpy is installed
+    (``value`` as float64 with NaN for missing values), to a list otherwise.
+    Takes the filters of ``query_readings``.
+    """
+    columns = {name: [] for name in Reading._fields}
+    appends = [columns[name].append for name in Reading._fields]
+    for reading in query_readings(session, **filters):
+        for append, item in zip(appends, reading):
+            append(item)
+    if np is None:
+        return columns
+    arrays = {
+        name: np.array(values, dtype=object)
+        for name, values in columns.items()
+    }
+    arrays["reading_id"] = np.array(columns["reading_id"], dtype=np.int64)
+    arrays["time"] = np.array(columns["time"], dtype="datetime64[us]")
+    arrays["value"] = np.array(
+        [
+            value if isinstance(value, (int, float)) else np.nan
+            for value in columns["value"]
+        ],
+        dtype=np.float64,
+    )
+    return arrays
+
+
+def latest_readings(session, sensor=None, measurement=None, topic=None):
+    """
+    Return the newest ``Reading`` of every sensor and measurement.
+
+    Optionally only of one ``sensor``, ``measurement`` or ``topic``;
+    ordered by sensor, then measurement.
+    """
+    reading = SensorMeasurement
+    newest = _filter_names(
+        select(func.max(reading.sensor_measurement_num_id)),
+        sensor, measurement, topic,
+    ).group_by(reading.sensor_num_id, reading.measurement_num_id)
+    result = session.execute(
+        _readings_select()
+        .where(reading.sensor_measurement_num_id.in_(newest))
+    )
+    latest = {
+        (row.sensor_id, row.measurement): Reading._make(row)
+        for row in result
+    }
+
+    # series whose newest reading was compacted into a block
+    block = ReadingBlock
+    newest_blocks = _filter_names(
+        select(func.max(block.max_reading_id)),
+        sensor, measurement, topic, block,
+    ).group_by(block.sensor_num_id, block.measurement_num_id)
+    labels = None
+    for row in session.execute(
+        _blocks_select().where(block.max_reading_id.in_(newest_blocks))
+    ):
+        series = (row.sensor_id, row.measurement)
+        current = latest.get(series)
+        if current is not None and current.reading_id > row.max_reading_id:
+            continue
+        if labels is None:
+            labels = label_names(session)
+        latest[series] = _block_reading(
+            row, max(block_readings(row)), labels
+        )
+    return [latest[series] for series in sorted(latest)]
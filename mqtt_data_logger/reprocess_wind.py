@@ -0,0 +1,272 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, 4CSCC development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import argparse
+from collections import Counter, defaultdict
+from numbers import Real
+from pathlib import Path
+
+from sqlalchemy import bindparam, insert, select, update
+from sqlalchemy.orm import Session
+
+from mqtt_data_logger.db import (
+    DEFAULT_SQLITE_PROFILE,
+    SQLITE_PROFILES,
+    create_sqlite_engine,
+)
+from mqtt_data_logger.log_data import DimensionCache
+from mqtt_data_logger.munge_wind import lookup_beauforts, lookup_cardinals
+from mqtt_data_logger.sensor_data_models import SensorMeasurement
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+readings = SensorMeasurement.__table__
+
+_set_labels = (
+    update(readings)
+    .where(readings.c.sensor_measurement_num_id == bindparam("reading_id"))
+    .values(
+        value=bindparam("new_value"), label_num_id=bindparam("new_label_id")
+    )
+)
+
+
+def _chunks(session, measurement_num_id, chunk_size):
+    """Yield the readings of one measurement, ``chunk_size`` at a time."""
+    after_id = 0
+    while True:
+        rows = session.execute(
+            select(
+                readings.c.sensor_measurement_num_id,
+                readings.c.topic_num_id,
+                readings.c.sensor_num_id,
+                readings.c.time,
+                readings.c.value,
+                readings.c.label_num_id,
+                readings.c.packet_key,
+            )
+            .where(readings.c.measurement_num_id == measurement_num_id)
+            .where(readings.c.sensor_measurement_num_id > after_id)
+            .order_by(readings.c.sensor_measurement_num_id)
+            .limit(chunk_size)
+        ).all()
+        if not rows:
+            return
+        yield rows
+        after_id = rows[-1].sensor_measurement_num_id
+
+
+def _values(rows):
+    values = [row.value for row in rows]
+    if np is not None:
+        return np.array(values, dtype=float)
+    return values
+
+
+def _in_range(rows, low, high):
+    """Return the rows whose value is a number in low..high, and the rest."""
+    good = []
+    bad = 0
+    for row in rows:
+        value = row.value
+        if (
+            isinstance(value, Real) and not isinstance(value, bool)
+            and low <= value < high
+        ):
+            good.append(row)
+        else:
+            bad += 1
+    return good, bad
+
+
+def _reprocess_beaufort(session, cache, chunk_size):
+    """
+    Relabel ``wind_speed_beaufort`` readings from their stored speed.
+
+    Returns the numbers of readings updated and of readings skipped since
+    their speed is not one ``lookup_beauforts`` can classify.
+    """
+    updated = skipped = 0
+    for rows in _chunks(
+        session, cache.measurement_id(session, "wind_speed_beaufort"),
+        chunk_size,
+    ):
+        rows, bad = _in_range(rows, 0, 999)
+        skipped += bad
+        labels, classes = lookup_beauforts(_values(rows))
+        label_ids = [cache.label_id(session, str(label)) for label in labels]
+        changes = [
+            {
+                "reading_id": row.sensor_measurement_num_id,
+                "new_value": row.value,
+                "new_label_id": label_id,
+            }
+            for row, label_id in zip(rows, label_ids)
+            if row.label_num_id != label_id
+        ]
+        if changes:
+            session.execute(_set_labels, changes)
+        session.commit()
+        updated += len(changes)
+    return updated, skipped
+
+
+def _packet(row):
+    """What tells the readings of one packet apart from other packets."""
+    return row.topic_num_id, row.sensor_num_id, row.time, row.packet_key
+
+
+def _reprocess_cardinal(session, cache, chunk_size):
+    """
+    Recompute ``cardinal_direction`` readings from the ``wind_direction``
+    reading of the same packet, adding the ones that are missing.
+
+    Readings of a packet share its topic, sensor, time and packet key. A
+    wind direction that shares them with another wind or cardinal
+    direction, e.g. of two packets without a key logged in the same
+    second, cannot be paired and is left alone, as is a direction
+    ``lookup_cardinals`` cannot classify.
+
+    Returns the numbers of readings updated, added, skipped since their
+    direction is out of range and skipped since they are ambiguous.
+    """
+    wind_direction = cache.measurement_id(session, "wind_direction")
+    cardinal = cache.measurement_id(session, "cardinal_direction")
+    updated = added = skipped = ambiguous = 0
+    for rows in _chunks(session, wind_direction, chunk_size):
+        times = [row.time for row in rows]
+        in_times = (
+            select(readings)
+            .where(readings.c.time >= min(times))
+            .where(readings.c.time <= max(times))
+        )
+        winds = Counter(
+            _packet(row) for row in session.execute(
+                in_times.where(readings.c.measurement_num_id == wind_direction)
+            )
+        )
+        existing = defaultdict(list)
+        for row in session.execute(
+            in_times.where(readings.c.measurement_num_id == cardinal)
+        ):
+            existing[_packet(row)].append(row)
+
+        rows, bad = _in_range(rows, 0, 360)
+        skipped += bad
+        paired = []
+        for row in rows:
+            if winds[_packet(row)] > 1 or len(existing[_packet(row)]) > 1:
+                ambiguous += 1
+            else:
+                paired.append(row)
+        rows = paired
+        labels, degrees = lookup_cardinals(_values(rows))
+
+        changes = []
+        missing = []
+        for row, label, degree in zip(rows, labels, degrees):
+            label_id = cache.label_id(session, str(label))
+            degree = float(degree)
+            stored = existing[_packet(row)]
+            if not stored:
+                missing.append({
+                    "topic_num_id": row.topic_num_id,
+                    "sensor_num_id": row.sensor_num_id,
+                    "measurement_num_id": cardinal,
+                    "time": row.time,
+                    "value": degree,
+                    "label_num_id": label_id,
+                    "packet_key": row.packet_key,
+                })
+                continue
+            stored, = stored
+            if (stored.label_num_id, stored.value) != (label_id, degree):
+                changes.append({
+                    "reading_id": stored.sensor_measurement_num_id,
+                    "new_value": degree,
+                    "new_label_id": label_id,
+                })
+        if changes:
+            session.execute(_set_labels, changes)
+        if missing:
+            session.execute(insert(readings), missing)
+        session.commit()
+        updated += len(changes)
+        added += len(missing)
+    return updated, added, skipped, ambiguous
+
+
+def reprocess_wind(engine, chunk_size=50000):
+    """
+    Recompute the derived wind readings of a database in bulk.
+
+    ``wind_speed_beaufort`` labels are reclassified from the stored speed
+    and ``cardinal_direction`` readings from the raw ``wind_direction``
+    reading logged with them, ``chunk_size`` readings per transaction,
+    using the array lookups of ``munge_wind``. Only readings whose label or
+    value changed are rewritten. Readings compacted into blocks are not
+    reprocessed. Readings that cannot be classified or paired are skipped
+    and counted instead of stopping the run halfway.
+
+    Parameters:
+    - engine (Engine): The sensor data database.
+    - chunk_size (int): Readings classified and committed at a time.
+
+    Returns:
+    dict: Numbers of beaufort readings updated and skipped, and of
+    cardinal readings updated, added, skipped and left ambiguous.
+    """
+    with Session(engine) as session:
+        cache = DimensionCache()
+        beaufort_updated, beaufort_skipped = _reprocess_beaufort(
+            session, cache, chunk_size
+        )
+        (
+            cardinal_updated, cardinal_added, cardinal_skipped,
+            cardinal_ambiguous,
+        ) = _reprocess_cardinal(session, cache, chunk_size)
+        cache.commit_pending()
+    return {
+        "beaufort_updated": beaufort_updated,
+        "beaufort_skipped": beaufort_skipped,
+        "cardinal_updated": cardinal_updated,
+        "cardinal_added": cardinal_added,
+        "cardinal_skipped": cardinal_skipped,
+        "cardinal_ambiguous": cardinal_ambiguous,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="reprocess_wind",
+        description="Recompute beaufort and cardinal direction readings "
+                    "from the stored wind speed and direction. Readings "
+                    "already compacted into blocks by "
+                    "compact_sensor_data_db are left as they are.",
+    )
+    parser.add_argument("db", type=Path)
+    parser.add_argument("--chunk-size", type=int, default=50000)
+    parser.add_argument(
+        "--sqlite-profile", choices=list(SQLITE_PROFILES),
+        default=DEFAULT_SQLITE_PROFILE,
+    )
+    args = parser.parse_args(argv)
+
+    engine = create_sqlite_engine(args.db, args.sqlite_profile)
+    try:
+        print(reprocess_wind(engine, args.chunk_size))
+    finally:
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,361 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, 4CSCC development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import argparse
+from datetime import datetime, timedelta
+from numbers import Real
+from pathlib import Path
+
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from mqtt_data_logger.compression import (
+    block_readings,
+    from_micros,
+    overlapping_blocks,
+)
+from mqtt_data_logger.db import (
+    DEFAULT_SQLITE_PROFILE,
+    SQLITE_PROFILES,
+    create_sqlite_engine,
+)
+from mqtt_data_logger.sensor_data_models import (
+    Base,
+    Sensor,
+    Measurement,
+    ReadingBlock,
+    SensorMeasurement,
+    MinuteRollup,
+    HourRollup,
+    DayRollup,
+)
+
+
+# bucket size in seconds, model and sqlite strftime format of every rollup,
+# finest first
+ROLLUPS = [
+    (60, MinuteRollup, "%Y-%m-%d %H:%M:00.000000"),
+    (3600, HourRollup, "%Y-%m-%d %H:00:00.000000"),
+    (86400, DayRollup, "%Y-%m-%d 00:00:00.000000"),
+]
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def bucket_start(time, seconds):
+    """Return the start of the ``seconds`` long bucket ``time`` falls in."""
+    return time - (time - EPOCH) % timedelta(seconds=seconds)
+
+
+def _is_number(value):
+    return isinstance(value, Real) and not isinstance(value, bool)
+
+
+def _aggregate(readings, seconds):
+    """Sum up reading dicts into ``[count, total, min, max]`` per bucket."""
+    buckets = {}
+    for reading in readings:
+        value = reading["value"]
+        if not _is_number(value):
+            continue
+        key = (
+            reading["sensor_num_id"],
+            reading["measurement_num_id"],
+            bucket_start(reading["time"], seconds),
+        )
+        bucket = buckets.get(key)
+        if bucket is None:
+            buckets[key] = [1, value, value, value]
+        else:
+            bucket[0] += 1
+            bucket[1] += value
+            bucket[2] = min(bucket[2], value)
+            bucket[3] = max(bucket[3], value)
+    return [
+        {
+            "sensor_num_id": sensor_num_id,
+            "measurement_num_id": measurement_num_id,
+            "bucket": bucket,
+            "count": count,
+            "total": total,
+            "min": low,
+            "max": high,
+        }
+        for (sensor_num_id, measurement_num_id, bucket), (
+            count, total, low, high
+        ) in buckets.items()
+    ]
+
+
+def _merge_statement(model):
+    """Upsert that folds new aggregates into an existing bucket."""
+    table = model.__table__
+    statement = sqlite_insert(table)
+    return statement.on_conflict_do_update(
+        index_elements=[
+            table.c.sensor_num_id,
+            table.c.measurement_num_id,
+            table.c.bucket,
+        ],
+        set_={
+            "count": table.c.count + statement.excluded["count"],
+            "total": table.c.total + statement.excluded["total"],
+            "min": func.min(table.c.min, statement.excluded["min"]),
+            "max": func.max(table.c.max, statement.excluded["max"]),
+        },
+    )
+
+
+def update_rollups(session, readings):
+    """
+    Fold a batch of new readings into every rollup table.
+
+    ``readings`` are the row dicts just inserted into sensor_measurements
+    (``sensor_num_id``, ``measurement_num_id``, ``time``, ``value``);
+    readings without a numeric value are skipped. Runs in the caller's
+    transaction so the rollups commit together with the readings.
+    """
+    for seconds, model, fmt in ROLLUPS:
+        rows = _aggregate(readings, seconds)
+        if rows:
+            session.execute(_merge_statement(model), rows)
+
+
+def _backfill_window(conn, start, end):
+    reading_time = SensorMeasurement.time
+    for seconds, model, fmt in ROLLUPS:
+        table = model.__table__
+        bucket = func.strftime(fmt, reading_time)
+        conn.execute(
+            delete(table)
+            .where(table.c.bucket >= start)
+            .where(table.c.bucket < end)
+        )
+        conn.execute(insert(table).from_select(
+            ["sensor_num_id", "measurement_num_id", "bucket", "count",
+             "total", "min", "max"],
+            select(
+                SensorMeasurement.sensor_num_id,
+                SensorMeasurement.measurement_num_id,
+                bucket,
+                func.count(SensorMeasurement.value),
+                func.sum(SensorMeasurement.value),
+                func.min(SensorMeasurement.value),
+                func.max(SensorMeasurement.value),
+            )
+            .where(reading_time >= start)
+            .where(reading_time < end)
+            .where(func.typeof(SensorMeasurement.value).in_(
+                ["integer", "real"]
+            ))
+            .group_by(
+                SensorMeasurement.sensor_num_id,
+                SensorMeasurement.measurement_num_id,
+                bucket,
+            ),
+        ))
+
+    # readings compacted into blocks are aggregated here instead
+    readings = [
+        {
+            "sensor_num_id": block.sensor_num_id,
+            "measurement_num_id": block.measurement_num_id,
+            "time": from_micros(micros),
+            "value": value,
+        }
+        for block in conn.execute(
+            overlapping_blocks(select(ReadingBlock), start, end)
+        )
+        for _, micros, value, _ in block_readings(block, start, end)
+    ]
+    for seconds, model, fmt in ROLLUPS:
+        rows = _aggregate(readings, seconds)
+        if rows:
+            conn.execute(_merge_statement(model), rows)
+
+
+def backfill_rollups(engine, start=None, end=None):
+    """
+    Rebuild the rollup tables from the stored readings.
+
+    Works one day at a time, each in its own transaction: the day's
+    buckets are deleted and recomputed with ``GROUP BY`` in sqlite, so a
+    backfill can be rerun or interrupted safely. ``start`` is rounded down
+    and ``end`` up to whole days; they default to the first and last
+    reading.
+
+    Returns:
+    int: The number of days rebuilt.
+    """
+    Base.metadata.create_all(
+        engine,
+        tables=[model.__table__ for _, model, _ in ROLLUPS]
+        + [ReadingBlock.__table__],
+    )
+    with engine.connect() as conn:
+        first, last = conn.execute(select(
+            func.min(SensorMeasurement.time), func.max(SensorMeasurement.time)
+        )).one()
+        first_block, last_block = conn.execute(select(
+            func.min(ReadingBlock.start_time), func.max(ReadingBlock.end_time)
+        )).one()
+    times = [
+        time for time in (first, last, first_block, last_block)
+        if time is not None
+    ]
+    if not times:
+        return 0
+    first, last = min(times), max(times)
+    start = bucket_start(start or first, 86400)
+    end = end or last + timedelta(microseconds=1)
+
+    days = 0
+    while start < end:
+        with engine.begin() as conn:
+            _backfill_window(conn, start, start + timedelta(days=1))
+        start += timedelta(days=1)
+        days += 1
+    return days
+
+
+def pick_rollup(resolution):
+    """
+    Return the coarsest rollup model whose buckets divide ``resolution``
+    seconds, None if raw readings are needed. A rollup bucket is never
+    split, so a coarser one would land whole in the wrong series bucket.
+    """
+    picked = None
+    for seconds, model, fmt in ROLLUPS:
+        if resolution % seconds == 0:
+            picked = model
+    return picked
+
+
+def _rollup_seconds(model):
+    return next(seconds for seconds, m, fmt in ROLLUPS if m is model)
+
+
+def read_series(session, sensor, measurement, start, end, resolution=None):
+    """
+    Return a sensor's measurement between ``start`` and ``end``.
+
+    Without a ``resolution`` every raw reading is returned. Otherwise the
+    readings are aggregated into ``resolution`` second buckets, reading
+    from the coarsest rollup table whose buckets divide it, so a week
+    of 1 Hz data at an hourly resolution costs 168 rollup rows instead of
+    604800 readings.
+
+    Parameters:
+    - session (Session): The database session.
+    - sensor (str): Name of the sensor.
+    - measurement (str): Name of the measurement.
+    - start (datetime): First time included, naive UTC.
+    - end (datetime): First time excluded, naive UTC.
+    - resolution (float): Bucket size in seconds, None for raw readings.
+
+    Returns:
+    list: ``(time, count, mean, min, max)`` tuples in time order.
+    """
+    sensor_num_id = select(Sensor.sensor_num_id).where(
+        Sensor.sensor_id == sensor
+    ).scalar_subquery()
+    measurement_num_id = select(Measurement.measurement_num_id).where(
+        Measurement.measurement == measurement
+    ).scalar_subquery()
+
+    model = None if resolution is None else pick_rollup(resolution)
+    if model is None:
+        rows = session.execute(
+            select(SensorMeasurement.time, SensorMeasurement.value)
+            .where(SensorMeasurement.sensor_num_id == sensor_num_id)
+            .where(SensorMeasurement.measurement_num_id == measurement_num_id)
+            .where(SensorMeasurement.time >= start)
+            .where(SensorMeasurement.time < end)
+            .order_by(SensorMeasurement.time)
+        ).all()
+        # readings compacted into blocks are stored there instead
+        rows.extend(
+            (from_micros(micros), value)
+            for block in session.execute(overlapping_blocks(
+                select(ReadingBlock)
+                .where(ReadingBlock.sensor_num_id == sensor_num_id)
+                .where(
+                    ReadingBlock.measurement_num_id == measurement_num_id
+                ),
+                start, end,
+            )).scalars()
+            for _, micros, value, _ in block_readings(block, start, end)
+        )
+        rows = [
+            (time, 1, value, value, value)
+            for time, value in sorted(rows, key=lambda row: row[0])
+            if _is_number(value)
+        ]
+    else:
+        # buckets overlapping start are included whole
+        rows = session.execute(
+            select(
+                model.bucket, model.count, model.total, model.min, model.max
+            )
+            .where(model.sensor_num_id == sensor_num_id)
+            .where(model.measurement_num_id == measurement_num_id)
+            .where(model.bucket >= bucket_start(
+                start, _rollup_seconds(model)
+            ))
+            .where(model.bucket < end)
+            .order_by(model.bucket)
+        ).all()
+    if resolution is None:
+        return rows
+
+    series = {}
+    for time, count, total, low, high in rows:
+        bucket = bucket_start(time, resolution)
+        merged = series.get(bucket)
+        if merged is None:
+            series[bucket] = [count, total, low, high]
+        else:
+            merged[0] += count
+            merged[1] += total
+            merged[2] = min(merged[2], low)
+            merged[3] = max(merged[3], high)
+    return [
+        (bucket, count, total / count, low, high)
+        for bucket, (count, total, low, high) in series.items()
+    ]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="backfill_rollups",
+        description="Rebuild the 1 minute, 1 hour and 1 day rollup tables "
+                    "from the stored readings.",
+    )
+    parser.add_argument("db", type=Path)
+    parser.add_argument(
+        "--start", type=datetime.fromisoformat, help="ISO time, UTC"
+    )
+    parser.add_argument(
+        "--end", type=datetime.fromisoformat, help="ISO time, UTC"
+    )
+    parser.add_argument(
+        "--sqlite-profile", choices=list(SQLITE_PROFILES),
+        default=DEFAULT_SQLITE_PROFILE,
+    )
+    args = parser.parse_args(argv)
+
+    engine = create_sqlite_engine(args.db, args.sqlite_profile)
+    try:
+        days = backfill_rollups(engine, args.start, args.end)
+        print(f"Rebuilt rollups of {days} days")
+    finally:
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
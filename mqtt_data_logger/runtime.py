@@ -0,0 +1,168 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, 4CSCC development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import logging
+
+from paho.mqtt.client import topic_matches_sub
+from sqlalchemy.orm import sessionmaker
+
+from mqtt_data_logger.backends import backend_for
+from mqtt_data_logger.batch_writer import BatchWriter
+from mqtt_data_logger.config import is_sqlite_url, sqlite_path
+from mqtt_data_logger.db import create_database_engine
+from mqtt_data_logger.metrics import ERRORS, file_size
+from mqtt_data_logger.util import get_mqtt_client
+
+
+logger = logging.getLogger(__name__)
+
+
+class TopicRouter:
+    """
+    Picks the database of a topic from the ``config.Route``s.
+
+    The first route whose topic filter matches wins, ``default`` when none
+    does (None drops the packet). Topics are few and repeat, so the
+    decision is cached per topic.
+    """
+
+    def __init__(self, routes, default=None):
+        self.routes = list(routes)
+        self.default = default
+        self._databases = {}
+
+    def database_for(self, topic):
+        try:
+            return self._databases[topic]
+        except KeyError:
+            pass
+        database = next(
+            (
+                route.database for route in self.routes
+                if topic_matches_sub(route.topic, topic)
+            ),
+            self.default,
+        )
+        self._databases[topic] = database
+        return database
+
+
+class RoutedStorage:
+    """
+    One pooled engine, ``StorageBackend`` and ``BatchWriter`` per database.
+
+    Takes the place of a single ``BatchWriter`` for ``log_sensor_data``:
+    ``put`` routes each packet to the writer of its database, so every
+    database is written by its own thread, in its own transactions, and a
+    slow or unavailable database only backs up its own queue.
+
+    Parameters:
+    - config (LoggerConfig): The databases and routes.
+    - writer_options (dict): Keyword arguments of every ``BatchWriter``.
+    - wrap_write (callable): Applied to each write function, e.g. to
+      profile it.
+
+    Methods:
+    - put(packet): Queues a packet for its database.
+    - qsize(): Packets waiting over all databases.
+    - stats(): Writer counters by database.
+    - db_size(): Bytes of the SQLite databases.
+    - close(): Flushes and closes every writer and engine.
+    """
+
+    def __init__(self, config, writer_options=None, wrap_write=None):
+        self.config = config
+        self.router = TopicRouter(
+            config.routes,
+            None if config.routes else config.default_database.name,
+        )
+        self.unrouted = 0
+        self.engines = {}
+        self.writers = {}
+        self.backends = {}
+        for database in config.databases:
+            engine = create_database_engine(
+                database.url,
+                database.sqlite_profile,
+                pool_size=database.pool_size,
+                max_overflow=database.max_overflow,
+            )
+            session = sessionmaker(bind=engine)()
+            backend = backend_for(database).prepare(session)
+            write_batch = backend.write_batch
+            if wrap_write is not None:
+                write_batch = wrap_write(write_batch)
+            self.engines[database.name] = engine
+            self.backends[database.name] = backend
+            self.writers[database.name] = BatchWriter(
+                session, write_batch=write_batch, **(writer_options or {})
+            ).start()
+
+    def put(self, packet):
+        """Queue ``packet`` for the database of its topic."""
+        database = self.router.database_for(packet.topic)
+        if database is None:
+            self.unrouted += 1
+            ERRORS.labels("unrouted").inc()
+            return False
+        return self.writers[database].put(packet)
+
+    def qsize(self):
+        return sum(writer.qsize() for writer in self.writers.values())
+
+    def stats(self):
+        stats = {
+            name: writer.stats() for name, writer in self.writers.items()
+        }
+        stats["unrouted"] = self.unrouted
+        return stats
+
+    def db_size(self):
+        return sum(
+            file_size(sqlite_path(database.url))
+            for database in self.config.databases
+            if is_sqlite_url(database.url)
+        )
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+        for writer in self.writers.values():
+            writer.session.close()
+        for engine in self.engines.values():
+            engine.dispose()
+
+
+def connect_brokers(brokers, sensor_data_callback):
+    """
+    Create a client per ``config.BrokerConfig`` and start its network loop.
+
+    Each client subscribes only to its broker's topic filters. A broker
+    that cannot be reached yet is retried in the background instead of
+    keeping the others from starting.
+    """
+    clients = []
+    for broker in brokers:
+        client = get_mqtt_client(sensor_data_callback, broker, connect=False)
+        try:
+            client.connect(broker.host, broker.port, broker.keepalive)
+        except OSError as e:
+            logger.warning(
+                "Broker %s (%s:%s) unavailable, retrying: %s",
+                broker.name, broker.host, broker.port, e,
+            )
+            client.connect_async(broker.host, broker.port, broker.keepalive)
+        client.loop_start()
+        clients.append(client)
+    return clients
+
+
+def disconnect_brokers(clients):
+    for client in clients:
+        client.disconnect()
+        client.loop_stop()
@@ -7,17 +7,20 @@
 # ----------------------------------------------------------------------------
 
 
-from sqlalchemy.sql import func
+import logging
+
+from sqlalchemy.sql import func, text
 from sqlalchemy import (
+    BigInteger,
     Column,
     Integer,
     String,
     ForeignKey,
-    Table,
+    Index,
     Float,
     TIMESTAMP,
     DateTime,
-    create_engine,
+    LargeBinary,
 )
 
 from sqlalchemy.orm import (
@@ -30,52 +33,23 @@ from sqlalchemy.orm import (
 from pathlib import Path
 
 from sys import argv
-from icecream import ic
-
 
-Base = declarative_base()
+from mqtt_data_logger.db import create_sqlite_engine
 
 
-###############################################################################
-# connection tables
-###############################################################################
+logger = logging.getLogger(__name__)
 
-topic_sensor_measurement = Table(
-    "topic_sensor_measurement",
-    Base.metadata,
-    Column("topic_num_id", Integer, ForeignKey("topics.topic_num_id")),
-    Column(
-        "sensor_measurement_num_id",
-        Integer,
-        ForeignKey("sensor_measurements.sensor_measurement_num_id"),
-    ),
-)
 
-sensor_sensor_measurement = Table(
-    "sensor_sensor_measurement",
-    Base.metadata,
-    Column("sensor_num_id", Integer, ForeignKey("sensors.sensor_num_id")),
-    Column(
-        "sensor_measurement_num_id",
-        Integer,
-        ForeignKey("sensor_measurements.sensor_measurement_num_id"),
-    ),
-)
+Base = declarative_base()
 
-measurement_kind_sensor_measurement = Table(
-    "measurement_kind_sensor_measurement",
-    Base.metadata,
-    Column(
-        "measurement_num_id",
-        Integer,
-        ForeignKey("measurements.measurement_num_id"),
-    ),
-    Column(
-        "sensor_measurement_num_id",
-        Integer,
-        ForeignKey("sensor_measurements.sensor_measurement_num_id"),
-    ),
-)
+# Version 2 stores the topic, sensor and measurement ids directly on each
+# reading instead of in one association table per dimension. Older databases
+# are converted with ``migrate_sensor_data_db``.
+# Version 3 drops the unused value_2 column and stores string values as ids
+# into the labels table, a handful of labels repeat in millions of rows.
+# Version 4 adds the packet_key of redelivered packets, a version 3 database
+# is upgraded in place.
+SCHEMA_VERSION = 4
 
 
 ###############################################################################
@@ -112,7 +86,7 @@ class Topic(Base):
         Returns:
         None
         """
-        ic(f"Adding Topic: {topic_to_add}")
+        logger.debug("Adding Topic: %s", topic_to_add)
         topic = (
             session.query(Topic).filter_by(topic=topic_to_add).one_or_none()
         )
@@ -153,7 +127,7 @@ class Sensor(Base):
         Returns:
         None
         """
-        ic(f"Adding Sensor: {sensor_to_add}")
+        logger.debug("Adding Sensor: %s", sensor_to_add)
         existing_sensor = (
             session.query(Sensor).filter_by(sensor_id=sensor_to_add).one_or_none()
         )
@@ -192,7 +166,7 @@ class Measurement(Base):
         Returns:
         None
         """
-        ic(f"Adding Sensor: {measurement_to_add}")
+        logger.debug("Adding Measurement: %s", measurement_to_add)
         measurement = (
             session.query(Measurement).filter_by(measurement=measurement_to_add).one_or_none()
         )
@@ -201,52 +175,105 @@ class Measurement(Base):
         session.add(Measurement(measurement=measurement_to_add))
         session.commit()
 
+
+class Label(Base):
+    """
+    A distinct string value of a reading, e.g. "NNE" or "Gentle Breeze".
+
+    Readings refer to their label by id instead of repeating the string.
+
+    Attributes:
+    - label_num_id (int): The primary key of the label.
+    - label (str): The string value.
+    """
+
+    __tablename__ = "labels"
+    label_num_id = Column(Integer, primary_key=True)
+    label = Column(String, unique=True, nullable=False)
+
+
 class SensorMeasurement(Base):
     """
     Represents a sensor measurement reading stored in the 'sensor_measurements' table of the database.
 
-    This class provides an ORM mapping for the 'sensor_measurements' table. It includes relationships to the 'Topic', 'Sensor', and 'Measurement' classes and records various details about each sensor measurement.
+    This class provides an ORM mapping for the 'sensor_measurements' table. Each reading carries foreign keys to the 'Topic', 'Sensor', and 'Measurement' classes, so writing a reading is a single insert and reading one back needs no association tables.
 
     Attributes:
     - sensor_measurement_num_id (int): The primary key of the sensor measurement.
+    - topic_num_id (int): Foreign key to the 'topics' table.
+    - sensor_num_id (int): Foreign key to the 'sensors' table.
+    - measurement_num_id (int): Foreign key to the 'measurements' table.
     - topic (relationship): The relationship to the 'Topic' class.
     - sensor (relationship): The relationship to the 'Sensor' class.
     - time (TIMESTAMP): The time at which the measurement was recorded.
     - measurement (relationship): The relationship to the 'Measurement' class.
-    - value (float): The numerical value of the measurement.
-    - value_2 (float): An additional numerical value for the measurement.
-    - str_value (str): The string representation of the measurement value.
+    - value (float): The numerical value of the measurement, NULL for
+      readings with only a string value.
+    - label_num_id (int): Foreign key to the 'labels' table, NULL for
+      readings without a string value.
+    - label (relationship): The relationship to the 'Label' class.
+    - str_value (str): The string value of the measurement, "" if none.
+    - packet_key (int): The sequence number or device time (microseconds)
+      of the packet, NULL if it carried neither. Unique per sensor and
+      measurement, so a redelivered packet is not stored twice.
 
     Methods:
     - __repr__(): Returns a string representation of the sensor measurement instance.
     """
 
     __tablename__ = "sensor_measurements"
+    __table_args__ = (
+        Index(
+            "ix_sensor_measurements_sensor_measurement_time",
+            "sensor_num_id",
+            "measurement_num_id",
+            "time",
+        ),
+        Index("ix_sensor_measurements_topic_time", "topic_num_id", "time"),
+        Index("ix_sensor_measurements_time", "time"),
+        # partial, most packets carry no key and cost the index nothing
+        Index(
+            "ux_sensor_measurements_packet_key",
+            "sensor_num_id",
+            "measurement_num_id",
+            "packet_key",
+            unique=True,
+            sqlite_where=text("packet_key IS NOT NULL"),
+            postgresql_where=text("packet_key IS NOT NULL"),
+        ),
+    )
     sensor_measurement_num_id = Column(Integer, primary_key=True)
 
-    topic = relationship(
-        "Topic",
-        secondary=topic_sensor_measurement,
-        backref=backref("sensor_measurements"),
+    topic_num_id = Column(
+        Integer, ForeignKey("topics.topic_num_id"), nullable=False
     )
-
-    sensor = relationship(
-        "Sensor",
-        secondary=sensor_sensor_measurement,
-        backref=backref("sensor_measurements"),
+    sensor_num_id = Column(
+        Integer, ForeignKey("sensors.sensor_num_id"), nullable=False
     )
+    measurement_num_id = Column(
+        Integer, ForeignKey("measurements.measurement_num_id"), nullable=False
+    )
+
+    topic = relationship("Topic", backref=backref("sensor_measurements"))
+
+    sensor = relationship("Sensor", backref=backref("sensor_measurements"))
 
     time = Column(TIMESTAMP(timezone=True), server_default=func.now())
 
     measurement = relationship(
-        "Measurement",
-        secondary=measurement_kind_sensor_measurement,
-        backref=backref("sensor_measurements"),
+        "Measurement", backref=backref("sensor_measurements")
     )
 
     value = Column(Float)
-    value_2 = Column(Float)
-    str_value = Column(String)
+    label_num_id = Column(Integer, ForeignKey("labels.label_num_id"))
+
+    label = relationship("Label")
+
+    packet_key = Column(BigInteger)
+
+    @property
+    def str_value(self):
+        return self.label.label if self.label is not None else ""
 
     def __repr__(self):
         """
@@ -263,27 +290,172 @@ class SensorMeasurement(Base):
             "time: {}, "
             "measurement_kind: {}, "
             "measurement_value: {}".format(
-                self.topic[0].topic,
-                self.sensor[0].sensor_id,
+                self.topic.topic,
+                self.sensor.sensor_id,
                 self.time.strftime("%Y-%m-%d %H:%M:%S"),
-                self.measurement[0].measurement,
+                self.measurement.measurement,
                 self.value,
-                self.value_2,
-                self.str_value,
             )
         )
 
 
+class _Rollup:
+    """
+    Columns shared by the rollup tables.
+
+    Each row aggregates the numeric readings of one sensor and measurement
+    over one time bucket; the mean is ``total / count`` so buckets can be
+    merged by adding them up.
+
+    Attributes:
+    - sensor_num_id (int): Foreign key to the 'sensors' table.
+    - measurement_num_id (int): Foreign key to the 'measurements' table.
+    - bucket (DateTime): Start of the bucket, naive UTC.
+    - count (int): Number of readings in the bucket.
+    - total (float): Sum of the reading values.
+    - min (float): Smallest reading value.
+    - max (float): Largest reading value.
+    """
+
+    sensor_num_id = Column(
+        Integer, ForeignKey("sensors.sensor_num_id"), primary_key=True
+    )
+    measurement_num_id = Column(
+        Integer, ForeignKey("measurements.measurement_num_id"),
+        primary_key=True,
+    )
+    bucket = Column(DateTime, primary_key=True)
+    count = Column(Integer, nullable=False)
+    total = Column(Float, nullable=False)
+    min = Column(Float, nullable=False)
+    max = Column(Float, nullable=False)
+
+    @property
+    def mean(self):
+        return self.total / self.count
+
+
+class MinuteRollup(_Rollup, Base):
+    """Per minute aggregates of the readings, see ``_Rollup``."""
+
+    __tablename__ = "rollups_1m"
+
+
+class HourRollup(_Rollup, Base):
+    """Per hour aggregates of the readings, see ``_Rollup``."""
+
+    __tablename__ = "rollups_1h"
+
+
+class DayRollup(_Rollup, Base):
+    """Per day aggregates of the readings, see ``_Rollup``."""
+
+    __tablename__ = "rollups_1d"
+
+
+class LatestReading(Base):
+    """
+    Snapshot of the newest value of every topic, sensor and measurement.
+
+    Kept by ``LatestValues`` in the logger process, so "what is the current
+    value of everything" is a read of this small table instead of a search
+    through sensor_measurements.
+
+    Attributes:
+    - topic (str): Name of the topic.
+    - sensor (str): Name of the sensor.
+    - measurement (str): Name of the measurement.
+    - time (DateTime): When the value was received, naive UTC.
+    - value (float): The numerical value.
+    - str_value (str): The string value, "" if there is none.
+    """
+
+    __tablename__ = "latest_readings"
+
+    topic = Column(String, primary_key=True)
+    sensor = Column(String, primary_key=True)
+    measurement = Column(String, primary_key=True)
+    time = Column(DateTime, nullable=False)
+    value = Column(Float)
+    str_value = Column(String)
+
+
+class SpoolOffset(Base):
+    """
+    How far a spool has been replayed into this database.
+
+    Written in the same transaction as the replayed readings, so after a
+    crash replay resumes exactly after the last committed packet.
+
+    Attributes:
+    - name (str): Name of the spool.
+    - offset (int): Spool offset of the first packet not yet replayed.
+    """
+
+    __tablename__ = "spool_offsets"
+
+    name = Column(String, primary_key=True)
+    offset = Column(Integer, nullable=False)
+
+
+class ReadingBlock(Base):
+    """
+    The readings of one topic, sensor and measurement in a closed window,
+    compressed into one row by ``compression.compact_readings``.
+
+    ``query_readings`` and ``latest_readings`` decode blocks transparently,
+    see ``compression`` for the encoding of ``data``.
+
+    Attributes:
+    - block_num_id (int): The primary key of the block.
+    - topic_num_id (int): Foreign key to the 'topics' table.
+    - sensor_num_id (int): Foreign key to the 'sensors' table.
+    - measurement_num_id (int): Foreign key to the 'measurements' table.
+    - start_time (DateTime): Time of the first reading, naive UTC.
+    - end_time (DateTime): Time of the last reading, naive UTC.
+    - count (int): Number of readings in the block.
+    - max_reading_id (int): Highest sensor_measurement_num_id in the block.
+    - data (bytes): The encoded ids, times, labels and values.
+    """
+
+    __tablename__ = "reading_blocks"
+    __table_args__ = (
+        Index(
+            "ix_reading_blocks_sensor_measurement_start",
+            "sensor_num_id",
+            "measurement_num_id",
+            "start_time",
+        ),
+        Index("ix_reading_blocks_topic_start", "topic_num_id", "start_time"),
+        Index("ix_reading_blocks_start", "start_time"),
+    )
+
+    block_num_id = Column(Integer, primary_key=True)
+    topic_num_id = Column(
+        Integer, ForeignKey("topics.topic_num_id"), nullable=False
+    )
+    sensor_num_id = Column(
+        Integer, ForeignKey("sensors.sensor_num_id"), nullable=False
+    )
+    measurement_num_id = Column(
+        Integer, ForeignKey("measurements.measurement_num_id"), nullable=False
+    )
+    start_time = Column(DateTime, nullable=False)
+    end_time = Column(DateTime, nullable=False)
+    count = Column(Integer, nullable=False)
+    max_reading_id = Column(Integer, nullable=False)
+    data = Column(LargeBinary, nullable=False)
+
+
 def initialize_sensor_data_db(fp="/home/beta/sensor_data.db"):
     """Initialize the database."""
-    ic
     try:
         fp = Path(argv[1])
     except IndexError:
         print("No filepath provided. Using default filepath.")
 
     # with Path(fp) as sqlite_filepath:
-    engine = ic(create_engine(f"sqlite:///{fp}"))
+    engine = create_sqlite_engine(fp)
 
     Base.metadata.create_all(engine)
 
@@ -0,0 +1,366 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, 4CSCC development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import time
+import zlib
+from functools import partial
+from pathlib import Path
+
+from mqtt_data_logger.__main__ import get_parser, resolve_config
+from mqtt_data_logger.batch_writer import BatchWriter
+from mqtt_data_logger.callbacks import parse_sensor_packet, set_packet_parser
+from mqtt_data_logger.clocks import SensorClocks
+from mqtt_data_logger.log_data import (
+    DimensionCache,
+    DuplicateFilter,
+    add_sensors_reading_records_bulk,
+)
+from mqtt_data_logger.logs import (
+    configure_logging,
+    logging_options,
+    stop_logging,
+)
+from mqtt_data_logger.parsing import PacketParser
+from mqtt_data_logger.util import get_mqtt_client, start_session
+
+
+logger = logging.getLogger(__name__)
+
+
+# how the broker traffic is split between the workers
+# - shared: every worker joins one MQTT shared subscription, the broker
+#   hands each message to a single worker
+# - hash: every worker subscribes to all sensor_data, keeps the topics that
+#   hash to its shard and drops the rest before decoding them
+SUBSCRIPTIONS = ("shared", "hash")
+
+# where the workers send their packets
+# - writer: one writer process owns the database, writes stay serialized
+# - shards: each worker writes to a database file of its own
+SINKS = ("writer", "shards")
+
+
+def topic_shard(topic, shards):
+    """Return the shard ``topic`` belongs to, stable across processes."""
+    return zlib.crc32(topic.encode("utf-8")) % shards
+
+
+def shard_db_fp(db_fp, shard):
+    """Return the database file of ``shard`` next to ``db_fp``."""
+    db_fp = Path(db_fp)
+    return db_fp.with_name(
+        "{}_shard{}{}".format(db_fp.stem, shard, db_fp.suffix)
+    )
+
+
+class ShardMessageHandler:
+    """
+    Paho message callback of one worker.
+
+    Drops messages of other shards (hash subscriptions only), decodes the
+    rest, drops packets ``duplicate_filter`` has seen, stamps them with
+    ``clocks`` and hands them to ``sink``, like ``log_sensor_data``. Counts
+    what it did in ``counts``.
+
+    Each worker has a filter and clocks of its own: a packet redelivered to
+    another worker of a shared subscription is only skipped by the unique
+    index of the database it ends up in.
+    """
+
+    def __init__(
+        self, shard, shards, subscription, sink, duplicate_filter=None,
+        clocks=None,
+    ):
+        self.shard = shard
+        self.shards = shards
+        self.subscription = subscription
+        self.sink = sink
+        self.duplicate_filter = duplicate_filter
+        self.clocks = clocks
+        self.counts = {
+            "received": 0,
+            "skipped": 0,
+            "parsed": 0,
+            "malformed": 0,
+            "duplicates": 0,
+        }
+
+    def __call__(self, client, userdata, msg):
+        self.counts["received"] += 1
+        if (
+            self.subscription == "hash"
+            and topic_shard(msg.topic, self.shards) != self.shard
+        ):
+            self.counts["skipped"] += 1
+            return
+        try:
+            packet = parse_sensor_packet(msg.topic, msg.payload, time.time())
+        except Exception as e:
+            self.counts["malformed"] += 1
+            logger.warning("Malformed packet on %s: %s", msg.topic, e)
+            return
+        self.counts["parsed"] += 1
+        if self.duplicate_filter is not None and self.duplicate_filter.seen(
+            packet
+        ):
+            self.counts["duplicates"] += 1
+            return
+        if self.clocks is not None:
+            packet = self.clocks.stamp(packet)
+        self.sink(packet)
+
+
+def _open_batch_writer(db_fp, options):
+    session = start_session(db_fp, options["sqlite_profile"])
+    cache = DimensionCache().warm(session)
+    session.commit()
+    return BatchWriter(
+        session,
+        max_batch_size=options["batch_size"],
+        max_latency=options["max_latency"],
+        max_queue_size=options["queue_size"],
+        write_batch=partial(
+            add_sensors_reading_records_bulk, cache=cache,
+            rollups=options.get("rollups", False),
+        ),
+    ).start()
+
+
+def ingest_worker(shard, options, packet_queue, stats_queue, stop_event):
+    """Process entry point of a worker: receive, decode and forward."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    configure_logging(**options.get("logging", {}))
+    set_packet_parser(
+        PacketParser(decoder=options.get("json_decoder", "auto"))
+    )
+    writer = None
+    if options["sink"] == "shards":
+        writer = _open_batch_writer(
+            shard_db_fp(options["db"], shard), options
+        )
+        sink = writer.put
+    else:
+        sink = packet_queue.put
+
+    handler = ShardMessageHandler(
+        shard, options["workers"], options["subscription"], sink,
+        duplicate_filter=(
+            DuplicateFilter(options["dedup_capacity"])
+            if options["dedup_capacity"] else None
+        ),
+        clocks=SensorClocks(options["clock_tolerance"]),
+    )
+    broker = options["broker"]
+    # every worker needs a client id of its own
+    broker = broker._replace(client_id="{}-{}".format(
+        broker.client_id or "mqtt-data-logger-" + options["share_group"],
+        shard,
+    ))
+    share_group = None
+    if options["subscription"] == "shared":
+        share_group = options["share_group"]
+    client = get_mqtt_client(handler, broker, share_group=share_group)
+    client.loop_start()
+
+    def report():
+        stats = dict(handler.counts)
+        if writer is not None:
+            stats.update(writer.stats())
+        stats_queue.put(("worker", shard, stats))
+
+    try:
+        while not stop_event.wait(options["stats_interval"]):
+            report()
+    finally:
+        client.disconnect()
+        client.loop_stop()
+        if writer is not None:
+            writer.close()
+        report()
+        stop_logging()
+
+
+def writer_loop(packet_queue, writer, stop_marker=None):
+    """Move packets from ``packet_queue`` into ``writer`` until the marker."""
+    while True:
+        packet = packet_queue.get()
+        if packet is stop_marker:
+            return
+        writer.put(packet)
+
+
+def writer_process(options, packet_queue, stats_queue, stop_event):
+    """Process entry point of the single serialized writer."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    configure_logging(**options.get("logging", {}))
+    writer = _open_batch_writer(options["db"], options)
+    try:
+        writer_loop(packet_queue, writer)
+    finally:
+        writer.close()
+        stats_queue.put(("writer", None, writer.stats()))
+        stop_logging()
+
+
+class ShardedSupervisor:
+    """
+    Starts and stops the worker processes of a sharded logger.
+
+    Each of the ``workers`` processes subscribes to a slice of the
+    sensor_data traffic and decodes it on its own core. With the "writer"
+    sink, parsed packets go through a multiprocessing queue to one writer
+    process, otherwise each worker writes its own shard database.
+
+    Workers report their counters every ``stats_interval`` seconds;
+    ``aggregate_stats`` sums the latest report of every process.
+    """
+
+    def __init__(self, options):
+        self.options = options
+        self._context = multiprocessing.get_context("spawn")
+        self._stop = self._context.Event()
+        self._packets = self._context.Queue(options["queue_size"])
+        self._stats = self._context.Queue()
+        self._workers = []
+        self._writer = None
+        self._latest = {}
+
+    def start(self):
+        """Start the writer (if any) and the worker processes."""
+        if self.options["sink"] == "writer":
+            self._writer = self._context.Process(
+                target=writer_process,
+                args=(self.options, self._packets, self._stats, self._stop),
+                name="mqtt-data-logger-writer",
+            )
+            self._writer.start()
+        for shard in range(self.options["workers"]):
+            worker = self._context.Process(
+                target=ingest_worker,
+                args=(shard, self.options, self._packets, self._stats,
+                      self._stop),
+                name=f"mqtt-data-logger-worker-{shard}",
+            )
+            worker.start()
+            self._workers.append(worker)
+        return self
+
+    def poll_stats(self, timeout=None):
+        """Collect pending reports, waiting up to ``timeout`` for one."""
+        try:
+            while True:
+                kind, shard, stats = self._stats.get(timeout=timeout)
+                self._latest[(kind, shard)] = stats
+                timeout = 0
+        except queue.Empty:
+            pass
+        return self.aggregate_stats()
+
+    def aggregate_stats(self):
+        """Sum the latest counters of all workers (and the writer)."""
+        total = {}
+        for (kind, shard), stats in self._latest.items():
+            for name, value in stats.items():
+                key = name if kind == "worker" else f"writer_{name}"
+                total[key] = total.get(key, 0) + value
+        total["workers"] = sum(w.is_alive() for w in self._workers)
+        return total
+
+    def stop(self):
+        """Stop the workers, then let the writer drain its queue."""
+        self._stop.set()
+        for worker in self._workers:
+            worker.join()
+        if self._writer is not None:
+            self._packets.put(None)
+            self._writer.join()
+        return self.poll_stats(timeout=0.1)
+
+
+def main(argv=None):
+    parser = get_parser()
+    parser.prog = "run_mqtt_logger_sharded"
+    parser.add_argument(
+        "--workers", type=int, default=os.cpu_count(),
+        help="number of ingest processes",
+    )
+    parser.add_argument(
+        "--subscription", choices=SUBSCRIPTIONS, default="shared",
+        help="split traffic with a shared subscription or a topic hash",
+    )
+    parser.add_argument(
+        "--share-group", default="mqtt-data-logger",
+        help="name of the shared subscription group",
+    )
+    parser.add_argument(
+        "--sink", choices=SINKS, default="writer",
+        help="one writer process, or one database per worker",
+    )
+    parser.add_argument(
+        "--stats-interval", type=float, default=10.0,
+        help="seconds between aggregate stats reports",
+    )
+    args = parser.parse_args(argv)
+    config = resolve_config(args, parser)
+    if len(config.brokers) > 1 or not config.is_single_sqlite():
+        parser.error("the sharded logger runs on one broker and one database")
+    broker = config.brokers[0]
+    if args.no_batching or args.partition:
+        parser.error("the sharded logger always batches, without partitions")
+    if args.latest_values or args.live_port is not None:
+        parser.error("the sharded logger does not keep latest values")
+    if args.spool:
+        parser.error("the sharded logger does not spool")
+    if args.metrics_port is not None:
+        parser.error("the sharded logger does not serve metrics")
+    if args.profile or args.replay:
+        parser.error("profile or replay with run_mqtt_logger")
+    if args.dedup_capacity < 0:
+        parser.error("--dedup-capacity cannot be negative")
+    if args.clock_tolerance < 0:
+        parser.error("--clock-tolerance cannot be negative")
+
+    options = {
+        "workers": args.workers,
+        "subscription": args.subscription,
+        "share_group": args.share_group,
+        "sink": args.sink,
+        "broker": broker,
+        "db": str(args.db),
+        "sqlite_profile": args.sqlite_profile,
+        "batch_size": args.batch_size,
+        "max_latency": args.max_latency,
+        "queue_size": args.queue_size,
+        "stats_interval": args.stats_interval,
+        "rollups": args.rollups,
+        "json_decoder": args.json_decoder,
+        "dedup_capacity": args.dedup_capacity,
+        "clock_tolerance": args.clock_tolerance,
+        # every process logs through its own queue listener
+        "logging": logging_options(args),
+    }
+    configure_logging(**options["logging"])
+    supervisor = ShardedSupervisor(options).start()
+    try:
+        while True:
+            time.sleep(args.stats_interval)
+            logger.info("Stats: %s", supervisor.poll_stats(timeout=0))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        logger.info("Final stats: %s", supervisor.stop())
+        stop_logging()
+
+
+if __name__ == "__main__":
+    main()
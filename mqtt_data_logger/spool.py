@@ -0,0 +1,428 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, 4CSCC development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import logging
+import mmap
+import struct
+import threading
+import zlib
+from collections import namedtuple
+from pathlib import Path
+
+from sqlalchemy import select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import OperationalError
+
+from mqtt_data_logger.callbacks import parse_sensor_packet
+from mqtt_data_logger.log_data import add_sensors_reading_records_bulk
+from mqtt_data_logger.sensor_data_models import SpoolOffset
+
+
+logger = logging.getLogger(__name__)
+
+
+# record header: length and crc32 of the body that follows; a zero length
+# marks the end of the data written to a segment
+HEADER = struct.Struct("<II")
+# start of the body: received_at and length of the utf-8 topic
+BODY = struct.Struct("<dH")
+
+SEGMENT_SUFFIX = ".spool"
+
+# A raw mqtt message read back from the spool. ``offset`` is where it
+# starts, ``next_offset`` where the record after it starts.
+SpoolRecord = namedtuple(
+    "SpoolRecord",
+    ["offset", "next_offset", "topic", "payload", "received_at"],
+)
+
+
+def _segment_path(directory, base):
+    return directory / "{:020d}{}".format(base, SEGMENT_SUFFIX)
+
+
+def _encode(topic, payload, received_at):
+    topic = topic.encode("utf-8")
+    body = BODY.pack(received_at, len(topic)) + topic + payload
+    return HEADER.pack(len(body), zlib.crc32(body)) + body
+
+
+def _decode(view, position, limit):
+    """Return ``(record fields, next position)`` or None at the end."""
+    if position + HEADER.size > limit:
+        return None
+    length, crc = HEADER.unpack_from(view, position)
+    start = position + HEADER.size
+    if length == 0 or start + length > limit:
+        return None
+    body = bytes(view[start:start + length])
+    if zlib.crc32(body) != crc:
+        return None
+    received_at, topic_length = BODY.unpack_from(body)
+    topic_end = BODY.size + topic_length
+    topic = body[BODY.size:topic_end].decode("utf-8")
+    return (topic, body[topic_end:], received_at), start + length
+
+
+def segment_bases(directory):
+    """Return the base offsets of the segment files, oldest first."""
+    return sorted(
+        int(fp.stem) for fp in Path(directory).glob("*" + SEGMENT_SUFFIX)
+    )
+
+
+def read_records(directory, offset=0, max_records=1000):
+    """
+    Return up to ``max_records`` ``SpoolRecord``s of the spool in
+    ``directory`` from ``offset`` on.
+
+    The segments are only mapped for reading, unlike opening a ``Spool``
+    nothing is extended or zeroed, so this is safe on the spool of a
+    running logger: a record it is still writing is not seen yet.
+    """
+    directory = Path(directory)
+    records = []
+    bases = segment_bases(directory)
+    for index, base in enumerate(bases):
+        next_base = bases[index + 1] if index + 1 < len(bases) else None
+        if next_base is not None and next_base <= offset:
+            continue
+        position = max(offset - base, 0)
+        try:
+            f = open(_segment_path(directory, base), "rb")
+        except FileNotFoundError:
+            # released by the logger since it was listed
+            continue
+        with f:
+            if f.seek(0, 2) == 0:
+                # created, but not sized yet
+                break
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as view:
+                while len(records) < max_records:
+                    decoded = _decode(view, position, len(view))
+                    if decoded is None:
+                        break
+                    (topic, payload, received_at), end = decoded
+                    records.append(SpoolRecord(
+                        base + position, base + end, topic, payload,
+                        received_at,
+                    ))
+                    position = end
+        if len(records) >= max_records:
+            break
+    return records
+
+
+class Spool:
+    """
+    Append-only, memory-mapped log of raw mqtt messages.
+
+    The log is a directory of fixed size segment files named after the
+    offset of their first byte. ``append`` copies a checksummed record into
+    the mapped active segment, which costs microseconds and never touches
+    the database; a full segment is closed and a new one started. Offsets
+    are contiguous across segments.
+
+    On open, the active (newest) segment is scanned and everything after
+    its last valid record, e.g. a record torn by a crash, is zeroed.
+
+    Records survive a crash of the process as soon as ``append`` returns,
+    and a power failure once ``flush`` has synced them to disk.
+
+    Parameters:
+    - directory (Path): Where the segment files live.
+    - segment_size (int): Bytes per segment, the largest possible record.
+
+    Methods:
+    - append(topic, payload, received_at): Adds a record, returns its offset.
+    - read(offset, max_records): Returns the records from ``offset`` on.
+    - end_offset(): Returns the offset the next record will get.
+    - wait(timeout): Waits until a record was appended.
+    - flush(): Syncs the active segment to disk.
+    - release(offset): Deletes segments entirely before ``offset``.
+    - close(): Flushes and unmaps the active segment.
+    """
+
+    def __init__(self, directory, segment_size=16 * 1024 * 1024):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.segment_size = segment_size
+        self.appended = 0
+        self._lock = threading.Lock()
+        self._appended = threading.Event()
+        bases = self.segments()
+        self._open_segment(bases[-1] if bases else 0)
+
+    def segments(self):
+        """Return the base offsets of the segment files, oldest first."""
+        return segment_bases(self.directory)
+
+    def _open_segment(self, base):
+        fp = _segment_path(self.directory, base)
+        with open(fp, "a+b") as f:
+            f.truncate(max(self.segment_size, f.seek(0, 2)))
+        self._file = open(fp, "r+b")
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        self._base = base
+        position = 0
+        while True:
+            decoded = _decode(self._map, position, len(self._map))
+            if decoded is None:
+                break
+            position = decoded[1]
+        # clear whatever a crash left behind the last good record
+        self._map[position:] = bytes(len(self._map) - position)
+        self._position = position
+
+    def _roll(self):
+        self._map.flush()
+        self._map.close()
+        self._file.close()
+        self._open_segment(self._base + self._position)
+
+    def append(self, topic, payload, received_at):
+        """Append a raw message, returns the offset of its record."""
+        record = _encode(topic, payload, received_at)
+        if len(record) + HEADER.size > self.segment_size:
+            raise ValueError(
+                "Record of {} bytes does not fit a spool segment of {}".format(
+                    len(record), self.segment_size
+                )
+            )
+        with self._lock:
+            # keep room for the zero header that ends the segment
+            if self._position + len(record) + HEADER.size > len(self._map):
+                self._roll()
+            position = self._position
+            # body first, header last: readers see a record only once whole
+            self._map[position + HEADER.size:position + len(record)] = (
+                record[HEADER.size:]
+            )
+            self._map[position:position + HEADER.size] = (
+                record[:HEADER.size]
+            )
+            self._position += len(record)
+            self.appended += 1
+        self._appended.set()
+        return self._base + position
+
+    def end_offset(self):
+        """Return the offset the next appended record will get."""
+        with self._lock:
+            return self._base + self._position
+
+    def wait(self, timeout=None):
+        """Wait up to ``timeout`` seconds for an append, True if one came."""
+        appended = self._appended.wait(timeout)
+        self._appended.clear()
+        return appended
+
+    def read(self, offset, max_records=1000):
+        """Return up to ``max_records`` ``SpoolRecord``s from ``offset``."""
+        return read_records(self.directory, offset, max_records)
+
+    def flush(self):
+        """Sync the active segment to disk."""
+        with self._lock:
+            self._map.flush()
+
+    def release(self, offset):
+        """Delete the segments whose records all lie before ``offset``."""
+        bases = self.segments()
+        released = 0
+        for base, next_base in zip(bases, bases[1:]):
+            if next_base > offset or base == self._base:
+                break
+            _segment_path(self.directory, base).unlink()
+            released += 1
+        return released
+
+    def close(self):
+        with self._lock:
+            self._map.flush()
+            self._map.close()
+            self._file.close()
+
+
+def committed_offset(session, name="default"):
+    """Return the offset replay of spool ``name`` has committed up to."""
+    return session.execute(
+        select(SpoolOffset.offset).where(SpoolOffset.name == name)
+    ).scalar_one_or_none() or 0
+
+
+def _set_offset(name, offset):
+    def set_offset(session):
+        statement = sqlite_insert(SpoolOffset.__table__).values(
+            name=name, offset=offset
+        )
+        session.execute(statement.on_conflict_do_update(
+            index_elements=["name"], set_={"offset": offset}
+        ))
+    return set_offset
+
+
+class SpoolReplayer:
+    """
+    Drains a ``Spool`` into the database, exactly once.
+
+    Records are read from the committed offset, parsed and written with
+    ``add_sensors_reading_records_bulk``; the new offset is stored in the
+    spool_offsets table in the same transaction, so every record is
+    written once even if the process dies between batches. While the
+    database is locked or unavailable the batch is retried with backoff,
+    the records stay safe in the spool and ingest carries on.
+
+    Attributes:
+    - spool (Spool): The spool to replay.
+    - session (Session): Only used by the replay thread.
+    - cache (DimensionCache): Dimension ids for the bulk writer.
+    - name (str): Key of the offset in spool_offsets.
+    - max_batch_size (int): Records committed per transaction at most.
+    - max_latency (float): Seconds to wait for new records when idle.
+    - rollups (bool): Also update the rollup tables.
+    - latest_values (LatestValues): Updated with every parsed packet.
+    - clocks (SensorClocks): Assigns the time of every parsed packet.
+    """
+
+    def __init__(
+        self,
+        spool,
+        session,
+        cache,
+        name="default",
+        max_batch_size=500,
+        max_latency=0.5,
+        rollups=False,
+        latest_values=None,
+        clocks=None,
+        retry_delay=0.5,
+        max_retry_delay=30.0,
+    ):
+        self.spool = spool
+        self.session = session
+        self.cache = cache
+        self.name = name
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.rollups = rollups
+        self.latest_values = latest_values
+        self.clocks = clocks
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.counts = {
+            "replayed": 0,
+            "malformed": 0,
+            "failed": 0,
+            "batches": 0,
+            "retries": 0,
+        }
+        self.offset = committed_offset(session, name)
+        session.commit()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name="mqtt-data-logger-spool", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def replay_once(self):
+        """Write the next batch of records, returns how many were read."""
+        records = self.spool.read(self.offset, self.max_batch_size)
+        if not records:
+            return 0
+        parsed = []
+        for record in records:
+            try:
+                packet = parse_sensor_packet(
+                    record.topic, record.payload, record.received_at
+                )
+            except Exception as e:
+                self.counts["malformed"] += 1
+                logger.warning(
+                    "Malformed packet on %s: %s", record.topic, e
+                )
+                continue
+            if self.clocks is not None:
+                packet = self.clocks.stamp(packet)
+            parsed.append((record, packet))
+        packets = [packet for record, packet in parsed]
+        try:
+            self._write(packets, records[-1].next_offset)
+        except OperationalError:
+            raise
+        except Exception as e:
+            # one bad packet must not block the spool, retry one by one
+            logger.error("Spool batch failed, replaying singly: %s", e)
+            packets = self._write_singly(parsed, records[-1].next_offset)
+        self.counts["batches"] += 1
+        if self.latest_values is not None:
+            for packet in packets:
+                self.latest_values.update(packet)
+        self.spool.release(self.offset)
+        return len(records)
+
+    def _write(self, packets, next_offset):
+        add_sensors_reading_records_bulk(
+            self.session, packets, self.cache, self.rollups,
+            before_commit=_set_offset(self.name, next_offset),
+        )
+        self.offset = next_offset
+        self.counts["replayed"] += len(packets)
+
+    def _write_singly(self, parsed, next_offset):
+        written = []
+        for record, packet in parsed:
+            try:
+                self._write([packet], record.next_offset)
+            except OperationalError:
+                raise
+            except Exception as e:
+                self.counts["failed"] += 1
+                logger.error("Dropping packet at %s: %s", record.offset, e)
+            else:
+                written.append(packet)
+        self._write([], next_offset)
+        return written
+
+    def close(self, timeout=None):
+        """Replay what is left in the spool, then stop."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def stats(self):
+        stats = dict(self.counts)
+        stats["lag_bytes"] = self.spool.end_offset() - self.offset
+        return stats
+
+    def _run(self):
+        delay = self.retry_delay
+        while True:
+            try:
+                read = self.replay_once()
+            except OperationalError as e:
+                self.counts["retries"] += 1
+                logger.warning(
+                    "Spool replay failed, retrying in %ss: %s", delay, e
+                )
+                if self._stop.wait(delay):
+                    return
+                delay = min(delay * 2, self.max_retry_delay)
+                continue
+            delay = self.retry_delay
+            self.spool.flush()
+            if read:
+                continue
+            if self._stop.is_set():
+                return
+            self.spool.wait(self.max_latency)
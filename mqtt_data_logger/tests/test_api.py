@@ -0,0 +1,159 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, 4CSCC development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import json
+import tempfile
+import threading
+import unittest
+import urllib.error
+import urllib.request
+from datetime import datetime, timezone
+from http import HTTPStatus
+from pathlib import Path
+
+from mqtt_data_logger.api import (
+    ReadingsApi,
+    ResponseCache,
+    Watermark,
+    make_server,
+)
+from mqtt_data_logger.db import create_sqlite_engine
+from mqtt_data_logger.latest import LatestValues
+from mqtt_data_logger.log_data import (
+    SensorPacket,
+    add_sensors_reading_records_bulk,
+)
+from mqtt_data_logger.util import start_session
+
+
+def packet(minute, temp):
+    at = datetime(2024, 5, 1, 12, minute, tzinfo=timezone.utc).timestamp()
+    return SensorPacket("sensor_data/env", "env", {"temp": temp}, at)
+
+
+class TestReadingsApi(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        db_fp = Path(self.tmpdir.name) / "sensor_data.db"
+        self.session = start_session(db_fp)
+        add_sensors_reading_records_bulk(
+            self.session, [packet(m, float(m)) for m in range(5)],
+            rollups=True,
+        )
+        self.engine = create_sqlite_engine(db_fp, read_only=True)
+        self.api = ReadingsApi(
+            self.engine, ResponseCache(ttl=60), Watermark(self.engine, 0)
+        )
+
+    def tearDown(self):
+        self.session.close()
+        self.session.get_bind().dispose()
+        self.engine.dispose()
+        self.tmpdir.cleanup()
+
+    def get(self, path, query="", if_none_match=None):
+        status, headers, body = self.api.respond(path, query, if_none_match)
+        return status, headers, json.loads(body) if body else None
+
+    def test_latest_is_cached_until_new_readings(self):
+        status, headers, body = self.get("/latest", "sensor=env")
+        self.assertEqual(status, HTTPStatus.OK)
+        self.assertEqual(body["readings"][0]["value"], 4.0)
+        self.get("/latest", "sensor=env")
+        self.assertEqual(self.api.cache.hits, 1)
+
+        status, _, _ = self.get(
+            "/latest", "sensor=env", if_none_match=headers["ETag"]
+        )
+        self.assertEqual(status, HTTPStatus.NOT_MODIFIED)
+
+        add_sensors_reading_records_bulk(self.session, [packet(9, 9.0)])
+        status, new_headers, body = self.get(
+            "/latest", "sensor=env", if_none_match=headers["ETag"]
+        )
+        self.assertEqual(status, HTTPStatus.OK)
+        self.assertNotEqual(new_headers["ETag"], headers["ETag"])
+        self.assertEqual(body["readings"][0]["value"], 9.0)
+
+    def test_readings_pages(self):
+        _, _, body = self.get("/readings", "measurement=temp&limit=3")
+        self.assertEqual([r["value"] for r in body["readings"]], [0, 1, 2])
+        _, _, body = self.get(
+            "/readings", f"measurement=temp&limit=3&after={body['next']}"
+        )
+        self.assertEqual([r["value"] for r in body["readings"]], [3, 4])
+        self.assertIsNone(body["next"])
+
+    def test_series_and_errors(self):
+        _, _, body = self.get(
+            "/series", "sensor=env&measurement=temp&resolution=3600"
+            "&start=2024-05-01T00:00&end=2024-05-02T00:00",
+        )
+        self.assertEqual(body["series"], [{
+            "time": "2024-05-01T12:00:00", "count": 5, "mean": 2.0,
+            "min": 0.0, "max": 4.0,
+        }])
+        status, _, body = self.get("/series", "sensor=env")
+        self.assertEqual(status, HTTPStatus.BAD_REQUEST)
+        status, _, _ = self.get("/readings", "start=yesterday")
+        self.assertEqual(status, HTTPStatus.BAD_REQUEST)
+        for path, query in [
+            ("/readings", "limit=-1"),
+            ("/readings", "limit=0"),
+            ("/series", "sensor=env&measurement=temp&resolution=0"
+                        "&start=2024-05-01T00:00&end=2024-05-02T00:00"),
+            ("/series", "sensor=env&measurement=temp&resolution=-60"
+                        "&start=2024-05-01T00:00&end=2024-05-02T00:00"),
+        ]:
+            status, _, body = self.get(path, query)
+            self.assertEqual(status, HTTPStatus.BAD_REQUEST, query)
+        self.assertEqual(body["error"], "resolution must be positive, "
+                                        "not '-60'")
+        status, _, _ = self.get("/nope")
+        self.assertEqual(status, HTTPStatus.NOT_FOUND)
+
+    def test_internal_errors(self):
+        def fail(session, params):
+            raise RuntimeError("database is gone")
+
+        self.api.routes["/readings"] = fail
+        with self.assertLogs("mqtt_data_logger.api", "ERROR"):
+            status, _, body = self.get("/readings")
+        self.assertEqual(status, HTTPStatus.INTERNAL_SERVER_ERROR)
+        self.assertEqual(body, {"error": "internal error"})
+
+    def test_latest_from_snapshot(self):
+        latest = LatestValues()
+        latest.update(packet(7, 7.0))
+        latest.snapshot(self.session.get_bind())
+        api = ReadingsApi(self.engine, latest_snapshot=True)
+        status, headers, body = api.respond("/latest", "sensor=env")
+        self.assertEqual(json.loads(body)["readings"][0]["value"], 7.0)
+
+    def test_http_round_trip(self):
+        server = make_server(self.api, port=0)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        url = "http://127.0.0.1:{}/latest".format(server.server_address[1])
+        try:
+            with urllib.request.urlopen(url) as response:
+                etag = response.headers["ETag"]
+                self.assertEqual(len(json.load(response)["readings"]), 1)
+            request = urllib.request.Request(
+                url, headers={"If-None-Match": etag}
+            )
+            with self.assertRaises(urllib.error.HTTPError) as raised:
+                urllib.request.urlopen(request)
+            self.assertEqual(raised.exception.code, 304)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,121 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, 4CSCC development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import asyncio
+import json
+import time
+import unittest
+
+from sqlalchemy.exc import OperationalError
+
+from mqtt_data_logger.async_ingest import AsyncIngestPipeline
+from mqtt_data_logger.callbacks import dead_letters
+from mqtt_data_logger.log_data import DuplicateFilter
+
+
+def payload(sensor="env", seq=None, **data):
+    packet = {"sensor": sensor, "data": data}
+    if seq is not None:
+        packet["seq"] = seq
+    return json.dumps(packet).encode()
+
+
+class TestAsyncIngestPipeline(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.batches = []
+
+    def slow_write(self, session, packets):
+        time.sleep(0.05)
+        self.batches.append(packets)
+
+    async def test_pipeline_writes_batches(self):
+        pipeline = await AsyncIngestPipeline(
+            None, self.slow_write, max_batch_size=10, max_latency=0.01
+        ).start()
+        for i in range(25):
+            pipeline.submit("sensor_data/env", payload(temp=i))
+            await asyncio.sleep(0)
+        await pipeline.stop()
+
+        packets = [p for batch in self.batches for p in batch]
+        self.assertEqual([p.measurements["temp"] for p in packets],
+                         list(range(25)))
+        stats = pipeline.stats()
+        self.assertEqual(stats["written"], 25)
+        self.assertEqual(stats["stages"]["end_to_end"]["count"], 25)
+
+    async def test_receive_does_not_wait_for_writes(self):
+        pipeline = await AsyncIngestPipeline(
+            None, self.slow_write, max_batch_size=1, max_latency=0
+        ).start()
+        started = time.perf_counter()
+        for i in range(20):
+            pipeline.submit("sensor_data/env", payload(temp=i))
+            await asyncio.sleep(0)
+        # 20 writes take a second, receiving them must not
+        self.assertLess(time.perf_counter() - started, 0.5)
+        await pipeline.stop()
+        self.assertEqual(pipeline.stats()["written"], 20)
+
+    async def test_malformed_and_dropped(self):
+        pipeline = await AsyncIngestPipeline(
+            None, self.slow_write, queue_size=1
+        ).start()
+        malformed = dead_letters.count
+        self.assertTrue(pipeline.submit("sensor_data/env", b"not json"))
+        self.assertFalse(pipeline.submit("sensor_data/env", payload(t=1)))
+        await pipeline.stop()
+
+        stats = pipeline.stats()
+        self.assertEqual(stats["malformed"], 1)
+        self.assertEqual(stats["dropped"], 1)
+        self.assertEqual(dead_letters.count, malformed + 1)
+
+    async def test_redelivered_packets_are_dropped(self):
+        pipeline = await AsyncIngestPipeline(
+            None, self.slow_write, max_latency=0.01,
+            duplicate_filter=DuplicateFilter(),
+        ).start()
+        for seq in (1, 2, 1):
+            pipeline.submit("sensor_data/env", payload(seq=seq, temp=1.0))
+            await asyncio.sleep(0)
+        await pipeline.stop()
+
+        packets = [p for batch in self.batches for p in batch]
+        self.assertEqual([p.key for p in packets], [1, 2])
+        self.assertEqual(pipeline.stats()["duplicates"], 1)
+
+    async def test_failed_batches_are_retried(self):
+        locked = [True]
+
+        def write(session, packets):
+            if locked:
+                locked.pop()
+                raise OperationalError("INSERT", {}, "database is locked")
+            if any(p.measurements["temp"] == 2 for p in packets):
+                raise ValueError("bad packet")
+            self.batches.append(packets)
+
+        pipeline = await AsyncIngestPipeline(
+            None, write, max_batch_size=5, max_latency=1, retry_delay=0
+        ).start()
+        for i in range(5):
+            pipeline.submit("sensor_data/env", payload(temp=i))
+        with self.assertLogs("mqtt_data_logger.async_ingest", "ERROR"):
+            await pipeline.stop()
+
+        # the lock is retried, then the bad packet only drops itself
+        packets = [p for batch in self.batches for p in batch]
+        self.assertEqual([p.measurements["temp"] for p in packets],
+                         [0, 1, 3, 4])
+        stats = pipeline.stats()
+        self.assertEqual((stats["written"], stats["failed"]), (4, 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,189 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, 4CSCC development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import os
+import tempfile
+import unittest
+from pathlib import Path
+
+from sqlalchemy import func, select
+from sqlalchemy.orm import sessionmaker
+
+from mqtt_data_logger.backends import PostgresCopyBackend, SQLiteBackend
+from mqtt_data_logger.db import create_database_engine
+from mqtt_data_logger.log_data import SensorPacket
+from mqtt_data_logger.query import query_readings
+from mqtt_data_logger.sensor_data_models import (
+    Base,
+    Sensor,
+    SensorMeasurement,
+    SpoolOffset,
+)
+
+try:
+    import psycopg
+except ImportError:
+    psycopg = None
+
+# e.g. postgresql+psycopg://logger@localhost/mqtt_logger_test, the tables of
+# that database are dropped by the tests
+POSTGRES_URL = os.environ.get("MQTT_LOGGER_TEST_POSTGRES_URL")
+
+
+class BackendTests:
+    """The behaviour every ``StorageBackend`` has, run once per backend."""
+
+    def make_backend(self):
+        raise NotImplementedError
+
+    def database_url(self):
+        raise NotImplementedError
+
+    def setUp(self):
+        self.engine = create_database_engine(self.database_url())
+        Base.metadata.drop_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+        self.backend = self.make_backend().prepare(self.session)
+
+    def tearDown(self):
+        self.session.close()
+        Base.metadata.drop_all(self.engine)
+        self.engine.dispose()
+
+    def readings(self):
+        self.session.commit()
+        return sorted(
+            query_readings(self.session),
+            key=lambda reading: reading.reading_id,
+        )
+
+    def count(self, model):
+        return self.session.execute(
+            select(func.count()).select_from(model)
+        ).scalar()
+
+    def test_writes_readings(self):
+        self.backend.write_batch(self.session, [
+            SensorPacket("sensor_data/env", "env", {"temp": 20.5,
+                                                    "humidity": 41.0},
+                         1700000000.0),
+            SensorPacket("sensor_data/wind", "anemometer",
+                         {"wind_speed_beaufort": ("Calm", 0.5)},
+                         1700000001.25),
+        ])
+        readings = self.readings()
+        self.assertEqual(
+            [(r.topic, r.sensor, r.measurement, r.value, r.str_value)
+             for r in readings],
+            [
+                ("sensor_data/env", "env", "temp", 20.5, ""),
+                ("sensor_data/env", "env", "humidity", 41.0, ""),
+                ("sensor_data/wind", "anemometer", "wind_speed_beaufort",
+                 0.5, "Calm"),
+            ],
+        )
+        self.assertEqual(
+            readings[2].time.replace(tzinfo=None).isoformat(),
+            "2023-11-14T22:13:21.250000",
+        )
+
+    def test_dimensions_are_reused(self):
+        for received_at in (1.0, 2.0):
+            self.backend.write_batch(self.session, [
+                SensorPacket("sensor_data/env", "env", {"temp": 20.0},
+                             received_at),
+                SensorPacket("sensor_data/env", "env_2", {"temp": 21.0},
+                             received_at),
+            ])
+        self.assertEqual(len(self.readings()), 4)
+        self.assertEqual(self.count(Sensor), 2)
+
+    def test_before_commit_runs_in_the_transaction(self):
+        def record_offset(session):
+            session.add(SpoolOffset(name="spool", offset=7))
+
+        self.backend.write_batch(
+            self.session,
+            [SensorPacket("sensor_data/env", "env", {"temp": 20.0}, 1.0)],
+            before_commit=record_offset,
+        )
+        self.assertEqual(self.session.get(SpoolOffset, "spool").offset, 7)
+        self.assertEqual(len(self.readings()), 1)
+
+    def test_failed_batch_is_rolled_back(self):
+        def fail(session):
+            raise RuntimeError("disk full")
+
+        packets = [SensorPacket("sensor_data/new", "new", {"co2": 400.0},
+                                1.0)]
+        with self.assertRaises(RuntimeError):
+            self.backend.write_batch(self.session, packets,
+                                     before_commit=fail)
+        self.assertEqual(self.readings(), [])
+
+        # the ids of the rolled back names were forgotten
+        self.backend.write_batch(self.session, packets)
+        reading, = self.readings()
+        self.assertEqual((reading.sensor, reading.value), ("new", 400.0))
+
+    def test_redelivered_readings_are_skipped(self):
+        packets = [
+            SensorPacket("sensor_data/env", "env", {"temp": 20.0}, 1.0, 1),
+            SensorPacket("sensor_data/env", "env", {"temp": 21.0}, 2.0, 2),
+        ]
+        self.backend.write_batch(self.session, packets)
+        # the broker resends the second packet with a new one
+        self.backend.write_batch(self.session, packets[1:] + [
+            SensorPacket("sensor_data/env", "env", {"temp": 22.0}, 3.0, 3),
+        ])
+        self.assertEqual(
+            [r.value for r in self.readings()], [20.0, 21.0, 22.0]
+        )
+
+    def test_empty_batch(self):
+        self.backend.write_batch(self.session, [])
+        self.assertEqual(self.count(SensorMeasurement), 0)
+
+
+class TestSQLiteBackend(BackendTests, unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        self.directory.cleanup()
+
+    def database_url(self):
+        return f"sqlite:///{Path(self.directory.name) / 'test.db'}"
+
+    def make_backend(self):
+        return SQLiteBackend()
+
+
+@unittest.skipUnless(
+    POSTGRES_URL and psycopg is not None,
+    "set MQTT_LOGGER_TEST_POSTGRES_URL and install psycopg",
+)
+class TestPostgresCopyBackend(BackendTests, unittest.TestCase):
+
+    def database_url(self):
+        return POSTGRES_URL
+
+    def make_backend(self):
+        return PostgresCopyBackend()
+
+
+class TestPostgresCopyBackendCsv(TestPostgresCopyBackend):
+
+    def make_backend(self):
+        return PostgresCopyBackend(copy_format="csv")
+
+
+if __name__ == "__main__":
+    unittest.main()
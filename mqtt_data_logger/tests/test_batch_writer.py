@@ -0,0 +1,122 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, 4CSCC development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import tempfile
+import time
+import unittest
+from pathlib import Path
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from mqtt_data_logger.batch_writer import BatchWriter
+from mqtt_data_logger.log_data import SensorPacket
+from mqtt_data_logger.sensor_data_models import Base, SensorMeasurement
+
+
+def make_packet(sensor="env", temp=25.0):
+    return SensorPacket(
+        "sensor_data/env", sensor, {"temp": temp, "humidity": 50.0},
+        time.time(),
+    )
+
+
+class TestBatchWriter(unittest.TestCase):
+
+    def setUp(self):
+        # a file database so the writer thread sees the same tables
+        self.tmpdir = tempfile.TemporaryDirectory()
+        db_fp = Path(self.tmpdir.name) / "sensor_data.db"
+        self.engine = create_engine(f"sqlite:///{db_fp}")
+        Base.metadata.create_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+        self.batches = []
+
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+        self.tmpdir.cleanup()
+
+    def recording_writer(self, session, batch):
+        self.batches.append(list(batch))
+
+    def test_flushes_by_size(self):
+        writer = BatchWriter(
+            self.session, max_batch_size=10, max_latency=60,
+            write_batch=self.recording_writer,
+        ).start()
+        for i in range(25):
+            writer.put(make_packet(temp=i))
+        writer.close()
+
+        self.assertEqual([len(b) for b in self.batches], [10, 10, 5])
+        self.assertEqual(writer.stats()["written"], 25)
+
+    def test_flushes_by_deadline(self):
+        writer = BatchWriter(
+            self.session, max_batch_size=1000, max_latency=0.05,
+            write_batch=self.recording_writer,
+        ).start()
+        writer.put(make_packet())
+        time.sleep(0.5)
+
+        self.assertEqual(len(self.batches), 1)
+        writer.close()
+
+    def test_drop_overflow(self):
+        writer = BatchWriter(
+            self.session, max_queue_size=2, overflow="drop",
+            write_batch=self.recording_writer,
+        )
+        # not started, so nothing drains the queue
+        results = [writer.put(make_packet()) for _ in range(3)]
+
+        self.assertEqual(results, [True, True, False])
+        self.assertEqual(writer.stats()["dropped"], 1)
+
+    def test_close_without_flush_discards(self):
+        writer = BatchWriter(
+            self.session, max_batch_size=1000, max_latency=60,
+            flush_on_shutdown=False, write_batch=self.recording_writer,
+        ).start()
+        for _ in range(5):
+            writer.put(make_packet())
+        writer.close()
+
+        self.assertEqual(self.batches, [])
+        self.assertEqual(writer.stats()["dropped"], 5)
+
+    def test_bad_packet_only_drops_itself(self):
+        def failing_writer(session, batch):
+            if any(packet.sensor == "bad" for packet in batch):
+                raise ValueError("bad packet")
+            self.recording_writer(session, batch)
+
+        writer = BatchWriter(
+            self.session, max_batch_size=3, max_latency=60,
+            write_batch=failing_writer,
+        ).start()
+        for sensor in ("env", "bad", "env"):
+            writer.put(make_packet(sensor))
+        with self.assertLogs("mqtt_data_logger.batch_writer", "ERROR"):
+            writer.close()
+
+        self.assertEqual([len(b) for b in self.batches], [1, 1])
+        stats = writer.stats()
+        self.assertEqual((stats["written"], stats["failed"]), (2, 1))
+
+    def test_writes_records(self):
+        writer = BatchWriter(self.session, max_latency=0.01).start()
+        for i in range(20):
+            writer.put(make_packet(temp=i))
+        writer.close()
+
+        self.assertEqual(self.session.query(SensorMeasurement).count(), 40)
+
+
+if __name__ == "__main__":
+    unittest.main()
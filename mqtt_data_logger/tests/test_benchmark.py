@@ -0,0 +1,82 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, 4CSCC development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import json
+import unittest
+
+from mqtt_data_logger import callbacks
+from mqtt_data_logger.benchmark import (
+    SCENARIOS,
+    _result,
+    find_regressions,
+    generate_messages,
+    percentile,
+    run_benchmarks,
+)
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_generate_messages_is_reproducible_mix(self):
+        messages = generate_messages(300, seed=1)
+        self.assertEqual(messages, generate_messages(300, seed=1))
+        topics = {topic for topic, payload in messages}
+        self.assertEqual(
+            topics,
+            {"sensor_data/env", "sensor_data/wind", "sensor_data/air_quality"},
+        )
+        packet = json.loads(messages[0][1])
+        self.assertIn("sensor", packet)
+        self.assertIn("data", packet)
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile(values, 100), 100)
+        self.assertIsNone(percentile([], 50))
+
+    def test_result_without_latencies(self):
+        result = _result("direct", 0, 0.5, [], 100, 100, 0)
+        self.assertIsNone(result["latency_p99_ms"])
+        self.assertEqual(find_regressions(
+            {"results": {"direct": result}},
+            {"results": {"direct": {
+                "msgs_per_sec": 0.0, "latency_p99_ms": 10.0,
+            }}},
+        ), [])
+
+    def test_run_benchmarks_reports_every_scenario(self):
+        report = run_benchmarks(40, max_latency=0.01)
+        self.assertEqual(set(report["results"]), set(SCENARIOS))
+        for result in report["results"].values():
+            self.assertEqual(result["messages"], 40)
+            self.assertGreater(result["msgs_per_sec"], 0)
+            self.assertGreater(result["db_bytes_growth"], 0)
+        self.assertEqual(report["parameters"]["messages"], 40)
+        json.dumps(report)
+        # the inline scenario leaves no session of its deleted database
+        self.assertFalse(hasattr(callbacks, "session"))
+        self.assertIsNone(callbacks.dimension_cache)
+
+    def test_find_regressions(self):
+        baseline = {"results": {"direct": {
+            "msgs_per_sec": 1000.0, "latency_p99_ms": 10.0,
+        }}}
+        faster = {"results": {"direct": {
+            "msgs_per_sec": 1050.0, "latency_p99_ms": 9.0,
+        }}}
+        slower = {"results": {"direct": {
+            "msgs_per_sec": 800.0, "latency_p99_ms": 12.0,
+        }}}
+        self.assertEqual(find_regressions(faster, baseline), [])
+        self.assertEqual(len(find_regressions(slower, baseline)), 2)
+        self.assertEqual(find_regressions(slower, baseline, 0.5), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
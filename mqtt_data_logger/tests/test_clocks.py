@@ -0,0 +1,162 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, 4CSCC development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import json
+import time
+import unittest
+from types import SimpleNamespace
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from mqtt_data_logger import callbacks
+from mqtt_data_logger.clocks import CLAMP_STEP, SensorClocks
+from mqtt_data_logger.log_data import (
+    SensorPacket,
+    add_sensors_reading_records_bulk,
+    utc_datetime,
+)
+from mqtt_data_logger.query import query_readings
+from mqtt_data_logger.sensor_data_models import Base
+
+NOW = 1_700_000_000.0
+
+
+def packet(received_at, sent_at=None, sensor="env"):
+    return SensorPacket(
+        "sensor_data/env", sensor, {"temp": 20.0}, received_at,
+        sent_at=sent_at,
+    )
+
+
+class TestSensorClocks(unittest.TestCase):
+
+    def setUp(self):
+        self.clocks = SensorClocks(tolerance=2.0)
+
+    def times(self, packets):
+        return [self.clocks.stamp(p).time for p in packets]
+
+    def test_receipt_time_without_device_time(self):
+        self.assertEqual(self.times([packet(NOW)]), [NOW])
+
+    def test_device_time_of_a_clock_in_sync(self):
+        # the second packet spent 30s in the broker, it was still sent then
+        self.assertEqual(
+            self.times([packet(NOW + 0.2, NOW), packet(NOW + 40, NOW + 10)]),
+            [NOW, NOW + 10],
+        )
+        # the delay raised the estimate only by the drift of 10s
+        self.assertAlmostEqual(self.clocks.skew("env"), 0.201)
+        self.assertEqual(self.clocks.stats()["corrected"], 0)
+
+    def test_skewed_clock_is_corrected(self):
+        # a sensor five minutes behind, with a little network delay, is
+        # only corrected once that lasted the settle time
+        offsets = [300.1, 300.3, 300.2, 300.1, 300.4, 300.1, 300.2]
+        packets = [
+            packet(NOW + i * 60 + offset, NOW + i * 60)
+            for i, offset in enumerate(offsets)
+        ]
+        with self.assertLogs("mqtt_data_logger.clocks", "WARNING"):
+            times = self.times(packets)
+        self.assertAlmostEqual(self.clocks.skew("env"), 300.106, places=6)
+        expected = [p.sent_at for p in packets[:5]] + [
+            NOW + 300 + 300.1, NOW + 360 + 300.106,
+        ]
+        for time, expected_time in zip(times, expected):
+            self.assertAlmostEqual(time, expected_time, places=6)
+        self.assertEqual(self.clocks.stats()["corrected"], 2)
+
+        # a sensor ahead of the logger is corrected from the first packet
+        ahead = self.clocks.stamp(packet(NOW, NOW + 60, sensor="fast"))
+        self.assertEqual(ahead.time, NOW)
+
+    def test_redelivered_backlog_keeps_device_times(self):
+        self.times([packet(NOW + 0.1, NOW)])
+        # an hour of packets redelivered after a reconnect
+        backlog = [
+            packet(NOW + 3600 + i * 0.01, NOW + minute * 60)
+            for i, minute in enumerate(range(1, 61))
+        ]
+        self.assertEqual(
+            self.times(backlog), [p.sent_at for p in backlog]
+        )
+
+    def test_restart_with_a_backlog(self):
+        # the first packets after a restart are an hour of redelivered
+        # backlog of a sensor in sync, then it reports live
+        backlog = [
+            packet(NOW + 3600 + i * 0.01, NOW + minute * 60)
+            for i, minute in enumerate(range(60))
+        ]
+        live = [
+            packet(NOW + 3600 + minute * 60 + 0.1, NOW + 3600 + minute * 60)
+            for minute in range(1, 11)
+        ]
+        with self.assertNoLogs("mqtt_data_logger.clocks", "WARNING"):
+            times = self.times(backlog + live)
+        self.assertEqual(times, [p.sent_at for p in backlog + live])
+        self.assertEqual(self.clocks.stats()["corrected"], 0)
+
+    def test_lost_clock_is_not_trusted(self):
+        self.assertEqual(self.times([packet(NOW, 12.0)]), [NOW])
+        self.assertEqual(self.clocks.stats()["untrusted"], 1)
+
+    def test_times_of_a_sensor_do_not_go_backwards(self):
+        times = self.times([
+            packet(NOW), packet(NOW), packet(NOW - 1), packet(NOW - 60),
+            packet(NOW, sensor="other"),
+        ])
+        self.assertEqual(times, [
+            NOW, NOW + CLAMP_STEP, NOW + 2 * CLAMP_STEP,
+            # more than the tolerance older, a late reading
+            NOW - 60,
+            NOW,
+        ])
+        self.assertEqual(self.clocks.stats()["clamped"], 2)
+
+
+class TestDeviceTimes(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine("sqlite:///:memory:")
+        Base.metadata.create_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+
+    def test_readings_get_the_time_of_their_packet(self):
+        # sent half a second ago by a sensor in sync
+        sent_at = time.time() - 0.5
+        writer = SimpleNamespace(packets=[])
+        writer.put = writer.packets.append
+        callbacks.set_batch_writer(writer)
+        callbacks.set_sensor_clocks(SensorClocks())
+        try:
+            callbacks.log_sensor_data(None, None, SimpleNamespace(
+                topic="sensor_data/env",
+                payload=json.dumps({
+                    "sensor": "env", "data": {"temp": 20.0},
+                    "time": sent_at,
+                }).encode(),
+            ))
+        finally:
+            callbacks.set_batch_writer(None)
+            callbacks.set_sensor_clocks(None)
+        add_sensors_reading_records_bulk(self.session, writer.packets)
+
+        reading, = query_readings(self.session)
+        self.assertEqual(
+            reading.time.replace(tzinfo=None), utc_datetime(sent_at)
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,267 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, 4CSCC development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import math
+import random
+import tempfile
+import unittest
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+from sqlalchemy import func, select
+from sqlalchemy.orm import sessionmaker
+
+from mqtt_data_logger.compression import (
+    block_keys,
+    compact_readings,
+    decode_block,
+    encode_block,
+    to_micros,
+)
+from mqtt_data_logger.db import create_sqlite_engine
+from mqtt_data_logger.export import archive_readings, export_readings, pa
+from mqtt_data_logger.log_data import (
+    SensorPacket,
+    add_sensors_reading_records_bulk,
+)
+from mqtt_data_logger.metrics import file_size
+from mqtt_data_logger.query import (
+    iter_reading_pages,
+    latest_readings,
+    query_readings,
+)
+from mqtt_data_logger.rollups import backfill_rollups
+from mqtt_data_logger.sensor_data_models import (
+    Base,
+    HourRollup,
+    ReadingBlock,
+    SensorMeasurement,
+)
+
+DAY = datetime(2024, 5, 1)
+
+
+def timestamp(time):
+    return time.replace(tzinfo=timezone.utc).timestamp()
+
+
+class TestBlockEncoding(unittest.TestCase):
+
+    def round_trip(self, readings):
+        self.assertEqual(decode_block(encode_block(readings)), readings)
+
+    def test_regular_readings(self):
+        start = to_micros(DAY)
+        self.round_trip([
+            (100 + i, start + i * 60_000_000, 20.0 + (i % 7) * 0.25, None)
+            for i in range(500)
+        ])
+
+    def test_irregular_readings(self):
+        generator = random.Random(0)
+        micros = to_micros(DAY)
+        readings = []
+        for i in range(500):
+            micros += generator.randrange(0, 10_000_000)
+            value = generator.choice([
+                None, 0.0, -0.0, 1e300, -2.5, generator.uniform(-1e6, 1e6),
+                float("inf"), 7.0,
+            ])
+            label = generator.choice([None, 1, 2, 300])
+            readings.append(
+                (generator.randrange(1, 10**9), micros, value, label)
+            )
+        self.round_trip(readings)
+
+    def test_nan(self):
+        (_, _, value, _), = decode_block(
+            encode_block([(1, 0, float("nan"), None)])
+        )
+        self.assertTrue(math.isnan(value))
+
+    def test_repeated_values_are_small(self):
+        readings = [
+            (i, to_micros(DAY) + i * 1_000_000, 22.5, 7)
+            for i in range(1, 1001)
+        ]
+        # a byte for the id and the time, two bits for the value
+        self.assertLess(len(encode_block(readings)), 2300)
+
+    def test_packet_keys(self):
+        readings = [(i, i * 1_000_000, 1.0, None) for i in range(1, 5)]
+        keys = [0, 1, None, 2**63 - 1]
+        data = encode_block(readings, keys)
+        self.assertEqual(decode_block(data), readings)
+        self.assertEqual(
+            block_keys(ReadingBlock(data=data)), {0, 1, 2**63 - 1}
+        )
+
+
+class TestCompaction(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db_fp = Path(self.tmpdir.name) / "sensor_data.db"
+        self.engine = create_sqlite_engine(self.db_fp)
+        Base.metadata.create_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+        packets = []
+        # two days of a reading a minute, and one on the third day
+        for minute in range(0, 2 * 24 * 60, 10):
+            at = timestamp(DAY + timedelta(minutes=minute))
+            packets.append(SensorPacket(
+                "sensor_data/env", "env",
+                {"temp": 20.0 + (minute // 60) % 5, "status": ("ok", None)},
+                at,
+            ))
+            packets.append(SensorPacket(
+                "sensor_data/wind", "wind",
+                {"cardinal_direction": ("NNE", 22.5)}, at,
+            ))
+        packets.append(SensorPacket(
+            "sensor_data/env", "env", {"temp": 30.0},
+            timestamp(DAY + timedelta(days=2, hours=1)),
+        ))
+        add_sensors_reading_records_bulk(self.session, packets)
+        self.before = list(query_readings(self.session))
+
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+        self.tmpdir.cleanup()
+
+    def compact(self):
+        result = compact_readings(self.engine, DAY + timedelta(days=2))
+        self.session.commit()
+        return result
+
+    def count(self, model):
+        return self.session.execute(
+            select(func.count()).select_from(model)
+        ).scalar()
+
+    def test_compacts_closed_windows(self):
+        blocks, compacted = self.compact()
+
+        # env temp, env status and wind per day
+        self.assertEqual(blocks, 6)
+        self.assertEqual(compacted, len(self.before) - 1)
+        self.assertEqual(self.count(SensorMeasurement), 1)
+        self.assertEqual(self.count(ReadingBlock), 6)
+        self.assertEqual(self.compact(), (0, 0))
+
+    def test_redelivered_packets_are_dropped(self):
+        redelivered = SensorPacket(
+            "sensor_data/env", "keyed", {"temp": 1.0},
+            timestamp(DAY + timedelta(hours=3)), key=7,
+        )
+        add_sensors_reading_records_bulk(self.session, [redelivered])
+        self.compact()
+        # stored again once its reading left the table
+        add_sensors_reading_records_bulk(self.session, [redelivered])
+        self.assertEqual(self.count(SensorMeasurement), 2)
+
+        self.assertEqual(self.compact(), (0, 0))
+        self.assertEqual(self.count(SensorMeasurement), 1)
+        self.assertEqual(
+            len(list(query_readings(self.session, sensor="keyed"))), 1
+        )
+
+    def test_queries_decode_blocks(self):
+        self.compact()
+
+        self.assertEqual(list(query_readings(self.session)), self.before)
+        self.assertEqual(
+            list(query_readings(self.session, descending=True)),
+            self.before[::-1],
+        )
+        filters = {
+            "sensor": "env",
+            "measurement": "temp",
+            "start": DAY + timedelta(hours=20),
+            "end": DAY + timedelta(days=2, hours=2),
+        }
+        expected = [
+            r for r in self.before
+            if (r.sensor, r.measurement) == ("env", "temp")
+            and filters["start"] <= r.time < filters["end"]
+        ]
+        self.assertEqual(
+            list(query_readings(self.session, **filters)), expected
+        )
+        self.assertEqual(
+            list(query_readings(self.session, limit=5, **filters)),
+            expected[:5],
+        )
+        pages = list(iter_reading_pages(self.session, page_size=7, **filters))
+        self.assertEqual(sum(pages, []), expected)
+
+    def test_latest_readings(self):
+        latest = latest_readings(self.session)
+        self.compact()
+        self.assertEqual(latest_readings(self.session), latest)
+        self.assertEqual(
+            latest_readings(self.session, sensor="wind")[0].str_value, "NNE"
+        )
+
+    def test_backfilled_rollups_include_blocks(self):
+        backfill_rollups(self.engine)
+        self.session.commit()
+        rollups = self.session.execute(
+            select(HourRollup.bucket, HourRollup.count, HourRollup.total)
+            .order_by(HourRollup.bucket, HourRollup.measurement_num_id)
+        ).all()
+        self.compact()
+        backfill_rollups(self.engine)
+        self.session.commit()
+        self.assertEqual(
+            self.session.execute(
+                select(HourRollup.bucket, HourRollup.count, HourRollup.total)
+                .order_by(HourRollup.bucket, HourRollup.measurement_num_id)
+            ).all(),
+            rollups,
+        )
+
+    @unittest.skipIf(pa is None, "pyarrow is not installed")
+    def test_export_and_archive_include_blocks(self):
+        self.compact()
+        exported, last_id, files = export_readings(
+            self.engine, Path(self.tmpdir.name) / "export"
+        )
+        self.assertEqual(exported, len(self.before))
+        self.assertEqual(last_id, max(r.reading_id for r in self.before))
+
+        cutoff = DAY + timedelta(days=1, hours=12)
+        archived = archive_readings(
+            self.engine, Path(self.tmpdir.name) / "archive", 0,
+            now=cutoff,
+        )
+        self.session.commit()
+        self.assertEqual(
+            archived, len([r for r in self.before if r.time < cutoff])
+        )
+        self.assertEqual(
+            list(query_readings(self.session)),
+            [r for r in self.before if r.time >= cutoff],
+        )
+
+    def vacuum(self):
+        self.session.close()
+        with self.engine.connect() as conn:
+            conn.exec_driver_sql("VACUUM")
+            conn.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+        return file_size(self.db_fp)
+
+    def test_database_shrinks(self):
+        size = self.vacuum()
+        self.compact()
+        # most of what is left is a page per table and index
+        self.assertLess(self.vacuum(), size / 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,218 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, 4CSCC development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import json
+import tempfile
+import unittest
+from pathlib import Path
+
+from sqlalchemy import func, select
+
+from mqtt_data_logger import callbacks
+from mqtt_data_logger.__main__ import main
+from mqtt_data_logger.config import (
+    DEFAULT_DB,
+    ConfigError,
+    Route,
+    load_config,
+)
+from mqtt_data_logger.log_data import SensorPacket
+from mqtt_data_logger.profiling import write_capture
+from mqtt_data_logger.runtime import RoutedStorage, TopicRouter
+from mqtt_data_logger.sensor_data_models import SensorMeasurement
+from mqtt_data_logger.util import start_session
+
+
+SITE_TOML = """
+[[brokers]]
+name = "roof"
+host = "roof.local"
+subscriptions = ["sensor_data/wind/#"]
+
+[[brokers]]
+host = "lab.local"
+port = 1884
+
+[databases.main]
+path = "{tmpdir}/main.db"
+
+[databases.weather]
+url = "sqlite:///{tmpdir}/weather.db"
+sqlite_profile = "durable"
+
+[[routes]]
+topic = "sensor_data/wind/#"
+database = "weather"
+
+[[routes]]
+topic = "sensor_data/#"
+database = "main"
+"""
+
+
+def readings(db_fp):
+    session = start_session(db_fp)
+    try:
+        return session.execute(
+            select(func.count()).select_from(SensorMeasurement)
+        ).scalar()
+    finally:
+        session.close()
+
+
+class TestLoadConfig(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.tmpdir = Path(self.directory.name)
+        self.site = self.tmpdir / "site.toml"
+        self.site.write_text(SITE_TOML.format(tmpdir=self.tmpdir))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_defaults(self):
+        config = load_config(environ={})
+        broker, = config.brokers
+        self.assertEqual((broker.host, broker.port), ("localhost", 1883))
+        self.assertEqual(broker.subscriptions, ("sensor_data/#",))
+        self.assertEqual(
+            config.default_database.url, f"sqlite:///{DEFAULT_DB}"
+        )
+        self.assertEqual(config.routes, [])
+        self.assertTrue(config.is_single_sqlite())
+
+    def test_file(self):
+        config = load_config(self.site, environ={})
+        self.assertEqual(
+            [(b.name, b.host, b.port) for b in config.brokers],
+            [("roof", "roof.local", 1883), ("lab.local", "lab.local", 1884)],
+        )
+        self.assertEqual(
+            config.brokers[0].subscriptions, ("sensor_data/wind/#",)
+        )
+        self.assertEqual(
+            [d.name for d in config.databases], ["main", "weather"]
+        )
+        self.assertEqual(config.databases[1].sqlite_profile, "durable")
+        self.assertEqual(config.routes[0], Route("sensor_data/wind/#",
+                                                 "weather"))
+        self.assertFalse(config.is_single_sqlite())
+
+    def test_environment_then_arguments_override(self):
+        environ = {
+            "MQTT_LOGGER_CONFIG": str(self.site),
+            "MQTT_LOGGER_BROKERS": "env.local:1885",
+            "MQTT_LOGGER_SUBSCRIPTIONS": "sensor_data/env/#, sensor_data/aq/#",
+            "MQTT_LOGGER_DB": str(self.tmpdir / "env.db"),
+        }
+        config = load_config(environ=environ)
+        broker, = config.brokers
+        self.assertEqual((broker.host, broker.port), ("env.local", 1885))
+        self.assertEqual(
+            broker.subscriptions, ("sensor_data/env/#", "sensor_data/aq/#")
+        )
+        self.assertEqual(
+            config.default_database.url, f"sqlite:///{self.tmpdir}/env.db"
+        )
+
+        config = load_config(
+            environ=environ, brokers=["cli.local"], db="postgresql://h/db"
+        )
+        self.assertEqual(config.brokers[0].host, "cli.local")
+        self.assertEqual(config.default_database.url, "postgresql://h/db")
+        self.assertEqual(config.databases[1].name, "weather")
+
+    def test_json_file(self):
+        site = self.tmpdir / "site.json"
+        site.write_text(json.dumps({
+            "databases": {"main": str(self.tmpdir / "main.db")},
+        }))
+        config = load_config(site, environ={})
+        self.assertEqual(config.default_database.name, "main")
+
+    def test_invalid(self):
+        site = self.tmpdir / "site.json"
+        for document in [
+            {"routes": [{"topic": "a/#", "database": "missing"}]},
+            {"brokers": [{"port": 1883}]},
+            {"brokers": [{"host": "h", "subscriptions": "sensor_data/#"}]},
+            {"brokers": [{"host": "h", "port": "mqtt"}]},
+            {"brokers": [{"host": "h", "keepalive": None}]},
+            {"databases": {"main": {"path": "main.db", "pool_size": "x"}}},
+            {"databases": {"pg": {"url": "postgresql://h/db",
+                                  "rollups": True}}},
+            {"databases": {"main": {"path": "main.db",
+                                    "chunk_interval": "1 day"}}},
+            {"databases": {"pg": {"url": "postgresql://h/db",
+                                  "copy_format": "text"}}},
+        ]:
+            site.write_text(json.dumps(document))
+            with self.assertRaises(ConfigError):
+                load_config(site, environ={})
+        with self.assertRaises(ConfigError):
+            load_config(self.tmpdir / "missing.toml", environ={})
+
+
+class TestRouting(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.tmpdir = Path(self.directory.name)
+        self.site = self.tmpdir / "site.toml"
+        self.site.write_text(SITE_TOML.format(tmpdir=self.tmpdir))
+
+    def tearDown(self):
+        callbacks.set_batch_writer(None)
+        self.directory.cleanup()
+
+    def test_first_matching_route_wins(self):
+        router = TopicRouter([
+            Route("sensor_data/wind/#", "weather"),
+            Route("sensor_data/#", "main"),
+        ])
+        self.assertEqual(router.database_for("sensor_data/wind/1"), "weather")
+        self.assertEqual(router.database_for("sensor_data/env"), "main")
+        self.assertIsNone(router.database_for("other/topic"))
+
+    def test_routed_storage(self):
+        storage = RoutedStorage(
+            load_config(self.site, environ={}), {"max_latency": 0.01}
+        )
+        storage.put(SensorPacket("sensor_data/wind/1", "w", {"gust": 3.0},
+                                 1.0))
+        storage.put(SensorPacket("sensor_data/env", "e", {"temp": 20.0},
+                                 1.0))
+        self.assertFalse(storage.put(SensorPacket("other", "o", {"x": 1.0},
+                                                  1.0)))
+        storage.close()
+        self.assertEqual(readings(self.tmpdir / "weather.db"), 1)
+        self.assertEqual(readings(self.tmpdir / "main.db"), 1)
+        self.assertEqual(storage.stats()["unrouted"], 1)
+        self.assertGreater(storage.db_size(), 0)
+
+    def test_main_replays_into_routed_databases(self):
+        capture = self.tmpdir / "capture.jsonl"
+        write_capture(capture, [
+            ("sensor_data/wind/1", json.dumps({
+                "sensor": "w", "data": {"wind_speed": 3.0},
+            }).encode(), None),
+            ("sensor_data/env", json.dumps({
+                "sensor": "e", "data": {"temp": 20.0, "humidity": 40.0},
+            }).encode(), None),
+        ])
+        main([
+            "--config", str(self.site), "--replay", str(capture),
+            "--profile-output", str(self.tmpdir / "profile"),
+            "--log-level", "WARNING",
+        ])
+        self.assertEqual(readings(self.tmpdir / "weather.db"), 1)
+        self.assertEqual(readings(self.tmpdir / "main.db"), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
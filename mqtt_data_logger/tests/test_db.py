@@ -0,0 +1,61 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, 4CSCC development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import tempfile
+import unittest
+from pathlib import Path
+
+from sqlalchemy import text
+
+from mqtt_data_logger.db import SQLITE_PROFILES, create_sqlite_engine
+
+
+class TestSqliteProfiles(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db_fp = Path(self.tmpdir.name) / "sensor_data.db"
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def pragma(self, engine, name):
+        with engine.connect() as conn:
+            return conn.execute(text(f"PRAGMA {name}")).scalar()
+
+    def test_profiles_apply_pragmas(self):
+        # sqlite reports synchronous as 0 (OFF), 1 (NORMAL) or 2 (FULL)
+        expected_synchronous = {
+            "durable": 2, "balanced": 1, "max-throughput": 0,
+        }
+        for profile in SQLITE_PROFILES:
+            engine = create_sqlite_engine(self.db_fp, profile)
+            self.assertEqual(self.pragma(engine, "journal_mode"), "wal")
+            self.assertEqual(
+                self.pragma(engine, "synchronous"),
+                expected_synchronous[profile],
+            )
+            self.assertEqual(
+                self.pragma(engine, "busy_timeout"),
+                SQLITE_PROFILES[profile]["busy_timeout"],
+            )
+            engine.dispose()
+
+    def test_override_single_pragma(self):
+        engine = create_sqlite_engine(
+            self.db_fp, "balanced", cache_size=-1234
+        )
+        self.assertEqual(self.pragma(engine, "cache_size"), -1234)
+        engine.dispose()
+
+    def test_unknown_profile(self):
+        with self.assertRaises(ValueError):
+            create_sqlite_engine(self.db_fp, "reckless")
+
+
+if __name__ == "__main__":
+    unittest.main()
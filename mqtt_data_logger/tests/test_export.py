@@ -0,0 +1,98 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, 4CSCC development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import tempfile
+import unittest
+from datetime import datetime, timezone
+from pathlib import Path
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from mqtt_data_logger.export import archive_readings, export_readings, pa
+from mqtt_data_logger.log_data import (
+    SensorPacket,
+    add_sensors_reading_records_bulk,
+)
+from mqtt_data_logger.sensor_data_models import Base, SensorMeasurement
+
+
+def timestamp(*args):
+    return datetime(*args, tzinfo=timezone.utc).timestamp()
+
+
+@unittest.skipIf(pa is None, "pyarrow is not installed")
+class TestExport(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.out_dir = Path(self.tmpdir.name) / "export"
+        self.engine = create_engine(
+            f"sqlite:///{Path(self.tmpdir.name) / 'sensor_data.db'}"
+        )
+        Base.metadata.create_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+        add_sensors_reading_records_bulk(self.session, [
+            SensorPacket("sensor_data/env", "env", {"temp": 1.0, "rh": 2.0},
+                         timestamp(2024, 5, 1, 12)),
+            SensorPacket("sensor_data/wind", "wind",
+                         {"cardinal_direction": ("NNE", 22.5)},
+                         timestamp(2024, 5, 1, 13)),
+            SensorPacket("sensor_data/env", "env", {"temp": 3.0},
+                         timestamp(2024, 5, 20, 12)),
+        ])
+
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+        self.tmpdir.cleanup()
+
+    def test_export_partitions_by_date_and_sensor(self):
+        exported, last_id, files = export_readings(
+            self.engine, self.out_dir, chunk_size=2
+        )
+
+        self.assertEqual(exported, 4)
+        self.assertEqual(last_id, 4)
+        self.assertEqual(
+            sorted({f.parent.relative_to(self.out_dir).as_posix()
+                    for f in files}),
+            ["date=2024-05-01/sensor=env", "date=2024-05-01/sensor=wind",
+             "date=2024-05-20/sensor=env"],
+        )
+        table = pa.parquet.read_table(
+            self.out_dir / "date=2024-05-01" / "sensor=wind"
+        )
+        self.assertEqual(table.column("str_value").to_pylist(), ["NNE"])
+        self.assertEqual(
+            table.column("measurement").to_pylist(), ["cardinal_direction"]
+        )
+
+    def test_export_arrow_ipc(self):
+        exported, last_id, files = export_readings(
+            self.engine, self.out_dir, fmt="arrow",
+            start=datetime(2024, 5, 2),
+        )
+
+        self.assertEqual(exported, 1)
+        with pa.ipc.open_file(str(files[0])) as reader:
+            self.assertEqual(reader.read_all().column("value").to_pylist(),
+                             [3.0])
+
+    def test_archive_moves_old_readings(self):
+        archived = archive_readings(
+            self.engine, self.out_dir, older_than_days=7,
+            now=datetime(2024, 5, 21),
+        )
+
+        self.assertEqual(archived, 3)
+        remaining = self.session.query(SensorMeasurement).all()
+        self.assertEqual([r.value for r in remaining], [3.0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,93 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, 4CSCC development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import json
+import tempfile
+import unittest
+import urllib.request
+from datetime import datetime, timezone
+from pathlib import Path
+
+from mqtt_data_logger.latest import LatestValues, start_live_feed
+from mqtt_data_logger.log_data import SensorPacket
+from mqtt_data_logger.util import start_session
+
+
+def packet(minute, measurements, sensor="env"):
+    at = datetime(2024, 5, 1, 12, minute, tzinfo=timezone.utc).timestamp()
+    return SensorPacket("sensor_data/env", sensor, measurements, at)
+
+
+class TestLatestValues(unittest.TestCase):
+
+    def test_keeps_newest_value_per_key(self):
+        latest = LatestValues()
+        latest.update(packet(2, {"temp": 2.0, "status": "ok"}))
+        latest.update(packet(1, {"temp": 1.0}))  # arrived late, older
+        latest.update(packet(3, {"dir": ("NNE", 22.5)}, sensor="wind"))
+
+        temp = latest.get("sensor_data/env", "env", "temp")
+        self.assertEqual(temp.value, 2.0)
+        self.assertEqual(temp.time, datetime(2024, 5, 1, 12, 2))
+        status = latest.get("sensor_data/env", "env", "status")
+        self.assertEqual((status.value, status.str_value), (None, "ok"))
+        self.assertEqual(
+            [v.measurement for v in latest.values()], ["status", "temp", "dir"]
+        )
+
+    def test_subscribers_get_changes(self):
+        latest = LatestValues(max_subscriber_queue=1)
+        subscriber = latest.subscribe()
+        latest.update(packet(1, {"temp": 1.0, "rh": 50.0}))
+        self.assertEqual(subscriber.get_nowait().measurement, "temp")
+        self.assertEqual(latest.dropped_events, 1)
+        latest.close()
+        self.assertIsNone(subscriber.get_nowait())
+
+    def test_snapshot_and_load(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            session = start_session(Path(tmpdir) / "sensor_data.db")
+            engine = session.get_bind()
+            latest = LatestValues()
+            latest.update(packet(1, {"temp": 1.0, "rh": 50.0}))
+            self.assertEqual(latest.snapshot(engine), 2)
+            self.assertEqual(latest.snapshot(engine), 0)
+            latest.update(packet(2, {"temp": 2.0}))
+            self.assertEqual(latest.snapshot(engine), 1)
+
+            restored = LatestValues().load(engine)
+            self.assertEqual(restored.values(), latest.values())
+            session.close()
+            engine.dispose()
+
+    def test_live_feed(self):
+        latest = LatestValues()
+        latest.update(packet(1, {"temp": 1.0}))
+        server = start_live_feed(latest, port=0)
+        url = "http://127.0.0.1:{}".format(server.server_address[1])
+        try:
+            with urllib.request.urlopen(url + "/latest") as response:
+                readings = json.load(response)["readings"]
+            self.assertEqual(readings[0]["value"], 1.0)
+
+            with urllib.request.urlopen(url + "/events") as events:
+                self.assertEqual(
+                    events.headers["Content-Type"], "text/event-stream"
+                )
+                first = json.loads(events.readline()[len(b"data: "):])
+                events.readline()
+                latest.update(packet(2, {"temp": 2.0}))
+                second = json.loads(events.readline()[len(b"data: "):])
+            self.assertEqual((first["value"], second["value"]), (1.0, 2.0))
+        finally:
+            latest.close()
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == "__main__":
+    unittest.main()
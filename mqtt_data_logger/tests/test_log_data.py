@@ -0,0 +1,277 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, 4CSCC development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import json
+import unittest
+from functools import partial
+
+from sqlalchemy import create_engine, event, select
+from sqlalchemy.orm import sessionmaker
+
+from mqtt_data_logger.log_data import (
+    DimensionCache,
+    DuplicateFilter,
+    SensorPacket,
+    add_sensors_reading_record,
+    add_sensors_reading_records,
+    add_sensors_reading_records_bulk,
+)
+from mqtt_data_logger.metrics import DUPLICATE_READINGS
+from mqtt_data_logger.parsing import PacketParser
+from mqtt_data_logger.sensor_data_models import (
+    Base, Topic, Sensor, Measurement, MinuteRollup, SensorMeasurement,
+)
+
+TEST_DATABASE_URL = "sqlite:///:memory:"
+
+
+class TestDimensionCache(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine(TEST_DATABASE_URL)
+        Base.metadata.create_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+        self.statements = []
+        event.listen(
+            self.engine, "before_cursor_execute", self.record_statement
+        )
+
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+
+    def record_statement(self, conn, cursor, statement, *args):
+        self.statements.append(statement)
+
+    def selects(self):
+        return [s for s in self.statements if s.startswith("SELECT")]
+
+    def test_cached_record_matches_orm_record(self):
+        cache = DimensionCache()
+        add_sensors_reading_record(
+            self.session, "sensor_data/wind", "anemometer",
+            {"wind_speed_beaufort": ("Calm", 0.5)}, cache=cache,
+        )
+
+        record = self.session.query(SensorMeasurement).one()
+        self.assertEqual(record.topic.topic, "sensor_data/wind")
+        self.assertEqual(record.sensor.sensor_id, "anemometer")
+        self.assertEqual(
+            record.measurement.measurement, "wind_speed_beaufort"
+        )
+        self.assertEqual(record.value, 0.5)
+        self.assertEqual(record.str_value, "Calm")
+
+    def test_warm_cache_issues_no_selects(self):
+        add_sensors_reading_record(self.session, "sensor_data", "env")
+        cache = DimensionCache().warm(self.session)
+        self.session.commit()
+        self.statements.clear()
+
+        for _ in range(5):
+            add_sensors_reading_record(
+                self.session, "sensor_data", "env", cache=cache
+            )
+
+        self.assertEqual(self.selects(), [])
+        self.assertEqual(cache.misses, 0)
+        self.assertEqual(self.session.query(SensorMeasurement).count(), 12)
+
+    def test_miss_reuses_existing_row(self):
+        Topic().add(self.session, "sensor_data")
+        cache = DimensionCache()
+
+        topic_id = cache.topic_id(self.session, "sensor_data")
+
+        self.assertEqual(self.session.query(Topic).count(), 1)
+        self.assertEqual(
+            topic_id, self.session.query(Topic).one().topic_num_id
+        )
+
+    def test_insert_race_falls_back_to_lookup(self):
+        Sensor().add(self.session, "env")
+        cache = DimensionCache()
+        # pretend the first lookup missed, as if another writer inserted
+        # the sensor right after we looked
+        real_execute = self.session.execute
+        calls = []
+
+        def execute(statement, *args, **kwargs):
+            result = real_execute(statement, *args, **kwargs)
+            if not calls:
+                calls.append(statement)
+                result.scalar_one_or_none = lambda: None
+            return result
+
+        self.session.execute = execute
+        sensor_id = cache.sensor_id(self.session, "env")
+        del self.session.execute
+
+        self.assertEqual(
+            sensor_id, self.session.query(Sensor).one().sensor_num_id
+        )
+        self.assertEqual(self.session.query(Sensor).count(), 1)
+
+    def test_rollback_discards_pending_ids(self):
+        cache = DimensionCache()
+        cache.measurement_id(self.session, "temp")
+        self.session.rollback()
+        cache.discard_pending()
+
+        # the id is looked up again rather than trusted after a rollback
+        measurement_id = cache.measurement_id(self.session, "temp")
+        self.session.commit()
+        self.assertEqual(cache.misses, 2)
+        self.assertEqual(
+            measurement_id,
+            self.session.query(Measurement).one().measurement_num_id,
+        )
+
+
+class TestBulkInsert(unittest.TestCase):
+
+    packets = [
+        SensorPacket("sensor_data/env", "env", {"temp": 21.5, "rh": 40.0}, 0),
+        SensorPacket(
+            "sensor_data/wind", "wind",
+            {"wind_direction": 10.0, "cardinal_direction": ("N", 0)}, 0,
+        ),
+        SensorPacket("sensor_data/env", "env_2", {"temp": 19.0}, 0),
+    ]
+
+    def dump(self, write_batch):
+        engine = create_engine(TEST_DATABASE_URL)
+        Base.metadata.create_all(engine)
+        session = sessionmaker(bind=engine)()
+        write_batch(session, self.packets)
+        rows = {}
+        for table in Base.metadata.sorted_tables:
+            # time is the insert clock, so it differs between runs
+            columns = [c for c in table.c if c.name != "time"]
+            query = table.select().with_only_columns(*columns)
+            rows[table.name] = sorted(
+                tuple(r) for r in session.execute(query)
+            )
+        session.close()
+        return rows
+
+    def test_bulk_matches_orm_rows(self):
+        self.assertEqual(
+            self.dump(add_sensors_reading_records_bulk),
+            self.dump(add_sensors_reading_records),
+        )
+
+    def test_bulk_empty_batch(self):
+        rows = self.dump(lambda session, packets: (
+            add_sensors_reading_records_bulk(session, [])
+        ))
+        self.assertEqual(rows["sensor_measurements"], [])
+
+
+    def test_string_readings_are_labels(self):
+        packet = PacketParser().parse("sensor_data/env", json.dumps({
+            "sensor": "s1", "data": {"state": "on", "t": 1.0},
+        }).encode(), 0.0)
+        for write_batch in [
+            add_sensors_reading_records,
+            partial(add_sensors_reading_records, cache=DimensionCache()),
+            add_sensors_reading_records_bulk,
+        ]:
+            engine = create_engine(TEST_DATABASE_URL)
+            Base.metadata.create_all(engine)
+            session = sessionmaker(bind=engine)()
+            write_batch(session, [packet])
+            self.assertEqual(sorted(
+                (r.measurement.measurement, r.value, r.str_value)
+                for r in session.query(SensorMeasurement)
+            ), [("state", None, "on"), ("t", 1.0, "")])
+            session.close()
+            engine.dispose()
+
+
+class TestDeduplication(unittest.TestCase):
+
+    packets = [
+        SensorPacket("sensor_data/env", "env", {"temp": 20.0, "rh": 40.0},
+                     60.0, 1),
+        SensorPacket("sensor_data/env", "env", {"temp": 21.0}, 61.0, 2),
+        SensorPacket("sensor_data/env", "env_2", {"temp": 19.0}, 62.0, 1),
+        SensorPacket("sensor_data/env", "env_3", {"temp": 18.0}, 63.0),
+    ]
+
+    def setUp(self):
+        self.engine = create_engine(TEST_DATABASE_URL)
+        Base.metadata.create_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+
+    def count(self, model):
+        return self.session.query(model).count()
+
+    def test_filter_drops_seen_keys(self):
+        duplicates = DuplicateFilter(capacity=3)
+        self.assertEqual(
+            [duplicates.seen(packet) for packet in self.packets * 2],
+            [False, False, False, False, True, True, True, False],
+        )
+        self.assertEqual(duplicates.duplicates, 3)
+
+        # the least recently seen key is forgotten first
+        duplicates = DuplicateFilter(capacity=2)
+        first, second, third = self.packets[:3]
+        for packet in (first, second, first, third):
+            duplicates.seen(packet)
+        self.assertTrue(duplicates.seen(first))
+        self.assertFalse(duplicates.seen(second))
+
+    def test_filter_keeps_packets_of_other_topics(self):
+        # one sensor, two topics, the same device time and so the same key
+        air = SensorPacket("sensor_data/air", "s1", {"temp": 20.5}, 60.0,
+                           1700000000000000)
+        wind = SensorPacket("sensor_data/wind", "s1", {"speed": 3.0}, 60.0,
+                            1700000000000000)
+        duplicates = DuplicateFilter()
+        self.assertEqual(
+            [duplicates.seen(packet) for packet in (air, wind, air, wind)],
+            [False, False, True, True],
+        )
+        add_sensors_reading_records(self.session, [air, wind])
+        self.assertEqual(self.count(SensorMeasurement), 2)
+
+    def test_write_paths_skip_stored_keys(self):
+        for write_batch in [
+            add_sensors_reading_records,
+            partial(add_sensors_reading_records, cache=DimensionCache()),
+            add_sensors_reading_records_bulk,
+        ]:
+            self.session.query(SensorMeasurement).delete()
+            write_batch(self.session, self.packets)
+            duplicates = DUPLICATE_READINGS.value
+            # redelivered, the unkeyed packet of env_3 cannot be told apart
+            write_batch(self.session, self.packets)
+            self.assertEqual(self.count(SensorMeasurement), 6)
+            self.assertEqual(DUPLICATE_READINGS.value - duplicates, 4)
+
+    def test_rollups_count_stored_readings_once(self):
+        for _ in range(2):
+            add_sensors_reading_records_bulk(
+                self.session, self.packets[:2], rollups=True
+            )
+        self.assertEqual(
+            self.session.execute(
+                select(MinuteRollup.count, MinuteRollup.total)
+                .order_by(MinuteRollup.measurement_num_id)
+            ).all(),
+            [(2, 41.0), (1, 40.0)],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,130 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, 4CSCC development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import json
+import logging
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+from mqtt_data_logger import logs
+from mqtt_data_logger.logs import (
+    JsonFormatter,
+    PayloadSampler,
+    configure_logging,
+    log_payload,
+    stop_logging,
+)
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestPayloadSampler(unittest.TestCase):
+
+    def test_every_nth(self):
+        sampler = PayloadSampler(every=3)
+        self.assertEqual(
+            [sampler.sample() for _ in range(7)],
+            [False, False, True, False, False, True, False],
+        )
+        self.assertEqual((sampler.seen, sampler.sampled), (7, 2))
+
+    def test_rate_limit(self):
+        clock = FakeClock()
+        sampler = PayloadSampler(rate=2, clock=clock)
+        self.assertEqual(sum(sampler.sample() for _ in range(10)), 2)
+        clock.now = 0.5
+        self.assertEqual(sum(sampler.sample() for _ in range(10)), 1)
+        clock.now = 10.0
+        self.assertEqual(sum(sampler.sample() for _ in range(10)), 2)
+
+    def test_rate_below_one(self):
+        clock = FakeClock()
+        sampler = PayloadSampler(rate=0.1, clock=clock)
+        self.assertEqual(sum(sampler.sample() for _ in range(10)), 1)
+        clock.now = 5.0
+        self.assertEqual(sum(sampler.sample() for _ in range(10)), 0)
+        clock.now = 10.0
+        self.assertEqual(sum(sampler.sample() for _ in range(10)), 1)
+
+
+class TestConfigureLogging(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.log_file = Path(self.directory.name) / "logger.log"
+
+    def tearDown(self):
+        stop_logging()
+        logger = logging.getLogger("mqtt_data_logger")
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+        logger.propagate = True
+        logger.setLevel(logging.NOTSET)
+        logs.payload_logger.setLevel(logging.NOTSET)
+        logs.set_payload_sampler(PayloadSampler())
+        self.directory.cleanup()
+
+    def lines(self):
+        stop_logging()
+        return self.log_file.read_text().splitlines()
+
+    def test_json_records_through_the_queue(self):
+        configure_logging(fmt="json", log_file=self.log_file)
+        logging.getLogger("mqtt_data_logger.spool").warning(
+            "Malformed packet on %s", "sensor_data/env",
+            extra={"topic": "sensor_data/env"},
+        )
+        logging.getLogger("mqtt_data_logger.spool").debug("not logged")
+        lines = self.lines()
+        self.assertEqual(len(lines), 1)
+        record = json.loads(lines[0])
+        self.assertEqual(record["level"], "WARNING")
+        self.assertEqual(record["logger"], "mqtt_data_logger.spool")
+        self.assertEqual(
+            record["message"], "Malformed packet on sensor_data/env"
+        )
+        self.assertEqual(record["topic"], "sensor_data/env")
+
+    def test_payloads_only_when_enabled_and_sampled(self):
+        configure_logging(level="DEBUG", log_file=self.log_file)
+        log_payload("sensor_data/env", b'{"sensor": "env"}')
+        self.assertEqual(logs.payload_sampler.seen, 0)
+
+        configure_logging(
+            log_file=self.log_file, log_payloads=True, payload_every=2
+        )
+        for i in range(4):
+            log_payload("sensor_data/env", f"payload {i}".encode())
+        lines = self.lines()
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].endswith(
+            "Topic: sensor_data/env Message: payload 1"
+        ))
+
+    def test_exceptions_are_formatted(self):
+        try:
+            raise RuntimeError("boom")
+        except RuntimeError:
+            record = logging.LogRecord(
+                "mqtt_data_logger", logging.ERROR, __file__, 1, "failed",
+                (), sys.exc_info(),
+            )
+        document = json.loads(JsonFormatter().format(record))
+        self.assertIn("RuntimeError: boom", document["exc_info"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,115 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, 4CSCC development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import json
+import tempfile
+import unittest
+import urllib.request
+from pathlib import Path
+
+from mqtt_data_logger import metrics
+from mqtt_data_logger.log_data import (
+    DimensionCache,
+    SensorPacket,
+    add_sensors_reading_records_bulk,
+)
+from mqtt_data_logger.metrics import (
+    Counter,
+    Gauge,
+    Histogram,
+    Registry,
+    start_metrics_server,
+)
+from mqtt_data_logger.parsing import MalformedPacket, PacketParser
+from mqtt_data_logger.util import start_session
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_render(self):
+        registry = Registry()
+        received = Counter("received_total", "received", registry=registry)
+        errors = Counter("errors_total", "errors", ["kind"], registry)
+        depth = Gauge("depth", "depth", registry=registry)
+        latency = Histogram("latency", "latency", [0.1, 1], registry=registry)
+        received.inc(3)
+        errors.labels("write").inc()
+        errors.labels("malformed").inc(2)
+        depth.set_function(lambda: 7)
+        for value in (0.05, 0.1, 0.5, 2):
+            latency.observe(value)
+
+        lines = registry.render().splitlines()
+        self.assertIn("# TYPE received_total counter", lines)
+        self.assertIn("received_total 3", lines)
+        self.assertIn('errors_total{kind="malformed"} 2', lines)
+        self.assertIn('errors_total{kind="write"} 1', lines)
+        self.assertIn("depth 7", lines)
+        self.assertIn('latency_bucket{le="0.1"} 2', lines)
+        self.assertIn('latency_bucket{le="1"} 3', lines)
+        self.assertIn('latency_bucket{le="+Inf"} 4', lines)
+        self.assertIn("latency_sum 2.65", lines)
+        self.assertIn("latency_count 4", lines)
+
+    def test_label_count_is_checked(self):
+        errors = Counter("errors_total", "errors", ["kind"], registry=None)
+        with self.assertRaises(ValueError):
+            errors.labels("write", "extra")
+
+    def test_endpoint(self):
+        registry = Registry()
+        Counter("received_total", "received", registry=registry).inc()
+        server = start_metrics_server(registry, port=0)
+        try:
+            url = "http://127.0.0.1:{}/metrics".format(server.server_port)
+            with urllib.request.urlopen(url) as response:
+                self.assertTrue(
+                    response.headers["Content-Type"].startswith("text/plain")
+                )
+                self.assertIn(b"received_total 1", response.read())
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+class TestInstrumentation(unittest.TestCase):
+
+    def test_parser_counts_and_times(self):
+        parsed = metrics.MESSAGES_PARSED.value
+        decoded = metrics.DECODE_SECONDS.count
+        malformed = metrics.ERRORS.labels("malformed").value
+        parser = PacketParser()
+        parser.parse("sensor_data/env", json.dumps(
+            {"sensor": "env", "data": {"temp": 21.5}}
+        ).encode())
+        with self.assertRaises(MalformedPacket):
+            parser.parse("sensor_data/env", b"{broken")
+        self.assertEqual(metrics.MESSAGES_PARSED.value, parsed + 1)
+        self.assertEqual(metrics.DECODE_SECONDS.count, decoded + 1)
+        self.assertEqual(
+            metrics.ERRORS.labels("malformed").value, malformed + 1
+        )
+
+    def test_bulk_writer_counts_stored_readings(self):
+        packets = metrics.PACKETS_STORED.value
+        readings = metrics.READINGS_STORED.value
+        commits = metrics.COMMIT_SECONDS.count
+        with tempfile.TemporaryDirectory() as tmpdir:
+            session = start_session(Path(tmpdir) / "sensor_data.db")
+            add_sensors_reading_records_bulk(session, [
+                SensorPacket("sensor_data/env", "env",
+                             {"temp": 21.5, "humidity": 40.0}, 1.0),
+                SensorPacket("sensor_data/env", "env", {"temp": 21.6}, 2.0),
+            ], DimensionCache())
+            session.close()
+        self.assertEqual(metrics.PACKETS_STORED.value, packets + 2)
+        self.assertEqual(metrics.READINGS_STORED.value, readings + 3)
+        self.assertEqual(metrics.COMMIT_SECONDS.count, commits + 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,256 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, 4CSCC development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import io
+import tempfile
+import unittest
+from contextlib import redirect_stderr
+from pathlib import Path
+
+from sqlalchemy import create_engine, insert
+from sqlalchemy.orm import sessionmaker
+
+from mqtt_data_logger.log_data import (
+    SensorPacket,
+    add_sensors_reading_records_bulk,
+)
+from mqtt_data_logger.migrate import (
+    is_legacy_schema,
+    legacy_metadata,
+    legacy_sensor_measurements,
+    legacy_topic_sensor_measurement,
+    legacy_sensor_sensor_measurement,
+    legacy_measurement_kind_sensor_measurement,
+    main,
+    migrate_sensor_data_db,
+    schema_version,
+    v2_metadata,
+    v2_sensor_measurements,
+)
+from mqtt_data_logger.query import query_readings
+from mqtt_data_logger.sensor_data_models import (
+    SCHEMA_VERSION, Base, Topic, Sensor, Measurement, Label,
+    SensorMeasurement,
+)
+
+
+class TestMigrate(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.source_fp = Path(self.tmpdir.name) / "sensor_data.db"
+        self.target_fp = Path(self.tmpdir.name) / "sensor_data.v2.db"
+        self.source = create_engine(f"sqlite:///{self.source_fp}")
+        for model in (Topic, Sensor, Measurement):
+            model.__table__.create(self.source)
+        legacy_metadata.create_all(self.source)
+        with self.source.begin() as conn:
+            conn.execute(insert(Topic), [{"topic": "sensor_data/env"}])
+            conn.execute(insert(Sensor), [{"sensor_id": "env"}])
+            conn.execute(
+                insert(Measurement),
+                [{"measurement": "temp"}, {"measurement": "humidity"}],
+            )
+        self.next_id = 1
+
+    def tearDown(self):
+        self.source.dispose()
+        self.tmpdir.cleanup()
+
+    def add_legacy_readings(self, count):
+        with self.source.begin() as conn:
+            for _ in range(count):
+                reading_id = self.next_id
+                self.next_id += 1
+                conn.execute(insert(legacy_sensor_measurements).values(
+                    sensor_measurement_num_id=reading_id,
+                    value=float(reading_id), str_value="",
+                ))
+                conn.execute(insert(legacy_topic_sensor_measurement).values(
+                    topic_num_id=1, sensor_measurement_num_id=reading_id,
+                ))
+                conn.execute(insert(legacy_sensor_sensor_measurement).values(
+                    sensor_num_id=1, sensor_measurement_num_id=reading_id,
+                ))
+                conn.execute(
+                    insert(legacy_measurement_kind_sensor_measurement).values(
+                        measurement_num_id=1 + reading_id % 2,
+                        sensor_measurement_num_id=reading_id,
+                    )
+                )
+
+    def target_readings(self):
+        engine = create_engine(f"sqlite:///{self.target_fp}")
+        session = sessionmaker(bind=engine)()
+        readings = [
+            (r.sensor_measurement_num_id, r.topic.topic, r.sensor.sensor_id,
+             r.measurement.measurement, r.value)
+            for r in session.query(SensorMeasurement).order_by(
+                SensorMeasurement.sensor_measurement_num_id
+            )
+        ]
+        session.close()
+        engine.dispose()
+        return readings
+
+    def test_migrates_in_chunks(self):
+        self.add_legacy_readings(7)
+
+        migrated = migrate_sensor_data_db(
+            self.source_fp, self.target_fp, chunk_size=3
+        )
+
+        self.assertTrue(is_legacy_schema(self.source))
+        self.assertEqual(migrated, 7)
+        readings = self.target_readings()
+        self.assertEqual(len(readings), 7)
+        self.assertEqual(
+            readings[0], (1, "sensor_data/env", "env", "humidity", 1.0)
+        )
+        self.assertEqual(readings[1][3], "temp")
+
+    def test_resumes_after_last_chunk(self):
+        self.add_legacy_readings(4)
+        migrate_sensor_data_db(self.source_fp, self.target_fp, chunk_size=3)
+        self.add_legacy_readings(2)
+
+        migrated = migrate_sensor_data_db(
+            self.source_fp, self.target_fp, chunk_size=3
+        )
+
+        self.assertEqual(migrated, 6)
+        self.assertEqual(
+            [r[0] for r in self.target_readings()], [1, 2, 3, 4, 5, 6]
+        )
+
+    def test_rejects_version_2_source(self):
+        with self.assertRaises(ValueError):
+            migrate_sensor_data_db(
+                self.target_fp, Path(self.tmpdir.name) / "other.db"
+            )
+
+
+class TestMigrateVersion2(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.source_fp = Path(self.tmpdir.name) / "sensor_data.db"
+        self.target_fp = Path(self.tmpdir.name) / "sensor_data.v3.db"
+        self.source = create_engine(f"sqlite:///{self.source_fp}")
+        for model in (Topic, Sensor, Measurement):
+            model.__table__.create(self.source)
+        v2_metadata.create_all(self.source)
+        with self.source.begin() as conn:
+            conn.execute(insert(Topic), [{"topic": "sensor_data/wind"}])
+            conn.execute(insert(Sensor), [{"sensor_id": "wind"}])
+            conn.execute(
+                insert(Measurement), [{"measurement": "cardinal_direction"}]
+            )
+            conn.execute(insert(v2_sensor_measurements), [
+                {
+                    "topic_num_id": 1, "sensor_num_id": 1,
+                    "measurement_num_id": 1, "value": degrees,
+                    "str_value": label,
+                }
+                for degrees, label in [
+                    (22.5, "NNE"), (22.5, "NNE"), (45.0, "NE"), (None, ""),
+                ]
+            ])
+
+    def tearDown(self):
+        self.source.dispose()
+        self.tmpdir.cleanup()
+
+    def test_labels_are_dictionary_encoded(self):
+        self.assertEqual(schema_version(self.source), 2)
+        self.assertEqual(
+            migrate_sensor_data_db(self.source_fp, self.target_fp), 4
+        )
+
+        engine = create_engine(f"sqlite:///{self.target_fp}")
+        session = sessionmaker(bind=engine)()
+        try:
+            self.assertEqual(schema_version(engine), SCHEMA_VERSION)
+            self.assertEqual(
+                sorted(label.label for label in session.query(Label)),
+                ["NE", "NNE"],
+            )
+            self.assertEqual(
+                [(r.value, r.str_value) for r in query_readings(session)],
+                [(22.5, "NNE"), (22.5, "NNE"), (45.0, "NE"), (None, "")],
+            )
+        finally:
+            session.close()
+            engine.dispose()
+
+
+
+class TestUpgradeVersion3(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db_fp = Path(self.tmpdir.name) / "sensor_data.db"
+        self.engine = create_engine(f"sqlite:///{self.db_fp}")
+        Base.metadata.create_all(self.engine)
+        with self.engine.begin() as conn:
+            conn.exec_driver_sql(
+                "DROP INDEX ux_sensor_measurements_packet_key"
+            )
+            conn.exec_driver_sql(
+                "ALTER TABLE sensor_measurements DROP COLUMN packet_key"
+            )
+            conn.execute(insert(Topic), [{"topic": "sensor_data/env"}])
+            conn.execute(insert(Sensor), [{"sensor_id": "env"}])
+            conn.execute(insert(Measurement), [{"measurement": "temp"}])
+            conn.exec_driver_sql(
+                "INSERT INTO sensor_measurements (topic_num_id, "
+                "sensor_num_id, measurement_num_id, value) "
+                "VALUES (1, 1, 1, 20.5)"
+            )
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.tmpdir.cleanup()
+
+    def test_upgrade_in_place(self):
+        self.assertEqual(schema_version(self.engine), 3)
+        self.assertTrue(is_legacy_schema(self.engine))
+
+        main([str(self.db_fp)])
+
+        self.assertEqual(schema_version(self.engine), SCHEMA_VERSION)
+        session = sessionmaker(bind=self.engine)()
+        try:
+            packet = SensorPacket("sensor_data/env", "env", {"temp": 21.0},
+                                  1.0, 7)
+            for _ in range(2):
+                add_sensors_reading_records_bulk(session, [packet])
+            self.assertEqual(
+                [(r.value, r.packet_key)
+                 for r in session.query(SensorMeasurement)],
+                [(20.5, None), (21.0, 7)],
+            )
+        finally:
+            session.close()
+
+    def test_current_or_missing_database_exits(self):
+        main([str(self.db_fp)])
+        with self.assertRaises(SystemExit) as exited, \
+                redirect_stderr(io.StringIO()):
+            main([str(self.db_fp)])
+        self.assertEqual(exited.exception.code, 0)
+
+        missing = self.db_fp.with_name("missing.db")
+        with self.assertRaises(SystemExit) as exited, \
+                redirect_stderr(io.StringIO()):
+            main([str(missing)])
+        self.assertEqual(exited.exception.code, 2)
+        self.assertFalse(missing.exists())
+
+
+if __name__ == "__main__":
+    unittest.main()
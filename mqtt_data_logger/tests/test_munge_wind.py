@@ -0,0 +1,172 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, 4CSCC development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import tempfile
+import unittest
+from datetime import datetime, timezone
+from pathlib import Path
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from mqtt_data_logger.log_data import (
+    SensorPacket,
+    add_sensors_reading_records_bulk,
+)
+from mqtt_data_logger.munge_wind import (
+    lookup_beaufort,
+    lookup_beauforts,
+    lookup_cardinal,
+    lookup_cardinals,
+    np,
+)
+from mqtt_data_logger.reprocess_wind import reprocess_wind
+from mqtt_data_logger.sensor_data_models import (
+    Base,
+    Measurement,
+    SensorMeasurement,
+)
+
+
+ANGLES = [0, 11.25, 33.7, 100, 200, 300, 348.75, 359.9]
+SPEEDS = [0, 0.5, 1, 18.9, 28.5, 29, 117.9, 118, 500]
+
+
+class TestArrayLookups(unittest.TestCase):
+
+    def test_sequences_match_scalar_lookups(self):
+        labels, degrees = lookup_cardinals(ANGLES)
+        self.assertEqual(
+            list(zip(labels, degrees)), [lookup_cardinal(a) for a in ANGLES]
+        )
+        labels, classes = lookup_beauforts(SPEEDS)
+        self.assertEqual(labels, [lookup_beaufort(s)[0] for s in SPEEDS])
+        self.assertEqual(classes, [0, 0, 1, 3, 4, 5, 11, 12, 12])
+
+    @unittest.skipIf(np is None, "numpy is not installed")
+    def test_numpy_arrays_match_sequences(self):
+        labels, degrees = lookup_cardinals(np.array(ANGLES))
+        self.assertEqual(
+            (labels.tolist(), degrees.tolist()), lookup_cardinals(ANGLES)
+        )
+        labels, classes = lookup_beauforts(np.array(SPEEDS))
+        self.assertEqual(
+            (labels.tolist(), classes.tolist()), lookup_beauforts(SPEEDS)
+        )
+
+    def test_out_of_range_raises(self):
+        with self.assertRaises(ValueError):
+            lookup_cardinals([10, 360])
+        with self.assertRaises(ValueError):
+            lookup_beauforts([-1])
+        if np is not None:
+            with self.assertRaises(ValueError):
+                lookup_cardinals(np.array([10, np.nan]))
+
+
+class TestReprocessWind(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.engine = create_engine(
+            f"sqlite:///{Path(self.tmpdir.name) / 'sensor_data.db'}"
+        )
+        Base.metadata.create_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+        at = datetime(2024, 5, 1, tzinfo=timezone.utc).timestamp()
+        add_sensors_reading_records_bulk(self.session, [
+            SensorPacket("sensor_data/wind", "wind", {
+                "wind_direction": 100,
+                "wind_speed_beaufort": ("Calm", 28.5),
+                "cardinal_direction": ("N", 0),
+            }, at),
+            # logged before the cardinal direction was derived
+            SensorPacket("sensor_data/wind", "wind", {
+                "wind_direction": 200,
+            }, at + 60),
+        ])
+
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+        self.tmpdir.cleanup()
+
+    def readings(self, measurement):
+        return [
+            (r.str_value, r.value) for r in self.session.query(
+                SensorMeasurement
+            ).join(Measurement).filter(
+                Measurement.measurement == measurement
+            ).order_by(SensorMeasurement.time)
+        ]
+
+    def test_reprocess_fixes_and_adds_derived_readings(self):
+        counts = reprocess_wind(self.engine, chunk_size=1)
+
+        self.assertEqual(counts, {
+            "beaufort_updated": 1,
+            "beaufort_skipped": 0,
+            "cardinal_updated": 1,
+            "cardinal_added": 1,
+            "cardinal_skipped": 0,
+            "cardinal_ambiguous": 0,
+        })
+        self.assertEqual(
+            self.readings("wind_speed_beaufort"), [("Moderate Breeze", 28.5)]
+        )
+        self.assertEqual(
+            self.readings("cardinal_direction"),
+            [("E", 90.0), ("SSW", 202.5)],
+        )
+        self.assertEqual(reprocess_wind(self.engine), {
+            "beaufort_updated": 0,
+            "beaufort_skipped": 0,
+            "cardinal_updated": 0,
+            "cardinal_added": 0,
+            "cardinal_skipped": 0,
+            "cardinal_ambiguous": 0,
+        })
+
+    def test_bad_and_ambiguous_readings_are_skipped(self):
+        at = datetime(2024, 5, 2, tzinfo=timezone.utc).timestamp()
+        add_sensors_reading_records_bulk(self.session, [
+            SensorPacket("sensor_data/wind", "wind", {
+                "wind_direction": 400, "wind_speed_beaufort": ("Calm", -1),
+            }, at),
+            # two packets without a key in the same second
+            SensorPacket("sensor_data/wind", "wind", {
+                "wind_direction": 10, "cardinal_direction": ("N", 0),
+            }, at + 60),
+            SensorPacket("sensor_data/wind", "wind", {
+                "wind_direction": 100, "cardinal_direction": ("N", 0),
+            }, at + 60),
+            # the same with keys tells the packets apart
+            SensorPacket("sensor_data/wind", "wind", {
+                "wind_direction": 10, "cardinal_direction": ("N", 0),
+            }, at + 120, key=1),
+            SensorPacket("sensor_data/wind", "wind", {
+                "wind_direction": 100, "cardinal_direction": ("N", 0),
+            }, at + 120, key=2),
+        ])
+
+        counts = reprocess_wind(self.engine, chunk_size=2)
+
+        self.assertEqual(counts, {
+            "beaufort_updated": 1,
+            "beaufort_skipped": 1,
+            "cardinal_updated": 2,
+            "cardinal_added": 1,
+            "cardinal_skipped": 1,
+            "cardinal_ambiguous": 2,
+        })
+        self.assertEqual(self.readings("cardinal_direction")[-4:], [
+            ("N", 0.0), ("N", 0.0), ("N", 0.0), ("E", 90.0),
+        ])
+
+
+if __name__ == "__main__":
+    unittest.main()
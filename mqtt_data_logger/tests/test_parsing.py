@@ -0,0 +1,184 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, 4CSCC development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import json
+import unittest
+from types import SimpleNamespace
+
+from sqlalchemy.exc import OperationalError
+
+from mqtt_data_logger import callbacks
+from mqtt_data_logger.log_data import DuplicateFilter
+from mqtt_data_logger.parsing import (
+    DECODERS,
+    LABEL,
+    NUMBER,
+    DeadLetters,
+    MalformedPacket,
+    Measurements,
+    PacketParser,
+    PacketSchema,
+)
+
+
+def payload(data, sensor="env", **fields):
+    return json.dumps({"sensor": sensor, "data": data, **fields}).encode()
+
+
+class TestPacketParser(unittest.TestCase):
+
+    def test_every_decoder_parses_bytes(self):
+        for name in DECODERS:
+            packet = PacketParser(decoder=name).parse(
+                "sensor_data/env", payload({"temp": 21.5, "status": "ok"}), 1.0
+            )
+            self.assertEqual(packet.sensor, "env")
+            self.assertEqual(packet.received_at, 1.0)
+            self.assertEqual(
+                packet.measurements, {"temp": 21.5, "status": "ok"}
+            )
+        with self.assertRaises(ValueError):
+            PacketParser(decoder="nope")
+
+    def test_wind_munging(self):
+        packet = PacketParser().parse("sensor_data/wind", payload(
+            {"wind_speed": 28.5, "wind_direction": 100}
+        ))
+        self.assertEqual(dict(packet.measurements), {
+            "wind_speed_beaufort": ("Moderate Breeze", 28.5),
+            "wind_direction": 100,
+            "cardinal_direction": ("E", 90),
+        })
+
+    def test_malformed_packets(self):
+        parser = PacketParser()
+        for bad in [
+            b"not json",
+            b"[1, 2]",
+            json.dumps({"data": {"temp": 1}}).encode(),
+            payload({}),
+            payload({"temp": True}),
+            payload({"temp": {"nested": 1}}),
+            payload({"wind_direction": 400}),
+            payload({"temp": 1}, seq=-1),
+            payload({"temp": 1}, seq=1.5),
+            payload({"temp": 1}, time="now"),
+        ]:
+            with self.assertRaises(MalformedPacket, msg=bad):
+                parser.parse("sensor_data/env", bad)
+
+    def test_packet_keys(self):
+        parser = PacketParser()
+        data = {"temp": 1.0}
+        for fields, key in [
+            ({}, None),
+            ({"seq": 7}, 7),
+            ({"seq": 7, "time": 1700000000.5}, 7),
+            ({"time": 1700000000.5}, 1700000000500000),
+        ]:
+            packet = parser.parse("sensor_data/env", payload(data, **fields))
+            self.assertEqual(packet.key, key)
+
+    def test_topic_schemas(self):
+        parser = PacketParser(schemas=[
+            ("sensor_data/wind", PacketSchema(
+                required=["wind_speed"],
+                kinds={"wind_speed": NUMBER, "cardinal": LABEL},
+            )),
+            ("sensor_data/#", PacketSchema()),
+        ])
+        with self.assertRaisesRegex(MalformedPacket, "missing"):
+            parser.parse("sensor_data/wind", payload({"temp": 1.0}))
+        with self.assertRaisesRegex(MalformedPacket, "should be a number"):
+            parser.parse("sensor_data/wind", payload({"wind_speed": "fast"}))
+        parser.parse("sensor_data/env", payload({"temp": 1.0}))
+        with self.assertRaisesRegex(MalformedPacket, "no packet schema"):
+            parser.parse("other/topic", payload({"temp": 1.0}))
+
+    def test_measurements_struct(self):
+        measurements = Measurements(["temp", "rh"], [1.0, 2.0])
+        self.assertEqual(measurements["rh"], 2.0)
+        self.assertEqual(
+            list(measurements.items()), [("temp", 1.0), ("rh", 2.0)]
+        )
+        self.assertNotIn("co2", measurements)
+        self.assertFalse(hasattr(measurements, "__dict__"))
+
+
+class TestDeadLetters(unittest.TestCase):
+
+    def test_callback_counts_instead_of_raising(self):
+        dead_letters = DeadLetters()
+        original = callbacks.dead_letters
+        callbacks.dead_letters = dead_letters
+        try:
+            with self.assertLogs("mqtt_data_logger", "WARNING"):
+                callbacks.log_sensor_data(None, None, SimpleNamespace(
+                    topic="sensor_data/env", payload=b"{broken"
+                ))
+        finally:
+            callbacks.dead_letters = original
+        self.assertEqual(dead_letters.stats(), {
+            "dead_letters": 1, "reasons": {"invalid JSON": 1},
+        })
+        self.assertEqual(dead_letters.latest[0][2], b"{broken")
+
+
+class TestDuplicateFilter(unittest.TestCase):
+
+    def test_callback_drops_redelivered_packets(self):
+        writer = SimpleNamespace(packets=[])
+        writer.put = writer.packets.append
+        callbacks.set_batch_writer(writer)
+        callbacks.set_duplicate_filter(DuplicateFilter())
+        try:
+            for seq in (1, 2, 1):
+                callbacks.log_sensor_data(None, None, SimpleNamespace(
+                    topic="sensor_data/env",
+                    payload=payload({"temp": 20.0}, seq=seq),
+                ))
+        finally:
+            callbacks.set_batch_writer(None)
+            callbacks.set_duplicate_filter(None)
+        self.assertEqual([packet.key for packet in writer.packets], [1, 2])
+
+
+class TestInlineWrite(unittest.TestCase):
+
+    def test_locked_database_is_retried(self):
+        calls = []
+
+        def add_record(**record):
+            calls.append(record)
+            if len(calls) == 1:
+                raise OperationalError("INSERT", {}, "database is locked")
+
+        session = SimpleNamespace(rollbacks=0)
+        session.rollback = lambda: setattr(
+            session, "rollbacks", session.rollbacks + 1
+        )
+        original = callbacks.add_sensors_reading_record
+        callbacks.add_sensors_reading_record = add_record
+        callbacks.set_session(session)
+        try:
+            with self.assertLogs("retry.api", "WARNING"):
+                callbacks.log_sensor_data(None, None, SimpleNamespace(
+                    topic="sensor_data/env",
+                    payload=payload({"temp": 20.0}, seq=7),
+                ))
+        finally:
+            callbacks.add_sensors_reading_record = original
+            callbacks.set_session(None)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(calls[0], calls[1])
+        self.assertEqual(calls[1]["packet_key"], 7)
+        self.assertEqual(calls[1]["measurements"], {"temp": 20.0})
+        self.assertEqual(session.rollbacks, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
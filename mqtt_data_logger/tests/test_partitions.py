@@ -0,0 +1,147 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, 4CSCC development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import sqlite3
+import tempfile
+import unittest
+from datetime import datetime, timezone
+from pathlib import Path
+
+from mqtt_data_logger.batch_writer import BatchWriter
+from mqtt_data_logger.log_data import SensorPacket
+from mqtt_data_logger.partitions import PartitionedStorage
+from mqtt_data_logger.sensor_data_models import SensorMeasurement
+
+
+def timestamp(*args):
+    return datetime(*args, tzinfo=timezone.utc).timestamp()
+
+
+class TestPartitionedStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.directory = Path(self.tmpdir.name)
+        self.storage = PartitionedStorage(self.directory, "day", max_open=1)
+        self.storage.write_batch(None, [
+            SensorPacket("sensor_data", "env", {"temp": 1.0},
+                         timestamp(2024, 5, 1, 23, 59)),
+            SensorPacket("sensor_data", "env", {"temp": 2.0},
+                         timestamp(2024, 5, 2, 0, 1)),
+            SensorPacket("sensor_data", "env", {"temp": 3.0},
+                         timestamp(2024, 5, 3, 12)),
+        ])
+
+    def tearDown(self):
+        self.storage.close()
+        self.tmpdir.cleanup()
+
+    def test_routes_by_received_at(self):
+        self.assertEqual(
+            self.storage.partitions(),
+            ["2024-05-01", "2024-05-02", "2024-05-03"],
+        )
+        session = self.storage.session_for("2024-05-02")
+        reading = session.query(SensorMeasurement).one()
+        self.assertEqual(reading.value, 2.0)
+        self.assertEqual(reading.time, datetime(2024, 5, 2, 0, 1))
+
+    def test_month_granularity(self):
+        storage = PartitionedStorage(self.directory / "monthly", "month")
+        self.assertEqual(
+            storage.partition_key(timestamp(2024, 5, 31, 23)), "2024-05"
+        )
+        storage.close()
+
+    def test_partitions_between(self):
+        self.assertEqual(
+            self.storage.partitions_between(
+                datetime(2024, 5, 2, 6), datetime(2024, 5, 3)
+            ),
+            ["2024-05-02", "2024-05-03"],
+        )
+        self.assertEqual(
+            self.storage.partitions_between(end=datetime(2024, 5, 1, 6)),
+            ["2024-05-01"],
+        )
+
+    def test_logged_fans_out_newest_first(self):
+        records = self.storage.logged(number_of_records=2)
+        self.assertEqual([r.value for r in records], [3.0, 2.0])
+        self.assertEqual(records[0].sensor, "env")
+
+        records = self.storage.logged(
+            start=datetime(2024, 5, 1), end=datetime(2024, 5, 2)
+        )
+        self.assertEqual([r.value for r in records], [1.0])
+
+    def test_logged_survives_closed_partitions(self):
+        self.storage.write_batch(None, [
+            SensorPacket("sensor_data/wind", "wind",
+                         {"cardinal_direction": (label, degrees)},
+                         timestamp(2024, 5, day, 12))
+            for day, label, degrees in [(1, "N", 0.0), (2, "NNE", 22.5)]
+        ])
+        records = self.storage.logged(sensor="wind")
+        self.assertEqual([r.str_value for r in records], ["NNE", "N"])
+
+    def test_retry_skips_committed_partitions(self):
+        # a directory where the file of the 5th should be, it cannot open
+        self.storage.path_for("2024-05-05").mkdir()
+        writer = BatchWriter(
+            None, max_latency=60, retries=3, retry_delay=0,
+            write_batch=self.storage.write_batch,
+        ).start()
+        for day in (4, 5):
+            writer.put(SensorPacket("sensor_data", "env", {"temp": 4.0},
+                                    timestamp(2024, 5, day, 12)))
+        with self.assertLogs("mqtt_data_logger.batch_writer", "ERROR"):
+            writer.close()
+
+        stats = writer.stats()
+        self.assertEqual((stats["written"], stats["failed"]), (1, 1))
+        session = self.storage.session_for("2024-05-04")
+        self.assertEqual(session.query(SensorMeasurement).count(), 1)
+
+    def test_archive_and_drop(self):
+        archive_dir = self.directory / "archive"
+        moved = self.storage.archive("2024-05-01", archive_dir)
+        self.storage.drop("2024-05-02")
+
+        self.assertTrue(moved.exists())
+        self.assertEqual(self.storage.partitions(), ["2024-05-03"])
+
+    def test_archive_keeps_readings_of_open_readers(self):
+        # a reader such as the API server keeps the WAL from being removed
+        reader = sqlite3.connect(self.storage.path_for("2024-05-01"))
+        try:
+            reader.execute("SELECT 1 FROM sensor_measurements").fetchall()
+            self.storage.write_batch(None, [
+                SensorPacket("sensor_data", "env", {"temp": 5.0},
+                             timestamp(2024, 5, 1, 18)),
+            ])
+            moved = self.storage.archive(
+                "2024-05-01", self.directory / "archive"
+            )
+            self.storage.drop("2024-05-02")
+        finally:
+            reader.close()
+
+        self.assertEqual(sorted(
+            fp.name for fp in self.directory.iterdir() if fp.is_file()
+        ), [self.storage.path_for("2024-05-03").name])
+        archived = sqlite3.connect(moved)
+        try:
+            self.assertEqual(archived.execute(
+                "SELECT count(*) FROM sensor_measurements"
+            ).fetchone()[0], 2)
+        finally:
+            archived.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
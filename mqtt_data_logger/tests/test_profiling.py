@@ -0,0 +1,175 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, 4CSCC development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import json
+import pstats
+import tempfile
+import unittest
+from datetime import datetime, timezone
+from pathlib import Path
+
+from sqlalchemy import func, select
+
+from mqtt_data_logger import callbacks
+from mqtt_data_logger.__main__ import main
+from mqtt_data_logger.benchmark import generate_messages
+from mqtt_data_logger.profiling import (
+    SamplingProfiler,
+    read_capture,
+    replay_capture,
+    write_capture,
+)
+from mqtt_data_logger.sensor_data_models import SensorMeasurement
+from mqtt_data_logger.spool import HEADER, Spool
+from mqtt_data_logger.util import start_session
+
+
+class TestCapture(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.tmpdir = Path(self.directory.name)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_round_trip(self):
+        messages = [
+            ("sensor_data/env", b'{"sensor": "env"}', 1.5),
+            ("sensor_data/raw", b"\xff\x00", 2.5),
+        ]
+        write_capture(self.tmpdir / "capture.jsonl", messages)
+        self.assertEqual(
+            list(read_capture(self.tmpdir / "capture.jsonl")), messages
+        )
+
+    def test_spool_directory_is_a_capture(self):
+        spool = Spool(self.tmpdir / "spool", segment_size=4096)
+        for i in range(100):
+            spool.append("sensor_data/env", b"payload %d" % i, float(i))
+        spool.close()
+        messages = list(read_capture(self.tmpdir / "spool"))
+        self.assertEqual(len(messages), 100)
+        self.assertEqual(
+            messages[-1], ("sensor_data/env", b"payload 99", 99.0)
+        )
+
+    def test_reading_a_live_spool_changes_nothing(self):
+        spool = Spool(self.tmpdir / "spool", segment_size=4096)
+        try:
+            for i in range(3):
+                spool.append("sensor_data/env", b"payload %d" % i, float(i))
+            # the logger is halfway through a record: body, but no header
+            position = spool.end_offset() + HEADER.size
+            spool._map[position:position + 4] = b"torn"
+            segment = next((self.tmpdir / "spool").iterdir())
+            before = segment.read_bytes()
+
+            messages = list(read_capture(self.tmpdir / "spool"))
+            self.assertEqual(len(messages), 3)
+            self.assertEqual(segment.read_bytes(), before)
+            self.assertEqual(bytes(spool._map[position:position + 4]),
+                             b"torn")
+        finally:
+            spool.close()
+
+    def test_replay_calls_the_callback(self):
+        received = []
+        replayed = replay_capture(
+            [("sensor_data/env", b"{}", 1.0)] * 3,
+            lambda client, userdata, msg: received.append(msg.topic),
+        )
+        self.assertEqual(replayed, 3)
+        self.assertEqual(received, ["sensor_data/env"] * 3)
+
+
+class TestProfiling(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.tmpdir = Path(self.directory.name)
+        self.capture = self.tmpdir / "capture.jsonl"
+        write_capture(self.capture, [
+            (topic, payload, None)
+            for topic, payload in generate_messages(300)
+        ])
+
+    def tearDown(self):
+        callbacks.set_latest_values(None)
+        self.directory.cleanup()
+
+    def replay(self, *options):
+        db_fp = self.tmpdir / "sensor_data.db"
+        output = self.tmpdir / "profile"
+        main([
+            "--db", str(db_fp), "--replay", str(self.capture),
+            "--profile-output", str(output), "--log-level", "WARNING",
+            *options,
+        ])
+        session = start_session(db_fp)
+        self.assertGreater(session.execute(
+            select(func.count()).select_from(SensorMeasurement)
+        ).scalar(), 300)
+        session.close()
+        return output, json.loads(
+            Path(f"{output}.stages.json").read_text()
+        )
+
+    def test_replay_reports_stages(self):
+        output, breakdown = self.replay()
+        stages = breakdown["stages"]
+        self.assertEqual(stages["callback"]["calls"], 300)
+        self.assertEqual(stages["decode"]["calls"], 300)
+        self.assertGreater(stages["write"]["calls"], 0)
+        self.assertGreaterEqual(stages["insert"]["seconds"], 0)
+
+    def test_cprofile(self):
+        output, breakdown = self.replay("--profile", "cprofile")
+        self.assertEqual(breakdown["profiler"], "cprofile")
+        functions = {
+            name for filename, line, name in pstats.Stats(
+                str(Path(f"{output}.pstats"))
+            ).stats
+        }
+        self.assertIn("parse", functions)
+        self.assertIn("add_sensors_reading_records_bulk", functions)
+
+    def test_replay_keeps_captured_receipt_times(self):
+        at = datetime(2024, 5, 1, tzinfo=timezone.utc).timestamp()
+        write_capture(self.capture, [
+            ("sensor_data/env", b'{"sensor": "env", "data": {"temp": 1}}',
+             at + i * 60)
+            for i in range(3)
+        ])
+        db_fp = self.tmpdir / "sensor_data.db"
+        main(["--db", str(db_fp), "--replay", str(self.capture),
+              "--profile-output", str(self.tmpdir / "profile"),
+              "--log-level", "WARNING"])
+        session = start_session(db_fp)
+        try:
+            times = session.scalars(select(SensorMeasurement.time)).all()
+        finally:
+            session.close()
+        self.assertEqual(times, [
+            datetime(2024, 5, 1, 0, minute) for minute in range(3)
+        ])
+
+    def test_sampler_writes_collapsed_stacks(self):
+        sampler = SamplingProfiler()
+        sampler.sample()
+        stack, = [
+            stack for stack in sampler.stacks
+            if "test_sampler_writes_collapsed_stacks" in stack
+        ]
+        self.assertTrue(stack.startswith("MainThread;"))
+        sampler.write(self.tmpdir / "profile")
+        line = (self.tmpdir / "profile.collapsed").read_text().splitlines()[0]
+        self.assertTrue(line.rsplit(" ", 1)[1].isdigit())
+
+
+if __name__ == "__main__":
+    unittest.main()
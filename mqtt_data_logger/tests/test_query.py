@@ -0,0 +1,107 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, 4CSCC development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import contextlib
+import io
+import unittest
+from datetime import datetime, timezone
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from mqtt_data_logger.log_data import (
+    SensorPacket,
+    add_sensors_reading_records_bulk,
+    logged,
+)
+from mqtt_data_logger.query import (
+    iter_reading_pages,
+    np,
+    query_columns,
+    query_readings,
+)
+from mqtt_data_logger.sensor_data_models import Base
+
+
+def timestamp(minute):
+    return datetime(2024, 5, 1, 12, minute, tzinfo=timezone.utc).timestamp()
+
+
+class TestQueryReadings(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine("sqlite:///:memory:")
+        Base.metadata.create_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+        packets = []
+        for minute in range(10):
+            packets.append(SensorPacket(
+                "sensor_data/env", "env",
+                {"temp": float(minute), "humidity": 50.0}, timestamp(minute),
+            ))
+            packets.append(SensorPacket(
+                "sensor_data/wind", "wind",
+                {"cardinal_direction": ("NNE", 22.5)}, timestamp(minute),
+            ))
+        add_sensors_reading_records_bulk(self.session, packets)
+
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+
+    def test_filters_and_time_range(self):
+        readings = list(query_readings(
+            self.session, sensor="env", measurement="temp",
+            start=datetime(2024, 5, 1, 12, 2), end=datetime(2024, 5, 1, 12, 5),
+        ))
+        self.assertEqual([r.value for r in readings], [2.0, 3.0, 4.0])
+        self.assertEqual(readings[0].topic, "sensor_data/env")
+        self.assertEqual(readings[0].time, datetime(2024, 5, 1, 12, 2))
+
+        wind = list(query_readings(self.session, topic="sensor_data/wind"))
+        self.assertEqual(len(wind), 10)
+        self.assertEqual(wind[0].str_value, "NNE")
+        self.assertEqual(
+            list(query_readings(self.session, sensor="missing")), []
+        )
+
+    def test_keyset_pages_cover_range_once(self):
+        pages = list(iter_reading_pages(
+            self.session, page_size=7, sensor="env"
+        ))
+        self.assertEqual([len(page) for page in pages], [7, 7, 6])
+        ids = [r.reading_id for page in pages for r in page]
+        self.assertEqual(len(set(ids)), 20)
+
+        newest = list(query_readings(
+            self.session, measurement="temp", descending=True, limit=2
+        ))
+        self.assertEqual([r.value for r in newest], [9.0, 8.0])
+        older = query_readings(
+            self.session, measurement="temp", descending=True, limit=1,
+            after=newest[-1].key,
+        )
+        self.assertEqual([r.value for r in older], [7.0])
+
+    def test_query_columns(self):
+        columns = query_columns(self.session, sensor="env", measurement="temp")
+        self.assertEqual(list(columns["value"]), [float(m) for m in range(10)])
+        if np is not None:
+            self.assertEqual(columns["value"].dtype, np.float64)
+            self.assertEqual(columns["time"].dtype, np.dtype("datetime64[us]"))
+
+    def test_logged_prints_latest(self):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            records = logged(self.session, 3, sensor="env")
+        self.assertEqual(len(records), 3)
+        self.assertEqual(records[0].time, datetime(2024, 5, 1, 12, 9))
+        self.assertIn("sensor: env", out.getvalue())
+
+
+if __name__ == "__main__":
+    unittest.main()
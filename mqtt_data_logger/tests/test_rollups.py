@@ -0,0 +1,163 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, 4CSCC development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import tempfile
+import unittest
+from datetime import datetime, timezone
+from pathlib import Path
+
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import sessionmaker
+
+from mqtt_data_logger.compression import compact_readings
+from mqtt_data_logger.log_data import (
+    SensorPacket,
+    add_sensors_reading_records_bulk,
+)
+from mqtt_data_logger.rollups import (
+    backfill_rollups,
+    pick_rollup,
+    read_series,
+)
+from mqtt_data_logger.sensor_data_models import (
+    Base,
+    DayRollup,
+    HourRollup,
+    MinuteRollup,
+)
+
+
+def timestamp(*args):
+    return datetime(*args, tzinfo=timezone.utc).timestamp()
+
+
+PACKETS = [
+    SensorPacket("sensor_data", "env", {"temp": 1.0},
+                 timestamp(2024, 5, 1, 12, 0, 10)),
+    SensorPacket("sensor_data", "env", {"temp": 3.0},
+                 timestamp(2024, 5, 1, 12, 0, 50)),
+    SensorPacket("sensor_data", "env", {"temp": 8.0},
+                 timestamp(2024, 5, 1, 12, 1, 5)),
+    SensorPacket("sensor_data", "env", {"temp": 4.0},
+                 timestamp(2024, 5, 2, 6, 30)),
+]
+
+
+class TestRollups(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.engine = create_engine(
+            f"sqlite:///{Path(self.tmpdir.name) / 'sensor_data.db'}"
+        )
+        Base.metadata.create_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+        self.tmpdir.cleanup()
+
+    def rollup(self, model):
+        return [
+            (r.bucket, r.count, r.mean, r.min, r.max)
+            for r in self.session.scalars(select(model).order_by(model.bucket))
+        ]
+
+    def check_rollups(self):
+        self.assertEqual(self.rollup(MinuteRollup), [
+            (datetime(2024, 5, 1, 12, 0), 2, 2.0, 1.0, 3.0),
+            (datetime(2024, 5, 1, 12, 1), 1, 8.0, 8.0, 8.0),
+            (datetime(2024, 5, 2, 6, 30), 1, 4.0, 4.0, 4.0),
+        ])
+        self.assertEqual(self.rollup(HourRollup)[0],
+                         (datetime(2024, 5, 1, 12), 3, 4.0, 1.0, 8.0))
+        self.assertEqual(self.rollup(DayRollup), [
+            (datetime(2024, 5, 1), 3, 4.0, 1.0, 8.0),
+            (datetime(2024, 5, 2), 1, 4.0, 4.0, 4.0),
+        ])
+
+    def test_incremental_updates_merge_batches(self):
+        add_sensors_reading_records_bulk(self.session, PACKETS[:2],
+                                         rollups=True)
+        add_sensors_reading_records_bulk(self.session, PACKETS[2:],
+                                         rollups=True)
+        self.check_rollups()
+
+    def test_backfill_matches_incremental(self):
+        add_sensors_reading_records_bulk(self.session, PACKETS)
+        self.assertEqual(backfill_rollups(self.engine), 2)
+        self.check_rollups()
+        # rerunning rebuilds instead of double counting
+        backfill_rollups(self.engine, start=datetime(2024, 5, 1))
+        self.session.expire_all()
+        self.check_rollups()
+
+    def test_pick_rollup(self):
+        self.assertIsNone(pick_rollup(10))
+        self.assertIs(pick_rollup(60), MinuteRollup)
+        self.assertIs(pick_rollup(900), MinuteRollup)
+        self.assertIs(pick_rollup(7 * 86400), DayRollup)
+        # rollup buckets that do not divide the resolution are not used
+        self.assertIsNone(pick_rollup(90))
+        self.assertIs(pick_rollup(5400), MinuteRollup)
+        self.assertIs(pick_rollup(86400 + 3600), HourRollup)
+
+    def test_read_series(self):
+        add_sensors_reading_records_bulk(self.session, PACKETS, rollups=True)
+        start, end = datetime(2024, 5, 1), datetime(2024, 5, 3)
+
+        raw = read_series(self.session, "env", "temp", start, end)
+        self.assertEqual([r[2] for r in raw], [1.0, 3.0, 8.0, 4.0])
+
+        hourly = read_series(self.session, "env", "temp", start, end, 3600)
+        self.assertEqual(hourly, [
+            (datetime(2024, 5, 1, 12), 3, 4.0, 1.0, 8.0),
+            (datetime(2024, 5, 2, 6), 1, 4.0, 4.0, 4.0),
+        ])
+        two_minutes = read_series(
+            self.session, "env", "temp", start, end, 120
+        )
+        self.assertEqual(two_minutes[0],
+                         (datetime(2024, 5, 1, 12), 3, 4.0, 1.0, 8.0))
+
+    def test_read_series_matches_raw_readings(self):
+        packets = PACKETS + [
+            SensorPacket("sensor_data", "env", {"temp": 6.0},
+                         timestamp(2024, 5, 1, 12, 1, 40)),
+        ]
+        add_sensors_reading_records_bulk(self.session, packets, rollups=True)
+        start, end = datetime(2024, 5, 1), datetime(2024, 5, 3)
+
+        # 12:01 to 12:02 straddles the 90 s buckets 12:00 and 12:01:30
+        self.assertEqual(read_series(
+            self.session, "env", "temp", start, end, 90
+        ), [
+            (datetime(2024, 5, 1, 12), 3, 4.0, 1.0, 8.0),
+            (datetime(2024, 5, 1, 12, 1, 30), 1, 6.0, 6.0, 6.0),
+            (datetime(2024, 5, 2, 6, 30), 1, 4.0, 4.0, 4.0),
+        ])
+
+    def test_read_series_of_compacted_readings(self):
+        add_sensors_reading_records_bulk(self.session, PACKETS, rollups=True)
+        self.session.close()
+        compact_readings(self.engine, datetime(2024, 5, 2))
+        start, end = datetime(2024, 5, 1), datetime(2024, 5, 3)
+
+        # the first day is in a block now, the second still in the table
+        raw = read_series(self.session, "env", "temp", start, end)
+        self.assertEqual([r[2] for r in raw], [1.0, 3.0, 8.0, 4.0])
+        ten_seconds = read_series(
+            self.session, "env", "temp", start, end, 10
+        )
+        self.assertEqual(ten_seconds[0],
+                         (datetime(2024, 5, 1, 12, 0, 10), 1, 1.0, 1.0, 1.0))
+        self.assertEqual(len(ten_seconds), 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
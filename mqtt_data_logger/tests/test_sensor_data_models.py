@@ -7,7 +7,7 @@ from icecream import ic
 from sqlalchemy import create_engine, select
 from sqlalchemy.orm import sessionmaker
 from mqtt_data_logger.sensor_data_models import (
-    Base, Topic, Sensor, Measurement, SensorMeasurement,
+    Base, Topic, Sensor, Measurement, Label, SensorMeasurement,
     initialize_sensor_data_db
 )
 import os
@@ -56,10 +56,21 @@ class TestSensorData(unittest.TestCase):
         self.assertIn("sensors", tables)
         self.assertIn("measurements", tables)
         self.assertIn("sensor_measurements", tables)
-        # ancillary/mapping tables
-        self.assertIn("topic_sensor_measurement", tables)
-        self.assertIn("sensor_sensor_measurement", tables)
-        self.assertIn("measurement_kind_sensor_measurement", tables)
+        # readings reference their dimensions directly, no mapping tables
+        self.assertNotIn("topic_sensor_measurement", tables)
+        self.assertNotIn("sensor_sensor_measurement", tables)
+        self.assertNotIn("measurement_kind_sensor_measurement", tables)
+
+    def test_sensor_measurement_indexes(self):
+        """ Test the (sensor, measurement, time) index exists. """
+        indexes = {
+            index.name: [c.name for c in index.columns]
+            for index in SensorMeasurement.__table__.indexes
+        }
+        self.assertEqual(
+            indexes["ix_sensor_measurements_sensor_measurement_time"],
+            ["sensor_num_id", "measurement_num_id", "time"],
+        )
 
     def test_add_new_topic(self):
         ic()
@@ -142,12 +153,11 @@ class TestSensorData(unittest.TestCase):
         sensor = Sensor(sensor_id="EnvSensor01")
         measurement = Measurement(measurement="Temperature")
         sensor_measurement = SensorMeasurement(
-            topic=[topic],
-            sensor=[sensor],
-            measurement=[measurement],
+            topic=topic,
+            sensor=sensor,
+            measurement=measurement,
             value=23.5,
-            value_2=24.0,
-            str_value="23.5°C"
+            label=Label(label="23.5°C"),
         )
         self.session.add_all([topic, sensor, measurement, sensor_measurement])
         self.session.commit()
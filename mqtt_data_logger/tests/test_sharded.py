@@ -0,0 +1,110 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, 4CSCC development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import json
+import queue
+import unittest
+from types import SimpleNamespace
+
+from mqtt_data_logger.clocks import SensorClocks
+from mqtt_data_logger.config import DEFAULT_BROKER
+from mqtt_data_logger.log_data import DuplicateFilter
+from mqtt_data_logger.sharded import (
+    ShardMessageHandler,
+    shard_db_fp,
+    topic_shard,
+    writer_loop,
+)
+from mqtt_data_logger.util import get_mqtt_client
+
+
+def message(topic, sensor="env", **fields):
+    payload = json.dumps({"sensor": sensor, "data": {"temp": 1.0}, **fields})
+    return SimpleNamespace(topic=topic, payload=payload.encode())
+
+
+class TestSharding(unittest.TestCase):
+
+    topics = ["sensor_data/hub_{}".format(i) for i in range(50)]
+
+    def test_hash_splits_topics_between_shards(self):
+        packets = []
+        handlers = [
+            ShardMessageHandler(shard, 4, "hash", packets.append)
+            for shard in range(4)
+        ]
+        for topic in self.topics:
+            for handler in handlers:
+                handler(None, None, message(topic))
+
+        # every topic is kept by exactly one shard
+        kept = sorted(p.topic for p in packets)
+        self.assertEqual(kept, sorted(self.topics))
+        self.assertEqual(
+            sum(h.counts["skipped"] for h in handlers), 3 * len(self.topics)
+        )
+        self.assertEqual(topic_shard("sensor_data/hub_1", 4),
+                         topic_shard("sensor_data/hub_1", 4))
+
+    def test_shared_subscription_keeps_everything(self):
+        packets = []
+        handler = ShardMessageHandler(1, 4, "shared", packets.append)
+        for topic in self.topics:
+            handler(None, None, message(topic))
+        handler(None, None, SimpleNamespace(topic="sensor_data/x",
+                                            payload=b"{"))
+
+        self.assertEqual(len(packets), len(self.topics))
+        self.assertEqual(handler.counts["malformed"], 1)
+
+    def test_redelivered_packets_are_dropped(self):
+        packets = []
+        handler = ShardMessageHandler(
+            0, 1, "shared", packets.append,
+            duplicate_filter=DuplicateFilter(), clocks=SensorClocks(),
+        )
+        for seq in (1, 2, 1):
+            handler(None, None, message("sensor_data/env", seq=seq))
+
+        self.assertEqual([p.key for p in packets], [1, 2])
+        self.assertEqual(handler.counts["duplicates"], 1)
+        self.assertTrue(all(p.time is not None for p in packets))
+
+    def test_shared_client_subscriptions(self):
+        received = []
+        client = get_mqtt_client(
+            lambda client, userdata, msg: received.append(msg.topic),
+            DEFAULT_BROKER, connect=False, share_group="loggers",
+        )
+        self.assertEqual(client.user_data_get()["subscriptions"],
+                         ["$share/loggers/sensor_data/#"])
+        # messages arrive on their own topic, not the shared filter
+        client._handle_on_message(SimpleNamespace(
+            topic="sensor_data/env", payload=b"",
+        ))
+        self.assertEqual(received, ["sensor_data/env"])
+
+    def test_writer_loop_stops_at_marker(self):
+        packets = queue.Queue()
+        for i in range(3):
+            packets.put(i)
+        packets.put(None)
+        written = []
+
+        writer_loop(packets, SimpleNamespace(put=written.append))
+
+        self.assertEqual(written, [0, 1, 2])
+
+    def test_shard_db_fp(self):
+        self.assertEqual(
+            shard_db_fp("/data/sensor_data.db", 2).name,
+            "sensor_data_shard2.db",
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
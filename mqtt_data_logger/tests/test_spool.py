@@ -0,0 +1,152 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, 4CSCC development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import json
+import tempfile
+import unittest
+from pathlib import Path
+from types import SimpleNamespace
+
+from sqlalchemy import func, select, text
+
+from mqtt_data_logger import callbacks
+from mqtt_data_logger.log_data import DimensionCache
+from mqtt_data_logger.sensor_data_models import SensorMeasurement
+from mqtt_data_logger.spool import Spool, SpoolReplayer, committed_offset
+from mqtt_data_logger.util import start_session
+
+
+def payload(temp, sensor="env"):
+    return json.dumps({"sensor": sensor, "data": {"temp": temp}}).encode()
+
+
+class TestSpool(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.directory = Path(self.tmpdir.name) / "spool"
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_offsets_are_contiguous_across_segments(self):
+        spool = Spool(self.directory, segment_size=256)
+        offsets = [
+            spool.append("sensor_data/env", payload(i), 1000.0 + i)
+            for i in range(20)
+        ]
+        self.assertGreater(len(spool.segments()), 1)
+
+        records = spool.read(0, max_records=100)
+        self.assertEqual([r.offset for r in records], offsets)
+        self.assertEqual(records[3].payload, payload(3))
+        self.assertEqual(records[3].received_at, 1003.0)
+        for record, following in zip(records, records[1:]):
+            self.assertEqual(record.next_offset, following.offset)
+        self.assertEqual(
+            [r.offset for r in spool.read(offsets[7], 3)], offsets[7:10]
+        )
+        self.assertEqual(spool.read(spool.end_offset()), [])
+
+        spool.release(offsets[15])
+        self.assertEqual(spool.read(offsets[15])[0].offset, offsets[15])
+        self.assertLess(len(spool.segments()), 5)
+        spool.close()
+
+    def test_reopen_drops_torn_record(self):
+        spool = Spool(self.directory, segment_size=4096)
+        spool.append("sensor_data/env", payload(1), 1.0)
+        end = spool.append("sensor_data/env", payload(2), 2.0)
+        # a crash halfway through the second record
+        spool._map[end + 12:end + 20] = b"\xff" * 8
+        spool.close()
+
+        spool = Spool(self.directory, segment_size=4096)
+        self.assertEqual(len(spool.read(0)), 1)
+        self.assertEqual(spool.append("sensor_data/env", payload(3), 3.0), end)
+        self.assertEqual(
+            [r.payload for r in spool.read(0)], [payload(1), payload(3)]
+        )
+        spool.close()
+
+
+class TestSpoolReplayer(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.spool = Spool(Path(self.tmpdir.name) / "spool", 4096)
+        self.db_fp = Path(self.tmpdir.name) / "sensor_data.db"
+        self.session = start_session(self.db_fp)
+
+    def tearDown(self):
+        self.spool.close()
+        self.session.close()
+        self.session.get_bind().dispose()
+        self.tmpdir.cleanup()
+
+    def readings(self):
+        return self.session.execute(
+            select(func.count()).select_from(SensorMeasurement)
+        ).scalar()
+
+    def replayer(self):
+        return SpoolReplayer(self.spool, self.session, DimensionCache())
+
+    def test_replays_exactly_once(self):
+        for i in range(5):
+            self.spool.append("sensor_data/env", payload(float(i)), 1.0 + i)
+        self.spool.append("sensor_data/env", b"not json", 9.0)
+        with self.assertLogs("mqtt_data_logger.spool", "WARNING"):
+            replayer = self.replayer()
+            replayer.max_batch_size = 4
+            replayer.replay_once()
+
+            # a new replayer, as after a restart, resumes from the offset
+            replayer = self.replayer()
+            self.assertEqual(replayer.replay_once(), 2)
+            self.assertEqual(replayer.replay_once(), 0)
+        self.assertEqual(self.readings(), 5)
+        self.assertEqual(replayer.counts["malformed"], 1)
+        self.assertEqual(
+            committed_offset(self.session), self.spool.end_offset()
+        )
+        self.assertEqual(replayer.stats()["lag_bytes"], 0)
+
+    def test_bad_packet_does_not_block_the_spool(self):
+        # a reading the database refuses, as a constraint would
+        self.session.execute(text(
+            "CREATE TRIGGER reject BEFORE INSERT ON sensor_measurements "
+            "WHEN NEW.value = 2.0 BEGIN SELECT RAISE(ABORT, 'rejected'); END"
+        ))
+        self.session.commit()
+        self.spool.append("sensor_data/env", payload(1.0), 1.0)
+        self.spool.append("sensor_data/env", payload(2.0), 2.0)
+        self.spool.append("sensor_data/env", payload(3.0), 3.0)
+        replayer = self.replayer()
+        with self.assertLogs("mqtt_data_logger.spool", "WARNING"):
+            replayer.replay_once()
+        self.assertEqual(self.readings(), 2)
+        self.assertEqual(replayer.counts["failed"], 1)
+        self.assertEqual(replayer.offset, self.spool.end_offset())
+
+    def test_callback_appends_to_spool(self):
+        callbacks.set_spool(self.spool)
+        try:
+            callbacks.log_sensor_data(None, None, SimpleNamespace(
+                topic="sensor_data/env", payload=payload(1.0)
+            ))
+        finally:
+            callbacks.set_spool(None)
+        self.assertEqual(self.spool.read(0)[0].payload, payload(1.0))
+
+        replayer = self.replayer().start()
+        replayer.close()
+        self.assertEqual(self.readings(), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
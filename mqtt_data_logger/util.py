@@ -10,39 +10,68 @@
 from pathlib import Path
 
 from mqtt_data_logger.callbacks import on_connect, on_message, log_sensor_data
+from mqtt_data_logger.config import DEFAULT_BROKER, DEFAULT_DB
+from mqtt_data_logger.db import (
+    DEFAULT_SQLITE_PROFILE,
+    create_database_engine,
+    create_sqlite_engine,
+)
+from mqtt_data_logger.sensor_data_models import Base
 from paho.mqtt import client as mqtt
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy.orm import sessionmaker
 
-Base = declarative_base()
 
+def start_session(db_fp=Path(DEFAULT_DB), profile=DEFAULT_SQLITE_PROFILE):
+    """
+    Create a session to the database with a sqlite ``profile``.
 
-def start_session(db_fp=Path("/home/beta/sensor_data.db")):
-    """Create a session to the database."""
-    with db_fp as sqlite_filepath:
-        engine = create_engine(f"sqlite:///{sqlite_filepath}")
+    ``db_fp`` is a SQLite file or a SQLAlchemy URL of any database.
+    """
+    if "://" in str(db_fp):
+        engine = create_database_engine(str(db_fp), profile)
+    else:
+        engine = create_sqlite_engine(db_fp, profile)
 
-        Base.metadata.create_all(engine)
+    Base.metadata.create_all(engine)
 
-        Session = sessionmaker(bind=engine)
-        session = Session()
-        session.commit()
-        return session
+    Session = sessionmaker(bind=engine)
+    session = Session()
+    session.commit()
+    return session
 
 
-def get_mqtt_client():
-    """Create a MQTT client."""
-    client = client = mqtt.Client()
+def get_mqtt_client(
+    sensor_data_callback=log_sensor_data, broker=DEFAULT_BROKER, connect=True,
+    share_group=None,
+):
+    """
+    Create a MQTT client for a ``config.BrokerConfig``.
+
+    Messages on the broker's subscriptions go to ``sensor_data_callback``.
+    With a ``share_group`` the subscriptions are MQTT shared subscriptions
+    of that group, the broker hands each message to one of its clients.
+    With ``connect`` the client is connected before it is returned.
+    """
+    subscriptions = list(broker.subscriptions)
+    if share_group is not None:
+        subscriptions = [
+            "$share/{}/{}".format(share_group, topic)
+            for topic in subscriptions
+        ]
+    client = mqtt.Client(
+        client_id=broker.client_id,
+        userdata={"subscriptions": subscriptions},
+    )
+    if broker.username is not None:
+        client.username_pw_set(broker.username, broker.password)
     client.on_connect = on_connect
     client.on_message = on_message
-    client.message_callback_add("sensor_data/#", log_sensor_data)
-
-    try:
-        client.connect("localhost", 1883, 60)
-    except ConnectionRefusedError as ce:
-        raise ce
-    except Exception as e:
-        raise e
+    # messages of a shared subscription arrive on their own topic
+    for topic in broker.subscriptions:
+        client.message_callback_add(topic, sensor_data_callback)
+
+    if connect:
+        client.connect(broker.host, broker.port, broker.keepalive)
 
     return client